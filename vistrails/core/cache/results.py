@@ -0,0 +1,295 @@
+###############################################################################
+##
+## Copyright (C) 2014-2015, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+
+"""On-disk cache of module results, indexed by subpipeline signature.
+
+The in-memory persistent pipeline of the cached interpreter is lost when the
+process exits. This cache stores the (picklable) outputs of cacheable
+modules in a directory, one file per signature, so that another process
+sharing the same directory can skip recomputing them.
+"""
+
+from __future__ import division
+
+import cPickle as pickle
+import os
+import tempfile
+import time
+
+from vistrails.core import debug
+
+
+##############################################################################
+
+class ResultCacheEntry(object):
+    def __init__(self, abs_name, name, time, size):
+        self.abs_name = abs_name
+        self.name = name
+        self.time = time
+        self.size = size
+
+
+class ResultCache(object):
+    """A content-addressed store of module outputs.
+
+    Entries are pickled dictionaries mapping output port names to values,
+    stored as <directory>/<sig[:2]>/<sig>.pkl. Files are written to a
+    temporary name first and then renamed, so several processes can share
+    the same directory safely. The least recently used entries are removed
+    when the total size goes over max_size (in bytes, 0 means no limit).
+
+    """
+    SUFFIX = '.pkl'
+
+    def __init__(self, directory, max_size=0):
+        self.directory = directory
+        self.max_size = max_size
+        self.elements = {}
+        self.stats = {'hits': 0, 'misses': 0, 'writes': 0, 'evictions': 0}
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.init_cache()
+
+    def init_cache(self):
+        self.elements = {}
+        for root, dirs, files in os.walk(self.directory):
+            for f in files:
+                if f.endswith(self.SUFFIX):
+                    self._add_entry(os.path.join(root, f), f)
+
+    def _add_entry(self, abs_name, name):
+        try:
+            statinfo = os.stat(abs_name)
+        except OSError:
+            return None
+        entry = ResultCacheEntry(abs_name, name, statinfo.st_mtime,
+                                 statinfo.st_size)
+        self.elements[name] = entry
+        return entry
+
+    def _get_abs_name(self, signature):
+        return os.path.join(self.directory, signature[:2],
+                            signature + self.SUFFIX)
+
+    def size(self):
+        return sum(entry.size for entry in self.elements.itervalues())
+
+    def has_result(self, signature):
+        return os.path.exists(self._get_abs_name(signature))
+
+    def get(self, signature):
+        """get(signature: str) -> dict or None
+
+        Returns the outputs stored for signature, or None if they are not
+        in the cache.
+
+        """
+        abs_name = self._get_abs_name(signature)
+        try:
+            with open(abs_name, 'rb') as fp:
+                outputs = pickle.load(fp)
+        except IOError:
+            self.stats['misses'] += 1
+            return None
+        except Exception, e:
+            debug.warning("Discarding unreadable cache entry %s" % abs_name,
+                          e)
+            self.remove(signature)
+            self.stats['misses'] += 1
+            return None
+        # the modification time records the last use, for LRU eviction
+        now = time.time()
+        try:
+            os.utime(abs_name, (now, now))
+        except OSError:
+            pass
+        entry = self.elements.get(os.path.basename(abs_name))
+        if entry is None:
+            # written by another process
+            entry = self._add_entry(abs_name, os.path.basename(abs_name))
+        if entry is not None:
+            entry.time = now
+        self.stats['hits'] += 1
+        return outputs
+
+    def put(self, signature, outputs):
+        """put(signature: str, outputs: dict) -> bool
+
+        Stores the outputs for signature. Returns False if they could not
+        be pickled.
+
+        """
+        try:
+            data = pickle.dumps(outputs, pickle.HIGHEST_PROTOCOL)
+        except Exception, e:
+            debug.debug("Results for %s cannot be cached" % signature, e)
+            return False
+        if self.max_size and len(data) > self.max_size:
+            return False
+        abs_name = self._get_abs_name(signature)
+        dirname = os.path.dirname(abs_name)
+        tmp_name = None
+        try:
+            if not os.path.isdir(dirname):
+                try:
+                    os.makedirs(dirname)
+                except OSError:
+                    # might have been created concurrently
+                    if not os.path.isdir(dirname):
+                        raise
+            fd, tmp_name = tempfile.mkstemp(prefix='.tmp_', dir=dirname)
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(data)
+            if os.path.exists(abs_name):
+                # another process already stored this result
+                os.unlink(tmp_name)
+            else:
+                os.rename(tmp_name, abs_name)
+        except (IOError, OSError), e:
+            debug.warning("Could not write cache entry %s" % abs_name, e)
+            if tmp_name is not None and os.path.exists(tmp_name):
+                os.unlink(tmp_name)
+            return False
+        self._add_entry(abs_name, os.path.basename(abs_name))
+        self.stats['writes'] += 1
+        self.check_size()
+        return True
+
+    def check_size(self):
+        """check_size() -> None
+
+        Removes the least recently used entries until the cache is under
+        its maximum size.
+
+        """
+        if not self.max_size:
+            return
+        if self.size() <= self.max_size:
+            return
+        # pick up entries written by other processes before evicting
+        self.init_cache()
+        elements = sorted(self.elements.itervalues(),
+                          key=lambda entry: entry.time)
+        size = self.size()
+        for entry in elements:
+            if size <= self.max_size:
+                break
+            try:
+                os.unlink(entry.abs_name)
+            except OSError, e:
+                debug.warning("Could not remove file %s" % entry.abs_name, e)
+                continue
+            del self.elements[entry.name]
+            size -= entry.size
+            self.stats['evictions'] += 1
+
+    def remove(self, signature):
+        abs_name = self._get_abs_name(signature)
+        self.elements.pop(os.path.basename(abs_name), None)
+        if os.path.exists(abs_name):
+            os.unlink(abs_name)
+
+    def clear(self):
+        for entry in self.elements.values():
+            if os.path.exists(entry.abs_name):
+                os.unlink(entry.abs_name)
+        self.elements = {}
+
+
+_result_cache = None
+
+def get_result_cache():
+    """get_result_cache() -> ResultCache or None
+
+    Returns the on-disk result cache configured by 'resultCacheDir' and
+    'resultCacheSize', or None if it is disabled.
+
+    """
+    global _result_cache
+    from vistrails.core.configuration import get_vistrails_configuration
+    from vistrails.core.system import get_vistrails_directory
+    directory = get_vistrails_directory('resultCacheDir')
+    if directory is None:
+        return None
+    conf = get_vistrails_configuration()
+    max_size = (getattr(conf, 'resultCacheSize', 0) or 0) * 1024 * 1024
+    if _result_cache is None or _result_cache.directory != directory:
+        _result_cache = ResultCache(directory, max_size)
+    else:
+        _result_cache.max_size = max_size
+    return _result_cache
+
+##############################################################################
+
+import shutil
+import unittest
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='vt_results_')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_put_get(self):
+        cache = ResultCache(self.directory)
+        self.assertIsNone(cache.get('abcdef'))
+        self.assertTrue(cache.put('abcdef', {'value': [1, 2, 3]}))
+        self.assertEqual(cache.get('abcdef'), {'value': [1, 2, 3]})
+        self.assertEqual(cache.stats['hits'], 1)
+        self.assertEqual(cache.stats['misses'], 1)
+
+        # another process sees the same entries
+        other = ResultCache(self.directory)
+        self.assertTrue(other.has_result('abcdef'))
+        self.assertEqual(other.get('abcdef'), {'value': [1, 2, 3]})
+
+    def test_unpicklable(self):
+        cache = ResultCache(self.directory)
+        self.assertFalse(cache.put('abcdef', {'value': lambda: None}))
+        self.assertFalse(cache.has_result('abcdef'))
+
+    def test_eviction(self):
+        cache = ResultCache(self.directory)
+        cache.put('aa01', {'value': 'x' * 1000})
+        old_time = time.time() - 10
+        os.utime(cache._get_abs_name('aa01'), (old_time, old_time))
+        cache.put('bb02', {'value': 'y' * 1000})
+        cache.max_size = cache.size() - 1
+        cache.check_size()
+        self.assertFalse(cache.has_result('aa01'))
+        self.assertTrue(cache.has_result('bb02'))
+        self.assertEqual(cache.stats['evictions'], 1)
@@ -50,6 +50,7 @@ from parameter_exploration import ParameterExplorationEntity
 
 from vistrails.core.db.locator import FileLocator, BaseLocator
 from vistrails.core.db.io import load_vistrail
+from vistrails.core.query import extract_text
 import vistrails.core.system
 import vistrails.db.services.io
 from vistrails.core import debug
@@ -62,6 +63,24 @@ schema = ["create table entity(id integer primary key, type integer, "
           "create table workspaces(id text primary key)",
           "insert into workspaces values ('Default')"]
 
+# indexes used by searches, also added to databases created before they
+# existed
+index_schema = ["create index if not exists entity_type_idx "
+                "on entity(type)",
+                "create index if not exists entity_name_idx "
+                "on entity(name)",
+                "create index if not exists entity_user_idx "
+                "on entity(user)",
+                "create index if not exists entity_mod_time_idx "
+                "on entity(mod_time)",
+                "create index if not exists entity_children_parent_idx "
+                "on entity_children(parent)",
+                "create index if not exists entity_children_child_idx "
+                "on entity_children(child)"]
+
+fts_schema = ("create virtual table entity_fts using fts4("
+              "name, user, description, modules)")
+
 class Collection(object):
     entity_types = dict((x.type_id, x)
                         for x in [VistrailEntity, WorkflowEntity, 
@@ -93,7 +112,42 @@ class Collection(object):
                 debug.critical("Could not create vistrail index schema", e)
         else:
             self.conn = sqlite3.connect(self.database)
+        reindex = self.create_search_index()
         self.load_entities()
+        if reindex:
+            self.reindex_entities()
+
+    def create_search_index(self):
+        """create_search_index() -> bool
+
+        Creates the indexes used by search() if they are missing.
+        Returns True if the full-text table was just created and needs
+        to be filled from the existing entities.
+
+        """
+        self.has_fts = False
+        cur = self.conn.cursor()
+        try:
+            for s in index_schema:
+                cur.execute(s)
+            cur.execute("select count(*) from sqlite_master "
+                        "where name='entity_fts';")
+            if cur.fetchone()[0]:
+                self.has_fts = True
+                return False
+            try:
+                cur.execute(fts_schema)
+            except sqlite3.OperationalError, e:
+                debug.warning("Full-text search is not available, "
+                              "collection searches will not be indexed", e)
+                return False
+            self.has_fts = True
+            self.conn.commit()
+            return True
+        except sqlite3.Error, e:
+            debug.critical("Could not create vistrail index search schema",
+                           e)
+        return False
 
     #Singleton technique
     _instance = None
@@ -131,6 +185,8 @@ class Collection(object):
         cur.execute('delete from entity_children;')
         cur.execute('delete from workspaces;')
         cur.execute('delete from entity_workspace;')
+        if self.has_fts:
+            cur.execute('delete from entity_fts;')
 
     def get_current_entities(self):
         """NOTE: returns an iterator"""
@@ -230,6 +286,60 @@ class Collection(object):
         cur.execute('delete from entity_children where parent=?', (entity.id,))
         cur.executemany("insert into entity_children values (?, ?)",
                         ((entity.id, child.id) for child in entity.children))
+        self.index_entity(entity)
+
+    def reindex_entities(self):
+        """reindex_entities() -> None
+
+        Fills the full-text index from the loaded entities.  Workflow
+        entities read from the database don't have their pipeline, so
+        their module names are indexed when updateVistrail() next reads
+        their vistrail, e.g. when it is opened or saved.
+
+        """
+        for entity in self.entities.itervalues():
+            self.index_entity(entity)
+        self.conn.commit()
+
+    def index_entity(self, entity):
+        """ adds or replaces the full-text search entry for entity """
+        if not self.has_fts:
+            return
+        modules = entity.get_module_names()
+        description = entity.description
+        if description:
+            try:
+                description = extract_text(description)
+            except Exception:
+                pass
+        cur = self.conn.cursor()
+        if modules is None:
+            # pipeline is not loaded, keep the names indexed before
+            cur.execute("select modules from entity_fts where docid=?",
+                        (entity.id,))
+            row = cur.fetchone()
+            modules = row[0] if row is not None and row[0] else ''
+        else:
+            modules = ' '.join(modules)
+        cur.execute("insert or replace into entity_fts"
+                    "(docid, name, user, description, modules) "
+                    "values (?, ?, ?, ?, ?)",
+                    (entity.id, entity.name, entity.user, description,
+                     modules))
+
+    def search(self, search_stmt):
+        """search(search_stmt: SearchStmt) -> list of Entity
+
+        Returns the saved entities matching a statement compiled by
+        search.SearchCompiler, using the database indexes instead of
+        matching each entity in memory.
+
+        """
+        clause, params = search_stmt.to_sql(self.has_fts)
+        cur = self.conn.cursor()
+        cur.execute("select id from entity where %s;" % clause, params)
+        return [self.entities[row[0]] for row in cur.fetchall()
+                if row[0] in self.entities]
 
     def commit(self):
         self.save_entities()
@@ -280,6 +390,9 @@ class Collection(object):
             cur.execute("delete from entity where id=?", (entity.id,))
             cur.execute("delete from entity_children where parent=?", (entity.id,))
             cur.execute("delete from entity_children where child=?", (entity.id,))
+            if self.has_fts:
+                cur.execute("delete from entity_fts where docid=?",
+                            (entity.id,))
 
     def create_workflow_entity(self, workflow):
         entity = WorkflowEntity(workflow)
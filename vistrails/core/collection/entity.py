@@ -85,6 +85,11 @@ class Entity(object):
     def now(self):
         return datetime.now()
 
+    def get_module_names(self):
+        """Returns the names of the modules to index for this entity, or
+        None if they are not known, e.g. when loaded from the index."""
+        return []
+
     def timeval(self, time):
         try:
             return datetime.strptime(time, self.DATE_FORMAT)
@@ -35,4 +35,11 @@
 --#############################################################################
 create table entity(id integer primary key, type integer, name text, user integer, mod_time text, create_time text, size integer, description text, url text);
 create table entity_children(parent integer, child integer);
+create index entity_type_idx on entity(type);
+create index entity_name_idx on entity(name);
+create index entity_user_idx on entity(user);
+create index entity_mod_time_idx on entity(mod_time);
+create index entity_children_parent_idx on entity_children(parent);
+create index entity_children_child_idx on entity_children(child);
+create virtual table entity_fts using fts4(name, user, description, modules);
 create table type_map(id integer, type string);
\ No newline at end of file
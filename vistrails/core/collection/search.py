@@ -42,6 +42,7 @@ import re
 import time
 import unittest
 
+from vistrails.core.collection.entity import Entity
 from vistrails.core.query import extract_text
 
 ################################################################################
@@ -50,6 +51,40 @@ class SearchParseError(Exception):
     def __init__(self, *args, **kwargs):
         Exception.__init__(self, *args, **kwargs)
 
+def text_search_sql(column, text, fts=True):
+    """text_search_sql(column: str, text: str, fts: bool) -> (str, list)
+
+    Returns a where clause over the entity table that matches entities
+    whose indexed column contains words starting with each word in
+    text.  If fts is False, the full-text index is not available and
+    the clause falls back to a LIKE on the entity column.
+
+    """
+    words = re.findall(r'\w+', text, re.UNICODE)
+    if not words:
+        return ('0', [])
+    if fts:
+        query = ' '.join('%s:%s*' % (column, w) for w in words)
+        return ('entity.id in (select docid from entity_fts '
+                'where entity_fts match ?)', [query])
+    if column not in ('name', 'user', 'description'):
+        return ('0', [])
+    return (' and '.join(['entity.%s like ?' % column] * len(words)),
+            ['%%%s%%' % w for w in words])
+
+def text_match(text, value):
+    """text_match(text: str, value: str) -> bool
+
+    Returns whether value contains words starting with each word in
+    text, ignoring case, like the clauses from text_search_sql do.
+
+    """
+    words = re.findall(r'\w+', text.lower(), re.UNICODE)
+    if not words or not value:
+        return False
+    value_words = re.findall(r'\w+', value.lower(), re.UNICODE)
+    return all(any(v.startswith(w) for v in value_words) for w in words)
+
 class SearchStmt(object):
     def __init__(self, content):
         self.text = content
@@ -58,6 +93,15 @@ class SearchStmt(object):
     def match(self, entity):
         return True
 
+    def to_sql(self, fts=True):
+        """to_sql(fts: bool) -> (str, list)
+
+        Returns a where clause over the collection's entity table and
+        its parameters.
+
+        """
+        return ('1', [])
+
     def matchModule(self, v, m):
         return True
 
@@ -176,6 +220,12 @@ class TimeSearchStmt(SearchStmt):
     def __init__(self, date):
         self.date = self.parseDate(date)
 
+    def sql_date(self):
+        """Returns the date formatted the way the collection stores it,
+        so that comparisons on the text column follow time order."""
+        return datetime.datetime.fromtimestamp(self.date).strftime(
+            Entity.DATE_FORMAT)
+
     def parseDate(self, dateStr):
         def parseAgo(s):
             [amount, unit] = s.split(' ')
@@ -402,6 +452,9 @@ class BeforeSearchStmt(TimeSearchStmt):
         t = time.mktime(entity.mod_time)
         return t <= self.date
 
+    def to_sql(self, fts=True):
+        return ('entity.mod_time <= ?', [self.sql_date()])
+
 class AfterSearchStmt(TimeSearchStmt):
     def match(self, entity):
         if not entity.mod_time:
@@ -409,22 +462,40 @@ class AfterSearchStmt(TimeSearchStmt):
         t = time.mktime(entity.mod_time)
         return t >= self.date
 
+    def to_sql(self, fts=True):
+        return ('entity.mod_time >= ?', [self.sql_date()])
+
 class UserSearchStmt(SearchStmt):
     def match(self, entity):
-        if not entity.user:
-            return False
-        return self.content.match(entity.user)
+        return text_match(self.text, entity.user)
+
+    def to_sql(self, fts=True):
+        return text_search_sql('user', self.text, fts)
 
 class NotesSearchStmt(SearchStmt):
     def match(self, entity):
         if entity.description:
             plainNotes = extract_text(entity.description)
-            return self.content.search(plainNotes)
+            return text_match(self.text, plainNotes)
         return False
 
+    def to_sql(self, fts=True):
+        return text_search_sql('description', self.text, fts)
+
 class NameSearchStmt(SearchStmt):
     def match(self, entity):
-        return self.content.match(entity.name)
+        return text_match(self.text, entity.name)
+
+    def to_sql(self, fts=True):
+        return text_search_sql('name', self.text, fts)
+
+class ModuleSearchStmt(SearchStmt):
+    def match(self, entity):
+        return text_match(self.text,
+                          ' '.join(entity.get_module_names() or []))
+
+    def to_sql(self, fts=True):
+        return text_search_sql('modules', self.text, fts)
 
 class AndSearchStmt(SearchStmt):
     def __init__(self, lst):
@@ -434,6 +505,12 @@ class AndSearchStmt(SearchStmt):
             if not s.match(entity):
                 return False
         return True
+    def to_sql(self, fts=True):
+        if not self.matchList:
+            return ('1', [])
+        clauses = [s.to_sql(fts) for s in self.matchList]
+        return (' and '.join('(%s)' % c[0] for c in clauses),
+                [p for c in clauses for p in c[1]])
 
 class OrSearchStmt(SearchStmt):
     def __init__(self, lst):
@@ -443,12 +520,21 @@ class OrSearchStmt(SearchStmt):
             if s.match(entity):
                 return True
         return False
+    def to_sql(self, fts=True):
+        if not self.matchList:
+            return ('0', [])
+        clauses = [s.to_sql(fts) for s in self.matchList]
+        return (' or '.join('(%s)' % c[0] for c in clauses),
+                [p for c in clauses for p in c[1]])
 
 class NotSearchStmt(SearchStmt):
     def __init__(self, stmt):
         self.stmt = stmt
     def match(self, entity):
         return not self.stmt.match(entity)
+    def to_sql(self, fts=True):
+        clause, params = self.stmt.to_sql(fts)
+        return ('not (%s)' % clause, params)
 
 class TrueSearch(SearchStmt):
     def __init__(self):
@@ -512,6 +598,17 @@ class SearchCompiler(object):
             lst.append(NameSearchStmt(tok))
             tokStream = tokStream[1:]
         return (AndSearchStmt(lst), [])
+    def parseModule(self, tokStream):
+        if len(tokStream) == 0:
+            raise SearchParseError('Expected token, got end of search')
+        lst = []
+        while len(tokStream):
+            tok = tokStream[0]
+            if ':' in tok:
+                return (AndSearchStmt(lst), tokStream)
+            lst.append(ModuleSearchStmt(tok))
+            tokStream = tokStream[1:]
+        return (AndSearchStmt(lst), [])
     def parseBefore(self, tokStream):
         old_tokstream = tokStream
         try:
@@ -568,6 +665,7 @@ class SearchCompiler(object):
                 'before': parseBefore,
                 'after': parseAfter,
                 'name': parseName,
+                'module': parseModule,
                 'any': parseAny}
                 
             
@@ -666,6 +764,95 @@ class TestSearch(unittest.TestCase):
         # Test compiling these searches
         SearchCompiler('before')
         SearchCompiler('after')
+    def test_collection_search(self):
+        from vistrails.core.collection import Collection
+        from vistrails.core.collection.workflow import WorkflowEntity
+        collection = Collection(':memory:')
+        def add(name, user, notes, date):
+            entity = WorkflowEntity()
+            entity.name = name
+            entity.user = user
+            entity.description = notes
+            entity.mod_time = entity.create_time = \
+                datetime.datetime(*time.localtime(
+                        TimeSearchStmt(date).date)[:6])
+            entity.size = 0
+            entity.url = 'test'
+            collection.add_entity(entity)
+            return entity
+        e1 = add('Primes', 'alice', 'Sieve of Eratosthenes', '12 mar 2006')
+        e2 = add('Histogram', 'bob', 'numbers from primes', '12 mar 2008')
+        collection.save_entities()
+        def search(s):
+            stmt = SearchCompiler(s).searchStmt
+            return set(e.id for e in collection.search(stmt))
+        self.assertEquals(search('prim'), set([e1.id, e2.id]))
+        self.assertEquals(search('name:prim'), set([e1.id]))
+        self.assertEquals(search('notes:sieve'), set([e1.id]))
+        self.assertEquals(search('user:bob'), set([e2.id]))
+        self.assertEquals(search('before:1 jan 2007'), set([e1.id]))
+        self.assertEquals(search('prim after:1 jan 2007'), set([e2.id]))
+        collection.delete_entity(e1)
+        collection.save_entities()
+        self.assertEquals(search('prim'), set([e2.id]))
+
+    def test_match_words(self):
+        from vistrails.core.collection.workflow import WorkflowEntity
+        entity = WorkflowEntity()
+        entity.name = 'Histogram of primes'
+        entity.user = 'bob'
+        self.assertTrue(NameSearchStmt('prim').match(entity))
+        self.assertTrue(NameSearchStmt('PRIMES hist').match(entity))
+        self.assertFalse(NameSearchStmt('rimes').match(entity))
+        self.assertFalse(NameSearchStmt('primes sieve').match(entity))
+        self.assertTrue(UserSearchStmt('bo').match(entity))
+        self.assertFalse(UserSearchStmt('ob').match(entity))
+
+    def test_collection_modules(self):
+        import os
+        import shutil
+        import tempfile
+        from vistrails.core.collection import Collection
+        from vistrails.core.collection.workflow import WorkflowEntity
+        from vistrails.core.db.locator import FileLocator
+        from vistrails.core.system import vistrails_root_directory
+        directory = tempfile.mkdtemp()
+        try:
+            database = os.path.join(directory, 'index.db')
+            collection = Collection(database)
+            url = FileLocator(os.path.join(
+                    vistrails_root_directory(),
+                    'tests/resources/dummy_new.vt')).to_url()
+            collection.updateVistrail(url)
+            collection.commit()
+            collection.conn.close()
+            def search(s):
+                stmt = SearchCompiler(s).searchStmt
+                return sorted(e.name for e in collection.search(stmt)
+                              if isinstance(e, WorkflowEntity))
+            # saving entities loaded without their pipeline keeps the
+            # module names indexed
+            collection = Collection(database)
+            for entity in collection.entities.itervalues():
+                entity.was_updated = True
+            collection.commit()
+            self.assertEquals(search('module:filesink'), ['final'])
+            self.assertEquals(search('module:float'), ['float chain'])
+            # an index created before the full-text table existed gets
+            # the modules when the vistrail is read again
+            collection.conn.execute('drop table entity_fts;')
+            collection.conn.commit()
+            collection.conn.close()
+            collection = Collection(database)
+            self.assertEquals(search('name:final'), ['final'])
+            self.assertEquals(search('module:filesink'), [])
+            collection.updateVistrail(url)
+            collection.commit()
+            self.assertEquals(search('module:filesink'), ['final'])
+            self.assertEquals(search('module:integer'), ['int chain'])
+            collection.conn.close()
+        finally:
+            shutil.rmtree(directory)
 
 if __name__ == '__main__':
     unittest.main()
@@ -64,6 +64,11 @@ class WorkflowEntity(Entity):
             self.url = 'test'
             self.was_updated = True
 
+    def get_module_names(self):
+        if self.workflow is None:
+            return None
+        return [m.name for m in self.workflow.modules.itervalues()]
+
 #             self.name = self.workflow.name
 #             self.user = self.workflow.user
 #             self.mod_time = self.workflow.py_date
@@ -64,6 +64,8 @@ autoConnect: Automatically connect dragged in modules
 autoSave: Automatically save backup vistrails every two minutes
 batch: Run in batch mode instead of interactive mode
 cache: Cache previous results so they may be used in future computations
+cacheMaxModules: Maximum number of modules kept in the execution cache
+cacheMaxSize: Maximum estimated size of the execution cache (MB)
 dataDir: Default data directory
 db: The name for the database to load the vistrail from
 dbDefault: Save vistrails in a database by default
@@ -75,6 +77,7 @@ enablePackagesSilently: Automatically enable packages when needed
 errorLog: Write errors to a log file
 execute: Execute any specified workflows
 executionLog: Track execution provenance when running workflows
+executionThreads: Number of threads used to run independent modules
 fileDir: Default vistrail directory
 fixedSpreadsheetCells: Draw spreadsheet cells at a fixed size
 handlerDontAsk: Do not ask about extension handling at startup
@@ -88,7 +91,9 @@ jobCheckInterval: How often to check for jobs (in seconds)
 jobList: List running workflows
 jobInfo: List jobs in running workflow
 loadPackages: Whether to load the packages enabled in the configuration file
+loadPackagesOnDemand: Only load the enabled packages that the workflows use
 logDir: Log files directory
+loopThreads: Number of threads used to run loop iterations
 maxRecentVistrails: Number of recent vistrails
 maximizeWindows: VisTrails windows should be maximized
 migrateTags: Move tags to upgraded versions
@@ -96,10 +101,14 @@ multiHeads: Use multiple screens for VisTrails windows
 multithread: Server will start a thread for each request
 packageDir: System packages directory
 parameterExploration: Run parameter exploration instead of workflow
+parameterExplorationWorkers: Number of processes running a parameter exploration in batch mode
 parameters: List of parameters to use when running workflow
 port: The port for the database to load the vistrail from
+registrySnapshot: Start non-interactive sessions from a snapshot of the module registry
 repositoryHTTPURL: Remote package repository URL
 repositoryLocalPath: Local package repository directory
+resultCacheDir: Directory where module results are cached across sessions
+resultCacheSize: Maximum size of the on-disk result cache (MB)
 rootDirectory: Directory that contains the VisTrails source code
 rpcConfig: Config file for server connection options
 rpcInstances: Number of other instances that vistrails should start
@@ -121,6 +130,7 @@ spreadsheetDumpCells: Defines the location for generated cells
 spreadsheetDumpPDF: Whether the spreadsheet should dump images in PDF format
 staticRegistry: XML registry file
 stopOnError: Stop all workflow execution immediately after first error
+streamChunkSize: Number of values streamed downstream at once
 subworkflowsDir: Local subworkflows directory
 temporaryDir: Temporary files directory
 thumbs.autoSave: Save thumbnails of visual results
@@ -159,6 +169,18 @@ cache: Boolean
 
     Cache previous results so they may be used in future computations.
 
+cacheMaxModules: Integer
+
+    The maximum number of modules kept in the execution cache. The
+    least recently used modules (and the modules that depend on them)
+    are evicted once this is exceeded. 0 means no limit.
+
+cacheMaxSize: Integer
+
+    The maximum estimated size (in MB) of the output values kept in the
+    execution cache. The least recently used modules are evicted once
+    this is exceeded. 0 means no limit.
+
 dataDir: Path
 
     The location that VisTrails uses as a default directory for data.
@@ -207,6 +229,14 @@ executionLog: Boolean
 
     Track execution provenance when running workflows.
 
+executionThreads: Integer
+
+    The number of worker threads used to run the independent branches
+    of a workflow concurrently. Modules that are not cacheable (such as
+    output modules) and groups always run on the main thread. 0 means
+    modules are run one after the other. This is ignored when the GUI
+    is running.
+
 fileDir: Path
 
     The location that VisTrails uses as a default directory for
@@ -261,10 +291,26 @@ loadPackages: Boolean
 
     Whether to load the packages enabled in the configuration file
 
+loadPackagesOnDemand: Boolean
+
+    Start with the basic packages only, and load the other enabled
+    packages (with their dependencies) when a workflow that uses them is
+    validated. This makes short batch jobs start faster.
+
 logDir: Path
 
     The path that indicates where log files should be stored.
 
+loopThreads: Integer
+
+    The number of threads used to run the iterations of a module over
+    a list (implicit looping, and the Map/Fold modules of controlflow)
+    concurrently. This can be overridden for a module with its
+    'loop_threads' control parameter, which is required for modules
+    that are not cacheable (such as PythonSource). 0 means iterations
+    are run one after the other. This is ignored when the GUI is
+    running.
+
 logger: ConfigurationObject
 
     *Deprecated*
@@ -323,6 +369,15 @@ parameterExploration: Boolean
     Open and execute parameter exploration specified by the
     version argument after the .vt file.
 
+parameterExplorationWorkers: Integer
+
+    The number of worker processes that execute the cells of a
+    parameter exploration run in batch mode. Each worker keeps its own
+    cache, and cells sharing their upstream modules are sent to the
+    same worker. With 0 or 1, the GUI executes them as usual (laying
+    the cells out on the spreadsheet), or the VisTrails process itself
+    if the GUI is not available.
+
 parameters: String
 
     List of parameters to use when running workflow.
@@ -339,6 +394,12 @@ recentVistrailList: String
 
     Storage for recent vistrails. Users should not edit.
 
+registrySnapshot: Boolean
+
+    Save the module registry in the .vistrails directory and use it on
+    the next non-interactive start, so that the packages which have not
+    changed are only initialized when one of their modules is used.
+
 repositoryHTTPURL: URL
 
     URL used to locate packages available to be installed.
@@ -347,6 +408,19 @@ repositoryLocalPath: Path
 
     Path used to locate packages available to be installed.
 
+resultCacheDir: Path
+
+    Directory where the outputs of cacheable modules are stored, indexed
+    by their upstream signature, so that they can be reused by later
+    sessions or by other processes sharing the directory. The cache is
+    disabled if this is not set.
+
+resultCacheSize: Integer
+
+    The maximum size (in MB) of the on-disk result cache. The least
+    recently used results are removed once this is exceeded. 0 means no
+    limit.
+
 reviewMode: Boolean
 
     *Deprecated* Used to interactively export a pipeline.
@@ -450,6 +524,14 @@ stopOnError: Boolean
     Whether or not VisTrails stops executing the rest of the workflow
     if it encounters an error in one module.
 
+streamChunkSize: Integer
+
+    How many values a streaming output sends downstream at once. The
+    values then travel between streamed modules in lists of that size,
+    which is also as much as is buffered on a streamed connection. This
+    can be overridden for a module with its 'stream_chunk' control
+    parameter. 0 or 1 means values are streamed one at a time.
+
 subworkflowsDir: Path
 
     The location where a user's local subworkflows are stored.
@@ -629,6 +711,8 @@ base_config = {
      ConfigField("parameters", None, str, ConfigType.COMMAND_LINE),
      ConfigField("parameterExploration", False, bool,
                  ConfigType.COMMAND_LINE_FLAG),
+     ConfigField("parameterExplorationWorkers", 0, int,
+                 ConfigType.COMMAND_LINE),
      ConfigField('showWindow', True, bool, ConfigType.COMMAND_LINE_FLAG),
      ConfigField("withVersionTree", False, bool, ConfigType.COMMAND_LINE_FLAG),
      ConfigField("withWorkflow", False, bool, ConfigType.COMMAND_LINE_FLAG),
@@ -653,6 +737,9 @@ base_config = {
      ConfigField('cache', True, bool, ConfigType.ON_OFF),
      ConfigField('stopOnError', True, bool, ConfigType.ON_OFF),
      ConfigField('executionLog', True, bool, ConfigType.ON_OFF),
+     ConfigField('executionThreads', 0, int),
+     ConfigField('loopThreads', 0, int),
+     ConfigField('streamChunkSize', 0, int),
      ConfigField('errorLog', True, bool, ConfigType.ON_OFF),
      ConfigField('defaultFileType', system.vistrails_default_file_type(), str,
                  widget_type="combo",
@@ -715,6 +802,7 @@ base_config = {
     "Packages":
     [ConfigField('enablePackagesSilently', False, bool, ConfigType.ON_OFF),
      ConfigField('loadPackages', True, bool, ConfigType.ON_OFF),
+     ConfigField('loadPackagesOnDemand', False, bool, ConfigType.ON_OFF),
      ConfigField('installBundles', True, bool, ConfigType.ON_OFF),
      ConfigField('installBundlesWithPip', False, bool, ConfigType.ON_OFF,
                  depends_on="installBundles"),
@@ -733,7 +821,12 @@ base_config = {
      ConfigField('temporaryDir', None,  ConfigPath)],
     "Advanced":
     [ConfigField('singleInstance', True, bool, ConfigType.ON_OFF),
-     ConfigField('staticRegistry', None, ConfigPath)],
+     ConfigField('staticRegistry', None, ConfigPath),
+     ConfigField('registrySnapshot', False, bool, ConfigType.ON_OFF),
+     ConfigField('cacheMaxModules', 0, int),
+     ConfigField('cacheMaxSize', 0, int),
+     ConfigField('resultCacheDir', None, ConfigPath),
+     ConfigField('resultCacheSize', 1024, int)],
     "Web Sharing":
     [ConfigField('webRepositoryURL', "http://www.crowdlabs.org", ConfigURL),
      ConfigField('webRepositoryUser', None, str)],
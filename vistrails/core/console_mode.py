@@ -304,19 +304,66 @@ def run_parameter_exploration(locator, pe_id, extra_info = {},
             return (locator, pe_id,
                     debug.format_exception(e), debug.format_exc())
 
+def run_parameter_exploration_batch(locator, pe_id, output_dir=None,
+                                    workers=None, extra_info=None,
+                                    reason="Console Mode Parameter Exploration Execution"):
+    """run_parameter_exploration_batch(locator: Locator, pe_id: str/int,
+                                       output_dir: str, workers: int,
+                                       extra_info: dict, reason: str)
+                                       -> list of errors
+    Run parameter exploration pe_id without the GUI, using workers
+    processes (see vistrails.core.paramexplore.batch). Progress and
+    per-cell timings are recorded in output_dir, and cells already
+    recorded there are not executed again.
+    Returns a list of (locator, pe_id, cell name, error msg) tuples.
+
+    """
+    from vistrails.core.paramexplore.batch import run_exploration
+    try:
+        records = run_exploration(locator, pe_id, output_dir, workers,
+                                  extra_info, reason)
+    except Exception, e:
+        return [(locator, pe_id,
+                 debug.format_exception(e), debug.format_exc())]
+    errors = []
+    for record in records:
+        for module_id, error in sorted(record['errors'].iteritems()):
+            errors.append((locator, pe_id, record['name'],
+                           "module %s: %s" % (module_id, error)))
+    return errors
+
 def run_parameter_explorations(w_list, extra_info = {},
-                       reason="Console Mode Parameter Exploration Execution"):
+                       reason="Console Mode Parameter Exploration Execution",
+                       output_dir=None):
     """run(w_list: list of (locator, pe_id), reason: str) -> boolean
     For each workflow in w_list, run parameter exploration pe_id
     version can be a tag name or a version id.
+    They are only run in batch (see run_parameter_exploration_batch())
+    if parameterExplorationWorkers asks for several processes, or if the
+    GUI is not available. Otherwise the GUI executes them, even in batch
+    mode, laying the cells out on the spreadsheet and assembling their
+    thumbnails.
     Returns list of errors (empty list if there are no errors)
     """
+    conf = get_vistrails_configuration()
+    workers = getattr(conf, 'parameterExplorationWorkers', 0) or 0
     all_errors = []
     for locator, pe_id in w_list:
-        result = run_parameter_exploration(locator, pe_id, reason=reason,
-                                           extra_info=extra_info)
-        if result:
-            all_errors.append(result)
+        if workers > 1:
+            all_errors.extend(run_parameter_exploration_batch(
+                    locator, pe_id, output_dir, workers,
+                    extra_info=extra_info, reason=reason))
+        elif is_running_gui():
+            result = run_parameter_exploration(locator, pe_id, reason=reason,
+                                               extra_info=extra_info)
+            if result:
+                all_errors.append(result)
+        else:
+            # no spreadsheet to lay the cells out on; run them in this
+            # process
+            all_errors.extend(run_parameter_exploration_batch(
+                    locator, pe_id, output_dir, 0,
+                    extra_info=extra_info, reason=reason))
     return all_errors
 
 def cleanup():
@@ -0,0 +1,314 @@
+###############################################################################
+##
+## Copyright (C) 2014-2015, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+"""Shared cache of loaded vistrails and their materialized pipelines.
+
+This is used by long-running processes such as the XML-RPC server, which
+otherwise reload the same vistrail from the database for every request.
+Entries are validated against the modification time of the object in the
+database, so an outdated vistrail is never returned.
+
+"""
+from __future__ import division
+
+from collections import OrderedDict
+import threading
+import unittest
+
+
+class _CacheEntry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.mod_time = None
+        self.bundle = None
+        self.pipelines = OrderedDict()
+
+
+class VistrailCache(object):
+    """VistrailCache keeps the most recently used vistrails in memory.
+
+    Keys identify a vistrail, e.g. (host, port, db_name, vt_id). The cached
+    value is whatever the load function passed to get_bundle() returns (the
+    tuple returned by io.load_vistrail(), whose first element is the
+    vistrail). Pipelines materialized from a cached vistrail are kept with
+    it, up to max_pipelines per vistrail.
+
+    Cached objects are shared between threads: callers must not modify
+    them.
+
+    """
+    def __init__(self, max_vistrails=16, max_pipelines=32):
+        self.max_vistrails = max_vistrails
+        self.max_pipelines = max_pipelines
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._stats = dict.fromkeys(['hits', 'misses', 'invalidations',
+                                     'evictions', 'pipeline_hits',
+                                     'pipeline_misses'], 0)
+
+    def _get_entry(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                entry = _CacheEntry()
+            self._entries[key] = entry
+            self._evict(max(self.max_vistrails, 1))
+            return entry
+
+    def _evict(self, size):
+        # must be called with self._lock held
+        while len(self._entries) > size:
+            self._entries.popitem(last=False)
+            self._stats['evictions'] += 1
+
+    def _count(self, stat):
+        with self._lock:
+            self._stats[stat] += 1
+
+    def _load_entry(self, entry, mod_time, load):
+        # must be called with entry.lock held
+        if entry.bundle is not None:
+            if entry.mod_time == mod_time:
+                self._count('hits')
+                return
+            self._count('invalidations')
+        self._count('misses')
+        entry.bundle = None
+        entry.pipelines.clear()
+        entry.bundle = load()
+        entry.mod_time = mod_time
+
+    def get_bundle(self, key, mod_time, load):
+        """get_bundle(key: hashable, mod_time: datetime,
+                      load: callable) -> object
+        Returns the cached bundle for key, calling load() if it isn't
+        cached or if it was cached with a different modification time.
+
+        """
+        entry = self._get_entry(key)
+        with entry.lock:
+            self._load_entry(entry, mod_time, load)
+            return entry.bundle
+
+    def get_pipeline(self, key, mod_time, version, load):
+        """get_pipeline(key: hashable, mod_time: datetime, version: int,
+                        load: callable) -> Pipeline
+        Returns the pipeline for version of the vistrail cached for key,
+        materializing it once.
+
+        """
+        entry = self._get_entry(key)
+        with entry.lock:
+            self._load_entry(entry, mod_time, load)
+            pipelines = entry.pipelines
+            if version in pipelines:
+                self._count('pipeline_hits')
+                pipelines[version] = pipelines.pop(version)
+            else:
+                self._count('pipeline_misses')
+                pipelines[version] = entry.bundle[0].getPipeline(version)
+                while len(pipelines) > max(self.max_pipelines, 1):
+                    pipelines.popitem(last=False)
+            return pipelines[version]
+
+    def invalidate(self, key):
+        """invalidate(key: hashable) -> None
+        Drops the vistrail cached for key, if any.
+
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def shrink(self, size=None):
+        """shrink(size: int) -> None
+        Evicts the least recently used vistrails until at most size remain
+        (half of the current ones by default).
+
+        """
+        with self._lock:
+            if size is None:
+                size = len(self._entries) // 2
+            self._evict(size)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """stats() -> dict
+        Returns the hit and miss counters and the current size of the
+        cache.
+
+        """
+        with self._lock:
+            result = dict(self._stats)
+            result['vistrails'] = len(self._entries)
+            result['pipelines'] = sum(len(e.pipelines)
+                                      for e in self._entries.itervalues())
+            return result
+
+################################################################################
+
+class TestVistrailCache(unittest.TestCase):
+    class FakeVistrail(object):
+        def __init__(self):
+            self.materialized = []
+
+        def getPipeline(self, version):
+            self.materialized.append(version)
+            return ('pipeline', version)
+
+    def loader(self, loads):
+        def load():
+            loads.append(1)
+            return (self.FakeVistrail(), [], {}, [])
+        return load
+
+    def test_validation(self):
+        cache = VistrailCache()
+        loads = []
+        b1 = cache.get_bundle(('h', 1, 'db', 1), 1, self.loader(loads))
+        b2 = cache.get_bundle(('h', 1, 'db', 1), 1, self.loader(loads))
+        self.assertIs(b1, b2)
+        self.assertEqual(len(loads), 1)
+        b3 = cache.get_bundle(('h', 1, 'db', 1), 2, self.loader(loads))
+        self.assertIsNot(b1, b3)
+        self.assertEqual(len(loads), 2)
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'],
+                          stats['invalidations']),
+                         (1, 2, 1))
+
+    def test_pipelines(self):
+        cache = VistrailCache(max_pipelines=2)
+        loads = []
+        key = ('h', 1, 'db', 1)
+        load = self.loader(loads)
+        self.assertEqual(cache.get_pipeline(key, 1, 3, load), ('pipeline', 3))
+        cache.get_pipeline(key, 1, 3, load)
+        cache.get_pipeline(key, 1, 4, load)
+        cache.get_pipeline(key, 1, 5, load)
+        cache.get_pipeline(key, 1, 4, load)
+        vistrail = cache.get_bundle(key, 1, load)[0]
+        self.assertEqual(vistrail.materialized, [3, 4, 5])
+        self.assertEqual(len(loads), 1)
+        stats = cache.stats()
+        self.assertEqual(stats['pipelines'], 2)
+        self.assertEqual((stats['pipeline_hits'], stats['pipeline_misses']),
+                         (2, 3))
+        # new version of the vistrail drops its pipelines
+        cache.get_pipeline(key, 2, 4, load)
+        self.assertEqual(len(loads), 2)
+        self.assertEqual(cache.stats()['pipelines'], 1)
+
+    def test_eviction(self):
+        cache = VistrailCache(max_vistrails=2)
+        loads = []
+        for vt_id in [1, 2, 1, 3, 1, 2]:
+            cache.get_bundle(('h', 1, 'db', vt_id), 1, self.loader(loads))
+        self.assertEqual(len(loads), 4)
+        stats = cache.stats()
+        self.assertEqual(stats['vistrails'], 2)
+        self.assertEqual(stats['evictions'], 2)
+        cache.shrink()
+        self.assertEqual(cache.stats()['vistrails'], 1)
+        cache.clear()
+        self.assertEqual(cache.stats()['vistrails'], 0)
+
+    def test_db_eviction(self):
+        """An evicted vistrail loaded from a database is freed.
+        """
+        import gc
+        import os
+        import shutil
+        import tempfile
+        import weakref
+        from vistrails.core.db import io
+        from vistrails.core.db.locator import DBLocator
+        from vistrails.core.system import vistrails_root_directory
+        from vistrails.db.domain import DBVistrail
+        from vistrails.db.services import io as db_io
+
+        testdir = tempfile.mkdtemp(prefix='vt_')
+        try:
+            database = os.path.join(testdir, 'vistrails.db')
+            (save_bundle, vt_save_dir) = db_io.open_bundle_from_zip_xml(
+                    DBVistrail.vtType,
+                    os.path.join(vistrails_root_directory(),
+                                 'tests/resources/dummy_new.vt'))
+            shutil.rmtree(vt_save_dir)
+            db_connection = db_io.open_db_connection({'dialect': 'sqlite',
+                                                      'db': database})
+            try:
+                db_io.setup_db_tables(db_connection)
+                vt_id = db_io.save_bundle_to_db(save_bundle, db_connection,
+                                                do_copy=True).vistrail.db_id
+            finally:
+                db_io.close_db_connection(db_connection)
+            del save_bundle
+
+            cache = VistrailCache(max_vistrails=1)
+            locator = DBLocator('', 0, database, '', '', obj_id=vt_id,
+                                dialect='sqlite')
+            locator.use_cache = False
+            mod_time = locator.get_db_modification_time()
+            vistrail = weakref.ref(cache.get_bundle(
+                    1, mod_time, lambda: io.load_vistrail(locator))[0])
+            self.assertIsNotNone(vistrail())
+            cache.get_bundle(2, mod_time, self.loader([]))
+            gc.collect()
+            self.assertIsNone(vistrail())
+            # no copy was kept by the locator either
+            self.assertNotIn(locator._hash, DBLocator.cache)
+        finally:
+            shutil.rmtree(testdir)
+
+    def test_threads(self):
+        cache = VistrailCache()
+        loads = []
+        load = self.loader(loads)
+        results = []
+        def worker():
+            for i in xrange(20):
+                results.append(cache.get_pipeline(('h', 1, 'db', 1), 1,
+                                                  i % 4, load))
+        threads = [threading.Thread(target=worker) for i in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(loads), 1)
+        self.assertEqual(len(results), 80)
+        self.assertEqual(cache.stats()['pipeline_misses'], 4)
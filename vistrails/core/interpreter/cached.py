@@ -37,23 +37,29 @@
 from __future__ import division
 
 import base64
+from collections import OrderedDict
 import copy
 import gc
 import cPickle as pickle
+import sys
 
+from vistrails.core.cache.results import get_result_cache
 from vistrails.core.common import InstanceObject, VistrailsInternalError
+from vistrails.core.configuration import get_vistrails_configuration
 from vistrails.core.data_structures.bijectivedict import Bidict
 from vistrails.core import debug
 import vistrails.core.interpreter.base
 from vistrails.core.interpreter.base import AbortExecution
+from vistrails.core.interpreter.scheduler import ParallelScheduler, \
+    SynchronizedLogging
 import vistrails.core.interpreter.utils
 from vistrails.core.log.controller import DummyLogController
 from vistrails.core.modules.basic_modules import identifier as basic_pkg, \
                                                  Generator
 from vistrails.core.modules.module_registry import get_module_registry
-from vistrails.core.modules.vistrails_module import ModuleBreakpoint, \
-    ModuleConnector, ModuleError, ModuleErrors, ModuleHadError, \
-    ModuleSuspended, ModuleWasSuspended
+from vistrails.core.modules.vistrails_module import Module, \
+    ModuleBreakpoint, ModuleConnector, ModuleError, ModuleErrors, \
+    ModuleHadError, ModuleSuspended, ModuleWasSuspended
 from vistrails.core.utils import DummyView
 import vistrails.core.system
 import vistrails.core.vistrail.pipeline
@@ -195,6 +201,55 @@ class ViewUpdatingLogController(object):
 
 ###############################################################################
 
+# Containers longer than this are sized from a sample of their items
+_SIZE_SAMPLE = 100
+
+def estimate_value_size(value, _seen=None):
+    """estimate_value_size(value: object) -> int
+
+    Returns a rough estimate of the memory used by a value, in bytes.
+    Objects exposing 'nbytes' (numpy arrays) report it directly, and large
+    containers are extrapolated from a sample of their items.
+
+    """
+    if _seen is None:
+        _seen = set()
+    if id(value) in _seen or isinstance(value, Module):
+        return 0
+    _seen.add(id(value))
+    nbytes = getattr(value, 'nbytes', None)
+    if isinstance(nbytes, (int, long)):
+        return nbytes
+    try:
+        size = sys.getsizeof(value)
+    except TypeError:
+        size = 0
+    if isinstance(value, dict):
+        items = [i for pair in value.iteritems() for i in pair]
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        items = list(value)
+    else:
+        return size
+    if len(items) > _SIZE_SAMPLE:
+        sample = items[:_SIZE_SAMPLE]
+        sample_size = sum(estimate_value_size(i, _seen) for i in sample)
+        return size + sample_size * len(items) // _SIZE_SAMPLE
+    return size + sum(estimate_value_size(i, _seen) for i in items)
+
+def estimate_output_size(obj):
+    """estimate_output_size(obj: Module) -> int
+
+    Returns an estimate of the memory held by the output ports of a module
+    instance, in bytes.
+
+    """
+    seen = set()
+    return sum(estimate_value_size(value, seen)
+               for port, value in obj.outputPorts.iteritems()
+               if port != 'self')
+
+###############################################################################
+
 Variant_desc = None
 InputPort_desc = None
 
@@ -203,6 +258,12 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
     def __init__(self):
         vistrails.core.interpreter.base.BaseInterpreter.__init__(self)
         self.debugger = None
+        # Cache budget; None means use the 'cacheMaxModules' and
+        # 'cacheMaxSize' configuration settings, 0 means unbounded
+        self.max_cached_modules = None
+        self.max_cached_bytes = None
+        # None means use the 'executionThreads' configuration setting
+        self.execution_threads = None
         self.create()
 
     def create(self):
@@ -211,6 +272,11 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
         self._file_pool = FilePool()
         self._persistent_pipeline = vistrails.core.vistrail.pipeline.Pipeline()
         self._objects = {}
+        # persistent module ids, least recently used first
+        self._last_used = OrderedDict()
+        self._object_sizes = {}
+        self._cached_bytes = 0
+        self._cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
         self.filePool = self._file_pool
         self._streams = []
 
@@ -220,6 +286,9 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
         for obj in self._objects.itervalues():
             obj.clear()
         self._objects = {}
+        self._last_used = OrderedDict()
+        self._object_sizes = {}
+        self._cached_bytes = 0
 
     def __del__(self):
         self.clear()
@@ -228,9 +297,9 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
         """clean_modules(modules_to_clean: list of persistent module ids)
 
         Removes modules from the persistent pipeline, and the modules that
-        depend on them."""
+        depend on them. Returns the list of removed module ids."""
         if not modules_to_clean:
-            return
+            return []
         g = self._persistent_pipeline.graph
         modules_to_clean = (set(modules_to_clean) &
                             set(self._persistent_pipeline.modules.iterkeys()))
@@ -238,6 +307,118 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
         for v in dependencies:
             self._persistent_pipeline.delete_module(v)
             del self._objects[v]
+            self._last_used.pop(v, None)
+            self._cached_bytes -= self._object_sizes.pop(v, 0)
+        return dependencies
+
+    def touch_module(self, persistent_id):
+        """touch_module(persistent_id: int) -> None
+
+        Marks a persistent module as the most recently used one.
+
+        """
+        self._last_used.pop(persistent_id, None)
+        self._last_used[persistent_id] = None
+
+    def get_cache_limits(self):
+        """get_cache_limits() -> (int, int)
+
+        Returns the maximum number of persistent modules and the maximum
+        estimated size of their outputs (in bytes); 0 means unbounded.
+
+        """
+        max_modules = self.max_cached_modules
+        max_bytes = self.max_cached_bytes
+        conf = get_vistrails_configuration()
+        if max_modules is None:
+            max_modules = getattr(conf, 'cacheMaxModules', 0) or 0
+        if max_bytes is None:
+            max_bytes = (getattr(conf, 'cacheMaxSize', 0) or 0) * 1024 * 1024
+        return max_modules, max_bytes
+
+    def update_cache_sizes(self, persistent_ids):
+        """update_cache_sizes(persistent_ids: list of int) -> None
+
+        Estimates the output size of the given persistent modules that
+        computed and were not measured yet.
+
+        """
+        for i in persistent_ids:
+            obj = self._objects.get(i)
+            if obj is None or i in self._object_sizes or not obj.upToDate:
+                continue
+            size = estimate_output_size(obj)
+            self._object_sizes[i] = size
+            self._cached_bytes += size
+
+    def evict_modules(self, protected=()):
+        """evict_modules(protected: set of persistent ids) -> int
+
+        Removes least recently used modules (along with the modules that
+        depend on them) from the persistent pipeline until it fits the cache
+        budget. Modules in protected are never removed. Returns the number
+        of modules evicted.
+
+        """
+        max_modules, max_bytes = self.get_cache_limits()
+        if not max_modules and not max_bytes:
+            return 0
+        def over_budget():
+            return ((max_modules and len(self._objects) > max_modules) or
+                    (max_bytes and self._cached_bytes > max_bytes))
+        protected = set(protected)
+        g = self._persistent_pipeline.graph
+        evicted = 0
+        for persistent_id in list(self._last_used):
+            if not over_budget():
+                break
+            if (persistent_id in protected or
+                    persistent_id not in self._objects):
+                continue
+            if protected.intersection(
+                    g.vertices_topological_sort([persistent_id])):
+                continue
+            evicted += len(self.clean_modules([persistent_id]))
+        self._cache_stats['evictions'] += evicted
+        return evicted
+
+    def get_execution_threads(self):
+        """get_execution_threads() -> int
+
+        Returns the number of worker threads used to update independent
+        branches of a pipeline, 0 meaning serial execution. Execution is
+        always serial when the GUI is running.
+
+        """
+        from vistrails.core.application import get_vistrails_application
+        app = get_vistrails_application()
+        if app is not None and app.is_running_gui():
+            return 0
+        num_threads = self.execution_threads
+        if num_threads is None:
+            conf = get_vistrails_configuration()
+            num_threads = getattr(conf, 'executionThreads', 0) or 0
+        return max(num_threads, 0)
+
+    def get_result_cache(self):
+        """get_result_cache() -> ResultCache or None
+
+        Returns the on-disk cache new modules should use, if enabled.
+
+        """
+        return get_result_cache()
+
+    def cache_statistics(self):
+        """cache_statistics() -> dict
+
+        Returns the number of cache hits, misses and evictions, along with
+        the current number of persistent modules and their estimated size.
+
+        """
+        stats = dict(self._cache_stats)
+        stats['modules'] = len(self._objects)
+        stats['bytes'] = self._cached_bytes
+        return stats
 
     def clean_non_cacheable_modules(self):
         """clean_non_cacheable_modules() -> None
@@ -304,6 +485,7 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
         parent_exec = fetch('parent_exec', None)
 
         reg = get_module_registry()
+        result_cache = self.get_result_cache()
 
         if len(kwargs) > 0:
             raise VistrailsInternalError('Wrong parameters passed '
@@ -362,6 +544,7 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
             obj.interpreter = self
             obj.id = persistent_id
             obj.signature = module._signature
+            obj.result_cache = result_cache
             
             # Checking if output should be stored
             if module.has_annotation_with_key('annotate_output'):
@@ -480,10 +663,18 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
         def make_change_parameter(obj):
             return lambda *args: change_parameter(obj, *args)
 
+        # Independent branches are updated on worker threads if enabled;
+        # module logging calls then need to be serialized
+        num_threads = self.get_execution_threads()
+        if num_threads:
+            module_logging = SynchronizedLogging(logging_obj)
+        else:
+            module_logging = logging_obj
+
         # Update **all** modules in the current pipeline
         for i, obj in tmp_id_to_module_map.iteritems():
             obj.in_pipeline = True # set flag to indicate in pipeline
-            obj.logging = logging_obj
+            obj.logging = module_logging
             obj.change_parameter = make_change_parameter(obj)
             
             # Update object pipeline information
@@ -503,47 +694,58 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
         # Note that we accept any module in 'sinks', even if it's not actually
         # a sink in the graph
         if sinks is not None:
-            persistent_sinks = [tmp_id_to_module_map[sink]
-                                for sink in sinks
-                                if sink in tmp_id_to_module_map]
+            sink_ids = [sink for sink in sinks
+                        if sink in tmp_id_to_module_map]
         else:
-            persistent_sinks = [tmp_id_to_module_map[sink]
-                                for sink in pipeline.graph.sinks()]
+            sink_ids = pipeline.graph.sinks()
+        persistent_sinks = [tmp_id_to_module_map[sink] for sink in sink_ids]
 
         self._streams.append(Generator.generators)
         Generator.generators = []
 
         # Update new sinks
-        for obj in persistent_sinks:
+        def update_sink(obj, error=None):
+            """Updates a module, or handles the exception its update raised
+            on another thread. Returns whether execution should stop."""
             abort = False
             try:
+                if error is not None:
+                    raise error
                 obj.update()
-                continue
+                return False
             except ModuleWasSuspended:
-                continue
+                return False
             except ModuleHadError:
                 pass
             except AbortExecution:
-                break
+                return True
             except ModuleSuspended, ms:
                 ms.module.logging.end_update(ms.module, ms,
                                              was_suspended=True)
-                continue
+                return False
             except ModuleErrors, mes:
                 for me in mes.module_errors:
                     me.module.logging.end_update(me.module, me)
-                    logging_obj.signalError(me.module, me)
+                    module_logging.signalError(me.module, me)
                     abort = abort or me.abort
             except ModuleError, me:
                 me.module.logging.end_update(me.module, me, me.errorTrace)
-                logging_obj.signalError(me.module, me)
+                module_logging.signalError(me.module, me)
                 abort = me.abort
             except ModuleBreakpoint, mb:
                 mb.module.logging.end_update(mb.module)
-                logging_obj.signalError(mb.module, mb)
+                module_logging.signalError(mb.module, mb)
                 abort = True
-            if stop_on_error or abort:
-                break
+            return stop_on_error or abort
+
+        if num_threads:
+            scheduler = ParallelScheduler(num_threads)
+            scheduler.run(pipeline.graph, tmp_id_to_module_map, sink_ids,
+                          lambda obj: obj.update(), update_sink)
+        else:
+            for obj in persistent_sinks:
+                if update_sink(obj):
+                    break
 
         # execute all generators until inputs are exhausted
         # this makes sure branching and multiple sinks are executed correctly
@@ -740,6 +942,13 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
                 view.set_module_error(i, error)
         self.finalize_pipeline(pipeline, *(res[:-1]), **new_kwargs)
 
+        # Keep the persistent pipeline within the cache budget, without
+        # touching the modules the caller is about to look at
+        persistent_ids = set(obj.id for obj in res[1].itervalues())
+        if self.get_cache_limits()[1]:
+            self.update_cache_sizes(persistent_ids)
+        self.evict_modules(persistent_ids)
+
         result = InstanceObject(objects=res[1],
                               errors=res[2],
                               executed=res[3],
@@ -798,10 +1007,13 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
                     base64.b16encode(new_sig).lower()
                 module_id_map[new_module_id] = persistent_id
                 modules_added.add(new_module_id)
+                self._cache_stats['misses'] += 1
             else:
                 i = self._persistent_pipeline \
                         .subpipeline_id_from_signature(new_sig)
                 module_id_map[new_module_id] = i
+                self._cache_stats['hits'] += 1
+            self.touch_module(module_id_map[new_module_id])
         for connection in pipeline.connections.itervalues():
             new_sig = pipeline.connection_signature(connection.id)
             if not self._persistent_pipeline.has_connection_signature(new_sig):
@@ -820,8 +1032,12 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
                 i = self._persistent_pipeline \
                         .connection_id_from_signature(new_sig)
                 connection_id_map[connection.id] = i
-        # update persistent signatures
-        self._persistent_pipeline.compute_signatures()
+        # update persistent signatures (existing ones are still valid)
+        for i in modules_added:
+            self._persistent_pipeline.subpipeline_signature(module_id_map[i])
+        for i in connections_added:
+            self._persistent_pipeline.connection_signature(
+                connection_id_map[i])
         return (module_id_map, connection_id_map,
                 modules_added, connections_added)
         
@@ -931,6 +1147,142 @@ class TestCachedInterpreter(unittest.TestCase):
         finally:
             StandardOutput.compute = old_compute
 
+    def test_eviction(self):
+        """Test that the persistent pipeline stays within its budget."""
+        from vistrails.core.modules.basic_modules import StandardOutput
+        old_compute = StandardOutput.compute
+        StandardOutput.compute = lambda s: None
+
+        try:
+            from vistrails.core.db.locator import XMLFileLocator
+            from vistrails.core.vistrail.controller import VistrailController
+            from vistrails.core.db.io import load_vistrail
+
+            locator = XMLFileLocator(vistrails.core.system.vistrails_root_directory() +
+                                '/tests/resources/dummy.xml')
+            (v, abstractions, thumbnails, mashups) = load_vistrail(locator)
+            controller = VistrailController(v, locator, abstractions,
+                                            thumbnails,  mashups)
+            def get_pipeline(tag):
+                n = v.get_version_number(tag)
+                controller.change_selected_version(n)
+                controller.flush_delayed_actions()
+                return controller.current_pipeline, n
+
+            interpreter = CachedInterpreter()
+            interpreter.max_cached_modules = 4
+            interpreter.max_cached_bytes = 0
+            view = DummyView()
+            for tag in ['int chain', 'float chain', 'float chain']:
+                p, n = get_pipeline(tag)
+                result = interpreter.execute(p, locator=v,
+                                             current_version=n, view=view)
+                self.assertFalse(result.errors)
+                self.assertLessEqual(len(interpreter._objects), 4)
+            stats = interpreter.cache_statistics()
+            # 'int chain' was evicted to make room for 'float chain', which
+            # was then reused except for the non-cacheable StandardOutput
+            self.assertEqual(len(result.modules_added), 1)
+            self.assertEqual(stats['modules'], 4)
+            self.assertEqual(stats['misses'], 8)
+            self.assertEqual(stats['hits'], 3)
+            self.assertEqual(stats['evictions'], 2)
+            interpreter.clear()
+        finally:
+            StandardOutput.compute = old_compute
+
+    def test_result_cache(self):
+        """Test that results are reused through the on-disk cache."""
+        import shutil
+        import tempfile
+        from vistrails.core.db.locator import XMLFileLocator
+        from vistrails.core.vistrail.controller import VistrailController
+        from vistrails.core.db.io import load_vistrail
+
+        locator = XMLFileLocator(vistrails.core.system.vistrails_root_directory() +
+                            '/tests/resources/dummy.xml')
+        (v, abstractions, thumbnails, mashups) = load_vistrail(locator)
+        controller = VistrailController(v, locator, abstractions,
+                                        thumbnails,  mashups)
+        n = v.get_version_number('float chain')
+        controller.change_selected_version(n)
+        controller.flush_delayed_actions()
+        p = controller.current_pipeline
+
+        conf = get_vistrails_configuration()
+        directory = tempfile.mkdtemp(prefix='vt_results_')
+        conf.resultCacheDir = directory
+        try:
+            from vistrails.tests.utils import capture_stdout
+            # each interpreter stands for a fresh process
+            with capture_stdout():
+                interpreter = CachedInterpreter()
+                result = interpreter.execute(p, locator=v,
+                                             current_version=n,
+                                             view=DummyView())
+                self.assertFalse(result.errors)
+                interpreter.clear()
+                interpreter = CachedInterpreter()
+                result = interpreter.execute(p, locator=v,
+                                             current_version=n,
+                                             view=DummyView())
+                self.assertFalse(result.errors)
+                interpreter.clear()
+            # the last Float came from the disk cache, so its upstream
+            # didn't run either; the StandardOutput is not cacheable
+            executed = [i for i, e in result.executed.iteritems() if e]
+            self.assertEqual(len(executed), 1)
+            self.assertEqual(get_result_cache().stats['hits'], 1)
+        finally:
+            conf.resultCacheDir = None
+            shutil.rmtree(directory)
+
+    def test_parallel(self):
+        """Test that threaded execution gives the same results."""
+        from vistrails.core.modules.basic_modules import StandardOutput
+        old_compute = StandardOutput.compute
+        StandardOutput.compute = lambda s: None
+
+        try:
+            from vistrails.core.db.locator import XMLFileLocator
+            from vistrails.core.vistrail.controller import VistrailController
+            from vistrails.core.db.io import load_vistrail
+
+            locator = XMLFileLocator(vistrails.core.system.vistrails_root_directory() +
+                                '/tests/resources/dummy.xml')
+            (v, abstractions, thumbnails, mashups) = load_vistrail(locator)
+            controller = VistrailController(v, locator, abstractions,
+                                            thumbnails,  mashups)
+            n = v.get_version_number('float chain')
+            controller.change_selected_version(n)
+            controller.flush_delayed_actions()
+            p = controller.current_pipeline
+
+            outputs = []
+            for num_threads in [0, 4]:
+                interpreter = CachedInterpreter()
+                interpreter.execution_threads = num_threads
+                result = interpreter.execute(p, locator=v,
+                                             current_version=n,
+                                             view=DummyView())
+                self.assertFalse(result.errors)
+                self.assertTrue(all(result.executed.itervalues()))
+                outputs.append(dict(
+                        (i, obj.outputPorts.get('value'))
+                        for i, obj in result.objects.iteritems()))
+                interpreter.clear()
+            self.assertEqual(outputs[0], outputs[1])
+        finally:
+            StandardOutput.compute = old_compute
+
+    def test_estimate_size(self):
+        self.assertGreaterEqual(estimate_value_size(range(1000)),
+                                1000 * sys.getsizeof(0))
+        big = 'x' * 10000
+        self.assertGreaterEqual(estimate_value_size({'a': big}), 10000)
+        # shared objects are only counted once
+        self.assertLess(estimate_value_size([big, big]), 20000)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,344 @@
+###############################################################################
+##
+## Copyright (C) 2014-2015, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+
+"""Parallel update of the independent branches of a pipeline.
+
+The serial interpreter updates each sink in turn, and Module.update() walks
+upstream recursively, so independent branches never overlap. The
+ParallelScheduler updates modules as soon as everything upstream of them is
+done, using a pool of worker threads; modules that are not cacheable (which
+includes output and spreadsheet modules) and groups always run on the
+calling thread.
+
+Modules that override Module.update_upstream() (control flow, persistence)
+decide themselves which of their upstream modules get updated, and when. They
+are run on the calling thread as a single unit: the scheduler never updates
+anything upstream of them, and leaves it to their own update().
+"""
+
+from __future__ import division
+
+import Queue
+import threading
+
+
+##############################################################################
+
+_logging_lock = threading.RLock()
+
+class SynchronizedLogging(object):
+    """Wraps a logging controller so that calls from worker threads are
+    serialized.
+
+    Objects returned by the wrapped methods (loop or recursive log
+    controllers) are wrapped as well; they all share the same lock.
+
+    """
+    _plain_types = (type(None), bool, int, long, float, basestring)
+
+    def __init__(self, obj):
+        self._obj = obj
+
+    def __getattr__(self, name):
+        attr = getattr(self._obj, name)
+        if not callable(attr):
+            if isinstance(attr, self._plain_types):
+                return attr
+            return SynchronizedLogging(attr)
+        def locked(*args, **kwargs):
+            with _logging_lock:
+                result = attr(*args, **kwargs)
+            if isinstance(result, self._plain_types):
+                return result
+            return SynchronizedLogging(result)
+        return locked
+
+
+class ParallelScheduler(object):
+    """Updates the modules of a pipeline on a pool of threads.
+
+    update(obj) is called for each module (on a worker thread, or on the
+    calling thread for pinned modules), and done(obj, error) is then called
+    on the calling thread with the exception update() raised, or None.
+    done() returns True to stop scheduling new modules. Modules downstream
+    of a module that raised are not updated.
+
+    """
+    def __init__(self, num_threads):
+        self.num_threads = num_threads
+
+    @staticmethod
+    def is_pinned(obj):
+        """Whether a module needs to run on the calling thread.
+        """
+        return not obj.is_cacheable() or getattr(obj, 'is_group', False)
+
+    @staticmethod
+    def pulls_upstream(obj):
+        """Whether a module updates its upstream modules itself.
+        """
+        from vistrails.core.modules.vistrails_module import Module
+        method = getattr(type(obj), 'update_upstream', None)
+        if method is None:
+            return False
+        return (getattr(method, 'im_func', method) is not
+                Module.update_upstream.im_func)
+
+    def run(self, graph, objects, sinks, update, done):
+        """run(graph: Graph, objects: dict, sinks: list, update: callable,
+               done: callable) -> None
+
+        graph is the pipeline graph, objects maps its vertices to module
+        instances and sinks is the list of vertices to update (along with
+        everything upstream of them).
+
+        """
+        visited = self._upstream(graph, sinks)
+
+        # Everything upstream of a module that pulls its own upstream belongs
+        # to it; these are only ever updated from the calling thread
+        owners = [v for v in visited if self.pulls_upstream(objects[v])]
+        owned = set(objects[u]
+                    for u in self._upstream(graph, owners, include=False))
+
+        # Several vertices can map to the same persistent module
+        deps = {}       # module -> set of upstream modules
+        dependents = {} # module -> set of downstream modules
+        pinned = set()
+        for v in visited:
+            obj = objects[v]
+            if obj in owned:
+                continue
+            deps.setdefault(obj, set())
+            dependents.setdefault(obj, set())
+            if self.is_pinned(obj) or self.pulls_upstream(obj):
+                pinned.add(obj)
+            if self.pulls_upstream(obj):
+                continue
+            for (u, _) in graph.edges_to(v):
+                upstream = objects[u]
+                if upstream in owned:
+                    # update() will pull it, on the calling thread
+                    pinned.add(obj)
+                    continue
+                deps[obj].add(upstream)
+                dependents.setdefault(upstream, set()).add(obj)
+
+        waiting = dict((obj, len(d)) for obj, d in deps.iteritems())
+        ready = [obj for obj, n in waiting.iteritems() if n == 0]
+        tasks = Queue.Queue()
+        results = Queue.Queue()
+        running = [0]
+
+        def worker():
+            while True:
+                obj = tasks.get()
+                if obj is None:
+                    break
+                results.put((obj, self._call(update, obj)))
+
+        threads = []
+        for i in xrange(min(self.num_threads, len(deps))):
+            t = threading.Thread(target=worker,
+                                 name='VisTrails-worker-%d' % i)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+
+        stopped = False
+        try:
+            while ready or running[0]:
+                main_thread = []
+                if not stopped:
+                    for obj in ready:
+                        if obj in pinned:
+                            main_thread.append(obj)
+                        else:
+                            running[0] += 1
+                            tasks.put(obj)
+                ready = []
+                finished = [(obj, self._call(update, obj))
+                            for obj in main_thread]
+                if not finished and running[0]:
+                    finished.append(results.get())
+                    running[0] -= 1
+                while running[0]:
+                    try:
+                        finished.append(results.get_nowait())
+                    except Queue.Empty:
+                        break
+                    running[0] -= 1
+                for obj, error in finished:
+                    if done(obj, error):
+                        stopped = True
+                    if error is not None:
+                        continue
+                    for d in dependents[obj]:
+                        waiting[d] -= 1
+                        if waiting[d] == 0:
+                            ready.append(d)
+        finally:
+            for t in threads:
+                tasks.put(None)
+            for t in threads:
+                t.join()
+
+    @staticmethod
+    def _upstream(graph, vertices, include=True):
+        """Returns the vertices upstream of the given ones.
+        """
+        result = set()
+        if include:
+            to_visit = list(vertices)
+        else:
+            to_visit = [u for v in vertices for (u, _) in graph.edges_to(v)]
+        while to_visit:
+            v = to_visit.pop()
+            if v in result:
+                continue
+            result.add(v)
+            to_visit.extend(u for (u, _) in graph.edges_to(v))
+        return result
+
+    @staticmethod
+    def _call(update, obj):
+        try:
+            update(obj)
+        except Exception, e:
+            return e
+        return None
+
+##############################################################################
+
+import unittest
+
+class TestParallelScheduler(unittest.TestCase):
+    class FakeModule(object):
+        def __init__(self, name, pinned=False):
+            self.name = name
+            self.pinned = pinned
+
+        def is_cacheable(self):
+            return not self.pinned
+
+    class FakeControlModule(FakeModule):
+        def update_upstream(self):
+            pass
+
+    def make_graph(self, edges, vertices):
+        from vistrails.core.data_structures.graph import Graph
+        g = Graph()
+        for v in vertices:
+            g.add_vertex(v)
+        for i, (a, b) in enumerate(edges):
+            g.add_edge(a, b, i)
+        return g
+
+    def test_order(self):
+        # two independent branches 0 -> 1 -> 4 and 2 -> 3 -> 4
+        g = self.make_graph([(0, 1), (1, 4), (2, 3), (3, 4)], range(5))
+        objects = dict((i, self.FakeModule(i, pinned=(i == 4)))
+                       for i in xrange(5))
+        order = []
+        threads = {}
+        lock = threading.Lock()
+        def update(obj):
+            with lock:
+                order.append(obj.name)
+                threads[obj.name] = threading.current_thread()
+        finished = []
+        def done(obj, error):
+            self.assertIsNone(error)
+            finished.append(obj.name)
+            return False
+        ParallelScheduler(2).run(g, objects, [4], update, done)
+        self.assertItemsEqual(finished, range(5))
+        self.assertLess(order.index(0), order.index(1))
+        self.assertLess(order.index(2), order.index(3))
+        self.assertEqual(order[-1], 4)
+        self.assertIs(threads[4], threading.current_thread())
+
+    def test_error(self):
+        g = self.make_graph([(0, 1), (1, 2), (3, 2)], range(4))
+        objects = dict((i, self.FakeModule(i)) for i in xrange(4))
+        updated = []
+        def update(obj):
+            updated.append(obj.name)
+            if obj.name == 0:
+                raise ValueError("failed")
+        errors = {}
+        def done(obj, error):
+            errors[obj.name] = error
+            return False
+        ParallelScheduler(3).run(g, objects, [2], update, done)
+        self.assertIsInstance(errors[0], ValueError)
+        # downstream of the failed module is never updated
+        self.assertNotIn(1, updated)
+        self.assertNotIn(2, updated)
+        self.assertIn(3, updated)
+
+    def test_shared_objects(self):
+        # two vertices that map to the same persistent module
+        g = self.make_graph([(0, 2), (1, 2)], range(3))
+        shared = self.FakeModule('shared')
+        objects = {0: shared, 1: shared, 2: self.FakeModule(2)}
+        updated = []
+        ParallelScheduler(2).run(g, objects, [2], updated.append,
+                                 lambda obj, error: False)
+        self.assertEqual(len(updated), 2)
+
+    def test_pulls_upstream(self):
+        # 0 -> 1 -> 3 (control module) -> 4, and 2 -> 4, 1 -> 5 -> 4
+        g = self.make_graph([(0, 1), (1, 3), (3, 4), (2, 4), (1, 5), (5, 4)],
+                            range(6))
+        objects = dict((i, self.FakeModule(i)) for i in xrange(6))
+        objects[3] = self.FakeControlModule(3)
+        updated = []
+        threads = {}
+        def update(obj):
+            updated.append(obj.name)
+            threads[obj.name] = threading.current_thread()
+        ParallelScheduler(2).run(g, objects, [4], update,
+                                 lambda obj, error: False)
+        # the upstream of the control module is left to it
+        self.assertNotIn(0, updated)
+        self.assertNotIn(1, updated)
+        self.assertItemsEqual(updated, [2, 3, 4, 5])
+        self.assertIs(threads[3], threading.current_thread())
+        # 5 reads from 1, which belongs to the control module
+        self.assertIs(threads[5], threading.current_thread())
+        self.assertLess(updated.index(3), updated.index(4))
+        self.assertLess(updated.index(5), updated.index(4))
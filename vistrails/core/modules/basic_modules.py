@@ -50,13 +50,16 @@ from vistrails.core.utils import InstanceObject
 from vistrails.core import debug
 
 from abc import ABCMeta
+import ast
 from ast import literal_eval
+from collections import OrderedDict
 from itertools import izip
 import mimetypes
 import os
 import pickle
 import re
 import shutil
+import threading
 import zipfile
 import urllib
 
@@ -1004,7 +1007,113 @@ class Unpickle(Module):
 
 ##############################################################################
 
+class CompiledCodeCache(object):
+    """CompiledCodeCache keeps the code compiled by CodeRunnerMixin, so
+    that the same source is not parsed and compiled again each time a
+    module runs (e.g. in every iteration of a loop).
+
+    Keys include a hash of the source; the least recently used entries
+    are dropped once there are more than max_size.
+
+    """
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key, build):
+        """get(key: hashable, build: callable) -> object
+        Returns the object cached for key, calling build() to create it
+        if it isn't cached.
+
+        """
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is not None:
+                self._entries[key] = value
+                return value
+        # Compile outside of the lock; errors are not cached
+        value = build()
+        with self._lock:
+            self._entries[key] = value
+            while len(self._entries) > max(self.max_size, 1):
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+code_cache = CompiledCodeCache()
+
+
+def compile_code(code_str):
+    """compile_code(code_str: str) -> code
+    Compiles a piece of code run by CodeRunnerMixin.run_code().
+
+    """
+    # Python 2.6 needs code to end with newline
+    return code_cache.get(('code', sha_hash(code_str).digest()),
+                          lambda: compile(code_str + '\n', '<string>',
+                                          'exec'))
+
+
+def compile_function(code_str, arguments, outputs):
+    """compile_function(code_str: str, arguments: [str], outputs: [str])
+                          -> function
+    Compiles a piece of code into a function, see
+    CodeRunnerMixin.run_function().
+
+    The function takes a dictionary, where it stores the values of the
+    variables named in outputs, followed by the given arguments.
+
+    """
+    key = ('function', sha_hash(code_str).digest(), tuple(arguments),
+           tuple(outputs))
+    return code_cache.get(key, lambda: _build_function(code_str, arguments,
+                                                       outputs))
+
+
+def _build_function(code_str, arguments, outputs):
+    tree = ast.parse(code_str + '\n', '<string>')
+    # __future__ imports have to stay at the top of the module
+    future = []
+    body = list(tree.body)
+    while (body and isinstance(body[0], ast.ImportFrom) and
+           body[0].module == '__future__'):
+        future.append(body.pop(0))
+
+    results = '_vt_results'
+    init = [ast.Assign(targets=[ast.Name(id=name, ctx=ast.Store())],
+                       value=ast.Name(id='None', ctx=ast.Load()))
+            for name in outputs
+            if name not in arguments]
+    store = [ast.Assign(targets=[ast.Subscript(
+                                     value=ast.Name(id=results,
+                                                    ctx=ast.Load()),
+                                     slice=ast.Index(value=ast.Str(s=name)),
+                                     ctx=ast.Store())],
+                        value=ast.Name(id=name, ctx=ast.Load()))
+             for name in outputs]
+    function = ast.FunctionDef(
+            name='_vt_function',
+            args=ast.arguments(args=[ast.Name(id=name, ctx=ast.Param())
+                                     for name in [results] + arguments],
+                               vararg=None, kwarg=None, defaults=[]),
+            body=init + [ast.TryFinally(body=body or [ast.Pass()],
+                                        finalbody=store or [ast.Pass()])],
+            decorator_list=[])
+    tree = ast.Module(body=future + [function])
+    ast.fix_missing_locations(tree)
+    namespace = {}
+    exec compile(tree, '<string>', 'exec') in namespace
+    return namespace['_vt_function']
+
+
 class CodeRunnerMixin(object):
+    # Input ports that are not variables of the code
+    code_excluded_inputs = frozenset(['source', 'functionMode'])
+
     def __init__(self):
         self.output_ports_order = []
         super(CodeRunnerMixin, self).__init__()
@@ -1015,6 +1124,19 @@ class CodeRunnerMixin(object):
         # output_ports are reversed for display purposes...
         self.output_ports_order.reverse()
 
+    def _code_builtins(self):
+        import vistrails.core.packagemanager
+        def fail(msg):
+            raise ModuleError(self, msg)
+        def cache_this():
+            self.is_cacheable = lambda *args, **kwargs: True
+        return {'fail': fail,
+                'package_manager':
+                    vistrails.core.packagemanager.get_package_manager(),
+                'cache_this': cache_this,
+                'registry': get_module_registry(),
+                'self': self}
+
     def run_code(self, code_str,
                  use_input=False,
                  use_output=False):
@@ -1022,34 +1144,43 @@ class CodeRunnerMixin(object):
         use_input and use_output control whether to use the inputport
         and output port dictionary as local variables inside the
         execution."""
-        import vistrails.core.packagemanager
-        def fail(msg):
-            raise ModuleError(self, msg)
-        def cache_this():
-            self.is_cacheable = lambda *args, **kwargs: True
-        locals_ = locals()
+        locals_ = {'vistrails': vistrails}
         if use_input:
             for k in self.inputPorts:
-                locals_[k] = self.get_input(k)
+                if k not in self.code_excluded_inputs:
+                    locals_[k] = self.get_input(k)
         if use_output:
             for output_portname in self.output_ports_order:
                 locals_[output_portname] = None
-        _m = vistrails.core.packagemanager.get_package_manager()
-        reg = get_module_registry()
-        locals_.update({'fail': fail,
-                        'package_manager': _m,
-                        'cache_this': cache_this,
-                        'registry': reg,
-                        'self': self})
-        if 'source' in locals_:
-            del locals_['source']
-        # Python 2.6 needs code to end with newline
-        exec code_str + '\n' in locals_, locals_
+        locals_.update(self._code_builtins())
+        exec compile_code(code_str) in locals_, locals_
         if use_output:
             for k in self.output_ports_order:
                 if locals_.get(k) is not None:
                     self.set_output(k, locals_[k])
 
+    def run_function(self, code_str,
+                     use_input=False,
+                     use_output=False):
+        """run_function runs a piece of code like run_code, but as the
+        body of a function that is only compiled once for the whole
+        process, taking the input ports as arguments. Its variables are
+        local to each run, and the globals only hold the builtins.
+        """
+        kwargs = {}
+        if use_input:
+            for k in self.inputPorts:
+                if k not in self.code_excluded_inputs:
+                    kwargs[k] = self.get_input(k)
+        kwargs.update(self._code_builtins())
+        outputs = self.output_ports_order if use_output else []
+        function = compile_function(code_str, sorted(kwargs), outputs)
+        results = {}
+        function(results, **kwargs)
+        for k in outputs:
+            if results.get(k) is not None:
+                self.set_output(k, results[k])
+
 ##############################################################################
 
 class PythonSource(CodeRunnerMixin, NotCacheable, Module):
@@ -1064,16 +1195,25 @@ class PythonSource(CodeRunnerMixin, NotCacheable, Module):
 
     If you want a PythonSource execution to be cached, call
     cache_this().
+
+    With functionMode set, the code runs as the body of a function
+    compiled once, which is faster when the module runs many times
+    (looping, streaming); it can't define global variables then.
     """
     _settings = ModuleSettings(
         configure_widget=("vistrails.gui.modules.python_source_configure:"
                              "PythonSourceConfigurationWidget"))
-    _input_ports = [IPort('source', 'String', optional=True, default="")]
+    _input_ports = [IPort('source', 'String', optional=True, default=""),
+                    IPort('functionMode', 'Boolean', optional=True,
+                          default=False)]
     _output_pors = [OPort('self', 'Module')]
 
     def compute(self):
         s = urllib.unquote(str(self.get_input('source')))
-        self.run_code(s, use_input=True, use_output=True)
+        if self.get_input('functionMode'):
+            self.run_function(s, use_input=True, use_output=True)
+        else:
+            self.run_code(s, use_input=True, use_output=True)
 
 ##############################################################################
 
@@ -1193,12 +1333,14 @@ class Generator(object):
 
     generators = []
     def __init__(self, size=None, module=None, generator=None, port=None,
-                 accumulated=False):
+                 accumulated=False, batched=False):
         self.module = module
         self.generator = generator
         self.port = port
         self.size = size
         self.accumulated = accumulated
+        # if batched, each step yields a chunk (list or array) of values
+        self.batched = batched
         if generator and module not in Generator.generators:
             # add to global list of generators
             # they will be topologically ordered
@@ -1212,6 +1354,16 @@ class Generator(object):
             value = value.all()
         return value
     
+    def next_chunk(self):
+        """ return the values of the next step as a chunk, or None when the
+            stream is exhausted
+
+        """
+        value = self.next()
+        if value is None or self.batched:
+            return value
+        return [value]
+
     def all(self):
         """ exhausts next() for Streams
         
@@ -1219,7 +1371,10 @@ class Generator(object):
         items = []
         item = self.next()
         while item is not None:
-            items.append(item)
+            if self.batched:
+                items.extend(item)
+            else:
+                items.append(item)
             item = self.next()
         return items
 
@@ -1652,6 +1807,50 @@ class TestPythonSource(unittest.TestCase):
                 ]))
         self.assertEqual(results[-1], "nb is 42")
 
+    def test_function_mode(self):
+        """A PythonSource run as a function, compiled only once"""
+        import urllib2
+        from vistrails.tests.utils import execute, intercept_result
+        source = ('from __future__ import absolute_import\n'
+                  'customout = "nb is %d" % customin')
+        for value in [42, 12]:
+            with intercept_result(PythonSource, 'customout') as results:
+                self.assertFalse(execute([
+                        ('PythonSource', 'org.vistrails.vistrails.basic', [
+                            ('source', [('String', urllib2.quote(source))]),
+                            ('functionMode', [('Boolean', 'True')]),
+                            ('customin', [('Integer', str(value))])
+                        ]),
+                        ('String', 'org.vistrails.vistrails.basic', []),
+                    ],
+                    [
+                        (0, 'customout', 1, 'value'),
+                    ],
+                    add_port_specs=[
+                        (0, 'input', 'customin',
+                         'org.vistrails.vistrails.basic:Integer'),
+                        (0, 'output', 'customout',
+                         'org.vistrails.vistrails.basic:String'),
+                    ]))
+            self.assertEqual(results[-1], "nb is %d" % value)
+        digest = sha_hash(source).digest()
+        self.assertEqual(len([key for key in code_cache._entries
+                              if key[:2] == ('function', digest)]),
+                         1)
+
+    def test_code_cache(self):
+        """The compiled code cache drops the least recently used entries"""
+        cache = CompiledCodeCache(max_size=2)
+        built = []
+        def get(key):
+            def build():
+                built.append(key)
+                return key
+            return cache.get(key, build)
+        for key in ['a', 'b', 'a', 'c', 'a', 'b']:
+            self.assertEqual(get(key), key)
+        self.assertEqual(built, ['a', 'b', 'c', 'b'])
+
 
 class TestNumericConversions(unittest.TestCase):
     def test_full(self):
@@ -62,7 +62,10 @@ class ModuleDescriptor(DBModuleDescriptor):
     modules in the registry. There exists exactly one ModuleDescriptor
     for every registered VisTrails module in the system.
 
-    self.module: reference to the python class that defines the module
+    self.module: reference to the python class that defines the module.
+      Descriptors restored from a registry snapshot are created without
+      it, and the package is initialized when it is first accessed
+      (see loaded_module to get it without initializing anything)
     self.name: name of the module
     self.identifier: identifier of the package that module belongs to
     self.input_ports: dictionary of names of input ports to the types
@@ -132,6 +135,7 @@ class ModuleDescriptor(DBModuleDescriptor):
 
     def set_defaults(self, other=None):
         if other is None:
+            self._lazy = False
             self._abstraction_refs = 1
             self._is_abstract = False
             self._configuration_widget = None
@@ -156,7 +160,8 @@ class ModuleDescriptor(DBModuleDescriptor):
             self.children = copy.copy(other.children)
             
             self._base_descriptor = other._base_descriptor
-            self.module = other.module
+            self._module = other._module
+            self._lazy = other._lazy
             self._port_count = other._port_count
             self._abstraction_refs = self._abstraction_refs
             self._is_abstract = other._is_abstract
@@ -217,6 +222,19 @@ class ModuleDescriptor(DBModuleDescriptor):
     base_descriptor_id = DBModuleDescriptor.db_base_descriptor_id
     port_specs_list = DBModuleDescriptor.db_portSpecs
     
+    def _get_module(self):
+        if self._module is None and self._lazy:
+            from vistrails.core.packagemanager import get_package_manager
+            get_package_manager().initialize_lazy_package(self.identifier)
+        return self._module
+    def _set_module(self, module):
+        self._module = module
+    module = property(_get_module, _set_module)
+
+    def _get_loaded_module(self):
+        return self._module
+    loaded_module = property(_get_loaded_module)
+
     def _get_base_descriptor(self):
         if self._base_descriptor is None and self.base_descriptor_id >= 0:
             from vistrails.core.modules.module_registry import get_module_registry
@@ -530,6 +530,9 @@ class ModuleRegistry(DBRegistry):
 
     def set_defaults(self, other=None):
         self._root_descriptor = None
+        # package whose modules are being attached to the descriptors
+        # restored from a snapshot, see initialize_package()
+        self._binding_package = None
         self.signals = ModuleRegistrySignals()
         self.setup_indices()
         if other is None:
@@ -567,8 +570,8 @@ class ModuleRegistry(DBRegistry):
                 self.descriptors_by_id[descriptor.id] = descriptor
                 k = (descriptor.identifier, descriptor.name, 
                      descriptor.namespace, pkg.version, descriptor.version)
-                if descriptor.module is not None:
-                    self._module_key_map[descriptor.module] = k
+                if descriptor.loaded_module is not None:
+                    self._module_key_map[descriptor.loaded_module] = k
         for descriptor in self.descriptors_by_id.itervalues():
             if descriptor.base_descriptor_id in self.descriptors_by_id:
                 base_descriptor = \
@@ -897,6 +900,38 @@ class ModuleRegistry(DBRegistry):
         else:
             return vistrails.core.cache.hasher.Hasher.module_signature(module, chm)
 
+    def module_signature_key(self, module):
+        """Returns a hashable summary of everything module_signature()
+        looks at for a given core.vistrail.Module, so that callers can
+        tell whether a previously computed signature is still valid.
+
+        Returns None if the signature relies on a user-defined hasher
+        (for the module or for one of its parameters), since those can
+        change without the module changing (e.g. file modification
+        times).
+        """
+        chm = self._constant_hasher_map
+        descriptor = self.get_descriptor_by_name(module.package,
+                                                 module.name,
+                                                 module.namespace)
+        if descriptor and descriptor.hasher_callable():
+            return None
+        functions = []
+        for function in module.functions:
+            params = []
+            for p in function.params:
+                if chm and (p.identifier, p.type, p.namespace) in chm:
+                    return None
+                params.append((p.type, p.identifier, p.namespace,
+                               p.strValue, p.name, p.evaluatedStrValue))
+            functions.append((function.name, function.returnType,
+                              tuple(params)))
+        d = module.module_descriptor
+        return (d.name, d.package, d.namespace, d.package_version, d.version,
+                tuple(functions),
+                tuple((cp.name, cp.value)
+                      for cp in module.control_parameters))
+
     def get_module_color(self, identifier, name, namespace=None):
         return self.get_descriptor_by_name(identifier, name, namespace).module_color()
 
@@ -1172,37 +1207,24 @@ class ModuleRegistry(DBRegistry):
                                          "not specified.")
 
         package = self.package_versions[(identifier, package_version)]
-        desc_key = (name, namespace, version)
-        if desc_key in package.descriptor_versions:
-            raise ModuleAlreadyExists(identifier, name)
-
-        # We allow multiple inheritance as long as only one of the superclasses
-        # is a subclass of Module.
-        if settings.is_root:
-            base_descriptor = None
+        snapshot_key = (name, namespace or '', version or '')
+        binding = (package is self._binding_package and
+                   snapshot_key in package.descriptor_versions)
+        if binding:
+            # The descriptor was restored from a registry snapshot, it
+            # only needs its module
+            descriptor = package.descriptor_versions[snapshot_key]
+            descriptor.module = module
+            self._module_key_map[module] = (identifier, name, namespace,
+                                            package_version, version)
+            if issubclass(module,
+                    vistrails.core.modules.vistrails_module.Converter):
+                self._conversions = dict()
+                self._converters.add(descriptor)
         else:
-            candidates = self.get_subclass_candidates(module)
-            if len(candidates) != 1:
-                raise InvalidModuleClass(module)
-            base_class = candidates[0]
-            if base_class not in self._module_key_map:
-                raise MissingBaseClass(base_class)
-            base_descriptor = self.get_descriptor(base_class)
-
-        if module in self._module_key_map:
-            # This is really obsolete as having two descriptors
-            # pointing to the same module isn't a big deal except to
-            # get_descriptor which shouldn't be used often
-            if identifier != 'local.abstractions':
-                raise DuplicateModule(self.get_descriptor(module), identifier,
-                                      name, namespace)
-        elif self.has_descriptor_with_name(identifier, name, namespace,
-                                           package_version, version):
-            raise DuplicateIdentifier(identifier, name, namespace,
-                                      package_version, version)
-        descriptor = self.update_registry(base_descriptor, module, identifier, 
-                                          name, namespace, package_version,
-                                          version)
+            descriptor = self._add_module_descriptor(
+                    module, settings, package, identifier, name, namespace,
+                    package_version, version)
         if settings.is_root:
             self.root_descriptor = descriptor
 
@@ -1264,9 +1286,45 @@ class ModuleRegistry(DBRegistry):
         if settings.ghost_namespace:
             descriptor.ghost_namespace = settings.ghost_namespace
                  
-        self.signals.emit_new_module(descriptor)
-        if self.is_abstraction(descriptor):
-            self.signals.emit_new_abstraction(descriptor)
+        if not binding:
+            self.signals.emit_new_module(descriptor)
+            if self.is_abstraction(descriptor):
+                self.signals.emit_new_abstraction(descriptor)
+        return descriptor
+
+    def _add_module_descriptor(self, module, settings, package, identifier,
+                               name, namespace, package_version, version):
+        desc_key = (name, namespace, version)
+        if desc_key in package.descriptor_versions:
+            raise ModuleAlreadyExists(identifier, name)
+
+        # We allow multiple inheritance as long as only one of the superclasses
+        # is a subclass of Module.
+        if settings.is_root:
+            base_descriptor = None
+        else:
+            candidates = self.get_subclass_candidates(module)
+            if len(candidates) != 1:
+                raise InvalidModuleClass(module)
+            base_class = candidates[0]
+            if base_class not in self._module_key_map:
+                raise MissingBaseClass(base_class)
+            base_descriptor = self.get_descriptor(base_class)
+
+        if module in self._module_key_map:
+            # This is really obsolete as having two descriptors
+            # pointing to the same module isn't a big deal except to
+            # get_descriptor which shouldn't be used often
+            if identifier != 'local.abstractions':
+                raise DuplicateModule(self.get_descriptor(module), identifier,
+                                      name, namespace)
+        elif self.has_descriptor_with_name(identifier, name, namespace,
+                                           package_version, version):
+            raise DuplicateIdentifier(identifier, name, namespace,
+                                      package_version, version)
+        descriptor = self.update_registry(base_descriptor, module, identifier, 
+                                          name, namespace, package_version,
+                                          version)
         return descriptor
 
     def auto_add_subworkflow(self, subworkflow):
@@ -1489,6 +1547,10 @@ class ModuleRegistry(DBRegistry):
         return spec
 
     def add_port_spec(self, descriptor, spec):
+        if (self._binding_package is not None and
+                descriptor.has_port_spec(spec.name, spec.type)):
+            # The port was restored from a registry snapshot
+            return
         # check if the spec is valid
         try:
             spec.descriptors()
@@ -1625,6 +1687,11 @@ class ModuleRegistry(DBRegistry):
         if (package.identifier, package.version) not in self.package_versions:
             self.add_package(package)
         self.set_current_package(package)
+        binding = package.is_lazy()
+        if binding:
+            # The descriptors were restored from a registry snapshot, we
+            # only attach the modules to them
+            self._binding_package = package
         try:
             package.initialize()
             # Perform auto-initialization
@@ -1655,7 +1722,11 @@ class ModuleRegistry(DBRegistry):
 
             # allow all modules to auto_add_ports!
             added_descriptors = set()
+            if binding:
+                added_descriptors.update(package.descriptor_list)
             for descriptor in package.descriptor_list:
+                if descriptor in added_descriptors:
+                    continue
                 if hasattr(descriptor, 'module'):
                     self.auto_add_ports(descriptor.module)
                     added_descriptors.add(descriptor)
@@ -1676,12 +1747,84 @@ class ModuleRegistry(DBRegistry):
         except Exception, e:
             raise package.InitializationFailed(package, 
                                                [traceback.format_exc()])
+        finally:
+            self._binding_package = None
+
+        if binding:
+            for descriptor in package.descriptor_list:
+                descriptor._lazy = False
+            package.set_lazy(None)
 
         # The package might have decided to rename itself, let's store that
         self.set_current_package(None)
         debug.splashMessage("Initializing " + package.codepath + '... done.')
         package._initialized = True 
 
+    def reserve_snapshot_ids(self, snapshot, identifiers):
+        """reserve_snapshot_ids(snapshot: ModuleRegistry,
+                                identifiers: [str]) -> bool
+        Makes sure the ids used by a registry snapshot are not given
+        to the descriptors and ports created from now on, so that the
+        descriptors of these packages can be moved from the snapshot with
+        add_snapshot_package(). Returns False if some of them are already
+        in use.
+
+        """
+        for package in snapshot.package_list:
+            if package.identifier not in identifiers:
+                continue
+            for descriptor in package.descriptor_list:
+                if descriptor.id in self.descriptors_by_id:
+                    return False
+        for package in snapshot.package_list:
+            for descriptor in package.descriptor_list:
+                self.idScope.updateBeginId(ModuleDescriptor.vtType,
+                                           descriptor.id + 1)
+                for spec in descriptor.port_specs_list:
+                    self.idScope.updateBeginId(PortSpec.vtType, spec.id + 1)
+                    for item in spec.port_spec_items:
+                        self.idScope.updateBeginId(PortSpecItem.vtType,
+                                                   item.id + 1)
+        return True
+
+    def add_snapshot_package(self, package, snapshot, converters=[]):
+        """add_snapshot_package(package: Package, snapshot: ModuleRegistry,
+                                converters: [(str, str)]) -> None
+        Adds the descriptors the snapshot registry has for a loaded
+        package without initializing it. Their modules are only imported
+        when first accessed, see PackageManager.initialize_lazy_package().
+        converters lists the (name, namespace) of the Converter
+        subclasses.
+
+        """
+        snapshot_package = snapshot.get_package_by_name(package.identifier,
+                                                        package.version)
+        if (package.identifier, package.version) not in self.package_versions:
+            self.add_package(package)
+        for descriptor in sorted(snapshot_package.descriptor_list,
+                                 key=lambda d: d.id):
+            base_id = descriptor.base_descriptor_id
+            if (base_id >= 0 and
+                    self.descriptors_by_id.get(base_id) is not
+                    snapshot.descriptors_by_id[base_id]):
+                # The base was initialized again, from its own package
+                base = snapshot.descriptors_by_id[base_id]
+                base = self.get_descriptor_by_name(base.identifier,
+                                                   base.name,
+                                                   base.namespace)
+                descriptor.base_descriptor_id = base.id
+            # Subclasses from other packages are not adopted with it
+            descriptor.children = []
+            descriptor._base_descriptor = None
+            descriptor._lazy = True
+            self.add_descriptor(descriptor, package)
+            if base_id >= 0:
+                base = self.descriptors_by_id[descriptor.base_descriptor_id]
+                base.children.append(descriptor)
+        for name, namespace in converters:
+            self._converters.add(package.descriptors[(name, namespace)])
+        self._conversions = dict()
+
     def delete_module(self, identifier, module_name, namespace=None):
         """deleteModule(module_name): Removes a module from the registry."""
         descriptor = self.get_descriptor_by_name(identifier, module_name, 
@@ -1700,8 +1843,8 @@ class ModuleRegistry(DBRegistry):
             self.signals.emit_deleted_abstraction(descriptor)
         package = self.packages[descriptor.identifier]
         self.delete_descriptor(descriptor, package)
-        if descriptor.module is not None:
-            del self._module_key_map[descriptor.module]
+        if descriptor.loaded_module is not None:
+            del self._module_key_map[descriptor.loaded_module]
 
     def remove_package(self, package):
         """remove_package(package) -> None:
@@ -1952,7 +2095,7 @@ class ModuleRegistry(DBRegistry):
         """get_module_hierarchy(descriptor) -> [klass].
         Returns the module hierarchy all the way to Module, excluding
         any mixins."""
-        if descriptor.module is None:
+        if descriptor.loaded_module is None:
             descriptors = [descriptor]
             base_id = descriptor.base_descriptor_id
             while base_id >= 0:
@@ -2084,8 +2227,8 @@ class ModuleRegistry(DBRegistry):
         
         """
         # use issubclass for speed if we've loaded the modules
-        if sub.module is not None and super.module is not None:
-            return issubclass(sub.module, super.module)
+        if sub.loaded_module is not None and super.loaded_module is not None:
+            return issubclass(sub.loaded_module, super.loaded_module)
         
         # otherwise, use descriptors themselves
         if sub == super:
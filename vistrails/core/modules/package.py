@@ -137,6 +137,7 @@ class Package(DBPackage):
             self._init_module = None
             self._loaded = False
             self._initialized = False
+            self._lazy_hooks = None
             self._abs_pkg_upgrades = {}
             self.package_dir = None
             self.prefix = None
@@ -149,6 +150,7 @@ class Package(DBPackage):
             self._init_module = other._init_module
             self._loaded = other._loaded
             self._initialized = other._initialized
+            self._lazy_hooks = other._lazy_hooks
             self._abs_pkg_upgrades = copy.copy(other._abs_pkg_upgrades)
             self.package_dir = other.package_dir
             self.prefix = other.prefix
@@ -487,18 +489,59 @@ class Package(DBPackage):
         else:
             self.description = "(No description available)"
 
+    # Functions of the init module the package manager calls, recorded in
+    # registry snapshots so that packages restored from one (see
+    # set_lazy()) are only initialized when one of these is really used
+    HOOKS = ['handle_all_errors', 'handle_module_upgrade_request',
+             'handle_missing_module', 'can_handle_identifier',
+             'can_handle_vt_file', 'contextMenuName', 'callContextMenu',
+             'loadVistrailFileHook', 'saveVistrailFileHook']
+
+    def set_lazy(self, hooks):
+        """set_lazy(hooks: list of str) -> None
+        Marks the package as restored from a registry snapshot: it is
+        loaded but not initialized, and its init module defines the
+        given hooks. None clears the mark once it gets initialized.
+
+        """
+        if hooks is None:
+            self._lazy_hooks = None
+        else:
+            self._lazy_hooks = frozenset(hooks)
+
+    def is_lazy(self):
+        return self._lazy_hooks is not None
+
+    def get_hooks(self):
+        """get_hooks() -> list of str
+        Returns the HOOKS that the package defines.
+
+        """
+        return [hook for hook in self.HOOKS if self._has_hook(hook)]
+
+    def _has_hook(self, name):
+        if self._lazy_hooks is not None:
+            return name in self._lazy_hooks
+        return hasattr(self._init_module, name)
+
+    def _get_hook(self, name):
+        if self._lazy_hooks is not None:
+            from vistrails.core.packagemanager import get_package_manager
+            get_package_manager().initialize_lazy_package(self.identifier)
+        return getattr(self._init_module, name)
+
     def can_handle_all_errors(self):
-        return hasattr(self._init_module, 'handle_all_errors')
+        return self._has_hook('handle_all_errors')
 
     def can_handle_upgrades(self):
-        return hasattr(self._init_module, 'handle_module_upgrade_request')
+        return self._has_hook('handle_module_upgrade_request')
 
     def can_handle_identifier(self, identifier):
         """ Asks package if it can handle this package
         """
         try:
-            return (hasattr(self.init_module, 'can_handle_identifier') and
-                    self.init_module.can_handle_identifier(identifier))
+            return (self._has_hook('can_handle_identifier') and
+                    self._get_hook('can_handle_identifier')(identifier))
         except Exception, e:
             debug.unexpected_exception(e)
             debug.critical("Got exception calling %s's can_handle_identifier: "
@@ -511,8 +554,8 @@ class Package(DBPackage):
         """ Asks package if it can handle a file inside a zipped vt file
         """
         try:
-            return (hasattr(self.init_module, 'can_handle_vt_file') and
-                    self.init_module.can_handle_vt_file(name))
+            return (self._has_hook('can_handle_vt_file') and
+                    self._get_hook('can_handle_vt_file')(name))
         except Exception, e:
             debug.unexpected_exception(e)
             debug.critical("Got exception calling %s's can_handle_vt_file: "
@@ -522,13 +565,14 @@ class Package(DBPackage):
             return False
 
     def can_handle_missing_modules(self):
-        return hasattr(self._init_module, 'handle_missing_module')
+        return self._has_hook('handle_missing_module')
 
     def handle_all_errors(self, *args, **kwargs):
-        return self._init_module.handle_all_errors(*args, **kwargs)
+        return self._get_hook('handle_all_errors')(*args, **kwargs)
 
     def handle_module_upgrade_request(self, *args, **kwargs):
-        return self._init_module.handle_module_upgrade_request(*args, **kwargs)
+        return self._get_hook('handle_module_upgrade_request')(*args,
+                                                               **kwargs)
         
     def handle_missing_module(self, *args, **kwargs):
         """report_missing_module(name, namespace):
@@ -537,7 +581,7 @@ class Package(DBPackage):
         present, to allow the package to dynamically add a missing
         module.
         """
-        return self._init_module.handle_missing_module(*args, **kwargs)
+        return self._get_hook('handle_missing_module')(*args, **kwargs)
 
     def add_abs_upgrade(self, new_desc, name, namespace, module_version):
         key = (name, namespace)
@@ -565,21 +609,21 @@ class Package(DBPackage):
         return None
 
     def has_contextMenuName(self):
-        return hasattr(self._init_module, 'contextMenuName')
+        return self._has_hook('contextMenuName')
 
     def contextMenuName(self, signature):
-        return self._init_module.contextMenuName(signature)
+        return self._get_hook('contextMenuName')(signature)
     
     def has_callContextMenu(self):
-        return hasattr(self._init_module, 'callContextMenu')
+        return self._has_hook('callContextMenu')
 
     def callContextMenu(self, signature):
-        return self._init_module.callContextMenu(signature)
+        return self._get_hook('callContextMenu')(signature)
 
     def loadVistrailFileHook(self, vistrail, tmp_dir):
-        if hasattr(self._init_module, 'loadVistrailFileHook'):
+        if self._has_hook('loadVistrailFileHook'):
             try:
-                self._init_module.loadVistrailFileHook(vistrail, tmp_dir)
+                self._get_hook('loadVistrailFileHook')(vistrail, tmp_dir)
             except Exception, e:
                 debug.unexpected_exception(e)
                 debug.critical("Got exception in %s's loadVistrailFileHook(): "
@@ -588,9 +632,9 @@ class Package(DBPackage):
                                            traceback.format_exc()))
 
     def saveVistrailFileHook(self, vistrail, tmp_dir):
-        if hasattr(self._init_module, 'saveVistrailFileHook'):
+        if self._has_hook('saveVistrailFileHook'):
             try:
-                self._init_module.saveVistrailFileHook(vistrail, tmp_dir)
+                self._get_hook('saveVistrailFileHook')(vistrail, tmp_dir)
             except Exception, e:
                 debug.unexpected_exception(e)
                 debug.critical("Got exception in %s's saveVistrailFileHook(): "
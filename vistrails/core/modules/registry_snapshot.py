@@ -0,0 +1,212 @@
+###############################################################################
+##
+## Copyright (C) 2014-2015, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+"""Snapshot of the module registry, persisted in the .vistrails directory.
+
+The snapshot is the registry saved to XML, along with an index that
+records, for each enabled package, its version and the modification time
+of its files. On the next start, the packages that did not change (nor
+their dependencies) are only loaded: their descriptors are taken from the
+snapshot and the package is initialized the first time one of its modules
+or hooks is used (see PackageManager.initialize_lazy_package()).
+
+"""
+from __future__ import division
+
+import json
+import os
+import sys
+import uuid
+
+from vistrails.core import debug
+from vistrails.core.system import current_dot_vistrails, vistrails_version
+import vistrails.core.modules.vistrails_module
+
+
+SNAPSHOT_VERSION = 1
+INDEX_FILENAME = 'registry_snapshot.json'
+
+# The modules of these packages are needed by everything anyway
+_EAGER_PACKAGES = ['basic_modules', 'abstraction']
+
+# Init module functions that mean the package creates modules from
+# something else than its own files
+_DYNAMIC_FUNCTIONS = ['reload_scripts', 'handle_missing_module']
+
+
+def package_mtime(package):
+    """package_mtime(package: Package) -> float or None
+    Returns the latest modification time of the files of a loaded
+    package.
+
+    """
+    try:
+        filename = sys.modules[package.prefix + package.codepath].__file__
+    except (KeyError, AttributeError, TypeError):
+        return None
+    if not os.path.basename(filename).startswith('__init__.'):
+        return os.path.getmtime(filename)
+    mtime = 0
+    for dirpath, dirnames, filenames in os.walk(os.path.dirname(filename)):
+        for name in filenames:
+            if name.endswith(('.pyc', '.pyo')):
+                continue
+            mtime = max(mtime, os.path.getmtime(os.path.join(dirpath, name)))
+    return mtime
+
+
+def package_key(package):
+    """package_key(package: Package) -> dict or None
+    Returns what identifies this version of a loaded package in the
+    snapshot index.
+
+    """
+    mtime = package_mtime(package)
+    if mtime is None:
+        return None
+    return {'codepath': package.codepath,
+            'version': package.version,
+            'mtime': mtime}
+
+
+def can_be_lazy(registry, package):
+    """can_be_lazy(registry: ModuleRegistry, package: Package) -> bool
+    Tells whether the descriptors of an initialized package can be
+    restored from a snapshot. This is not the case if something else than
+    the package's files determines its modules, or if some of them
+    compute their signatures with custom code.
+
+    """
+    if package.codepath in _EAGER_PACKAGES:
+        return False
+    init_module = package.init_module
+    if init_module is None or hasattr(init_module, '_subworkflows'):
+        return False
+    for name in _DYNAMIC_FUNCTIONS:
+        if hasattr(init_module, name):
+            return False
+    for descriptor in package.descriptor_list:
+        if descriptor.hasher_callable() is not None:
+            return False
+    for key in registry._constant_hasher_map:
+        if key[0] == package.identifier:
+            return False
+    return True
+
+
+def describe_package(registry, package):
+    """describe_package(registry: ModuleRegistry, package: Package)
+                          -> dict or None
+    Returns the index entry of an initialized (or lazy) package.
+
+    """
+    key = package_key(package)
+    if key is None:
+        return None
+    if package.is_lazy() or can_be_lazy(registry, package):
+        converter = vistrails.core.modules.vistrails_module.Converter
+        converters = [[d.name, d.namespace] for d in package.descriptor_list
+                      if d in registry._converters and
+                      d.loaded_module is not converter]
+        key.update(lazy=True, hooks=package.get_hooks(),
+                   converters=converters)
+    else:
+        key['lazy'] = False
+    return key
+
+
+def open_snapshot(directory=None):
+    """open_snapshot(directory: str) -> (dict, ModuleRegistry)
+    Reads the snapshot index and the registry it points to. Returns
+    (None, None) if there is no usable snapshot.
+
+    """
+    from vistrails.core.db.io import open_registry
+
+    if directory is None:
+        directory = current_dot_vistrails()
+    filename = os.path.join(directory, INDEX_FILENAME)
+    if not os.path.isfile(filename):
+        return None, None
+    try:
+        with open(filename, 'rb') as fp:
+            index = json.load(fp)
+        if (index.get('version') != SNAPSHOT_VERSION or
+                index.get('vistrails') != vistrails_version()):
+            return None, None
+        registry_file = os.path.join(directory, index['registry'])
+        if not os.path.isfile(registry_file):
+            return None, None
+        registry = open_registry(registry_file)
+    except Exception, e:
+        debug.warning("Couldn't read the registry snapshot", e)
+        return None, None
+    return index, registry
+
+
+def save_snapshot(registry, packages, previous=None, directory=None):
+    """save_snapshot(registry: ModuleRegistry, packages: dict,
+                     previous: dict, directory: str) -> dict
+    Saves the registry as the snapshot and returns the new index.
+    packages maps identifiers to the describe_package() entries. previous
+    is the index it replaces, whose registry file gets removed.
+
+    """
+    from vistrails.db.services.io import save_registry_to_xml
+
+    if directory is None:
+        directory = current_dot_vistrails()
+    index = {'version': SNAPSHOT_VERSION,
+             'vistrails': vistrails_version(),
+             'registry': 'registry_snapshot-%s.xml' % uuid.uuid1(),
+             'packages': packages}
+
+    # Write the new files first and switch to them atomically, so that
+    # other processes always find a complete snapshot
+    filename = os.path.join(directory, INDEX_FILENAME)
+    save_registry_to_xml(registry,
+                         os.path.join(directory, index['registry']))
+    tmp_filename = '%s.%s.tmp' % (filename, uuid.uuid1())
+    with open(tmp_filename, 'wb') as fp:
+        json.dump(index, fp, indent=1, sort_keys=True)
+    if os.path.exists(filename) and sys.platform.startswith('win'):
+        os.remove(filename)
+    os.rename(tmp_filename, filename)
+    if previous is not None and previous['registry'] != index['registry']:
+        try:
+            os.remove(os.path.join(directory, previous['registry']))
+        except OSError:
+            pass
+    return index
@@ -40,6 +40,7 @@ import copy
 from itertools import izip, product
 import json
 import sys
+import threading
 import time
 import traceback
 import warnings
@@ -310,6 +311,9 @@ class Module(object):
 
         self.signature = None
 
+        # on-disk result cache, set by the interpreter when enabled
+        self.result_cache = None
+
         # stores whether the output of the module should be annotated in the
         # execution log
         self.annotate_output = False
@@ -345,6 +349,8 @@ class Module(object):
         clone.output_specs = self.output_specs
         clone.input_specs_order = self.input_specs_order
         clone.output_specs_order = self.output_specs_order
+        # copies are used for loop iterations, which have fake signatures
+        clone.result_cache = None
 
         return clone
 
@@ -445,6 +451,55 @@ class Module(object):
                 params[spec.name] = module.translate_to_string(self.get_output(spec.name))
                 jm.setCache(self.signature, params, p_module.name)
 
+    def is_upstream_cacheable(self):
+        """ is_upstream_cacheable() -> bool
+            Checks that this module and everything upstream of it can be
+            reused across executions
+        """
+        if not self.is_cacheable():
+            return False
+        for connectorList in self.inputPorts.itervalues():
+            for connector in connectorList:
+                if not connector.obj.is_upstream_cacheable():
+                    return False
+        return True
+
+    def load_cached_result(self):
+        """ load_cached_result() -> bool
+            Sets outputs from the on-disk result cache if they were stored
+            by a previous execution
+        """
+        if (self.result_cache is None or self.upToDate or
+                self.signature is None or not self.is_cacheable()):
+            return False
+        outputs = self.result_cache.get(self.signature)
+        if outputs is None:
+            return False
+        for port_name, value in outputs.iteritems():
+            self.set_output(port_name, value)
+        self.upToDate = True
+        return True
+
+    def store_cached_result(self):
+        """ store_cached_result() -> None
+            Stores outputs in the on-disk result cache, if they can be
+            reused by another process
+        """
+        if self.result_cache is None or self.signature is None:
+            return
+        from vistrails.core.modules.basic_modules import Generator, \
+            PathObject
+        outputs = {}
+        for port_name, value in self.outputPorts.iteritems():
+            if port_name == 'self':
+                continue
+            # streams can't be stored, and files might be temporary
+            if isinstance(value, (Module, Generator, PathObject)):
+                return
+            outputs[port_name] = value
+        if self.is_upstream_cacheable():
+            self.result_cache.put(self.signature, outputs)
+
     def update_upstream(self):
         """ update_upstream() -> None
         Go upstream from the current module, then update its upstream
@@ -545,7 +600,7 @@ class Module(object):
         elif self.computed:
             return
         self.logging.begin_update(self)
-        if not self.setJobCache():
+        if not self.setJobCache() and not self.load_cached_result():
             self.update_upstream()
         if self.upToDate:
             if not self.computed:
@@ -598,6 +653,7 @@ class Module(object):
                     errorTrace=traceback.format_exc())
         if self.annotate_output:
             self.annotate_output_values()
+        self.store_cached_result()
         self.upToDate = True
         self.had_error = False
         self.logging.end_update(self)
@@ -634,6 +690,107 @@ class Module(object):
             return self.control_params[ModuleControlParam.LOOP_KEY]
         return default
 
+    def get_loop_threads(self, looped_module):
+        """get_loop_threads(looped_module: Module) -> int
+
+        Returns the number of threads used to run the iterations of a loop
+        over looped_module, 0 meaning they are run one after the other.
+        This is set by the 'loop_threads' control parameter, or else by the
+        'loopThreads' configuration setting, which only applies to cacheable
+        modules. Iterations are always serial when the GUI is running or if
+        the looped module is a group.
+
+        """
+        from vistrails.core.application import get_vistrails_application
+        app = get_vistrails_application()
+        if app is not None and app.is_running_gui():
+            return 0
+        if getattr(looped_module, 'is_group', False):
+            return 0
+        if ModuleControlParam.LOOP_THREADS_KEY in self.control_params:
+            num_threads = int(
+                    self.control_params[ModuleControlParam.LOOP_THREADS_KEY])
+        elif looped_module.is_cacheable():
+            conf = get_vistrails_configuration()
+            num_threads = getattr(conf, 'loopThreads', 0) or 0
+        else:
+            num_threads = 0
+        return max(num_threads, 0)
+
+    def update_iterations(self, loop, iterations, on_suspended=None):
+        """update_iterations(loop, iterations: list,
+                              on_suspended: callable) -> list
+
+        Updates the module of each (iteration, module) pair, logging them as
+        iterations of the loop. Returns, in the same order, the
+        ModuleSuspended exception raised by each module or None.
+        on_suspended(module, iteration, e) is called before the iteration is
+        marked as finished for suspended modules.
+
+        The iterations are run on a pool of threads if enabled (see
+        get_loop_threads()), in chunks given by the 'loop_chunk' control
+        parameter. Other exceptions are raised once all the iterations are
+        done; the first one in iteration order wins.
+
+        """
+        total = len(iterations)
+
+        def run(iteration, module):
+            loop.begin_iteration(module, iteration)
+            try:
+                module.update()
+            except ModuleSuspended, e:
+                if on_suspended is not None:
+                    on_suspended(module, iteration, e)
+                loop.end_iteration(module)
+                return e
+            loop.end_iteration(module)
+            return None
+
+        if total > 1:
+            num_threads = min(self.get_loop_threads(iterations[0][1]), total)
+        else:
+            num_threads = 0
+        if num_threads <= 1:
+            results = []
+            for n, (iteration, module) in enumerate(iterations):
+                self.logging.update_progress(self, n / total)
+                results.append(run(iteration, module))
+            return results
+
+        from multiprocessing.pool import ThreadPool
+        from vistrails.core.interpreter.scheduler import SynchronizedLogging
+
+        # Logging calls are serialized between the threads
+        loop = SynchronizedLogging(loop)
+        for iteration, module in iterations:
+            module.logging = SynchronizedLogging(module.logging)
+        logging = SynchronizedLogging(self.logging)
+        progress_lock = threading.Lock()
+        done = [0]
+
+        def run_chunk(chunk):
+            results = [run(iteration, module) for iteration, module in chunk]
+            with progress_lock:
+                done[0] += len(chunk)
+                logging.update_progress(self, done[0] / total)
+            return results
+
+        chunksize = int(self.control_params.get(
+                ModuleControlParam.LOOP_CHUNK_KEY, 1))
+        chunksize = max(chunksize, 1)
+        chunks = [iterations[i:i + chunksize]
+                  for i in xrange(0, total, chunksize)]
+        pool = ThreadPool(num_threads)
+        try:
+            # map() returns the results in order, and raises the first
+            # exception once every chunk is done
+            results = pool.map(run_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+        return [r for chunk_results in results for r in chunk_results]
+
     def compute_all(self):
         """This method executes the module once for each input.
            Similarly to controlflow's fold.
@@ -666,10 +823,8 @@ class Module(object):
         elements, port_names = self.do_combine(combine_type, inputs, port_names)
         num_inputs = len(elements)
         loop = self.logging.begin_loop_execution(self, num_inputs)
-        ## Update everything for each value inside the list
-        outputs = {}
+        iterations = []
         for i in xrange(num_inputs):
-            self.logging.update_progress(self, float(i)/num_inputs)
             module = copy.copy(self)
             module.list_depth = self.list_depth - 1
             module.had_error = False
@@ -683,20 +838,20 @@ class Module(object):
                 module.upToDate = False
                 module.computed = False
                 self.setInputValues(module, port_names, elements[i], i)
+            iterations.append((i, module))
 
-            loop.begin_iteration(module, i)
+        def on_suspended(module, i, e):
+            e.loop_iteration = i
+            module.logging.end_update(module, e, was_suspended=True)
 
-            try:
-                module.update()
-            except ModuleSuspended, e:
-                e.loop_iteration = i
-                module.logging.end_update(module, e, was_suspended=True)
+        ## Update everything for each value inside the list
+        results = self.update_iterations(loop, iterations, on_suspended)
+        outputs = {}
+        for (i, module), e in izip(iterations, results):
+            if e is not None:
                 suspended.append(e)
-                loop.end_iteration(module)
                 continue
 
-            loop.end_iteration(module)
-
             ## Getting the result from the output port
             for nameOutput in module.outputPorts:
                 if nameOutput not in outputs:
@@ -704,8 +859,6 @@ class Module(object):
                 output = module.get_output(nameOutput)
                 outputs[nameOutput].append(output)
 
-            self.logging.update_progress(self, i * 1.0 / num_inputs)
-
         if suspended:
             raise ModuleSuspended(
                     self,
@@ -743,6 +896,10 @@ class Module(object):
         """This method creates a generator object and sets the outputs as
         generators.
 
+        If the streamed inputs are batched, each step handles a chunk of
+        elements and the outputs are batched as well; modules that are
+        ChunkedStreaming compute once for the whole chunk.
+
         """
         from vistrails.core.modules.basic_modules import Generator
         type = self.control_params.get(ModuleControlParam.LOOP_KEY, 'pairwise')
@@ -755,22 +912,22 @@ class Module(object):
         ports = [port for port, depth, value in self.iterated_ports
                  if depth == self.list_depth]
         num_inputs = self.iterated_ports[0][2].size
+        iter_dict = dict([(port, value)
+                          for port, depth, value in self.iterated_ports])
+        streams = [iter_dict[port] for port in ports]
+        batched = any(stream.batched for stream in streams)
+        compute_chunks = batched and isinstance(self, ChunkedStreaming)
         # the generator will read next from each iterated input port and
         # compute the module again
         module = copy.copy(self)
         module.list_depth = self.list_depth - 1
-        if num_inputs:
-            milestones = [i*num_inputs//10 for i in xrange(1, 11)]
+        progress = StreamProgress(self.logging, module, num_inputs)
         def generator(self):
             self.logging.begin_compute(module)
             i = 0
             while 1:
-                iter_dict = dict([(port, (depth, value))
-                                  for port, depth, value in
-                                  self.iterated_ports])
-
-                elements = [iter_dict[port][1].next() for port in ports]
-                if None in elements:
+                chunks = self.next_stream_chunks(streams)
+                if chunks is None:
                     for name_output in module.outputPorts:
                         module.set_output(name_output, None)
                     if suspended:
@@ -783,29 +940,40 @@ class Module(object):
                     self.logging.update_progress(module, 1.0)
                     self.logging.end_update(module)
                     yield None
-                if num_inputs:
-                    if i in milestones:
-                        self.logging.update_progress(module, float(i)/num_inputs)
-                else:
-                    self.logging.update_progress(module, 0.5)
+                progress.update(i)
                 module.had_error = False
                 ## Type checking
                 if i == 0:
-                    self.typeChecking(module, ports, [elements])
+                    self.typeChecking(module, ports,
+                                      [[chunk[0] for chunk in chunks]])
 
-                module.upToDate = False
-                module.computed = False
+                if compute_chunks:
+                    values = [chunks]
+                else:
+                    values = izip(*chunks)
+                outputs = dict((name_output, [])
+                               for name_output in module.outputPorts)
+                for elements in values:
+                    module.upToDate = False
+                    module.computed = False
 
-                self.setInputValues(module, ports, elements, i)
+                    self.setInputValues(module, ports, elements, i)
 
-                try:
-                    module.compute()
-                except ModuleSuspended, e:
-                    e.loop_iteration = i
-                    suspended.append(e)
-                except Exception, e:
-                    raise ModuleError(module, str(e))
-                i += 1
+                    try:
+                        module.compute()
+                    except ModuleSuspended, e:
+                        e.loop_iteration = i
+                        suspended.append(e)
+                    except Exception, e:
+                        raise ModuleError(module, str(e))
+                    if batched and not compute_chunks:
+                        for name_output in outputs:
+                            outputs[name_output].append(
+                                    module.get_output(name_output))
+                if batched and not compute_chunks:
+                    for name_output, chunk in outputs.iteritems():
+                        module.set_output(name_output, chunk)
+                i += len(chunks[0])
                 yield True
 
         _generator = generator(self)
@@ -814,7 +982,8 @@ class Module(object):
             iterator = Generator(size=num_inputs,
                                  module=module,
                                  generator=_generator,
-                                 port=name_output)
+                                 port=name_output,
+                                 batched=batched)
             self.set_output(name_output, iterator)
 
     def compute_accumulate(self):
@@ -836,12 +1005,13 @@ class Module(object):
         module.computed = False
 
         inputs = dict([(port, []) for port in ports])
+        streams = [self.streamed_ports[port] for port in ports]
         def generator(self):
             self.logging.begin_update(module)
             i = 0
             while 1:
-                elements = [self.streamed_ports[port].next() for port in ports]
-                if None in elements:
+                chunks = self.next_stream_chunks(streams)
+                if chunks is None:
                     self.logging.begin_compute(module)
                     # assembled all inputs so do the actual computation
                     elements = [inputs[port] for port in ports]
@@ -862,11 +1032,11 @@ class Module(object):
                     self.logging.end_update(module)
                     yield None
 
-                for port, value in zip(ports, elements):
-                    inputs[port].append(value)
+                for port, chunk in zip(ports, chunks):
+                    inputs[port].extend(chunk)
                 for name_output in module.outputPorts:
                     module.set_output(name_output, None)
-                i += 1
+                i += len(chunks[0])
                 yield True
 
         _generator = generator(self)
@@ -905,7 +1075,7 @@ class Module(object):
                 module.set_output(name_output, None)
             while 1:
                 elements = [self.streamed_ports[port].next() for port in ports]
-                if None not in elements:
+                if all(element is not None for element in elements):
                     self.logging.begin_compute(module)
                     ## Type checking
                     self.typeChecking(module, ports, [elements])
@@ -1445,15 +1615,16 @@ class Module(object):
 
         ports = self.streamed_ports.keys()
         specs = []
-        num_inputs = self.streamed_ports[ports[0]].size
+        streams = [self.streamed_ports[port] for port in ports]
+        num_inputs = streams[0].size
+        batched = any(stream.batched for stream in streams)
         module = copy.copy(self)
         module.list_depth = self.list_depth - 1
         module.had_error = False
         module.upToDate = False
         module.computed = False
 
-        if num_inputs:
-            milestones = [i*num_inputs//10 for i in xrange(1, 11)]
+        progress = StreamProgress(self.logging, self, num_inputs)
 
         def _Generator(self):
             self.logging.begin_compute(module)
@@ -1462,30 +1633,36 @@ class Module(object):
             #intsum = 0
             userGenerator = UserGenerator(module)
             while 1:
-                elements = [self.streamed_ports[port].next() for port in ports]
-                if None in elements:
+                chunks = self.next_stream_chunks(streams)
+                if chunks is None:
                     self.logging.update_progress(self, 1.0)
                     self.logging.end_update(module)
                     for name_output in module.outputPorts:
                         module.set_output(name_output, None)
                     yield None
-                ## Type checking
-                self.typeChecking(module, ports, [elements])
-                self.setInputValues(module, ports, elements, i)
-
-                userGenerator.next()
-                # <compute here>
-                #intsum += dict(zip(ports, elements))['integerStream']
-                #print "Sum so far:", intsum
-
-                # <set output here if any>
-                #module.set_output(name_output, intsum)
-                if num_inputs:
-                    if i in milestones:
-                        self.logging.update_progress(self, float(i)/num_inputs)
-                else:
-                    self.logging.update_progress(self, 0.5)
-                i += 1
+                outputs = dict((name_output, [])
+                               for name_output in module.outputPorts)
+                for elements in izip(*chunks):
+                    ## Type checking
+                    self.typeChecking(module, ports, [elements])
+                    self.setInputValues(module, ports, elements, i)
+
+                    userGenerator.next()
+                    # <compute here>
+                    #intsum += dict(zip(ports, elements))['integerStream']
+                    #print "Sum so far:", intsum
+
+                    # <set output here if any>
+                    #module.set_output(name_output, intsum)
+                    if batched:
+                        for name_output in outputs:
+                            outputs[name_output].append(
+                                    module.get_output(name_output))
+                    progress.update(i)
+                    i += 1
+                if batched:
+                    for name_output, chunk in outputs.iteritems():
+                        module.set_output(name_output, chunk)
                 yield True
 
         generator = _Generator(self)
@@ -1494,11 +1671,26 @@ class Module(object):
             iterator = Generator(size=num_inputs,
                                  module=module,
                                  generator=generator,
-                                 port=name_output)
+                                 port=name_output,
+                                 batched=batched)
 
             self.set_output(name_output, iterator)
 
-    def set_streaming_output(self, port, generator, size=0):
+    def get_stream_chunk_size(self):
+        """get_stream_chunk_size() -> int
+
+        Returns how many values a streaming output sends downstream at once,
+        from the 'stream_chunk' control parameter or the 'streamChunkSize'
+        configuration setting. 1 or less means values are sent one by one.
+
+        """
+        if ModuleControlParam.STREAM_CHUNK_KEY in self.control_params:
+            return int(self.control_params[ModuleControlParam.STREAM_CHUNK_KEY])
+        conf = get_vistrails_configuration()
+        return getattr(conf, 'streamChunkSize', 0) or 0
+
+    def set_streaming_output(self, port, generator, size=0, chunksize=None,
+                             batched=False):
         """This method is used to set a streaming output port.
 
         :param port: the name of the output port to be set
@@ -1506,12 +1698,35 @@ class Module(object):
         :param generator: An iterator object supporting .next()
         :param size: The number of values if known (default=0)
         :type size: int
+        :param chunksize: How many values are sent downstream at once
+            (default: see get_stream_chunk_size())
+        :type chunksize: int
+        :param batched: Whether the iterator already returns chunks of values
+            (lists or arrays) rather than single values
+        :type batched: bool
         """
         from vistrails.core.modules.basic_modules import Generator
         module = copy.copy(self)
 
-        if size:
-            milestones = [i*size//10 for i in xrange(1, 11)]
+        if not batched:
+            if chunksize is None:
+                chunksize = self.get_stream_chunk_size()
+            if chunksize > 1:
+                def chunked(values):
+                    chunk = []
+                    for value in values:
+                        if value is None:
+                            break
+                        chunk.append(value)
+                        if len(chunk) == chunksize:
+                            yield chunk
+                            chunk = []
+                    if chunk:
+                        yield chunk
+                generator = chunked(generator)
+                batched = True
+
+        progress = StreamProgress(self.logging, self, size)
         def _Generator():
             i = 0
             while 1:
@@ -1530,18 +1745,33 @@ class Module(object):
                     self.logging.update_progress(self, 1.0)
                     yield None
                 module.set_output(port, value)
-                if size:
-                    if i in milestones:
-                        self.logging.update_progress(self, float(i)/size)
+                progress.update(i)
+                if batched:
+                    i += len(value)
                 else:
-                    self.logging.update_progress(self, 0.5)
-                i += 1
+                    i += 1
                 yield True
         _generator = _Generator()
         self.set_output(port, Generator(size=size,
                                         module=module,
                                         generator=_generator,
-                                        port=port))
+                                        port=port,
+                                        batched=batched))
+
+    def next_stream_chunks(self, streams):
+        """next_stream_chunks(streams: list) -> list
+
+        Reads the next step from each of the streamed inputs, as chunks of
+        values of the same length. Returns None when a stream is exhausted.
+
+        """
+        chunks = [stream.next_chunk() for stream in streams]
+        if any(chunk is None for chunk in chunks):
+            return None
+        if any(len(chunk) != len(chunks[0]) for chunk in chunks[1:]):
+            raise ModuleError(self, "Streamed inputs have different chunk "
+                                    "sizes")
+        return chunks
 
     def job_monitor(self):
         """ job_monitor() -> JobMonitor
@@ -1633,6 +1863,39 @@ class Streaming(object):
     """
     pass
 
+class ChunkedStreaming(object):
+    """ A mixin indicating that the module can compute on a whole chunk of a
+    batched stream at once
+
+    Its streamed input ports then get lists (or arrays) of values, and it
+    should set its outputs to chunks of the same length.
+
+    """
+    pass
+
+class StreamProgress(object):
+    """ Reports the progress of a stream every 10% of its size, whatever
+    the number of values handled at each step
+
+    """
+    def __init__(self, logging, module, size):
+        self.logging = logging
+        self.module = module
+        self.size = size
+        self.next_milestone = 0
+
+    def update(self, i):
+        if self.size:
+            if i >= self.next_milestone:
+                self.logging.update_progress(self.module,
+                                             float(i)/self.size)
+                self.next_milestone = (i * 10 // self.size + 1) * \
+                                      self.size / 10
+        elif self.next_milestone == 0:
+            # unknown size
+            self.logging.update_progress(self.module, 0.5)
+            self.next_milestone = 1
+
 ################################################################################
 
 class Converter(Module):
@@ -1859,3 +2122,99 @@ class TestImplicitLooping(unittest.TestCase):
 
     def test_list_custom(self):
         self.run_vt("test-list-custom.vt")
+
+
+class TestLoopThreads(unittest.TestCase):
+    class Looped(Module):
+        def update(self):
+            if self.n == 3:
+                raise ModuleSuspended(self, "suspended")
+            self.result = self.n * 2
+
+    def test_update_iterations(self):
+        """Runs iterations on threads, in chunks.
+        """
+        module = Module()
+        module.control_params[ModuleControlParam.LOOP_THREADS_KEY] = '3'
+        module.control_params[ModuleControlParam.LOOP_CHUNK_KEY] = '2'
+        self.assertEqual(module.get_loop_threads(self.Looped()), 3)
+        iterations = []
+        for i in xrange(7):
+            looped = self.Looped()
+            looped.n = i
+            iterations.append((i, looped))
+        suspended = []
+        results = module.update_iterations(
+                _dummy_logging, iterations,
+                lambda m, i, e: suspended.append(i))
+        self.assertEqual(suspended, [3])
+        self.assertEqual([e is not None for e in results],
+                         [False, False, False, True, False, False, False])
+        self.assertEqual([m.result for i, m in iterations if i != 3],
+                         [0, 2, 4, 8, 10, 12])
+
+
+class TestBatchedStreaming(unittest.TestCase):
+    def test_chunked_output(self):
+        """Streams values in chunks from set_streaming_output().
+        """
+        from vistrails.core.modules.basic_modules import Generator
+        generators = Generator.generators
+        Generator.generators = []
+        try:
+            module = Module()
+            module.set_streaming_output('out', iter(xrange(10)), 10,
+                                        chunksize=4)
+            stream = module.get_output('out')
+            self.assertTrue(stream.batched)
+            chunks = []
+            while stream.module.generator.next() is not None:
+                chunks.append(stream.next_chunk())
+            self.assertEqual(chunks, [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]])
+            self.assertIsNone(stream.next_chunk())
+        finally:
+            Generator.generators = generators
+
+    def test_pipeline(self):
+        """Streams chunks through a module that computes per element.
+        """
+        import urllib2
+        from vistrails.core.modules.basic_modules import PythonSource
+        from vistrails.tests.utils import execute, intercept_results
+        conf = get_vistrails_configuration()
+        old_chunk_size = conf.streamChunkSize
+        conf.streamChunkSize = 4
+        try:
+            with intercept_results(PythonSource, 'r') as (results,):
+                self.assertFalse(execute([
+                        ('PythonSource', 'org.vistrails.vistrails.basic', [
+                            ('source', [('String', urllib2.quote(
+                                "self.set_streaming_output('out', "
+                                "iter(xrange(10)), 10)"))]),
+                        ]),
+                        ('PythonSource', 'org.vistrails.vistrails.basic', [
+                            ('source', [('String', 'o%20%3D%20i%20*%202')]),
+                        ]),
+                        ('PythonSource', 'org.vistrails.vistrails.basic', [
+                            ('source', [('String', 'r%20%3D%20l')]),
+                        ]),
+                    ],
+                    [
+                        (0, 'out', 1, 'i'),
+                        (1, 'o', 2, 'l'),
+                    ],
+                    add_port_specs=[
+                        (0, 'output', 'out',
+                         'org.vistrails.vistrails.basic:Integer', 1),
+                        (1, 'input', 'i',
+                         'org.vistrails.vistrails.basic:Integer'),
+                        (1, 'output', 'o',
+                         'org.vistrails.vistrails.basic:Integer'),
+                        (2, 'input', 'l',
+                         'org.vistrails.vistrails.basic:List'),
+                        (2, 'output', 'r',
+                         'org.vistrails.vistrails.basic:List'),
+                    ]))
+        finally:
+            conf.streamChunkSize = old_chunk_size
+        self.assertEqual(results, [[0, 2, 4, 6, 8, 10, 12, 14, 16, 18]])
@@ -44,15 +44,18 @@ import inspect
 import itertools
 import os
 import sys
+import threading
 import warnings
 
-from vistrails.core import debug, get_vistrails_application, system
+from vistrails.core import debug, get_vistrails_application, \
+    is_running_gui, system
 from vistrails.core.configuration import ConfigurationObject, \
     get_vistrails_configuration
 import vistrails.core.data_structures.graph
 from vistrails.core.modules.module_registry import MissingPackage, \
     MissingPackageVersion
 from vistrails.core.modules.package import Package
+from vistrails.core.modules import registry_snapshot
 from vistrails.core.requirements import MissingRequirement
 from vistrails.core.utils import VistrailsInternalError, \
     versions_increasing, VistrailsDeprecation
@@ -173,6 +176,11 @@ class PackageManager(object):
         self._abstraction_pkg = None
         self._currently_importing_package = None
 
+        # Index of the registry snapshot, see initialize_packages()
+        self._registry_snapshot = None
+        self._lazy_lock = threading.RLock()
+        self._lazy_initializing = set()
+
         # Setup a global __import__ hook that calls Package#import_override()
         # for all imports executed from that package
         import __builtin__
@@ -182,7 +190,12 @@ class PackageManager(object):
         # Compute the list of available packages, _available_packages
         self.build_available_package_names_list()
 
-        if get_vistrails_configuration().loadPackages:
+        # identifier: str -> codepath: str, for the enabled packages that
+        # are not loaded yet, see require_packages()
+        self._enabled_identifiers = None
+
+        if (get_vistrails_configuration().loadPackages and
+                not self.load_packages_on_demand()):
             for pkg in self._startup.enabled_packages.itervalues():
                 self.add_package(pkg.name, prefix=pkg.prefix)
         else:
@@ -323,6 +336,7 @@ class PackageManager(object):
         self.remove_old_identifiers(pkg.identifier)
         self.remove_menu_items(pkg)
         pkg.finalize()
+        pkg.set_lazy(None)
         del self._package_list[codepath]
         self._registry.remove_package(pkg)
         app = get_vistrails_application()
@@ -506,6 +520,7 @@ class PackageManager(object):
             self.add_dependencies(pkg)
             #check_requirements is now called in pkg.initialize()
             #pkg.check_requirements()
+            self.initialize_lazy_dependencies(pkg.identifier)
             self._registry.initialize_package(pkg)
             self._registry.signals.emit_new_package(pkg.identifier, True)
             app.send_notification("package_added", codepath)
@@ -580,7 +595,7 @@ class PackageManager(object):
         app = get_vistrails_application()
         for package in self._package_list.itervalues():
             # print '+ initializing', package.codepath, id(package)
-            if package.initialized():
+            if package.initialized() or package.is_lazy():
                 # print '- already initialized'
                 continue
             try:
@@ -669,12 +684,22 @@ class PackageManager(object):
             raise self.DependencyCycle(e.back_edge[0],
                                        e.back_edge[1])
 
+        lazy_packages, snapshot = self.find_lazy_packages(sorted_packages)
+
         for name in sorted_packages:
             pkg = self.get_package(name)
-            if not pkg.initialized():
+            if name in lazy_packages:
+                entry = lazy_packages[name]
+                self._registry.add_snapshot_package(pkg, snapshot,
+                                                    entry['converters'])
+                pkg.set_lazy(entry['hooks'])
+                app = get_vistrails_application()
+                app.send_notification("package_added", pkg.codepath)
+            elif not pkg.initialized() and not pkg.is_lazy():
                 #check_requirements is now called in pkg.initialize()
                 #pkg.check_requirements()
                 try:
+                    self.initialize_lazy_dependencies(pkg.identifier)
                     self._registry.initialize_package(pkg)
                 except MissingRequirement, e:
                     if report_missing_dependencies:
@@ -697,8 +722,188 @@ class PackageManager(object):
                     app = get_vistrails_application()
                     app.send_notification("package_added", pkg.codepath)
 
+        if self.use_registry_snapshot():
+            self.save_registry_snapshot()
         self._startup.save_persisted_startup()
 
+    def load_packages_on_demand(self):
+        return get_vistrails_configuration().check('loadPackagesOnDemand')
+
+    def find_enabled_package(self, identifier):
+        """find_enabled_package(identifier: str) -> Package or None
+        Returns the package with that (or an old) identifier among the
+        packages enabled in the startup configuration, loading their
+        __init__ modules the first time.
+
+        """
+        if self._enabled_identifiers is None:
+            self._enabled_identifiers = {}
+            for startup_pkg in self._startup.enabled_packages.itervalues():
+                pkg = self.get_available_package(startup_pkg.name,
+                                                 prefix=startup_pkg.prefix)
+                try:
+                    pkg.load(startup_pkg.prefix or
+                             self._default_prefix_dict.get(pkg.codepath))
+                except Exception, e:
+                    debug.warning("Couldn't load package %s" %
+                                  startup_pkg.name, e)
+                    continue
+                for key in itertools.chain([pkg.identifier],
+                                           pkg.old_identifiers):
+                    self._enabled_identifiers[key] = pkg.codepath
+        codepath = self._enabled_identifiers.get(identifier)
+        if codepath is None:
+            return None
+        return self.get_available_package(codepath)
+
+    def require_packages(self, identifiers):
+        """require_packages(identifiers: iterable of str) -> None
+        Enables the packages with these identifiers that are enabled in
+        the startup configuration but not loaded yet, with their
+        dependencies. This is how packages get loaded when
+        loadPackagesOnDemand is set; the other missing packages are left
+        to the controller, which reports them or enables them when
+        validation fails.
+
+        """
+        missing = [identifier for identifier in set(identifiers)
+                   if not self.has_package(identifier)]
+        codepaths = set()
+        while missing:
+            identifier = missing.pop()
+            pkg = self.find_enabled_package(identifier)
+            if (pkg is None or pkg.codepath in codepaths or
+                    pkg.codepath in self._package_list):
+                continue
+            codepaths.add(pkg.codepath)
+            for dep in pkg.dependencies():
+                if isinstance(dep, tuple):
+                    dep = dep[0]
+                if not self.has_package(dep):
+                    missing.append(dep)
+        if not codepaths:
+            return
+        for codepath in codepaths:
+            self.add_package(
+                    codepath,
+                    prefix=self._startup.enabled_packages[codepath].prefix)
+        self.initialize_packages()
+
+        # Don't try again with the packages that failed
+        for key, codepath in self._enabled_identifiers.items():
+            if codepath in codepaths and codepath not in self._package_list:
+                del self._enabled_identifiers[key]
+
+    def use_registry_snapshot(self):
+        """use_registry_snapshot() -> bool
+        The snapshot is only used by non-interactive applications, where
+        package menus and widgets are not needed.
+
+        """
+        return (get_vistrails_configuration().check('registrySnapshot') and
+                not is_running_gui())
+
+    def find_lazy_packages(self, identifiers):
+        """find_lazy_packages(identifiers: [str])
+                                -> ({str: dict}, ModuleRegistry)
+        Returns the packages, among these (in dependency order), that
+        can be restored from the registry snapshot instead of being
+        initialized, with their entry in the snapshot index.
+
+        """
+        if not self.use_registry_snapshot():
+            return {}, None
+        index, snapshot = registry_snapshot.open_snapshot()
+        if index is None:
+            return {}, None
+        self._registry_snapshot = index
+
+        unchanged = set()
+        lazy_packages = {}
+        for identifier in identifiers:
+            pkg = self.get_package(identifier)
+            entry = index['packages'].get(identifier)
+            key = registry_snapshot.package_key(pkg)
+            if (entry is None or key is None or
+                    any(entry[k] != v for k, v in key.iteritems())):
+                continue
+            # A package changes if one of its dependencies does
+            if any(dep not in unchanged
+                   for dep in self.all_dependencies(identifier)
+                   if dep != identifier):
+                continue
+            unchanged.add(identifier)
+            if (entry['lazy'] and
+                    not pkg.initialized() and not pkg.is_lazy() and
+                    (identifier, pkg.version) in snapshot.package_versions):
+                lazy_packages[identifier] = entry
+        if (lazy_packages and
+                not self._registry.reserve_snapshot_ids(snapshot,
+                                                        lazy_packages)):
+            return {}, None
+        return lazy_packages, snapshot
+
+    def save_registry_snapshot(self):
+        """save_registry_snapshot() -> None
+        Saves the registry as the snapshot, unless the current one
+        describes the same packages.
+
+        """
+        entries = {}
+        for pkg in self._package_list.itervalues():
+            if pkg.initialized() or pkg.is_lazy():
+                entry = registry_snapshot.describe_package(self._registry,
+                                                           pkg)
+                if entry is not None:
+                    entries[pkg.identifier] = entry
+        previous = self._registry_snapshot
+        if previous is not None:
+            if previous['packages'] == entries:
+                return
+            if (self.load_packages_on_demand() and
+                    not set(previous['packages']).issubset(entries)):
+                # Keep the snapshot of the sessions that loaded more
+                return
+        try:
+            self._registry_snapshot = registry_snapshot.save_snapshot(
+                    self._registry, entries, previous)
+        except Exception, e:
+            debug.warning("Couldn't save the registry snapshot", e)
+
+    def initialize_lazy_package(self, identifier):
+        """initialize_lazy_package(identifier: str) -> None
+        Initializes a package restored from the registry snapshot, and the
+        ones it depends on. The descriptors it already has in the
+        registry get their modules.
+
+        """
+        with self._lazy_lock:
+            pkg = self.get_package(identifier)
+            if not pkg.is_lazy() or pkg.identifier in self._lazy_initializing:
+                return
+            self._lazy_initializing.add(pkg.identifier)
+            try:
+                for dep in self.all_dependencies(pkg.identifier):
+                    dep_pkg = self.get_package(dep)
+                    if dep_pkg is pkg:
+                        debug.log("Initializing %s from the registry "
+                                  "snapshot" % pkg.codepath)
+                        self._registry.initialize_package(pkg)
+                    elif dep_pkg.is_lazy():
+                        self.initialize_lazy_package(dep)
+            finally:
+                self._lazy_initializing.discard(pkg.identifier)
+
+    def initialize_lazy_dependencies(self, identifier):
+        """initialize_lazy_dependencies(identifier: str) -> None
+        Initializes the packages restored from the registry snapshot that
+        this one depends on, so that it can subclass their modules.
+
+        """
+        for dep in self.all_dependencies(identifier):
+            if dep != identifier and self.get_package(dep).is_lazy():
+                self.initialize_lazy_package(dep)
+
     def add_menu_items(self, pkg):
         """add_menu_items(pkg: Package) -> None
         If the package implemented the function menu_items(),
@@ -914,6 +1119,8 @@ def get_package_manager():
 
 ##############################################################################
 
+import shutil
+import tempfile
 import unittest
 
 
@@ -968,3 +1175,194 @@ class TestImports(unittest.TestCase):
                     'vistrails.tests.resources.import_targets.test5',
                     'vistrails.tests.resources.import_targets.test6']:
             self.assertIn(dep, deps)
+
+
+class TestRegistrySnapshot(unittest.TestCase):
+    def test_lazy_package(self):
+        """Restores a package from the snapshot and initializes it on use.
+        """
+        if is_running_gui():
+            self.skipTest("The registry snapshot is not used by the GUI")
+        conf = get_vistrails_configuration()
+        pm = get_package_manager()
+        reg = pm._registry
+        identifier = 'org.vistrails.vistrails.pythoncalc'
+        pm.initialize_lazy_package(identifier)
+
+        directory = tempfile.mkdtemp(prefix='vt_snapshot_')
+        old_conf = conf.dotVistrails, conf.registrySnapshot
+        old_snapshot = pm._registry_snapshot
+        conf.dotVistrails = directory
+        conf.registrySnapshot = True
+        try:
+            pm._registry_snapshot = None
+            pm.save_registry_snapshot()
+            self.assertTrue(os.path.isfile(os.path.join(
+                    directory, registry_snapshot.INDEX_FILENAME)))
+
+            pm.late_disable_package('pythonCalc')
+            pm.add_package('pythonCalc')
+            pm.initialize_packages()
+            pkg = pm.get_package(identifier)
+            self.assertTrue(pkg.is_lazy())
+            self.assertFalse(pkg.initialized())
+            descriptor = reg.get_descriptor_by_name(identifier, 'PythonCalc')
+            self.assertIsNone(descriptor.loaded_module)
+            self.assertTrue(descriptor.has_port_spec('value1', 'input'))
+
+            module = reg.get_module_by_name(identifier, 'PythonCalc')
+            self.assertEqual(module.__name__, 'PythonCalc')
+            self.assertTrue(pkg.initialized())
+            self.assertFalse(pkg.is_lazy())
+            self.assertIs(reg.get_descriptor(module), descriptor)
+        finally:
+            conf.dotVistrails, conf.registrySnapshot = old_conf
+            pm._registry_snapshot = old_snapshot
+            shutil.rmtree(directory)
+
+    def make_dependent_packages(self, directory):
+        """Creates the packages pkgy and pkgx, whose ModX subclasses ModY,
+        in directory, and makes them importable as user packages.
+        """
+        pm = get_package_manager()
+        userpackages = pm.import_user_packages_module()
+        if userpackages is None:
+            self.skipTest("No user package directory")
+        root = os.path.join(directory, 'userpackages')
+        os.mkdir(root)
+        userpackages.__path__.append(root)
+        self.addCleanup(userpackages.__path__.remove, root)
+        sources = {
+            'pkgy': ('identifier = "org.vistrails.tests.pkgy"\n'
+                     'name = "pkgy"\n'
+                     'version = "0.1"\n',
+                     'from vistrails.core.modules.vistrails_module import '
+                     'Module\n'
+                     'class ModY(Module):\n'
+                     '    pass\n'
+                     '_modules = [ModY]\n'),
+            'pkgx': ('identifier = "org.vistrails.tests.pkgx"\n'
+                     'name = "pkgx"\n'
+                     'version = "0.1"\n'
+                     'def package_dependencies():\n'
+                     '    return ["org.vistrails.tests.pkgy"]\n',
+                     'from userpackages.pkgy.init import ModY\n'
+                     'class ModX(ModY):\n'
+                     '    pass\n'
+                     '_modules = [ModX]\n')}
+        for codepath, (init_src, module_src) in sources.iteritems():
+            os.mkdir(os.path.join(root, codepath))
+            with open(os.path.join(root, codepath, '__init__.py'), 'w') as fp:
+                fp.write(init_src)
+            with open(os.path.join(root, codepath, 'init.py'), 'w') as fp:
+                fp.write(module_src)
+        def cleanup():
+            for codepath in ['pkgx', 'pkgy']:
+                if pm.has_package('org.vistrails.tests.%s' % codepath):
+                    pm.late_disable_package(codepath)
+            for name in sys.modules.keys():
+                if name.startswith(('userpackages.pkgx', 'userpackages.pkgy')):
+                    del sys.modules[name]
+        self.addCleanup(cleanup)
+        return root
+
+    def restore_dependent_packages(self, enable):
+        """Saves a snapshot with pkgx and pkgy, then disables them and
+        calls enable(root) to enable them again.
+        """
+        if is_running_gui():
+            self.skipTest("The registry snapshot is not used by the GUI")
+        conf = get_vistrails_configuration()
+        pm = get_package_manager()
+        reg = pm._registry
+        directory = tempfile.mkdtemp(prefix='vt_snapshot_')
+        self.addCleanup(shutil.rmtree, directory)
+        root = self.make_dependent_packages(directory)
+        pm.late_enable_package('pkgy')
+        pm.late_enable_package('pkgx')
+
+        old_conf = conf.dotVistrails, conf.registrySnapshot
+        old_snapshot = pm._registry_snapshot
+        conf.dotVistrails = directory
+        conf.registrySnapshot = True
+        try:
+            pm._registry_snapshot = None
+            pm.save_registry_snapshot()
+            self.assertTrue(
+                    pm._registry_snapshot['packages']
+                    ['org.vistrails.tests.pkgy']['lazy'])
+            pm.late_disable_package('pkgx')
+            pm.late_disable_package('pkgy')
+
+            enable(root)
+            self.assertTrue(pm.get_package('org.vistrails.tests.pkgx')
+                            .initialized())
+            self.assertTrue(pm.get_package('org.vistrails.tests.pkgy')
+                            .initialized())
+            mod_x = reg.get_descriptor_by_name('org.vistrails.tests.pkgx',
+                                               'ModX')
+            mod_y = reg.get_descriptor_by_name('org.vistrails.tests.pkgy',
+                                               'ModY')
+            self.assertIs(mod_x.base_descriptor, mod_y)
+            self.assertTrue(issubclass(mod_x.module, mod_y.module))
+        finally:
+            conf.dotVistrails, conf.registrySnapshot = old_conf
+            pm._registry_snapshot = old_snapshot
+
+    def test_changed_dependent(self):
+        """A changed package subclasses a module of a lazy package.
+        """
+        pm = get_package_manager()
+        def enable(root):
+            init = os.path.join(root, 'pkgx', 'init.py')
+            mtime = os.stat(init).st_mtime + 10
+            os.utime(init, (mtime, mtime))
+            pm.add_package('pkgy')
+            pm.add_package('pkgx')
+            pm.initialize_packages()
+        self.restore_dependent_packages(enable)
+
+    def test_late_enable_dependent(self):
+        """A package subclassing a module of a lazy package is enabled.
+        """
+        pm = get_package_manager()
+        def enable(root):
+            pm.add_package('pkgy')
+            pm.initialize_packages()
+            self.assertTrue(pm.get_package('org.vistrails.tests.pkgy')
+                            .is_lazy())
+            pm.late_enable_package('pkgx')
+        self.restore_dependent_packages(enable)
+
+
+class TestLoadPackagesOnDemand(unittest.TestCase):
+    def test_validate(self):
+        """Validating a pipeline loads the enabled packages it uses.
+        """
+        from vistrails.core.vistrail.controller import VistrailController
+        from vistrails.core.vistrail.module import Module
+        from vistrails.core.vistrail.pipeline import Pipeline
+
+        conf = get_vistrails_configuration()
+        pm = get_package_manager()
+        identifier = 'org.vistrails.vistrails.pythoncalc'
+        version = pm.get_package(identifier).version
+
+        # pythonCalc stays enabled in the configuration but is not loaded
+        pm.late_disable_package('pythonCalc')
+        pm._startup.set_package_to_enabled('pythonCalc')
+        old_conf = conf.loadPackagesOnDemand
+        conf.loadPackagesOnDemand = True
+        try:
+            self.assertFalse(pm.has_package(identifier))
+            pipeline = Pipeline()
+            pipeline.add_module(Module(id=0, name='PythonCalc',
+                                       package=identifier, version=version))
+            controller = VistrailController(auto_save=False)
+            controller.validate(pipeline)
+            self.assertTrue(pm.has_package(identifier))
+            self.assertTrue(pipeline.is_valid)
+        finally:
+            conf.loadPackagesOnDemand = old_conf
+            if not pm.has_package(identifier):
+                pm.late_enable_package('pythonCalc')
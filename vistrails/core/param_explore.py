@@ -42,6 +42,7 @@ from vistrails.core import debug
 from vistrails.core.vistrail.module_function import ModuleFunction
 from vistrails.core.vistrail.module_param import ModuleParam
 import copy
+import itertools
 
 import unittest
 
@@ -209,38 +210,78 @@ class ActionBasedParameterExploration(object):
         """
         results = []
         resultActions = []
-        
-        def exploreDimension(pipeline, performedActions, dim):
-            """ exploreDimension(pipeline: Pipeline, performedActions: [actions],
-                                 dim: int) -> None
-            Start applying actions to the pipeline at dimension
-            dim. 'pipeline' will not be modified in the function
-            
-            """
-            if dim<0:
-                results.append(pipeline)
-                resultActions.append(performedActions)
-                return
-            currentActions = actions[dim]
-            if len(currentActions)==0:
-                # Ignore empty dimension
-                exploreDimension(pipeline, performedActions, dim-1)
-                return
-            for actionSet in currentActions:
-                currentPipeline = copy.copy(pipeline)
-                currentPeformedActions = copy.copy(performedActions)
-                for action in actionSet:
-                    currentPipeline.perform_action(action)
-                    currentPeformedActions.append(action)
-                exploreDimension(currentPipeline, currentPeformedActions, dim-1)
-        
-        # perform pre_actions
+        for (pipeline, performedActions) in self.iter_explore(pipeline,
+                                                              actions,
+                                                              pre_actions):
+            results.append(pipeline)
+            resultActions.append(performedActions)
+        return (results, resultActions)
+
+    def count(self, actions):
+        """ count(actions: [action set]) -> int
+        Returns the number of pipelines explore() and iter_explore()
+        produce for actions
+
+        """
+        n = 1
+        for currentActions in actions:
+            n *= max(1, len(currentActions))
+        return n
+
+    def iter_explore(self, pipeline, actions, pre_actions=[]):
+        """ iter_explore(pipeline: Pipeline, actions: [action set],
+                         pre_actions: [action set])
+                -> iterator of (pipeline, actions)
+        Same as explore() but derives each interpolated pipeline only
+        when it is requested, in the same order. The pipelines of the
+        outer dimensions are kept and shared by all their inner
+        combinations, so only the actions of the dimensions that
+        changed since the previous pipeline are performed, and memory
+        does not grow with the number of combinations.
+
+        """
         currentPipeline = copy.copy(pipeline)
         for action in pre_actions:
             currentPipeline.perform_action(action)
-        
-        exploreDimension(currentPipeline, pre_actions, len(actions)-1)
-        return (results, resultActions)
+
+        # explore() applies the last dimension first, and it varies the
+        # slowest; empty dimensions are ignored
+        dims = [actions[dim] for dim in xrange(len(actions)-1, -1, -1)
+                if len(actions[dim]) > 0]
+        if not dims:
+            yield (currentPipeline, list(pre_actions))
+            return
+
+        # levels[i] is the pipeline with the steps of the first i
+        # dimensions applied
+        levels = [currentPipeline] + [None] * len(dims)
+        previous = None
+        for steps in itertools.product(*[xrange(len(d)) for d in dims]):
+            changed = 0
+            if previous is not None:
+                while steps[changed] == previous[changed]:
+                    changed += 1
+            for i in xrange(changed, len(dims)):
+                levels[i+1] = copy.copy(levels[i])
+                for action in dims[i][steps[i]]:
+                    levels[i+1].perform_action(action)
+            previous = steps
+            performedActions = list(pre_actions)
+            for i in xrange(len(dims)):
+                performedActions.extend(dims[i][steps[i]])
+            yield (levels[-1], performedActions)
+
+def _pipelinePosition(pId, sheetCount, rowCount, colCount):
+    """ _pipelinePosition(pId: int, sheetCount: int, rowCount: int,
+                          colCount: int) -> (int, int, int)
+    Returns the (row, col, sheet) position of the pId-th pipeline of a
+    parameter exploration
+
+    """
+    col = pId % colCount
+    row = (pId // colCount) % rowCount
+    sheet = (pId // (colCount*rowCount)) % sheetCount
+    return (row, col, sheet)
 
 def _pipelinePositions(sheetCount, rowCount, colCount,
                        pipelines):
@@ -254,13 +295,8 @@ def _pipelinePositions(sheetCount, rowCount, colCount,
 
     """
 
-    pipelinePositions = []
-    for pId in xrange(len(pipelines)):
-        col = pId % colCount
-        row = (pId // colCount) % rowCount
-        sheet = (pId // (colCount*rowCount)) % sheetCount
-        pipelinePositions.append((row, col, sheet))
-    return pipelinePositions
+    return [_pipelinePosition(pId, sheetCount, rowCount, colCount)
+            for pId in xrange(len(pipelines))]
 
 
 ################################################################################
@@ -283,5 +319,36 @@ class TestParameterExploration(unittest.TestCase):
                           (5, 5.0, 'two'),
                           (10, 10.0, 'three')])
 
+    def testIterExplore(self):
+        calls = []
+        class FakePipeline(object):
+            def __init__(self, performed=()):
+                self.performed = list(performed)
+            def __copy__(self):
+                return FakePipeline(self.performed)
+            def perform_action(self, action):
+                calls.append(action)
+                self.performed.append(action)
+
+        actions = [[('a1',), ('a2',), ('a3',)],
+                   [],
+                   [('c1', 'd1'), ('c2', 'd2')]]
+        expected = [['pre'] + list(c) + list(a)
+                    for c in actions[2] for a in actions[0]]
+        explorer = ActionBasedParameterExploration()
+        self.assertEqual(explorer.count(actions), 6)
+        pipelines, performedActions = explorer.explore(FakePipeline(),
+                                                       actions, ['pre'])
+        self.assertEqual([p.performed for p in pipelines], expected)
+        self.assertEqual(performedActions, expected)
+        # only the first pipeline is derived when it is requested
+        del calls[:]
+        explored = explorer.iter_explore(FakePipeline(), actions, ['pre'])
+        self.assertEqual(explored.next()[0].performed, expected[0])
+        self.assertEqual(calls, expected[0])
+        # the next one reuses the pipeline of the outer dimension
+        self.assertEqual(explored.next()[0].performed, expected[1])
+        self.assertEqual(calls, expected[0] + ['a2'])
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,489 @@
+###############################################################################
+##
+## Copyright (C) 2014-2015, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+"""Runs a stored parameter exploration without the GUI.
+
+The combinations of the exploration (its cells) are executed by a pool of
+worker processes. Each worker loads the vistrail once and keeps its
+CachedInterpreter between cells. Cells that only differ in the dimension
+changing the fewest modules are sent to the same worker, so the modules
+upstream of that dimension are computed once for all of them.
+
+When an output directory is given, every executed cell is recorded in a
+progress file there along with its execution time and errors. Running the
+same exploration again with that directory only executes the cells that
+are missing, so an interrupted batch can be resumed.
+"""
+
+from __future__ import division
+
+import copy
+import itertools
+import json
+import multiprocessing
+import os
+import time
+import unittest
+
+from vistrails.core import debug
+from vistrails.core.configuration import get_vistrails_configuration
+from vistrails.core.db.io import load_vistrail
+import vistrails.core.interpreter.default
+
+
+__all__ = ['find_paramexp', 'ExplorationWorker', 'run_exploration']
+
+
+PROGRESS_FILENAME = 'exploration.json'
+
+
+def find_paramexp(vistrail, pe_id):
+    """Returns the parameter exploration of a version id, or a named one.
+    """
+    try:
+        pe = vistrail.get_paramexp(int(pe_id))
+    except ValueError:
+        pe = vistrail.get_named_paramexp(pe_id)
+    if pe is None:
+        raise ValueError("No parameter exploration %r" % (pe_id,))
+    return pe
+
+
+class ExplorationWorker(object):
+    """Derives and executes the cells of a parameter exploration.
+
+    A cell is a tuple with one step index per dimension of the exploration.
+    """
+    def __init__(self, locator, pe_id, output_dir=None, extra_info=None,
+                 reason="Batch Parameter Exploration"):
+        from vistrails.core.vistrail.controller import VistrailController
+
+        (vistrail, abstractions, thumbnails, mashups) = load_vistrail(locator)
+        controller = VistrailController(vistrail, locator, abstractions,
+                                        thumbnails, mashups, auto_save=False)
+        self.locator = locator
+        self.name = locator.short_filename or 'exploration'
+        self.output_dir = output_dir
+        self.extra_info = extra_info or {}
+        self.reason = reason
+        self.pe = find_paramexp(vistrail, pe_id)
+        controller.change_selected_version(self.pe.action_id)
+        collected = self.pe.collectParameterActions(
+                controller.current_pipeline)
+        if not collected:
+            raise ValueError("Parameter exploration %r has no values" %
+                             (pe_id,))
+        self.actions, self.pre_actions, vistrail_vars = collected
+        self.dims = [max(1, len(actions)) for actions in self.actions]
+
+        self.base_pipeline = copy.copy(controller.current_pipeline)
+        for action in self.pre_actions:
+            self.base_pipeline.perform_action(action)
+
+        # vistrail variables explored by the exploration are replaced by
+        # their modules
+        self.vistrail_variables = dict(
+                (v.uuid, v) for v in controller.get_vistrail_variables()
+                if v.uuid not in vistrail_vars)
+
+        explored = [dim for dim in xrange(len(self.actions))
+                    if self.actions[dim]]
+        if explored:
+            self.vary_dim = min(explored,
+                                key=lambda d: len(self.affected_modules(d)))
+        else:
+            self.vary_dim = 0
+        self._partial = None
+
+    def get_header(self):
+        """Describes the exploration, to check a progress file against it.
+        """
+        return {'vistrail': self.name,
+                'exploration': self.pe.id,
+                'version': self.pe.action_id,
+                'dims': self.dims}
+
+    def cells(self):
+        """Returns all the cells, in the order the GUI executes them.
+        """
+        steps = [xrange(n) for n in reversed(self.dims)]
+        return [tuple(reversed(cell)) for cell in itertools.product(*steps)]
+
+    def affected_modules(self, dim):
+        """Returns the ids of the modules whose signature depends on dim.
+
+        These are the modules whose parameters the dimension changes and
+        everything downstream of them.
+        """
+        function_modules = {}
+        for module in self.base_pipeline.modules.itervalues():
+            for function in module.functions:
+                function_modules[function.real_id] = module.id
+        changed = set()
+        for step in self.actions[dim]:
+            for action in step:
+                for op in action.operations:
+                    if op.parentObjType == 'function' and \
+                            op.parentObjId in function_modules:
+                        changed.add(function_modules[op.parentObjId])
+        affected = set(changed)
+        for module_id in changed:
+            affected.update(self.base_pipeline.graph.bfs(module_id))
+        return affected
+
+    def group_cells(self, cells, chunks=1):
+        """Splits cells into lists that only differ in vary_dim.
+
+        Groups are split further when there are fewer than chunks of them,
+        so that every worker gets something to do.
+        """
+        groups = []
+        by_key = {}
+        for cell in cells:
+            key = cell[:self.vary_dim] + cell[self.vary_dim+1:]
+            try:
+                by_key[key].append(cell)
+            except KeyError:
+                by_key[key] = [cell]
+                groups.append(by_key[key])
+        if groups and len(groups) < chunks:
+            parts = -(-chunks // len(groups))
+            split = []
+            for group in groups:
+                size = -(-len(group) // parts)
+                split.extend(group[i:i+size]
+                             for i in xrange(0, len(group), size))
+            groups = split
+        return groups
+
+    def get_pipeline(self, cell):
+        """Returns the pipeline of a cell and the actions deriving it.
+
+        The pipeline with every dimension but vary_dim applied is kept, as
+        it is shared by consecutive cells of a group.
+        """
+        key = cell[:self.vary_dim] + cell[self.vary_dim+1:]
+        if self._partial is None or self._partial[0] != key:
+            pipeline = copy.copy(self.base_pipeline)
+            for dim in xrange(len(self.actions)-1, -1, -1):
+                if dim != self.vary_dim and self.actions[dim]:
+                    for action in self.actions[dim][cell[dim]]:
+                        pipeline.perform_action(action)
+            self._partial = (key, pipeline)
+        pipeline = copy.copy(self._partial[1])
+        if self.actions[self.vary_dim]:
+            for action in self.actions[self.vary_dim][cell[self.vary_dim]]:
+                pipeline.perform_action(action)
+
+        performed_actions = list(self.pre_actions)
+        for dim in xrange(len(self.actions)-1, -1, -1):
+            if self.actions[dim]:
+                performed_actions.extend(self.actions[dim][cell[dim]])
+        return pipeline, performed_actions
+
+    def run_cell(self, cell):
+        """Executes a cell and returns its record.
+
+        The record is a dict with the 'cell', the 'name' used for its
+        output files, its execution 'time' in seconds and its 'errors' as
+        messages keyed by module id.
+        """
+        name = '%s_%s' % (self.name, '_'.join('%d' % s for s in cell))
+        extra_info = dict(self.extra_info)
+        extra_info['nameDumpCells'] = name
+        if self.output_dir is not None:
+            extra_info['pathDumpCells'] = self.output_dir
+        errors = {}
+        start = time.time()
+        try:
+            pipeline, performed_actions = self.get_pipeline(cell)
+            kwargs = {'locator': self.locator,
+                      'current_version': self.pe.action_id,
+                      'reason': '%s %s' % (self.reason, name),
+                      'actions': performed_actions,
+                      'extra_info': extra_info}
+            if self.vistrail_variables:
+                kwargs['vistrail_variables'] = self.vistrail_variables.get
+            interpreter = \
+                vistrails.core.interpreter.default.get_default_interpreter()
+            result = interpreter.execute(pipeline, **kwargs)
+            for module_id, error in result.errors.iteritems():
+                errors['%s' % module_id] = debug.format_exception(error)
+        except Exception, e:
+            errors['pipeline'] = debug.format_exception(e)
+        return {'cell': list(cell),
+                'name': name,
+                'time': time.time() - start,
+                'errors': errors}
+
+
+_worker = None
+
+
+def _init_worker(*args):
+    """Initializes VisTrails and loads the exploration in a worker process.
+
+    When the process is forked, the application was copied from the parent
+    and doesn't need to be initialized again.
+    """
+    global _worker
+
+    import vistrails.core.application
+
+    try:
+        app = vistrails.core.application.get_vistrails_application()
+        if app is None:
+            vistrails.core.application.init({'spawned': True}, args=[])
+        _worker = ExplorationWorker(*args)
+    except Exception, e:
+        # Raising here would make the pool restart the worker forever
+        _worker = e
+
+
+def _run_cells(cells):
+    if isinstance(_worker, Exception):
+        raise _worker
+    return [_worker.run_cell(tuple(cell)) for cell in cells]
+
+
+def read_progress(filename, header):
+    """Returns the records in a progress file, keyed by cell.
+    """
+    records = {}
+    if not os.path.exists(filename):
+        return records
+    with open(filename, 'rb') as fp:
+        lines = iter(fp)
+        try:
+            file_header = json.loads(next(lines))
+        except (StopIteration, ValueError):
+            return records
+        if file_header != header:
+            raise ValueError("%s was written by a different parameter "
+                             "exploration" % filename)
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Line was cut short when the batch was interrupted
+                continue
+            records[tuple(record['cell'])] = record
+    return records
+
+
+def run_exploration(locator, pe_id, output_dir=None, workers=None,
+                    extra_info=None, reason="Batch Parameter Exploration"):
+    """run_exploration(locator: Locator, pe_id: str/int,
+                       output_dir: str, workers: int,
+                       extra_info: dict, reason: str) -> list of dict
+    Runs the parameter exploration pe_id (a version id or a name) of the
+    vistrail at locator, and returns the records of all its cells in
+    execution order (see ExplorationWorker.run_cell()).
+
+    workers is the number of worker processes, which defaults to the
+    'parameterExplorationWorkers' setting; with 0 or 1, the cells are
+    executed in this process.
+
+    """
+    if workers is None:
+        conf = get_vistrails_configuration()
+        workers = getattr(conf, 'parameterExplorationWorkers', 0) or 0
+    explorer = ExplorationWorker(locator, pe_id, output_dir, extra_info,
+                                 reason)
+    all_cells = explorer.cells()
+
+    records = {}
+    progress = None
+    if output_dir is not None:
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        filename = os.path.join(output_dir, PROGRESS_FILENAME)
+        records = read_progress(filename, explorer.get_header())
+        progress = open(filename, 'ab')
+        if not records:
+            progress.seek(0)
+            progress.truncate()
+            progress.write(json.dumps(explorer.get_header()) + '\n')
+
+    def add_record(record):
+        records[tuple(record['cell'])] = record
+        if progress is not None:
+            progress.write(json.dumps(record) + '\n')
+            progress.flush()
+
+    try:
+        cells = [cell for cell in all_cells if cell not in records]
+        if workers <= 1 or len(cells) <= 1:
+            for cell in cells:
+                add_record(explorer.run_cell(cell))
+        else:
+            groups = explorer.group_cells(cells, workers)
+            pool = multiprocessing.Pool(min(workers, len(groups)),
+                                        initializer=_init_worker,
+                                        initargs=(locator, pe_id,
+                                                  output_dir, extra_info,
+                                                  reason))
+            try:
+                for group_records in pool.imap_unordered(_run_cells, groups):
+                    for record in group_records:
+                        add_record(record)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+    finally:
+        if progress is not None:
+            progress.close()
+    return [records[cell] for cell in all_cells]
+
+
+################################################################################
+# Testing
+
+
+class TestRunExploration(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        import datetime
+        import tempfile
+        import urllib
+
+        from vistrails.core.db.locator import XMLFileLocator
+        from vistrails.core.paramexplore.function import PEFunction
+        from vistrails.core.paramexplore.param import PEParam
+        from vistrails.core.paramexplore.paramexplore import \
+            ParameterExploration
+        import vistrails.core.system
+        from vistrails.core.vistrail.controller import VistrailController
+
+        # One module computes v1 + v2, which the other one checks is 3.0
+        locator = XMLFileLocator(
+                vistrails.core.system.vistrails_root_directory() +
+                '/tests/resources/pythonsource.xml')
+        (vistrail, abstractions, thumbnails, mashups) = load_vistrail(locator)
+        controller = VistrailController(vistrail, locator, abstractions,
+                                        thumbnails, mashups, auto_save=False)
+        controller.change_selected_version(
+                vistrail.get_version_number('testPortsAndFail'))
+        # Modules get new ids when the workflow is upgraded
+        controller.flush_delayed_actions()
+        modules = controller.current_pipeline.modules.values()
+        sum_module, = [m for m in modules
+                       if any(f.name == 'v1' for f in m.functions)]
+        check_module, = [m for m in modules if m is not sum_module]
+        check = 'if v != 3.0:\n    fail("assert failed")\n'
+        functions = [
+            PEFunction(id=1, module_id=sum_module.id, port_name='v1',
+                       is_alias=0,
+                       parameters=[PEParam(id=1, pos=0, dimension=0,
+                                           interpolator='List',
+                                           value='[1.0, 2.0]')]),
+            PEFunction(id=2, module_id=check_module.id, port_name='source',
+                       is_alias=0,
+                       parameters=[PEParam(id=2, pos=0, dimension=1,
+                                           interpolator='List',
+                                           value=repr([urllib.quote(check),
+                                                       'pass']))])]
+        vistrail.add_paramexp(ParameterExploration(
+                action_id=controller.current_version,
+                name='batch', dims='[2, 2, 1, 1]', layout='{}',
+                user='test', date=datetime.datetime(2015, 1, 1),
+                functions=functions))
+        cls.check_module_id = '%d' % check_module.id
+
+        cls.directory = tempfile.mkdtemp(prefix='vt_pe_')
+        cls.locator = XMLFileLocator(os.path.join(cls.directory,
+                                                  'batch.xml'))
+        cls.locator.save(vistrail)
+
+    @classmethod
+    def tearDownClass(cls):
+        import shutil
+
+        shutil.rmtree(cls.directory)
+
+    def check_errors(self, records):
+        self.assertEqual([tuple(r['cell']) for r in records],
+                         [(0, 0, 0, 0), (1, 0, 0, 0),
+                          (0, 1, 0, 0), (1, 1, 0, 0)])
+        self.assertEqual([sorted(r['errors']) for r in records],
+                         [[], [self.check_module_id], [], []])
+
+    def test_groups(self):
+        worker = ExplorationWorker(self.locator, 'batch')
+        # The checking module is downstream of the summing one
+        self.assertEqual(worker.vary_dim, 1)
+        cells = worker.cells()
+        self.assertEqual(worker.group_cells(cells),
+                         [[(0, 0, 0, 0), (0, 1, 0, 0)],
+                          [(1, 0, 0, 0), (1, 1, 0, 0)]])
+        self.assertEqual(len(worker.group_cells(cells, 4)), 4)
+
+    def test_resume(self):
+        output_dir = os.path.join(self.directory, 'resume')
+        records = run_exploration(self.locator, 'batch', output_dir,
+                                  workers=0)
+        self.check_errors(records)
+
+        # Forget the last cell, as if the batch had been interrupted
+        filename = os.path.join(output_dir, PROGRESS_FILENAME)
+        with open(filename, 'rb') as fp:
+            lines = fp.readlines()
+        with open(filename, 'wb') as fp:
+            fp.writelines(lines[:-1])
+        resumed = run_exploration(self.locator, 'batch', output_dir,
+                                  workers=0)
+        self.check_errors(resumed)
+        last = tuple(json.loads(lines[-1])['cell'])
+        for record, old_record in itertools.izip(resumed, records):
+            if tuple(record['cell']) == last:
+                self.assertNotEqual(record['time'], old_record['time'])
+            else:
+                self.assertEqual(record, old_record)
+
+    def test_parallel(self):
+        output_dir = os.path.join(self.directory, 'parallel')
+        records = run_exploration(self.locator, 'batch', output_dir,
+                                  workers=2)
+        self.check_errors(records)
+        self.assertEqual(len(read_progress(
+                os.path.join(output_dir, PROGRESS_FILENAME),
+                ExplorationWorker(self.locator, 'batch').get_header())), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
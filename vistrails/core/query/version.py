@@ -37,6 +37,8 @@
 # notes in plain text, not html, should be fix later
 from __future__ import division
 
+import bisect
+from collections import OrderedDict
 import datetime
 import re
 import time
@@ -51,10 +53,276 @@ class SearchParseError(Exception):
     def __init__(self, *args, **kwargs):
         Exception.__init__(self, *args, **kwargs)
 
+class VersionIndex(object):
+    """Inverted index of a vistrail's versions used by the search
+    statements.
+
+    Maps users, dates, tags, descriptions, notes, the names and packages
+    of the modules in each version's pipeline and the pairs of module
+    names its connections link to action ids,
+    so that a statement only tests the distinct values once instead of
+    inspecting every action.  The index is built the first time it is
+    needed (see Vistrail.get_search_index) and the vistrail keeps it up
+    to date when actions and annotations are added.
+
+    """
+
+    module_types = set(['module', 'group', 'abstraction'])
+
+    # number of per-version pipeline states kept to update the module
+    # maps when an action is added
+    state_cache_size = 16
+
+    def __init__(self, vistrail):
+        self.vistrail = vistrail
+        self.build()
+
+    def build(self):
+        self.generation = getattr(self, 'generation', 0) + 1
+        self.users = {}
+        self.dates = []
+        self.tags = {}
+        self.notes = {}
+        self.descriptions = {}
+        self.action_descriptions = {}
+        self.modules = {}
+        self.packages = {}
+        self.edges = {}
+        self.module_info = {}
+        self.states = OrderedDict()
+        vistrail = self.vistrail
+
+        children = {}
+        for action in vistrail.actions:
+            self._add_action_info(action)
+            children.setdefault(action.prevId, []).append(action.id)
+        self.dates.sort()
+        self._add_annotations()
+
+        # walk the version tree, computing the modules and connections of
+        # each pipeline from its parent's
+        cached = set(sorted(vistrail.actionMap)[-self.state_cache_size:])
+        stack = [(child, {}) for child in children.get(0, [])]
+        while stack:
+            version, state = stack.pop()
+            state = self._apply_ops(vistrail.actionMap[version], dict(state))
+            self._add_state(version, state)
+            if version in cached:
+                self._cache_state(version, state)
+            stack.extend((child, state)
+                         for child in children.get(version, []))
+        self._update_counts()
+
+    def is_stale(self):
+        """Returns True if the vistrail was modified without going
+        through the methods that update the index."""
+        return (self.n_actions != len(self.vistrail.actionMap) or
+                self.n_annotations != len(self.vistrail.action_annotations))
+
+    def add_action(self, action):
+        """Indexes a new action."""
+        self.generation += 1
+        self._add_action_info(action)
+        state = self._apply_ops(action, self._get_state(action.prevId))
+        self._add_state(action.id, state)
+        self._cache_state(action.id, state)
+        self._update_counts()
+
+    def update_annotation(self, action_id, key):
+        """Reindexes the tag or notes of an action."""
+        from vistrails.core.vistrail.vistrail import Vistrail
+        self.generation += 1
+        value = self.vistrail.get_action_annotation(action_id, key)
+        if value is not None:
+            value = value.value
+        if key == Vistrail.TAG_ANNOTATION:
+            self._set_value(self.tags, action_id, value)
+        elif key == Vistrail.NOTES_ANNOTATION:
+            if value is not None:
+                value = extract_text(value)
+            self._set_value(self.notes, action_id, value)
+        self._update_counts()
+
+    def update_description(self, action_id):
+        """Reindexes the description of an action."""
+        self.generation += 1
+        old = self.action_descriptions.pop(action_id, None)
+        if old is not None:
+            self.descriptions[old].discard(action_id)
+            if not self.descriptions[old]:
+                del self.descriptions[old]
+        self._add_description(action_id)
+
+    def match_values(self, value_map, matches):
+        """Returns the set of action ids mapped from the keys of
+        value_map that satisfy matches."""
+        result = set()
+        for value, action_ids in value_map.iteritems():
+            if matches(value):
+                result.update(action_ids)
+        return result
+
+    def match_single_values(self, value_map, matches):
+        """Same as match_values for a map from action id to value."""
+        return set(action_id for action_id, value in value_map.iteritems()
+                   if matches(value))
+
+    def versions_before(self, t):
+        i = bisect.bisect_right(self.dates, (t, float('inf')))
+        return set(action_id for _, action_id in self.dates[:i])
+
+    def versions_after(self, t):
+        i = bisect.bisect_left(self.dates, (t, float('-inf')))
+        return set(action_id for _, action_id in self.dates[i:])
+
+    @staticmethod
+    def _set_value(value_map, action_id, value):
+        if value is None:
+            value_map.pop(action_id, None)
+        else:
+            value_map[action_id] = value
+
+    def _add_action_info(self, action):
+        if action.user:
+            self.users.setdefault(action.user, set()).add(action.id)
+        try:
+            t = time.mktime(time_strptime(action.date, "%d %b %Y %H:%M:%S"))
+        except (ValueError, OverflowError):
+            pass
+        else:
+            bisect.insort(self.dates, (t, action.id))
+        self._add_description(action.id)
+
+    def _add_description(self, action_id):
+        description = self.vistrail.get_description(action_id)
+        self.action_descriptions[action_id] = description
+        self.descriptions.setdefault(description, set()).add(action_id)
+
+    def _add_annotations(self):
+        from vistrails.core.vistrail.vistrail import Vistrail
+        for annotation in self.vistrail.action_annotations:
+            if annotation.key == Vistrail.TAG_ANNOTATION:
+                self.tags[annotation.action_id] = annotation.value
+            elif annotation.key == Vistrail.NOTES_ANNOTATION:
+                self.notes[annotation.action_id] = \
+                    extract_text(annotation.value)
+
+    def _update_counts(self):
+        self.n_actions = len(self.vistrail.actionMap)
+        self.n_annotations = len(self.vistrail.action_annotations)
+
+    def _apply_ops(self, action, state):
+        """Updates state with the module and connection operations of
+        action.  state maps module ids to (name, package) and
+        ('connection', id) to the ids of the connected modules."""
+        for op in action.operations:
+            if op.what == 'connection':
+                if op.vtType == 'add':
+                    state[('connection', op.objectId)] = \
+                        self._get_connection_info(op.data)
+                elif op.vtType == 'delete':
+                    state.pop(('connection', op.objectId), None)
+                elif op.vtType == 'change':
+                    state.pop(('connection', op.oldObjId), None)
+                    state[('connection', op.newObjId)] = \
+                        self._get_connection_info(op.data)
+                continue
+            if op.what == 'port' and op.parentObjType == 'connection':
+                # older vistrails add the ports of a connection separately
+                key = ('connection', op.parentObjId)
+                if key in state and op.vtType in ('add', 'change'):
+                    source, destination = state[key]
+                    if op.data.type == 'source':
+                        source = op.data.moduleId
+                    elif op.data.type == 'destination':
+                        destination = op.data.moduleId
+                    state[key] = (source, destination)
+                continue
+            if op.what not in self.module_types:
+                continue
+            if op.vtType == 'add':
+                state[op.objectId] = self._get_module_info(op.objectId,
+                                                           op.data)
+            elif op.vtType == 'delete':
+                state.pop(op.objectId, None)
+            elif op.vtType == 'change':
+                state.pop(op.oldObjId, None)
+                state[op.newObjId] = self._get_module_info(op.newObjId,
+                                                           op.data)
+        return state
+
+    @staticmethod
+    def _get_connection_info(connection):
+        source = connection.source
+        destination = connection.destination
+        return (source.moduleId if source is not None else None,
+                destination.moduleId if destination is not None else None)
+
+    def _get_module_info(self, module_id, module):
+        # module ids are never reused, so the names can be shared by
+        # all states
+        if module_id not in self.module_info:
+            self.module_info[module_id] = (module.name, module.package)
+        return self.module_info[module_id]
+
+    def _add_state(self, version, state):
+        modules = set()
+        edges = set()
+        for key, value in state.iteritems():
+            if isinstance(key, tuple):
+                source = self.module_info.get(value[0])
+                destination = self.module_info.get(value[1])
+                if source is not None and destination is not None:
+                    edges.add((source[0], destination[0]))
+            else:
+                modules.add(value)
+        for name, package in modules:
+            self.modules.setdefault(name, set()).add(version)
+            self.packages.setdefault(package, set()).add(version)
+        for edge in edges:
+            self.edges.setdefault(edge, set()).add(version)
+
+    def _cache_state(self, version, state):
+        self.states[version] = state
+        while len(self.states) > self.state_cache_size:
+            self.states.popitem(last=False)
+
+    def _get_state(self, version):
+        """Returns a copy of the pipeline state of version, replaying the
+        actions from the closest cached ancestor."""
+        path = []
+        while version != 0 and version not in self.states:
+            path.append(version)
+            version = self.vistrail.actionMap[version].prevId
+        state = dict(self.states.get(version, {}))
+        for version in reversed(path):
+            self._apply_ops(self.vistrail.actionMap[version], state)
+        return state
+
 class SearchStmt(object):
     def match(self, vistrail, action):
         return True
 
+    def match_index(self, index):
+        """match_index(index: VersionIndex) -> set of action ids
+
+        Like match(), matches every version.
+
+        """
+        return set(index.vistrail.actionMap)
+
+    def indexed_match(self, vistrail, action):
+        """Matches action using the vistrail's search index.  The
+        versions matched by this statement are computed once per index
+        update."""
+        index = vistrail.get_search_index()
+        cache = getattr(self, '_index_cache', None)
+        if cache is None or cache[0] is not index or \
+                cache[1] != index.generation:
+            cache = (index, index.generation, self.match_index(index))
+            self._index_cache = cache
+        return action.id in cache[2]
+
     def matchModule(self, v, m):
         return True
 
@@ -394,17 +662,17 @@ class TimeSearchStmt(SearchStmt):
         
 class BeforeSearchStmt(TimeSearchStmt):
     def match(self, vistrail, action):
-        if not action.date:
-            return False
-        t = time.mktime(time_strptime(action.date, "%d %b %Y %H:%M:%S"))
-        return t <= self.date
+        return self.indexed_match(vistrail, action)
+
+    def match_index(self, index):
+        return index.versions_before(self.date)
 
 class AfterSearchStmt(TimeSearchStmt):
     def match(self, vistrail, action):
-        if not action.date:
-            return False
-        t = time.mktime(time_strptime(action.date, "%d %b %Y %H:%M:%S"))
-        return t >= self.date
+        return self.indexed_match(vistrail, action)
+
+    def match_index(self, index):
+        return index.versions_after(self.date)
 
 class RegexEnabledSearchStmt(SearchStmt):
     def __init__(self, content, use_regex):
@@ -421,34 +689,41 @@ class RegexEnabledSearchStmt(SearchStmt):
 
 class UserSearchStmt(RegexEnabledSearchStmt):
     def match(self, vistrail, action):
-        if not action.user:
-            return False
-        return self._content_matches(action.user)
+        return self.indexed_match(vistrail, action)
+
+    def match_index(self, index):
+        return index.match_values(index.users, self._content_matches)
 
 class NotesSearchStmt(RegexEnabledSearchStmt):
     def match(self, vistrail, action):
-        if vistrail.has_notes(action.id):
-            plainNotes = extract_text(vistrail.get_notes(action.id))
-            return self._content_matches(plainNotes)
-        return False
+        return self.indexed_match(vistrail, action)
+
+    def match_index(self, index):
+        return index.match_single_values(index.notes, self._content_matches)
 
 class NameSearchStmt(RegexEnabledSearchStmt):
     def match(self, vistrail, action):
-        m = 0
-        tm = vistrail.get_tagMap()
-        if action.timestep in tm:
-            m = self._content_matches(tm[action.timestep])
-        if bool(m) == False:
-            m = self._content_matches(vistrail.get_description(action.timestep))
-        return bool(m)
+        return self.indexed_match(vistrail, action)
+
+    def match_index(self, index):
+        result = index.match_single_values(index.tags, self._content_matches)
+        result.update(index.match_values(index.descriptions,
+                                         self._content_matches))
+        return result
 
 class ModuleSearchStmt(RegexEnabledSearchStmt):
     def match(self, vistrail, action):
-        pipeline = vistrail.getPipeline(action.timestep)
-        for module in pipeline.modules.itervalues():
-            if self._content_matches(module.name):
-                return True
-        return False
+        return self.indexed_match(vistrail, action)
+
+    def match_index(self, index):
+        return index.match_values(index.modules, self._content_matches)
+
+class PackageSearchStmt(RegexEnabledSearchStmt):
+    def match(self, vistrail, action):
+        return self.indexed_match(vistrail, action)
+
+    def match_index(self, index):
+        return index.match_values(index.packages, self._content_matches)
 
 class AndSearchStmt(SearchStmt):
     def __init__(self, lst):
@@ -472,7 +747,7 @@ class NotSearchStmt(SearchStmt):
     def __init__(self, stmt):
         self.stmt = stmt
     def match(self, vistrail, action):
-        return not self.stmt.match(action)
+        return not self.stmt.match(vistrail, action)
 
 class TrueSearch(SearchStmt):
     def __init__(self):
@@ -547,6 +822,17 @@ class SearchCompiler(object):
             lst.append(ModuleSearchStmt(tok, use_regex))
             tokStream = tokStream[1:]
         return (AndSearchStmt(lst), [])
+    def parsePackage(self, tokStream, use_regex):
+        if len(tokStream) == 0:
+            raise SearchParseError('Expected token, got end of search')
+        lst = []
+        while len(tokStream):
+            tok = tokStream[0]
+            if ':' in tok:
+                return (AndSearchStmt(lst), tokStream)
+            lst.append(PackageSearchStmt(tok, use_regex))
+            tokStream = tokStream[1:]
+        return (AndSearchStmt(lst), [])
     def parseBefore(self, tokStream, use_regex):
         old_tokstream = tokStream
         try:
@@ -604,6 +890,7 @@ class SearchCompiler(object):
                 'after': parseAfter,
                 'name': parseName,
                 'module': parseModule,
+                'package': parsePackage,
                 'any': parseAny}
                 
             
@@ -702,6 +989,45 @@ class TestSearch(unittest.TestCase):
         # Test compiling these searches
         SearchCompiler('before')
         SearchCompiler('after')
+    def test_index_updates(self):
+        from vistrails.core.system import get_vistrails_basic_pkg_id
+        from vistrails.core.vistrail.controller import VistrailController
+        from vistrails.core.vistrail.vistrail import Vistrail
+
+        basic_pkg = get_vistrails_basic_pkg_id()
+        controller = VistrailController(Vistrail(), auto_save=False)
+        vistrail = controller.vistrail
+        def matches(search_str):
+            stmt = SearchCompiler(search_str, True).searchStmt
+            return set(a.id for a in vistrail.actions
+                       if stmt.match(vistrail, a))
+
+        m1 = controller.add_module(basic_pkg, 'String')
+        v1 = controller.current_version
+        self.assertEqual(matches('module:Str'), set([v1]))
+        index = vistrail.search_index
+
+        controller.add_module(basic_pkg, 'Integer')
+        v2 = controller.current_version
+        controller.delete_module(m1.id)
+        v3 = controller.current_version
+        vistrail.set_tag(v2, 'both modules')
+        vistrail.set_notes(v3, 'only an integer left')
+        self.assertEqual(matches('module:Str'), set([v1, v2]))
+        self.assertEqual(matches('module:Integer'), set([v2, v3]))
+        self.assertEqual(matches('package:%s' % basic_pkg),
+                         set([v1, v2, v3]))
+        self.assertEqual(matches('name:both'), set([v2]))
+        self.assertEqual(matches('notes:only'), set([v3]))
+        self.assertEqual(SearchStmt().match_index(index),
+                         set(vistrail.actionMap))
+
+        # updated in place, and in sync with a new index
+        self.assertIs(vistrail.search_index, index)
+        new_index = VersionIndex(vistrail)
+        for attr in ['users', 'dates', 'tags', 'notes', 'descriptions',
+                     'modules', 'packages', 'edges']:
+            self.assertEqual(getattr(index, attr), getattr(new_index, attr))
 
 if __name__ == '__main__':
     unittest.main()
@@ -37,9 +37,11 @@ from __future__ import division
 
 from vistrails.core import query
 from vistrails.core.modules.module_registry import get_module_registry
+from vistrails.core.vistrail.pipeline import Pipeline
 from vistrails.core.utils import append_to_dict_of_lists
 import copy
 import re
+import unittest
 
 ################################################################################
 
@@ -87,16 +89,131 @@ class VisualQuery(query.Query):
             target_ids = nextTargetIds
             template_ids = nextTemplateIds
 
-    def run(self, vistrail, name):
+    def source_requirements(self, source_id):
+        """source_requirements(source_id: int) -> (set, list)
+
+        Returns what a pipeline must contain for heuristicDAGIsomorphism
+        to match the query starting at source_id: the names of the
+        modules it visits, and for each module below the source, its
+        name with the names of the query modules one level up.  The
+        heuristic only looks for a module among the children of the
+        modules it matched on the previous level, which all have one of
+        those names.
+
+        """
+        template = self.queryPipeline
+        names = set()
+        edges = []
+        level = set([source_id])
+        while level:
+            level_names = frozenset(template.modules[i].name for i in level)
+            names.update(level_names)
+            next_level = set(moduleId
+                             for i in level
+                             for (moduleId, edgeId) in
+                             template.graph.edges_from(i))
+            for i in next_level:
+                edges.append((level_names, template.modules[i].name))
+            level = next_level
+        return (names, edges)
+
+    def prune_versions(self, vistrail, versions):
+        """prune_versions(vistrail: Vistrail, versions: list) -> list
+
+        Returns the versions whose pipelines may match the query,
+        using the module names and connections recorded in the
+        vistrail's search index so that most pipelines are never
+        materialized.
+
+        """
+        index = vistrail.get_search_index()
+        requirements = [(self.queryPipeline.modules[s].name,
+                         self.source_requirements(s))
+                        for s in self.queryPipeline.graph.sources()]
+
+        def satisfies(version, requirement):
+            names, edges = requirement
+            for name in names:
+                if version not in index.modules.get(name, ()):
+                    return False
+            for sources, name in edges:
+                if not any(version in index.edges.get((source, name), ())
+                           for source in sources):
+                    return False
+            return True
+
         result = []
-        self.tupleLength = 2
-        for version in self.versions_to_check:
-            p = vistrail.getPipeline(version)
+        for version in versions:
+            # run() skips the sources that are not in the pipeline, but
+            # the last one must match and no source may fail
+            for i, (name, requirement) in enumerate(requirements):
+                if (i + 1 < len(requirements) and
+                        version not in index.modules.get(name, ())):
+                    continue
+                if not satisfies(version, requirement):
+                    break
+            else:
+                result.append(version)
+        return result
+
+    def iter_pipelines(self, vistrail, versions):
+        """iter_pipelines(vistrail: Vistrail, versions: list)
+              -> iterator of (version, Pipeline)
+
+        Walks down the version tree applying each action to its
+        parent's pipeline, only visiting the branches that lead to
+        versions.  Pipelines are copied where the walk branches, so
+        each yielded pipeline is only valid until the next one.
+
+        """
+        versions = set(versions)
+        children = {}
+        for action in vistrail.actions:
+            append_to_dict_of_lists(children, action.prevId, action.id)
+        # versions on the paths from the root to the ones we want
+        needed = set()
+        for version in versions:
+            while version not in needed and version in vistrail.actionMap:
+                needed.add(version)
+                version = vistrail.actionMap[version].prevId
+
+        stack = [(0, Pipeline())]
+        while stack:
+            version, pipeline = stack.pop()
+            if version != 0:
+                try:
+                    pipeline.perform_action(vistrail.actionMap[version])
+                except Exception:
+                    pipeline = vistrail.getPipeline(version)
+            if version in versions:
+                yield (version, pipeline)
+            next_versions = [c for c in children.get(version, [])
+                             if c in needed]
+            for child in next_versions[1:]:
+                stack.append((child, copy.copy(pipeline)))
+            if next_versions:
+                stack.append((next_versions[0], pipeline))
+
+    def iter_matches(self, vistrail, versions):
+        """iter_matches(vistrail: Vistrail, versions: list)
+              -> iterator of (version, module_id)
+
+        Yields the matches of each version as soon as its pipeline is
+        matched, so callers can show results while the search runs.
+        The pipelines of the candidates are built by walking the
+        version tree instead of materializing each one from the root.
+
+        """
+        if self.queryPipeline is None or not self.queryPipeline.modules:
+            return
+        querySources = self.queryPipeline.graph.sources()
+        for version, p in self.iter_pipelines(
+                vistrail, self.prune_versions(vistrail, versions)):
             matches = set()
             queryModuleNameIndex = {}
             for moduleId, module in p.modules.iteritems():
                 append_to_dict_of_lists(queryModuleNameIndex, module.name, moduleId)
-            for querySourceId in self.queryPipeline.graph.sources():
+            for querySourceId in querySources:
                 querySourceName = self.queryPipeline.modules[querySourceId].name
                 if not queryModuleNameIndex.has_key(querySourceName):
                     # need to reset matches here!
@@ -125,10 +242,16 @@ class VisualQuery(query.Query):
                     break
                 
             for m in matches:
-                result.append((version, m))
-        self.queryResult = result
+                yield (version, m)
+
+    def run(self, vistrail, name):
+        self.tupleLength = 2
+        versions = self.versions_to_check
+        if isinstance(versions, (int, long)):
+            versions = [versions]
+        self.queryResult = list(self.iter_matches(vistrail, versions))
         self.computeIndices()
-        return result
+        return self.queryResult
                 
     def __call__(self):
         """Returns a copy of itself. This needs to be implemented so that
@@ -240,3 +363,48 @@ class VisualQuery(query.Query):
         #             except:
         #                 print 'Invalid query "%s".' % template.strValue
         #                 return False
+
+
+class TestVisualQuery(unittest.TestCase):
+    def test_pruning(self):
+        """Pruned versions are the ones that could not match"""
+        import os
+        from vistrails.core.db.io import load_vistrail
+        from vistrails.core.db.locator import FileLocator
+        from vistrails.core.system import vistrails_examples_directory
+
+        class ReferenceQuery(VisualQuery):
+            """Matches every version, materialized from the root"""
+            def prune_versions(self, vistrail, versions):
+                return versions
+
+            def iter_pipelines(self, vistrail, versions):
+                for version in versions:
+                    yield (version, vistrail.getPipeline(version))
+
+        locator = FileLocator(os.path.join(vistrails_examples_directory(),
+                                           'terminator.vt'))
+        vistrail = load_vistrail(locator)[0]
+        versions = sorted(vistrail.actionMap)
+        pipeline = vistrail.getPipeline(versions[-1])
+        for module in pipeline.modules.itervalues():
+            for function in list(module.functions):
+                module.delete_function_by_real_id(function.real_id)
+
+        query = VisualQuery(pipeline, versions)
+        # the tree walk builds the same pipelines as getPipeline
+        walked = 0
+        for version, p in query.iter_pipelines(vistrail, versions):
+            expected = vistrail.getPipeline(version)
+            self.assertEqual(p.modules, expected.modules)
+            self.assertEqual(p.connections, expected.connections)
+            walked += 1
+        self.assertEqual(walked, len(versions))
+
+        result = query.run(vistrail, '')
+        candidates = query.prune_versions(vistrail, versions)
+        self.assertIn(versions[-1], query.versionDict)
+        self.assertLess(len(candidates), len(versions))
+        self.assertEqual(sorted(result),
+                         sorted(ReferenceQuery(pipeline,
+                                               versions).run(vistrail, '')))
@@ -35,6 +35,7 @@
 ###############################################################################
 from __future__ import division
 
+from collections import OrderedDict
 import copy
 from itertools import izip
 import os
@@ -158,9 +159,22 @@ class VistrailController(object):
         # if _cache_pipelines is True, cache pipelines to speed up
         # version switching
         self._cache_pipelines = True
+        # at most this many pipelines are kept, least recently used first
+        # to go (the empty pipeline for the root is always kept)
+        self._max_cached_pipelines = 32
         self.flush_pipeline_cache()
         self._current_full_graph = None
         self._current_terse_graph = None
+        # what the terse graph was computed from, to update it incrementally
+        self._terse_context = None
+        self._terse_states = {}
+        self._terse_children = {}
+        self._terse_tags = {}
+        self._terse_tag_map = {}
+        self._terse_upgrades = set()
+        self._terse_upgrade_of = {}
+        self._terse_last_n = set()
+        self._terse_current_version = None
         self.show_upgrades = False
         self.num_versions_always_shown = 1
 
@@ -217,7 +231,33 @@ class VistrailController(object):
     current_pipeline = property(_get_current_pipeline, _set_current_pipeline)
 
     def flush_pipeline_cache(self):
-        self._pipelines = {0: Pipeline()}
+        self._pipelines = OrderedDict([(0, Pipeline())])
+
+    def get_cached_pipeline(self, version):
+        """get_cached_pipeline(version: int) -> Pipeline
+        Returns the pipeline cached for version, marking it as recently
+        used.
+
+        """
+        pipeline = self._pipelines.pop(version)
+        self._pipelines[version] = pipeline
+        return pipeline
+
+    def cache_pipeline(self, version, pipeline):
+        """cache_pipeline(version: int, pipeline: Pipeline) -> None
+        Stashes a pipeline to speed up switching back to version, evicting
+        the least recently used ones past _max_cached_pipelines.
+
+        """
+        self._pipelines.pop(version, None)
+        self._pipelines[version] = pipeline
+        while len(self._pipelines) > max(self._max_cached_pipelines, 1):
+            for old_version in self._pipelines:
+                if old_version != 0:
+                    del self._pipelines[old_version]
+                    break
+            else:
+                break
 
     def logging_on(self):
         return get_vistrails_configuration().check('executionLog')
@@ -536,6 +576,7 @@ class VistrailController(object):
         desc_key = Action.ANNOTATION_DESCRIPTION
         added_upgrade = False
         should_migrate_tags = get_vistrails_configuration().check("migrateTags")
+        changed_versions = [start_version]
         for action in self._delayed_actions:
             self.vistrail.add_action(action, start_version,
                                      self.current_session)
@@ -547,6 +588,7 @@ class VistrailController(object):
                 self.migrate_tags(start_version, action.id)
             self.current_version = action.id
             start_version = action.id
+            changed_versions.append(action.id)
             added_upgrade = True
         for pe in self._delayed_paramexps:
             pe.action_id = self.current_version
@@ -566,9 +608,12 @@ class VistrailController(object):
         self._delayed_actions = []
         self._delayed_paramexps = []
         self._delayed_mashups = []
-        if added_upgrade or added_moves:
+        if added_moves:
             self.recompute_terse_graph()
             self.invalidate_version_tree(False)
+        elif added_upgrade:
+            self.update_terse_graph(changed_versions)
+            self.invalidate_version_tree(False)
 
     def perform_action(self, action, do_validate=True, raise_exception=False):
         """ performAction(action: Action) -> timestep
@@ -606,7 +651,7 @@ class VistrailController(object):
                 self.vistrail.change_description(description, action.id)
             self.current_version = action.db_id
             self.set_changed(True)
-            self.recompute_terse_graph()
+            self.update_terse_graph([action.db_id])
             
     def create_module_from_descriptor(self, *args, **kwargs):
         return self.create_module_from_descriptor_static(self.id_scope,
@@ -2741,6 +2786,7 @@ class VistrailController(object):
             full = self._current_full_graph
         changed = False
         new_current_version = None
+        pruned = []
         for v in versions:
             if v!=0: # not root
                 highest = v
@@ -2755,12 +2801,21 @@ class VistrailController(object):
                     changed = True
                     if highest == self.current_version:
                         new_current_version = full.parent(highest)
+                    # pruning also removes the tags below highest
+                    pruned.append(highest)
+                    below = [highest]
+                    while below:
+                        version = below.pop()
+                        if version in self._terse_tags:
+                            pruned.append(version)
+                        below.extend(to for to, _ in
+                                     full.adjacency_list[version])
                 self.vistrail.pruneVersion(highest)
         if changed:
             self.set_changed(True)
         if new_current_version is not None:
             self.change_selected_version(new_current_version)
-        self.recompute_terse_graph()
+        self.update_terse_graph(pruned)
         self.invalidate_version_tree(False)
 
     def hide_versions_below(self, v=None):
@@ -2794,7 +2849,7 @@ class VistrailController(object):
 
         if changed:
             self.set_changed(True)
-        self.recompute_terse_graph()
+        self.update_terse_graph([v])
         self.invalidate_version_tree(False, False)
 
     def show_all_versions(self):
@@ -2926,27 +2981,8 @@ class VistrailController(object):
                                         'hideUpgrades', True)
         self.show_upgrades = show_upgrades
 
-        # get full version tree (including pruned nodes) this tree is
-        # kept updated all the time. This data is read only and should
-        # not be updated!
-        fullVersionTree = self.vistrail.tree.getVersionTree()
-
-        # create tersed tree
-        open_list = [(0, None, False, False)]  # Elements to be handled
-        tersedVersionTree = Graph()
-
-        # cache actionMap and tagMap because they're properties, sort
-        # of slow
-        am = self.vistrail.actionMap
-        tm = self.vistrail.get_tagMap()
-        last_n = self.vistrail.getLastActions(self.num_versions_always_shown)
-
         upgrades = set()
-        upgrade_rev_map = {}
-        current_version = self.current_version
-        def rev_map(v):
-            return upgrade_rev_map.get(v, v)
-
+        upgrade_of = {}
         if not self.show_upgrades:
             # process upgrade annotations
             for ann in self.vistrail.action_annotations:
@@ -2954,103 +2990,284 @@ class VistrailController(object):
                     continue
                 # The target is an upgrade
                 upgrades.add(int(ann.value))
-                # Map from upgraded version to original
-                upgrade_rev_map[int(ann.value)] = ann.action_id
-
-            # Map current version
-            current_version = rev_map(current_version)
-
-            # Map tags
-            tm, orig_tm = {}, tm
-            for version, name in sorted(orig_tm.iteritems(),
-                                        key=lambda p: p[0]):
-                v = version
-                while v in upgrade_rev_map:
-                    v = upgrade_rev_map[v]
-                    if v in orig_tm:
-                        # Found another tag in upgrade chain, don't move tag
-                        v = version
-                        break
-                tm[v] = name
-            del orig_tm
-
-            # Transitively flatten upgrade_rev_map
-            for k, v in upgrade_rev_map.iteritems():
-                while v in upgrade_rev_map:
-                    v = upgrade_rev_map[v]
-                upgrade_rev_map[k] = v
-
-        while open_list:
-            current, parent, expandable, collapsible = open_list.pop()
-
-            # mount children list
-            all_children = [
-                to for to, _ in fullVersionTree.adjacency_list[current]
-                if to in am]
-            children = []
-            while all_children:
-                child = all_children.pop()
-                # Pruned: drop it
-                if self.vistrail.is_pruned(child):
-                    pass
-                # An upgrade: get its children directly
-                # (unless it is tagged, and that tag couldn't be moved)
-                elif (not self.show_upgrades and child in upgrades and
-                        child not in tm):
-                    all_children.extend(
-                        to for to, _ in fullVersionTree.adjacency_list[child]
-                        if to in am)
+                upgrade_of[ann.action_id] = int(ann.value)
+        self._terse_upgrades = upgrades
+        self._terse_upgrade_of = upgrade_of
+        self._upgrade_rev_map = self._flatten_upgrade_rev_map(upgrade_of)
+        self._terse_tags = self.vistrail.get_tagMap()
+        self._terse_tag_map = self._map_terse_tags()
+        self._terse_context = self._get_terse_context(self.show_upgrades)
+        self._terse_last_n = set(self.vistrail.getLastActions(
+                                     self.num_versions_always_shown))
+        self._terse_current_version = \
+            self._upgrade_rev_map.get(self.current_version,
+                                      self.current_version)
+
+        # version -> (parent, expandable, collapsible) it was reached with
+        self._terse_states = {0: (None, False, False)}
+        # version -> versions it passed its state on to
+        self._terse_children = {}
+        self._current_terse_graph = Graph()
+        self._update_terse_versions([0])
+        self._current_full_graph = self.vistrail.tree.getVersionTree()
+
+    def update_terse_graph(self, versions=()):
+        """ update_terse_graph(versions: list of version numbers) -> None
+        Updates the terse graph after versions were added, tagged,
+        upgraded or pruned. Only the part of the graph below the changed
+        versions is walked again; changes of the current version and
+        of the latest versions are picked up automatically. Falls back
+        to recompute_terse_graph() if there is no graph yet or the view
+        settings changed.
+
+        """
+        if (self._current_terse_graph is None or
+                self._terse_context != self._get_terse_context()):
+            self.recompute_terse_graph()
+            return
+
+        dirty = set(versions)
+
+        # upgrades
+        upgrades_changed = False
+        if not self.show_upgrades:
+            for version in versions:
+                ann = self.vistrail.get_action_annotation(
+                        version, Vistrail.UPGRADE_ANNOTATION)
+                target = int(ann.value) if ann is not None else None
+                if target == self._terse_upgrade_of.get(version):
+                    continue
+                if version in self._terse_upgrade_of:
+                    # upgrade was changed or removed
+                    self.recompute_terse_graph()
+                    return
+                self._terse_upgrade_of[version] = target
+                self._terse_upgrades.add(target)
+                self._upgrade_rev_map[target] = \
+                    self._upgrade_rev_map.get(version, version)
+                dirty.add(target)
+                upgrades_changed = True
+
+        # tags
+        tags_changed = upgrades_changed
+        for version in versions:
+            tag = self.vistrail.get_tag(version)
+            if tag != self._terse_tags.get(version):
+                if tag is None:
+                    del self._terse_tags[version]
                 else:
-                    children.append(child)
+                    self._terse_tags[version] = tag
+                tags_changed = True
+        if tags_changed:
+            old_tag_map = self._terse_tag_map
+            self._terse_tag_map = self._map_terse_tags()
+            dirty.update(v for v in set(old_tag_map) | set(self._terse_tag_map)
+                         if old_tag_map.get(v) != self._terse_tag_map.get(v))
+
+        # versions that are shown because they are current or recent
+        last_n = set(self.vistrail.getLastActions(
+                         self.num_versions_always_shown))
+        dirty.update(last_n ^ self._terse_last_n)
+        self._terse_last_n = last_n
+        current_version = self._upgrade_rev_map.get(self.current_version,
+                                                    self.current_version)
+        if current_version != self._terse_current_version:
+            dirty.update([current_version, self._terse_current_version])
+            self._terse_current_version = current_version
+
+        # a version's own state may have changed, and so may the list of
+        # children of the version that reaches it
+        full = self.vistrail.tree.getVersionTree()
+        force = set()
+        for version in dirty:
+            if version in self._terse_states:
+                force.add(version)
+            parents = full.inverse_adjacency_list.get(version)
+            while parents:
+                parent = parents[-1][0]
+                if parent in self._terse_states:
+                    force.add(parent)
+                    break
+                parents = full.inverse_adjacency_list.get(parent)
+        self._update_terse_versions(sorted(force), force)
+        self._current_full_graph = full
 
-            display = (self.full_tree or
-                       current == 0 or                 # is root
-                       current in tm or                # hasTag:
-                       current in last_n or            # show latest
-                       current == current_version or   # isCurrentVersion
-                       len(children) != 1)             # leaf or branch
-
-            if (display or am[current].expand):        # forced expansion
-
-                # yes it will!  this needs to be here because if we
-                # are refining version view receives the graph without
-                # the non matching elements
-                if (not self.refine or
-                        (self.refine and not self.search) or
-                        current == 0 or
-                        (self.refine and self.search and
-                         self.search.match(self.vistrail, am[current])) or
-                        current == current_version):
-                    # add vertex...
-                    tersedVersionTree.add_vertex(current, tm.get(current))
-
-                    # ...and the parent
-                    if parent is not None:
-                        collapse_here = not collapsible and not display
-                        tersedVersionTree.add_edge(parent, current,
-                                                   (expandable, collapse_here))
-                        collapsible = collapsible or collapse_here
-
-                    # update the parent info that will be used by the
-                    # children of this node
-                    parentToChildren = current
-                    expandable = False
+    def _get_terse_context(self, show_upgrades=None):
+        if show_upgrades is None:
+            show_upgrades = not getattr(get_vistrails_configuration(),
+                                        'hideUpgrades', True)
+        return (id(self.vistrail), show_upgrades, self.full_tree, self.refine,
+                self.search, self.num_versions_always_shown)
+
+    @staticmethod
+    def _flatten_upgrade_rev_map(upgrade_of):
+        # Map from upgraded version to original
+        upgrade_rev_map = dict((v, k) for k, v in upgrade_of.iteritems())
+        # Transitively flatten upgrade_rev_map
+        for k, v in upgrade_rev_map.iteritems():
+            while v in upgrade_rev_map:
+                v = upgrade_rev_map[v]
+            upgrade_rev_map[k] = v
+        return upgrade_rev_map
+
+    def _map_terse_tags(self):
+        """ _map_terse_tags() -> dict
+        Returns the tags keyed by the version they are shown on, which is
+        the original version of an upgrade when upgrades are hidden
+
+        """
+        if self.show_upgrades:
+            return dict(self._terse_tags)
+        upgrade_rev_map = dict((v, k) for k, v in
+                               self._terse_upgrade_of.iteritems())
+        tm, orig_tm = {}, self._terse_tags
+        for version, name in sorted(orig_tm.iteritems(),
+                                    key=lambda p: p[0]):
+            v = version
+            while v in upgrade_rev_map:
+                v = upgrade_rev_map[v]
+                if v in orig_tm:
+                    # Found another tag in upgrade chain, don't move tag
+                    v = version
+                    break
+            tm[v] = name
+        return tm
+
+    def _update_terse_versions(self, roots, force=None):
+        """ _update_terse_versions(roots: list, force: set) -> None
+        Walks the version tree from each of the roots using the state
+        they were last reached with, and updates the terse graph. The walk
+        doesn't go into children that are reached with the same state as
+        before unless they are in force.
+
+        """
+        fullVersionTree = self.vistrail.tree.getVersionTree()
+        tersedVersionTree = self._current_terse_graph
+        states = self._terse_states
+        pushed = self._terse_children
+
+        # cache actionMap because it's a property, sort of slow
+        am = self.vistrail.actionMap
+        tm = self._terse_tag_map
+        last_n = self._terse_last_n
+        upgrades = self._terse_upgrades
+        current_version = self._terse_current_version
+
+        done = set()
+        for root in roots:
+            if root in done or root not in states:
+                continue
+            open_list = [(root,) + states[root]]  # Elements to be handled
+            while open_list:
+                current, parent, expandable, collapsible = open_list.pop()
+                done.add(current)
+                states[current] = (parent, expandable, collapsible)
+
+                # mount children list
+                all_children = [
+                    to for to, _ in fullVersionTree.adjacency_list[current]
+                    if to in am]
+                children = []
+                while all_children:
+                    child = all_children.pop()
+                    # Pruned: drop it
+                    if self.vistrail.is_pruned(child):
+                        pass
+                    # An upgrade: get its children directly
+                    # (unless it is tagged, and that tag couldn't be moved)
+                    elif (not self.show_upgrades and child in upgrades and
+                            child not in tm):
+                        all_children.extend(
+                            to for to, _ in
+                            fullVersionTree.adjacency_list[child]
+                            if to in am)
+                    else:
+                        children.append(child)
+
+                # forget versions that are not reached from here anymore
+                if current in pushed:
+                    kept = set(children)
+                    for child in pushed[current]:
+                        if child not in kept:
+                            self._forget_terse_versions(child)
+                pushed[current] = children
+
+                # edges are added again below if the version is shown
+                if current in tersedVersionTree.vertices:
+                    for froom, edge_id in \
+                            tersedVersionTree.inverse_adjacency_list[current][:]:
+                        tersedVersionTree.delete_edge(froom, current, edge_id)
+
+                display = (self.full_tree or
+                           current == 0 or                 # is root
+                           current in tm or                # hasTag:
+                           current in last_n or            # show latest
+                           current == current_version or   # isCurrentVersion
+                           len(children) != 1)             # leaf or branch
+
+                shown = False
+                if (display or am[current].expand):        # forced expansion
+
+                    # yes it will!  this needs to be here because if we
+                    # are refining version view receives the graph without
+                    # the non matching elements
+                    if (not self.refine or
+                            (self.refine and not self.search) or
+                            current == 0 or
+                            (self.refine and self.search and
+                             self.search.match(self.vistrail,
+                                               am[current])) or
+                            current == current_version):
+                        # add vertex...
+                        shown = True
+                        tersedVersionTree.add_vertex(current)
+                        tersedVersionTree.vertices[current] = tm.get(current)
+
+                        # ...and the parent
+                        if parent is not None:
+                            collapse_here = not collapsible and not display
+                            tersedVersionTree.add_edge(parent, current,
+                                                       (expandable,
+                                                        collapse_here))
+                            collapsible = collapsible or collapse_here
+
+                        # update the parent info that will be used by the
+                        # children of this node
+                        parentToChildren = current
+                        expandable = False
+                    else:
+                        parentToChildren = parent
+                        expandable = True
                 else:
                     parentToChildren = parent
                     expandable = True
-            else:
-                parentToChildren = parent
-                expandable = True
+                if not shown and current in tersedVersionTree.vertices:
+                    tersedVersionTree.delete_vertex(current)
+
+                if collapsible and len(children) > 1:
+                    collapsible = False
+                state = (parentToChildren, expandable, collapsible)
+                for child in children:
+                    if (force is not None and child not in force and
+                            states.get(child) == state):
+                        # nothing changed below this child
+                        continue
+                    open_list.append((child,) + state)
 
-            if collapsible and len(children) > 1:
-                collapsible = False
-            for child in children:
-                open_list.append((child, parentToChildren,
-                                  expandable, collapsible))
+    def _forget_terse_versions(self, version):
+        """ _forget_terse_versions(version: int) -> None
+        Removes version and the versions reached through it from the
+        terse graph
 
-        self._current_terse_graph = tersedVersionTree
-        self._current_full_graph = self.vistrail.tree.getVersionTree()
-        self._upgrade_rev_map = upgrade_rev_map
+        """
+        tersedVersionTree = self._current_terse_graph
+        versions = [version]
+        while versions:
+            v = versions.pop()
+            if v in tersedVersionTree.vertices:
+                tersedVersionTree.delete_vertex(v)
+            self._terse_states.pop(v, None)
+            versions.extend(self._terse_children.pop(v, ()))
 
     def save_version_graph(self, filename, tersed=True, highlight=None):
         if tersed:
@@ -3586,6 +3803,7 @@ class VistrailController(object):
                 vistrail.set_upgrade(new_version, str(upgrade_action.id))
                 if get_vistrails_configuration().check("migrateTags"):
                     self.migrate_tags(new_version, upgrade_action.id, vistrail)
+                upgraded_version = new_version
                 new_version = upgrade_action.id
                 for pe in new_param_exps:
                     pe.action_id = new_version
@@ -3597,7 +3815,7 @@ class VistrailController(object):
                     self._mashups.append(mashup)
 
                 self.set_changed(True)
-                self.recompute_terse_graph()
+                self.update_terse_graph([upgraded_version, new_version])
 
         def check_exceptions(exception_set):
             unhandled_exceptions = []
@@ -3623,6 +3841,10 @@ class VistrailController(object):
         return (new_version, cur_pipeline)
 
     def validate(self, pipeline, raise_exception=True):
+        pm = get_package_manager()
+        if pm.load_packages_on_demand():
+            pm.require_packages(module.package
+                                for module in pipeline.module_list)
         vistrail_vars = self.get_vistrail_variables()
         pipeline.validate(raise_exception, vistrail_vars)
     
@@ -3687,7 +3909,7 @@ class VistrailController(object):
                     return result
             # Fast check: if target is cached, copy it and we're done.
             elif version in self._pipelines:
-                result = copy.copy(self._pipelines[version])
+                result = copy.copy(self.get_cached_pipeline(version))
             else:
                 # Find the closest upstream pipeline to the current one
                 cv = self._current_full_graph.inverse_immutable().closest_vertex
@@ -3709,7 +3931,7 @@ class VistrailController(object):
                     if closest == 0:
                         result = self.vistrail.getPipeline(version)
                     else:
-                        result = copy.copy(self._pipelines[closest])
+                        result = copy.copy(self.get_cached_pipeline(closest))
                         action = self.vistrail.general_action_chain(closest, 
                                                                     version)
                         result.perform_action(action)
@@ -3732,9 +3954,9 @@ class VistrailController(object):
                             if not allow_fail:
                                 raise
                         else:
-                            self._pipelines[version] = copy.copy(result)
+                            self.cache_pipeline(version, copy.copy(result))
                     else:
-                        self._pipelines[version] = copy.copy(result)
+                        self.cache_pipeline(version, copy.copy(result))
             if do_validate:
                 try:
                     self.validate(result)
@@ -4380,3 +4602,65 @@ class TestTerseGraph(unittest.TestCase):
             13L: [(14L, (False, False)), (17L, (False, False))],
             4L: [], 6L: [], 10L: [], 14L: [], 17L: [],
         })
+
+    def test_incremental_update(self):
+        """Updates the tersed version tree incrementally"""
+        from vistrails.core.vistrail.action import Action
+
+        def graph(controller):
+            g = controller._current_terse_graph
+            return (g.vertices,
+                    dict((k, sorted(v))
+                         for k, v in g.adjacency_list.iteritems()))
+
+        def check(controller, versions=()):
+            controller.update_terse_graph(versions)
+            updated = graph(controller)
+            controller.recompute_terse_graph()
+            self.assertEqual(updated, graph(controller))
+
+        controller = self.get_workflow('upgrades1.xml')
+        vistrail = controller.vistrail
+        controller.change_selected_version(3)
+        controller.recompute_terse_graph()
+
+        # new actions
+        for version in [3, 3, 1, 10]:
+            controller.current_version = version
+            action = Action(id=-1, operations=[])
+            vistrail.add_action(action, version)
+            controller.current_version = action.id
+            check(controller, [action.id])
+
+        # upgrade
+        action = Action(id=-1, operations=[])
+        vistrail.add_action(action, 13)
+        vistrail.set_upgrade(13, str(action.id))
+        check(controller, [13, action.id])
+
+        # tags
+        vistrail.set_tag(8, 'eight')
+        check(controller, [8])
+        vistrail.set_tag(8, '')
+        check(controller, [8])
+
+        # pruning
+        vistrail.pruneVersion(10)
+        check(controller, [10])
+
+
+class TestPipelineCache(unittest.TestCase):
+    def test_bounded_cache(self):
+        """Makes sure cached pipelines are evicted least recently used
+        first"""
+        controller = VistrailController(Vistrail())
+        controller._max_cached_pipelines = 3
+        for version in [1, 2, 3]:
+            controller.cache_pipeline(version, Pipeline())
+        self.assertEqual(controller._pipelines.keys(), [0, 2, 3])
+        controller.get_cached_pipeline(2)
+        self.assertEqual(controller._pipelines.keys(), [0, 3, 2])
+        controller.cache_pipeline(4, Pipeline())
+        self.assertEqual(controller._pipelines.keys(), [0, 2, 4])
+        controller.flush_pipeline_cache()
+        self.assertEqual(controller._pipelines.keys(), [0])
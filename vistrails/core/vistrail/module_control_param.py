@@ -49,6 +49,9 @@ class ModuleControlParam(DBControlParameter):
     WHILE_OUTPUT_KEY = 'while_output' # output port for forwarded value
     WHILE_MAX_KEY = 'while_max' # Max iterations
     WHILE_DELAY_KEY = 'while_delay' # delay between iterations
+    LOOP_THREADS_KEY = 'loop_threads' # Run iterations on this many threads
+    LOOP_CHUNK_KEY = 'loop_chunk' # Iterations given to a thread at once
+    STREAM_CHUNK_KEY = 'stream_chunk' # Values sent downstream at once
     CACHE_KEY = 'cache' # Turn caching on/off for this module (not implemented)
     JOB_CACHE_KEY = 'job_cache' # Always persist output values to disk
 
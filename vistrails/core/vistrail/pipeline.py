@@ -135,6 +135,7 @@ class Pipeline(DBWorkflow):
             self._subpipeline_signatures = Bidict()
             self._module_signatures = Bidict()
             self._connection_signatures = Bidict()
+            self._signature_keys = {}
         else:
             self.is_valid = other.is_valid
             self.aliases = Bidict([(k,copy.copy(v))
@@ -148,6 +149,7 @@ class Pipeline(DBWorkflow):
             self._module_signatures = \
                 Bidict([(k,copy.copy(v))
                         for (k,v) in other._module_signatures.iteritems()])
+            self._signature_keys = dict(other._signature_keys)
 
         self.graph = Graph()
         for module in self.module_list:
@@ -263,6 +265,7 @@ class Pipeline(DBWorkflow):
         self._subpipeline_signatures = Bidict()
         self._module_signatures = Bidict()
         self._connection_signatures = Bidict()
+        self._signature_keys = {}
 
     def get_tmp_id(self, type):
         """get_tmp_id(type: str) -> long
@@ -397,6 +400,8 @@ class Pipeline(DBWorkflow):
             del self._module_signatures[id]
         if id in self._subpipeline_signatures:
             del self._subpipeline_signatures[id]
+        if id in self._signature_keys:
+            del self._signature_keys[id]
 
     def add_connection(self, c, *args):
         """add_connection(c: Connection) -> None 
@@ -827,11 +832,68 @@ class Pipeline(DBWorkflow):
         return signature in self._connection_signatures.inverse
 
     def refresh_signatures(self):
-        self._connection_signatures = {}
-        self._subpipeline_signatures = {}
-        self._module_signatures = {}
+        """refresh_signatures(): recompute out-of-date signatures
+
+        Parameters are often changed in place (aliases, vistrail
+        variables, parameter explorations), so rather than trusting the
+        pipeline operations, each module is compared against a summary
+        of what its signature was computed from. Only the modules that
+        changed are rehashed, and only the subpipeline and connection
+        signatures downstream of them are invalidated.
+
+        """
+        registry = get_module_registry()
+        changed = set()
+        signature_keys = {}
+        for module_id, module in self.modules.iteritems():
+            key = registry.module_signature_key(module)
+            upstream_key = sorted((m,
+                                   self.connections[edge_id].source.name,
+                                   self.connections[edge_id].destination.name)
+                                  for (m, edge_id) in
+                                  self.graph.edges_to(module_id))
+            old = self._signature_keys.get(module_id)
+            if old is None or old[1] != upstream_key:
+                changed.add(module_id)
+            if key is None or old is None or old[0] != key:
+                old_sig = self._module_signatures.get(module_id)
+                self._discard_signature(self._module_signatures, module_id)
+                if self.module_signature(module_id) != old_sig:
+                    changed.add(module_id)
+            signature_keys[module_id] = (key, upstream_key)
+        self._signature_keys = signature_keys
+
+        # discard everything downstream of a change, or no longer there
+        stale = set()
+        while changed:
+            module_id = changed.pop()
+            if module_id not in stale:
+                stale.add(module_id)
+                changed.update(m for (m, _) in
+                               self.graph.edges_from(module_id))
+        for module_id in self._module_signatures.keys():
+            if module_id not in self.modules:
+                self._discard_signature(self._module_signatures, module_id)
+        for module_id in self._subpipeline_signatures.keys():
+            if module_id in stale or module_id not in self.modules:
+                self._discard_signature(self._subpipeline_signatures,
+                                        module_id)
+        for conn_id in self._connection_signatures.keys():
+            if conn_id not in self.connections or \
+                    self.connections[conn_id].destinationId in stale:
+                self._discard_signature(self._connection_signatures, conn_id)
         self.compute_signatures()
 
+    @staticmethod
+    def _discard_signature(signatures, key):
+        """Removes key from a signature Bidict, keeping the inverse
+        mapping if it belongs to another key (signatures of identical
+        modules are not unique)."""
+        if key in signatures:
+            sig = dict.pop(signatures, key)
+            if signatures.inverse.get(sig) == key:
+                del signatures.inverse[sig]
+
     def compute_signatures(self):
         """compute_signatures(): compute all module and subpipeline signatures
         for this pipeline."""
@@ -1453,6 +1515,37 @@ class TestPipeline(unittest.TestCase):
         self.assertNotEquals(c_sig_size_before, c_sig_size_after)
         self.assertNotEquals(p_sig_size_before, p_sig_size_after)
 
+    def test_refresh_signatures(self):
+        """Makes sure only signatures downstream of a change are updated."""
+        p = self.create_default_pipeline()
+        p.refresh_signatures()
+        before = dict(p._subpipeline_signatures)
+        c_before = dict(p._connection_signatures)
+
+        p.modules[1].functions[0].params[0].strValue = '-'
+        p.refresh_signatures()
+        self.assertEqual(p._subpipeline_signatures[0], before[0])
+        self.assertNotEqual(p._subpipeline_signatures[1], before[1])
+        self.assertNotEqual(p._subpipeline_signatures[2], before[2])
+        self.assertNotEqual(p._connection_signatures[1], c_before[1])
+
+        # must match a pipeline that computes everything from scratch
+        fresh = copy.copy(p)
+        fresh._signature_keys = {}
+        fresh._module_signatures = Bidict()
+        fresh._subpipeline_signatures = Bidict()
+        fresh._connection_signatures = Bidict()
+        fresh.compute_signatures()
+        self.assertEqual(dict(p._subpipeline_signatures),
+                         dict(fresh._subpipeline_signatures))
+        self.assertEqual(dict(p._connection_signatures),
+                         dict(fresh._connection_signatures))
+
+        p.modules[1].functions[0].params[0].strValue = '+'
+        p.refresh_signatures()
+        self.assertEqual(dict(p._subpipeline_signatures), before)
+        self.assertEqual(p.subpipeline_id_from_signature(before[2]), 2)
+
     def test_delete_connections(self):
         p = self.create_default_pipeline()
         p.delete_connection(0)
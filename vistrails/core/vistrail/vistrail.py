@@ -122,6 +122,8 @@ class Vistrail(DBVistrail):
         # object to keep explicit expanded 
         # version tree always updated
         self.tree = ExplicitExpandedVersionTree(self)
+        # index used by version searches, built when first needed
+        self.search_index = None
         # add all versions to the trees
         for action in sorted(self.actions, key=lambda a: a.id):
             self.tree.addVersion(action.id, action.prevId)
@@ -546,6 +548,19 @@ class Vistrail(DBVistrail):
 
         # signal to update explicit tree
         self.tree.addVersion(action.id, action.prevId)
+        if self.search_index is not None:
+            self.search_index.add_action(action)
+
+    def get_search_index(self):
+        """get_search_index() -> VersionIndex
+        Returns the index used by version searches, building it the
+        first time or if the vistrail was changed behind its back.
+
+        """
+        if self.search_index is None or self.search_index.is_stale():
+            from vistrails.core.query.version import VersionIndex
+            self.search_index = VersionIndex(self)
+        return self.search_index
 
     def hasTag(self, tag):
         """ hasTag(tag) -> boolean 
@@ -600,6 +615,8 @@ class Vistrail(DBVistrail):
     def delete_action_annotation(self, action_id, key):
         annotation = self.get_action_annotation(action_id, key)
         self.db_delete_actionAnnotation(annotation)
+        if self.search_index is not None:
+            self.search_index.update_annotation(action_id, key)
 
     def set_action_annotation(self, action_id, key, value):
         changed = False
@@ -622,6 +639,8 @@ class Vistrail(DBVistrail):
             changed = True
         if changed:
             self.changed = True
+            if self.search_index is not None:
+                self.search_index.update_annotation(action_id, key)
             return True
         return False
 
@@ -765,6 +784,9 @@ class Vistrail(DBVistrail):
                                )
                 action.add_annotation(annotation)
             self.changed = True
+            if (self.search_index is not None and
+                    key == Action.ANNOTATION_DESCRIPTION):
+                self.search_index.update_description(version_number)
             return True
         return False
 
@@ -123,6 +123,48 @@ def getCurrentOperationDict(actions, currentOperations=None):
 
     return currentOperations
 
+# number of versions of depth between two operation checkpoints
+CHECKPOINT_INTERVAL = 64
+
+def getCheckpointedOperationDict(obj, version, interval=CHECKPOINT_INTERVAL):
+    """Returns getCurrentOperationDict(getActionChain(obj, version)), but
+    only replays the actions since the closest checkpointed ancestor.
+
+    Checkpoints are stored on obj, one every interval levels of depth,
+    and only hold references to the existing operations; they are
+    created as versions get materialized so any version is at most
+    interval actions away from one.
+    """
+    try:
+        checkpoints = obj._operation_checkpoints
+    except AttributeError:
+        checkpoints = obj._operation_checkpoints = {}
+
+    actions = []
+    currentOperations = {}
+    currentId = version
+    while currentId > 0:
+        action = obj.db_get_action_by_id(currentId)
+        try:
+            (checkpoint_action, operations) = checkpoints[currentId]
+        except KeyError:
+            pass
+        else:
+            # make sure the action wasn't replaced since
+            if checkpoint_action is action:
+                currentOperations.update(operations)
+                break
+        actions.append(action)
+        currentId = action.db_prevId
+    actions.reverse()
+
+    # currentId is either the root or a checkpoint, so both are aligned
+    for i, action in enumerate(actions):
+        getCurrentOperationDict([action], currentOperations)
+        if (i + 1) % interval == 0:
+            checkpoints[action.db_id] = (action, dict(currentOperations))
+    return currentOperations
+
 def getCurrentOperations(actions):
     # sort the values left in the hash and return the list
     sortedOperations = getCurrentOperationDict(actions).values()
@@ -38,7 +38,8 @@ from __future__ import division, with_statement
 from datetime import datetime
 from vistrails.core import debug
 from vistrails.core.bundles import py_import
-from vistrails.core.system import get_elementtree_library, strftime
+from vistrails.core.system import get_elementtree_library, strftime, \
+    time_strptime
 from vistrails.core.utils import Chdir
 from vistrails.core.mashup.mashup_trail import Mashuptrail
 from vistrails.core.modules.sub_module import get_cur_abs_namespace,\
@@ -48,9 +49,13 @@ import vistrails.core.requirements
 
 import os.path
 import shutil
+import sqlite3
+import sys
 import tempfile
+import time
 import copy
 import zipfile
+import zlib
 
 from vistrails.db import VistrailsDBException
 from vistrails.db.domain import DBVistrail, DBWorkflow, DBLog, DBAbstraction, DBGroup, \
@@ -74,8 +79,10 @@ ElementTree = get_elementtree_library()
 CONNECT_TIMEOUT = 15
 
 _db_lib = None
-def get_db_lib():
+def get_db_lib(db_connection=None):
     global _db_lib
+    if get_db_dialect(db_connection) == 'sqlite':
+        return sqlite3
     if _db_lib is None:
         MySQLdb = py_import('MySQLdb', {
                 'pip': 'mysql-python',
@@ -89,6 +96,68 @@ def set_db_lib(lib):
     global _db_lib
     _db_lib = lib
 
+class SQLiteConnection(sqlite3.Connection):
+    """Connection to a SQLite database file, also providing the parts of
+    the MySQLdb connection interface that the persistence layer uses.
+
+    """
+    dialect = 'sqlite'
+
+    def begin(self):
+        # sqlite3 opens a transaction before the first modifying statement
+        pass
+
+    def ping(self):
+        # there is no server to lose the connection to
+        return True
+
+def get_db_dialect(db_connection):
+    """get_db_dialect(db_connection) -> str
+    Returns 'sqlite' for connections to a SQLite database file, 'mysql'
+    otherwise.
+
+    """
+    return getattr(db_connection, 'dialect', 'mysql')
+
+def open_sqlite_connection(filename):
+    db_connection = sqlite3.connect(filename, timeout=CONNECT_TIMEOUT,
+                                    factory=SQLiteConnection)
+    # the DAOs expect byte strings, as returned by MySQLdb
+    db_connection.text_factory = str
+    # readers don't block the writer and vice versa
+    db_connection.execute("PRAGMA journal_mode=WAL;")
+    return db_connection
+
+def db_error_message(e):
+    """db_error_message(e: Exception) -> str
+    Formats an error raised by either database library.
+
+    """
+    if len(e.args) >= 2:
+        return "%s : %s" % (e.args[0], e.args[1])
+    return str(e)
+
+def escape_db_value(db_connection, value):
+    """escape_db_value(db_connection, value) -> str
+    Quotes value so that it can be used as a literal in a SQL command.
+
+    """
+    if get_db_dialect(db_connection) == 'sqlite':
+        if isinstance(value, (int, long, float)):
+            return str(value)
+        return "'%s'" % str(value).replace("'", "''")
+    return db_connection.escape(value, get_db_lib().converters.conversions)
+
+def get_db_datetime(value):
+    """get_db_datetime(value) -> datetime
+    SQLite returns dates as strings, MySQLdb as datetime objects.
+
+    """
+    if isinstance(value, basestring):
+        return datetime(*time_strptime(value.strip(),
+                                       '%Y-%m-%d %H:%M:%S')[0:6])
+    return value
+
 
 class SaveBundle(object):
     """Transient bundle of objects to be saved or loaded.
@@ -166,17 +235,17 @@ class SaveBundle(object):
         
         return cp
 
-def format_prepared_statement(statement):
-    """format_prepared_statement(statement: str) -> str
-    Formats a prepared statement for compatibility with the currently
-    loaded database library's paramstyle.
+def format_prepared_statement(statement, db_connection=None):
+    """format_prepared_statement(statement: str, db_connection) -> str
+    Formats a prepared statement for compatibility with the paramstyle of
+    the database library used by db_connection.
 
     Currently only supports 'qmark' and 'format' paramstyles.
     May be expanded later to allow for more compatibility options
     on input and output.  See PEP 249 for more info.
 
     """
-    style = get_db_lib().paramstyle
+    style = get_db_lib(db_connection).paramstyle
     if style == 'format':
         return statement.replace("?", "%s")
     elif style == 'qmark':
@@ -184,22 +253,37 @@ def format_prepared_statement(statement):
     return statement
 
 def open_db_connection(config):
+    """open_db_connection(config: dict) -> connection
+    Connects to the database described by config. With
+    config['dialect'] == 'sqlite', config['db'] is the path of a local
+    SQLite database file; otherwise config holds the MySQLdb connection
+    arguments.
 
+    """
     if config is None:
         msg = "You need to provide valid config dictionary"
         raise VistrailsDBException(msg)
+    if config.get('dialect') == 'sqlite':
+        try:
+            return open_sqlite_connection(config['db'])
+        except sqlite3.Error, e:
+            msg = "cannot open connection (%s)" % db_error_message(e)
+            raise VistrailsDBException(msg)
     if 'connect_timeout' not in config:
         config['connect_timeout'] = CONNECT_TIMEOUT
     try:
         # FIXME allow config to be kwargs and args?
-        db_connection = get_db_lib().connect(**config)
+        db_connection = get_db_lib().connect(**_mysql_config(config))
         #db_connection = get_db_lib().connect(config)
         return db_connection
     except get_db_lib().Error, e:
         # should have a DB exception type
-        msg = "cannot open connection (%d: %s)" % (e.args[0], e.args[1])
+        msg = "cannot open connection (%s)" % db_error_message(e)
         raise VistrailsDBException(msg)
 
+def _mysql_config(config):
+    return dict((k, v) for k, v in config.iteritems() if k != 'dialect')
+
 def close_db_connection(db_connection):
     if db_connection is not None:
         db_connection.close()
@@ -210,13 +294,16 @@ def test_db_connection(config):
     
     """
     #print "Testing config", config
+    if config.get('dialect') == 'sqlite':
+        close_db_connection(open_db_connection(config))
+        return
     if 'connect_timeout' not in config:
         config['connect_timeout'] = CONNECT_TIMEOUT
     try:
-        db_connection = get_db_lib().connect(**config)
+        db_connection = get_db_lib().connect(**_mysql_config(config))
         close_db_connection(db_connection)
     except get_db_lib().Error, e:
-        msg = "connection test failed (%d: %s)" % (e.args[0], e.args[1])
+        msg = "connection test failed (%s)" % db_error_message(e)
         raise VistrailsDBException(msg)
     except TypeError, e:
         msg = "connection test failed (%s)" %str(e)
@@ -230,7 +317,7 @@ def ping_db_connection(db_connection):
     """
     try:
         db_connection.ping()
-    except get_db_lib().OperationalError:
+    except get_db_lib(db_connection).OperationalError:
         return False
     return True
     
@@ -288,9 +375,9 @@ def get_db_object_list(config, obj_type):
         c.close()
         close_db_connection(db)
         
-    except get_db_lib().Error, e:
-        msg = "Couldn't get list of vistrails objects from db (%d : %s)" % \
-            (e.args[0], e.args[1])
+    except get_db_lib(db).Error, e:
+        msg = "Couldn't get list of vistrails objects from db (%s)" % \
+            db_error_message(e)
         raise VistrailsDBException(msg)
     return result
 
@@ -305,12 +392,12 @@ def get_db_object_modification_time(db_connection, obj_id, obj_type):
         db_connection.begin()
         c = db_connection.cursor()
         c.execute(command % (translate_to_tbl_name(obj_type), obj_id))
+        time = get_db_datetime(c.fetchall()[0][0])
         db_connection.commit()
-        time = c.fetchall()[0][0]
         c.close()
-    except get_db_lib().Error, e:
-        msg = "Couldn't get object modification time from db (%d : %s)" % \
-            (e.args[0], e.args[1])
+    except get_db_lib(db_connection).Error, e:
+        msg = "Couldn't get object modification time from db (%s)" % \
+            db_error_message(e)
         raise VistrailsDBException(msg)
     return time
 
@@ -327,9 +414,9 @@ def get_db_object_version(db_connection, obj_id, obj_type):
         c.execute(command % (translate_to_tbl_name(obj_type), obj_id))
         version = c.fetchall()[0][0]
         c.close()
-    except get_db_lib().Error, e:
-        msg = "Couldn't get object version from db (%d : %s)" % \
-            (e.args[0], e.args[1])
+    except get_db_lib(db_connection).Error, e:
+        msg = "Couldn't get object version from db (%s)" % \
+            db_error_message(e)
         raise VistrailsDBException(msg)
     return version
 
@@ -344,7 +431,7 @@ def get_db_version(db_connection):
         c.execute(command)
         version = c.fetchall()[0][0]
         c.close()
-    except get_db_lib().Error, e:
+    except get_db_lib(db_connection).Error, e:
         # just return None if we hit an error
         return None
     return version
@@ -374,7 +461,7 @@ def get_db_id_from_name(db_connection, obj_type, name):
         else:
             c.close()
             return int(rows[0][0])
-    except get_db_lib().Error, e:
+    except get_db_lib(db_connection).Error, e:
         c.close()
         msg = "Connection error when trying to get db id from name"
         raise VistrailsDBException(msg)
@@ -403,11 +490,11 @@ def get_db_abstraction_modification_time(db_connection, abstraction):
                              abstraction.db_id,
                              translate_to_tbl_name(DBVistrail.vtType),
                              id_value))
-        modtime = c.fetchall()[0][0]
+        modtime = get_db_datetime(c.fetchall()[0][0])
         c.close()
-    except get_db_lib().Error, e:
-        msg = "Couldn't get modification time from db (%d : %s)" % \
-            (e.args[0], e.args[1])
+    except get_db_lib(db_connection).Error, e:
+        msg = "Couldn't get modification time from db (%s)" % \
+            db_error_message(e)
         raise VistrailsDBException(msg)
     return modtime
 
@@ -442,9 +529,9 @@ def get_db_ids_from_vistrail(db_connection, vt_id, id_key):
         c.execute(command%(translate_to_tbl_name(DBAnnotation.vtType), id_key, vt_id))
         abs_ids = c.fetchall()
         c.close()
-    except get_db_lib().Error, e:
-        msg = "Couldn't get object ids from db (%d : %s)" % \
-            (e.args[0], e.args[1])
+    except get_db_lib(db_connection).Error, e:
+        msg = "Couldn't get object ids from db (%s)" % \
+            db_error_message(e)
         raise VistrailsDBException(msg)
     return [i[0] for i in abs_ids]
 
@@ -479,9 +566,9 @@ def get_matching_abstraction_id(db_connection, abstraction):
         if len(result) > 0:
             #print 'got result:', result
             id = result[0][0]
-    except get_db_lib().Error, e:
-        msg = "Couldn't get object modification time from db (%d : %s)" % \
-            (e.args[0], e.args[1])
+    except get_db_lib(db_connection).Error, e:
+        msg = "Couldn't get object modification time from db (%s)" % \
+            db_error_message(e)
         raise VistrailsDBException(msg)
     return id
 
@@ -491,18 +578,21 @@ def setup_db_tables(db_connection, version=None, old_version=None):
     if old_version is None:
         old_version = version
     try:
+        def translate_sqlite(cmd):
+            # the schema files are written for MySQL
+            cmd = cmd.replace(' engine=InnoDB', '')
+            cmd = cmd.replace('int not null auto_increment primary key',
+                              'integer primary key autoincrement')
+            if cmd.startswith('DROP TABLE IF EXISTS ') and ',' in cmd:
+                # one table per statement
+                tables = cmd[len('DROP TABLE IF EXISTS '):-1].split(',')
+                return ['DROP TABLE IF EXISTS %s;' % t.strip()
+                        for t in tables]
+            return [cmd]
+
         def execute_file(c, f):
             cmd = ""
-#             auto_inc_str = 'auto_increment'
-#             not_null_str = 'not null'
-#             engine_str = 'engine=InnoDB;'
             for line in f:
-#                 if line.find(auto_inc_str) > 0:
-#                     num = line.find(auto_inc_str)
-#                     line = line[:num] + line[num+len(auto_inc_str):]
-#                 if line.find(not_null_str) > 0:
-#                     num = line.find(not_null_str)
-#                     line = line[:num] + line[num+len(not_null_str):]
                 line = line.strip()
                 if cmd or not line.startswith('--'):
                     cmd += line
@@ -510,12 +600,12 @@ def setup_db_tables(db_connection, version=None, old_version=None):
                 else:
                     ending = None
                 if ending and ending[-1] == ';':
-                    # FIXME engine stuff switch for MySQLdb, sqlite3
                     cmd = cmd.rstrip()
-#                     if cmd.endswith(engine_str):
-#                         cmd = cmd[:-len(engine_str)] + ';'
-                    #print cmd
-                    c.execute(cmd)
+                    if get_db_dialect(db_connection) == 'sqlite':
+                        for statement in translate_sqlite(cmd):
+                            c.execute(statement)
+                    else:
+                        c.execute(cmd)
                     cmd = ""
 
         # delete tables
@@ -537,7 +627,8 @@ def setup_db_tables(db_connection, version=None, old_version=None):
 #         c.execute(db_script)
         f.close()
         c.close()
-    except get_db_lib().Error, e:
+        db_connection.commit()
+    except get_db_lib(db_connection).Error, e:
         raise VistrailsDBException("unable to create tables: " + str(e))
 
 ##############################################################################
@@ -654,6 +745,7 @@ def close_zip_xml(temp_dir):
     """
     if temp_dir is None:
         return
+    _zip_manifests.pop(temp_dir, None)
     if not os.path.isdir(temp_dir):
         if os.path.isfile(temp_dir):
             os.remove(temp_dir)
@@ -683,11 +775,13 @@ def unserialize(str, obj_type):
 
 def open_vistrail_from_xml(filename):
     """open_vistrail_from_xml(filename) -> Vistrail"""
-    tree = ElementTree.parse(filename)
-    version = get_version_for_xml(tree.getroot())
+    version = get_version_for_xml_file(filename)
     try:
         daoList = getVersionDAO(version)
-        vistrail = daoList.open_from_xml(filename, DBVistrail.vtType, tree)
+        if hasattr(daoList, 'stream_from_xml'):
+            vistrail = daoList.stream_from_xml(filename, DBVistrail.vtType)
+        else:
+            vistrail = daoList.open_from_xml(filename, DBVistrail.vtType)
         if vistrail is None:
             raise VistrailsDBException("Couldn't read vistrail from XML")
         vistrail = translate_vistrail(vistrail, version)
@@ -715,12 +809,14 @@ def open_vistrail_bundle_from_zip_xml(filename):
     z = zipfile.ZipFile(filename)
     try:
         z.extractall(vt_save_dir)
+        record_zip_manifest(filename, vt_save_dir, z.infolist())
     finally:
         z.close()
 
     vistrail = None
     log = None
     log_fname = None
+    log_segments = []
     abstraction_files = []
     unknown_files = []
     thumbnail_files = []
@@ -737,6 +833,8 @@ def open_vistrail_bundle_from_zip_xml(filename):
                     log_fname = os.path.join(root, fname)
                     # log = open_log_from_xml(os.path.join(root, fname))
                     # objs.append(DBLog.vtType, log)
+                elif root == os.path.join(vt_save_dir, 'log_segments'):
+                    log_segments.append(os.path.join(root, fname))
                 elif fname.startswith('abstraction_'):
                     abstraction_file = os.path.join(root, fname)
                     abstraction_files.append(abstraction_file)
@@ -765,6 +863,8 @@ def open_vistrail_bundle_from_zip_xml(filename):
                                        unknown_files)
     if vistrail is None:
         raise VistrailsDBException("vt file does not contain vistrail")
+    if log_segments:
+        log_fname = compact_log_segments(vt_save_dir, log_segments)
     vistrail.db_log_filename = log_fname
 
     # call package hooks
@@ -894,9 +994,12 @@ def save_vistrail_bundle_to_zip_xml(save_bundle, filename, vt_save_dir=None, ver
             shutil.copyfile(save_bundle.vistrail.db_log_filename, xml_fname)
             save_bundle.vistrail.db_log_filename = xml_fname
 
+    log_segment = None
     if save_bundle.log is not None:
         xml_fname = os.path.join(vt_save_dir, 'log')
-        save_log_to_xml(save_bundle.log, xml_fname, version, True)
+        log_segment = get_log_segment(save_bundle.log, version)
+        with open(xml_fname, 'ab') as f:
+            f.write(log_segment)
         save_bundle.vistrail.db_log_filename = xml_fname
 
     # Save Abstractions
@@ -973,21 +1076,27 @@ def save_vistrail_bundle_to_zip_xml(save_bundle, filename, vt_save_dir=None, ver
             package.saveVistrailFileHook(save_bundle.vistrail, vt_save_dir)
     except Exception, e:
         debug.warning("Could not call package hooks", str(e))
-    tmp_zip_dir = tempfile.mkdtemp(prefix='vt_zip')
-    tmp_zip_file = os.path.join(tmp_zip_dir, "vt.zip")
 
-    z = zipfile.ZipFile(tmp_zip_file, 'w')
-    try:
-        with Chdir(vt_save_dir):
-            # zip current directory
-            for root, dirs, files in os.walk('.'):
-                for f in files:
-                    z.write(os.path.join(root, f))
-        z.close()
-        shutil.copyfile(tmp_zip_file, filename)
-    finally:
-        os.unlink(tmp_zip_file)
-        os.rmdir(tmp_zip_dir)
+    # If only the log changed, the new executions are appended to the
+    # existing file as a new segment instead of rewriting everything
+    if log_segment is None or \
+            not append_log_segment(filename, vt_save_dir, log_segment):
+        tmp_zip_dir = tempfile.mkdtemp(prefix='vt_zip')
+        tmp_zip_file = os.path.join(tmp_zip_dir, "vt.zip")
+
+        z = zipfile.ZipFile(tmp_zip_file, 'w')
+        try:
+            with Chdir(vt_save_dir):
+                # zip current directory
+                for root, dirs, files in os.walk('.'):
+                    for f in files:
+                        z.write(os.path.join(root, f))
+            z.close()
+            shutil.copyfile(tmp_zip_file, filename)
+            record_zip_manifest(filename, vt_save_dir, z.infolist())
+        finally:
+            os.unlink(tmp_zip_file)
+            os.rmdir(tmp_zip_dir)
     save_bundle = SaveBundle(save_bundle.bundle_type, save_bundle.vistrail,
                              save_bundle.log, thumbnails=saved_thumbnails,
                              abstractions=saved_abstractions,
@@ -1178,7 +1287,9 @@ def get_saved_workflows(vistrail, db_connection):
     if not vistrail.db_id:
         return []
     c = db_connection.cursor()
-    c.execute("SELECT parent_id FROM workflow WHERE vistrail_id=%s;", (vistrail.db_id,))
+    command = format_prepared_statement(
+        "SELECT parent_id FROM workflow WHERE vistrail_id=%s;", db_connection)
+    c.execute(command, (vistrail.db_id,))
     ids = [i[0] for i in c.fetchall()]
     c.close()
     return ids
@@ -1186,38 +1297,109 @@ def get_saved_workflows(vistrail, db_connection):
 ##############################################################################
 # Logging I/O
 
-def open_log_from_xml(filename, was_appended=False):
-    """open_log_from_xml(filename) -> DBLog"""
+class _AppendedLogFile(object):
+    """Wraps a log written in append mode (a sequence of workflowExec
+    elements without a root) so it reads as a single <log> document."""
+
+    def __init__(self, f):
+        self._f = f
+        self._state = 0
+
+    def read(self, size=-1):
+        if self._state == 0:
+            self._state = 1
+            return "<log>\n"
+        if self._state == 1:
+            data = self._f.read(size)
+            if data:
+                return data
+            self._state = 2
+        if self._state == 2:
+            self._state = 3
+            return "</log>\n"
+        return ""
+
+def _workflow_exec_filter(versions=None, start_time=None, end_time=None):
+    """Returns a function accepting the workflow executions of a version
+    in the (first, last) range of versions that started between
+    start_time and end_time, or None if no restriction is given."""
+    if versions is None and start_time is None and end_time is None:
+        return None
+    def accept(workflow_exec):
+        if versions is not None:
+            version = workflow_exec.db_parent_version
+            if version is None or not versions[0] <= version <= versions[1]:
+                return False
+        ts_start = workflow_exec.db_ts_start
+        if start_time is not None and (ts_start is None or
+                                       ts_start < start_time):
+            return False
+        if end_time is not None and (ts_start is None or
+                                     ts_start > end_time):
+            return False
+        return True
+    return accept
+
+def open_log_from_xml(filename, was_appended=False, versions=None,
+                      start_time=None, end_time=None):
+    """open_log_from_xml(filename, was_appended: bool, versions: (int, int),
+                         start_time: datetime, end_time: datetime) -> DBLog
+
+    The file is parsed incrementally. If versions or start_time/end_time
+    are given, only the workflow executions of these versions that
+    started in that time window are loaded.
+
+    """
+    accept = _workflow_exec_filter(versions, start_time, end_time)
     if was_appended:
-        parser = ElementTree.XMLTreeBuilder()
-        parser.feed("<log>\n")
-        f = open(filename, "rb")
-        parser.feed(f.read())
-        parser.feed("</log>\n")
-        root = parser.close()
         workflow_execs = []
-        for node in root:
-            version = get_version_for_xml(node)
-            daoList = getVersionDAO(version)
-            workflow_exec = \
-                daoList.read_xml_object(DBWorkflowExec.vtType, node)
-            if version != currentVersion:
-                # if version is wrong, dump this into a dummy log object, 
-                # then translate, then get workflow_exec back
-                log = DBLog()
-                translate_log(log, currentVersion, version)
-                log.db_add_workflow_exec(workflow_exec)
-                log = translate_log(log, version)
-                workflow_exec = log.db_workflow_execs[0]
-            workflow_execs.append(workflow_exec)
+        with open(filename, 'rb') as f:
+            root = None
+            depth = 0
+            for event, node in ElementTree.iterparse(_AppendedLogFile(f),
+                                                     ('start', 'end')):
+                if event == 'start':
+                    if root is None:
+                        root = node
+                    depth += 1
+                    continue
+                depth -= 1
+                if depth != 1:
+                    continue
+                version = get_version_for_xml(node)
+                daoList = getVersionDAO(version)
+                workflow_exec = \
+                    daoList.read_xml_object(DBWorkflowExec.vtType, node)
+                # iterparse reads ahead, so node is near the end
+                for i in xrange(len(root) - 1, -1, -1):
+                    if root[i] is node:
+                        del root[i]
+                        break
+                if version != currentVersion:
+                    # if version is wrong, dump this into a dummy log object, 
+                    # then translate, then get workflow_exec back
+                    log = DBLog()
+                    translate_log(log, currentVersion, version)
+                    log.db_add_workflow_exec(workflow_exec)
+                    log = translate_log(log, version)
+                    workflow_exec = log.db_workflow_execs[0]
+                if accept is None or accept(workflow_exec):
+                    workflow_execs.append(workflow_exec)
         log = DBLog(workflow_execs=workflow_execs)
         vistrails.db.services.log.update_ids(log)
     else:
-        tree = ElementTree.parse(filename)
-        version = get_version_for_xml(tree.getroot())
+        version = get_version_for_xml_file(filename)
         daoList = getVersionDAO(version)
-        log = daoList.open_from_xml(filename, DBLog.vtType, tree)
-        log = translate_log(log, version)
+        if hasattr(daoList, 'stream_from_xml'):
+            log = daoList.stream_from_xml(filename, DBLog.vtType, accept)
+            log = translate_log(log, version)
+        else:
+            log = daoList.open_from_xml(filename, DBLog.vtType)
+            log = translate_log(log, version)
+            if accept is not None:
+                for workflow_exec in list(log.db_workflow_execs):
+                    if not accept(workflow_exec):
+                        log.db_delete_workflow_exec(workflow_exec)
         vistrails.db.services.log.update_id_scope(log)
     return log
 
@@ -1245,12 +1427,13 @@ def open_vt_log_from_db(db_connection, vt_id, version=None):
     if db_connection is not None:
         try:
             c = db_connection.cursor()
-            # FIXME MySQL versus sqlite3
-            res = c.execute("SELECT id FROM log_tbl WHERE vistrail_id=%s;", (vt_id,))
+            command = format_prepared_statement(
+                "SELECT id FROM log_tbl WHERE vistrail_id=%s;", db_connection)
+            res = c.execute(command, (vt_id,))
             ids = [i[0] for i in c.fetchall()]
             c.close()
-        except get_db_lib().Error, e:
-            debug.critical("Error getting log id:s %d: %s" % (e.args[0], e.args[1]))
+        except get_db_lib(db_connection).Error, e:
+            debug.critical("Error getting log id:s %s" % db_error_message(e))
     log = DBLog()
     if hasattr(dao_list, 'open_many_from_db'): # does not exist pre 1.0.2
         logs = dao_list.open_many_from_db(db_connection, DBLog.vtType, ids)
@@ -1327,6 +1510,161 @@ def save_log_bundle_to_db(save_bundle, db_connection, do_copy=False,
     log = save_log_to_db(save_bundle.log, db_connection, do_copy, version)
     return SaveBundle(DBLog.vtType, log=log)
 
+def get_log_segment(log, version=None):
+    """get_log_segment(log: DBLog, version: str) -> str
+    Returns the workflow executions of log serialized the way
+    save_log_to_xml(..., do_append=True) writes them.
+
+    """
+    (fd, fname) = tempfile.mkstemp(prefix='vt_log')
+    os.close(fd)
+    try:
+        save_log_to_xml(log, fname, version, True)
+        with open(fname, 'rb') as f:
+            return f.read()
+    finally:
+        os.unlink(fname)
+
+# What the files of each vt_save_dir were when they were last written to
+# or read from a vt file: vt_save_dir -> (vt filename, (size, mtime) of the
+# vt file, time recorded, {member name: (size, mtime, CRC)})
+_zip_manifests = {}
+
+# Files modified this close to the time their manifest was recorded might
+# change again without a different modification time
+MANIFEST_RACY_DELAY = 2
+
+def record_zip_manifest(filename, vt_save_dir, infolist):
+    """record_zip_manifest(filename: str, vt_save_dir: str,
+                           infolist: list) -> None
+    Remembers the size, modification time and CRC of the files of
+    vt_save_dir that were just stored in (or extracted from) the vt file
+    filename, whose members are described by infolist.
+
+    """
+    files = {}
+    for info in infolist:
+        path = os.path.join(vt_save_dir, *info.filename.split('/'))
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            if stat.st_size == info.file_size:
+                files[info.filename] = (stat.st_size, stat.st_mtime,
+                                        info.CRC)
+    stat = os.stat(filename)
+    _zip_manifests[vt_save_dir] = (os.path.abspath(filename),
+                                   (stat.st_size, stat.st_mtime),
+                                   time.time(), files)
+
+def append_log_segment(filename, vt_save_dir, log_segment):
+    """append_log_segment(filename: str, vt_save_dir: str,
+                          log_segment: str) -> bool
+    Adds log_segment to the vt file filename as a new member of the
+    'log_segments' directory, without rewriting the file. This is only
+    possible if every other file in vt_save_dir is already in the vt
+    file unchanged, and if the log stored there is what the log in
+    vt_save_dir was before log_segment was appended to it; otherwise
+    nothing is done and False is returned.
+
+    The files are compared using the manifest recorded when the vt file
+    was last written or opened, so only the ones modified since are read.
+    The segment is added to a copy of the vt file that then replaces it,
+    so the file is never left half-written.
+
+    """
+    manifest = _zip_manifests.get(vt_save_dir)
+    if manifest is None or not os.path.isfile(filename):
+        return False
+    vt_filename, vt_stat, recorded, files = manifest
+    stat = os.stat(filename)
+    if (vt_filename != os.path.abspath(filename) or
+            vt_stat != (stat.st_size, stat.st_mtime)):
+        return False
+    z = zipfile.ZipFile(filename, 'r')
+    try:
+        members = dict((info.filename, info) for info in z.infolist())
+    finally:
+        z.close()
+
+    log_size = 0
+    segment_ids = []
+    for name, info in members.iteritems():
+        if name.startswith('log_segments/'):
+            try:
+                segment_ids.append(int(name[len('log_segments/'):]))
+            except ValueError:
+                return False
+            log_size += info.file_size
+        elif name == 'log':
+            log_size += info.file_size
+
+    stored = set(['log'])
+    for root, dirs, fnames in os.walk(vt_save_dir):
+        for fname in fnames:
+            path = os.path.join(root, fname)
+            name = os.path.relpath(path, vt_save_dir).replace(os.sep, '/')
+            stat = os.stat(path)
+            if name == 'log':
+                if stat.st_size != log_size + len(log_segment):
+                    return False
+                continue
+            info = members.get(name)
+            if info is None or info.file_size != stat.st_size:
+                return False
+            known = files.get(name)
+            if (known is not None and
+                    known[:2] == (stat.st_size, stat.st_mtime) and
+                    stat.st_mtime < recorded - MANIFEST_RACY_DELAY):
+                crc = known[2]
+            else:
+                with open(path, 'rb') as f:
+                    crc = zlib.crc32(f.read()) & 0xffffffff
+            if crc != info.CRC:
+                return False
+            stored.add(name)
+    if any(name not in stored and not name.startswith('log_segments/')
+           for name in members):
+        return False
+
+    fd, tmp_filename = tempfile.mkstemp(
+            prefix='.vt_append', dir=os.path.dirname(os.path.abspath(filename)))
+    os.close(fd)
+    try:
+        shutil.copyfile(filename, tmp_filename)
+        shutil.copymode(filename, tmp_filename)
+        z = zipfile.ZipFile(tmp_filename, 'a')
+        try:
+            z.writestr('log_segments/%d' % (max(segment_ids or [0]) + 1),
+                       log_segment)
+        finally:
+            z.close()
+        if sys.platform.startswith('win'):
+            os.remove(filename)
+        os.rename(tmp_filename, filename)
+    except Exception:
+        if os.path.exists(tmp_filename):
+            os.unlink(tmp_filename)
+        raise
+    record_zip_manifest(filename, vt_save_dir, members.values())
+    return True
+
+def compact_log_segments(vt_save_dir, log_segments):
+    """compact_log_segments(vt_save_dir: str, log_segments: list) -> str
+    Appends the log segments extracted from a vt file to its 'log' file
+    (in order) and removes them, so the directory holds a single log.
+    Returns the name of the log file.
+
+    """
+    log_fname = os.path.join(vt_save_dir, 'log')
+    def segment_id(fname):
+        return int(os.path.basename(fname))
+    with open(log_fname, 'ab') as log_file:
+        for fname in sorted(log_segments, key=segment_id):
+            with open(fname, 'rb') as f:
+                shutil.copyfileobj(f, log_file)
+            os.unlink(fname)
+    os.rmdir(os.path.join(vt_save_dir, 'log_segments'))
+    return log_fname
+
 def merge_logs(new_log, vt_log_fname):
     log = open_log_from_xml(vt_log_fname, True)
     for workflow_exec in new_log.db_workflow_execs:
@@ -1526,15 +1864,15 @@ def open_thumbnails_from_db(db_connection, obj_type, obj_id, tmp_dir=None):
     SELECT a.value
     FROM action_annotation a
     WHERE a.akey = '__thumb__' AND a.entity_id = ? AND a.entity_type = ?
-    """)
+    """, db_connection)
     try:
         c = db_connection.cursor()
         c.execute(prepared_statement, (obj_id, obj_type))
         file_names = [file_name for (file_name,) in c.fetchall()]
         c.close()
-    except get_db_lib().Error, e:
-        msg = "Couldn't get thumbnails list from db (%d : %s)" % \
-            (e.args[0], e.args[1])
+    except get_db_lib(db_connection).Error, e:
+        msg = "Couldn't get thumbnails list from db (%s)" % \
+            db_error_message(e)
         raise VistrailsDBException(msg)
     # Next get all thumbnails from the db that aren't already in tmp_dir
     get_db_file_names = [fname for fname in file_names if fname not in os.listdir(tmp_dir)]
@@ -1544,15 +1882,15 @@ def open_thumbnails_from_db(db_connection, obj_type, obj_id, tmp_dir=None):
         SELECT t.image_bytes
         FROM thumbnail t
         WHERE t.file_name = ?
-        """)
+        """, db_connection)
         try:
             c = db_connection.cursor()
             c.execute(prepared_statement, (file_name,))
             row = c.fetchone()
             c.close()
-        except get_db_lib().Error, e:
-            msg = "Couldn't get thumbnail from db (%d : %s)" % \
-                (e.args[0], e.args[1])
+        except get_db_lib(db_connection).Error, e:
+            msg = "Couldn't get thumbnail from db (%s)" % \
+                db_error_message(e)
             raise VistrailsDBException(msg)
         if row is not None:
             image_bytes = row[0]
@@ -1582,23 +1920,22 @@ def save_thumbnails_to_db(absfnames, db_connection):
         return None
 
     # Determine which thumbnails already exist in db
-    statement = """
+    check_file_names = tuple(os.path.basename(absfname)
+                             for absfname in absfnames)
+    prepared_statement = format_prepared_statement(
+    """
     SELECT t.file_name
     FROM thumbnail t
-    WHERE t.file_name IN %s
-    """
-    check_file_names = [os.path.basename(absfname).replace("'", "''").replace("\\", "\\\\") for absfname in absfnames]
-    # SQL syntax needs SOMETHING if list is empty - use filename that's illegal on all platforms
-    check_file_names.append(':/')
-    sql_in_token = str(tuple(check_file_names))
+    WHERE t.file_name IN (%s)
+    """ % ', '.join(['?'] * len(check_file_names)), db_connection)
     try:
         c = db_connection.cursor()
-        c.execute(statement % sql_in_token)
+        c.execute(prepared_statement, check_file_names)
         db_file_names = [file_name for (file_name,) in c.fetchall()]
         c.close()
-    except get_db_lib().Error, e:
-        msg = "Couldn't check which thumbnails already exist in db (%d : %s)" % \
-            (e.args[0], e.args[1])
+    except get_db_lib(db_connection).Error, e:
+        msg = "Couldn't check which thumbnails already exist in db (%s)" % \
+            db_error_message(e)
         raise VistrailsDBException(msg)
     insert_absfnames = [absfname for absfname in absfnames if os.path.basename(absfname) not in db_file_names]
 
@@ -1607,22 +1944,23 @@ def save_thumbnails_to_db(absfnames, db_connection):
     """
     INSERT INTO thumbnail(file_name, image_bytes, last_modified)
     VALUES (?, ?, ?)
-    """)
+    """, db_connection)
     try:
         c = db_connection.cursor()
         for absfname in insert_absfnames:
             image_file = open(absfname, 'rb')
             image_bytes = image_file.read()
             image_file.close()
+            image_bytes = get_db_lib(db_connection).Binary(image_bytes)
             c.execute(prepared_statement, (os.path.basename(absfname), image_bytes, strftime(get_current_time(db_connection), '%Y-%m-%d %H:%M:%S')))
             db_connection.commit()
         c.close()
     except IOError, e:
         msg = "Couldn't read thumbnail file for writing to db: %s" % absfname
         raise VistrailsDBException(msg)
-    except get_db_lib().Error, e:
-        msg = "Couldn't insert thumbnail into db (%d : %s)" % \
-            (e.args[0], e.args[1])
+    except get_db_lib(db_connection).Error, e:
+        msg = "Couldn't insert thumbnail into db (%s)" % \
+            db_error_message(e)
         raise VistrailsDBException(msg)
     return None
 ##############################################################################
@@ -1777,6 +2115,18 @@ def get_version_for_xml(root):
     msg = "Cannot find version information"
     raise VistrailsDBException(msg)
 
+def get_version_for_xml_file(filename):
+    """get_version_for_xml_file(filename) -> str
+    Returns the version of an XML file, only reading up to its root
+    element.
+
+    """
+    with open(filename, 'rb') as f:
+        for event, root in ElementTree.iterparse(f, ('start',)):
+            return get_version_for_xml(root)
+    msg = "Cannot find version information"
+    raise VistrailsDBException(msg)
+
 def get_type_for_xml(root):
     return root.tag
 
@@ -1785,17 +2135,16 @@ def get_current_time(db_connection=None):
     if db_connection is not None:
         try:
             c = db_connection.cursor()
-            # FIXME MySQL versus sqlite3
-            c.execute("SELECT NOW();")
-            # c.execute("SELECT DATETIME('NOW');")
+            if get_db_dialect(db_connection) == 'sqlite':
+                c.execute("SELECT DATETIME('now', 'localtime');")
+            else:
+                c.execute("SELECT NOW();")
             row = c.fetchone()
             if row:
-                # FIXME MySQL versus sqlite3
-                timestamp = row[0]
-                # timestamp = strptime(row[0], '%Y-%m-%d %H:%M:%S')
+                timestamp = get_db_datetime(row[0])
             c.close()
-        except get_db_lib().Error, e:
-            debug.critical("Logger Error %d: %s" % (e.args[0], e.args[1]))
+        except get_db_lib(db_connection).Error, e:
+            debug.critical("Logger Error %s" % db_error_message(e))
 
     return timestamp
 
@@ -1872,3 +2221,342 @@ class TestDBIO(unittest.TestCase):
                 self.fail(str(e))
         finally:
             os.rmdir(testdir)
+
+    def test_sqlite_roundtrip(self):
+        """test saving and reopening a vistrail in a sqlite database"""
+
+        testdir = tempfile.mkdtemp(prefix='vt_')
+        config = {'dialect': 'sqlite',
+                  'db': os.path.join(testdir, 'vistrails.db')}
+        try:
+            (save_bundle, vt_save_dir) = open_bundle_from_zip_xml(
+                DBVistrail.vtType,
+                os.path.join(vistrails.core.system.vistrails_root_directory(),
+                             'tests/resources/dummy_new.vt'))
+            db_connection = open_db_connection(config)
+            try:
+                self.assertEqual(get_db_dialect(db_connection), 'sqlite')
+                setup_db_tables(db_connection)
+                save_bundle = save_bundle_to_db(save_bundle, db_connection,
+                                                do_copy=True)
+                vt_id = save_bundle.vistrail.db_id
+                bundle = open_bundle_from_db(DBVistrail.vtType,
+                                             db_connection, vt_id)
+                self.assertEqual(
+                    sorted(a.db_id for a in bundle.vistrail.db_actions),
+                    sorted(a.db_id for a in save_bundle.vistrail.db_actions))
+                self.assertEqual(
+                    sorted(t.db_name for t in bundle.vistrail.db_tags),
+                    sorted(t.db_name for t in save_bundle.vistrail.db_tags))
+            finally:
+                close_db_connection(db_connection)
+            self.assertIn(vt_id, [row[0] for row in
+                                  get_db_object_list(config,
+                                                     DBVistrail.vtType)])
+        finally:
+            shutil.rmtree(testdir)
+
+    def test_sqlite_groups(self):
+        """test that nested group workflows are reloaded from the database"""
+
+        def group_workflows(vistrail):
+            res = {}
+            def add_group(path, group):
+                workflow = group.db_workflow
+                res[path] = sorted(m.db_id for m in workflow.db_modules)
+                for module in workflow.db_modules:
+                    if module.vtType == DBGroup.vtType:
+                        add_group(path + (module.db_id,), module)
+            for action in vistrail.db_actions:
+                for op in action.db_operations:
+                    if op.vtType == 'add' and op.db_what == DBGroup.vtType:
+                        add_group((action.db_id, op.db_objectId), op.db_data)
+            return res
+
+        testdir = tempfile.mkdtemp(prefix='vt_')
+        config = {'dialect': 'sqlite',
+                  'db': os.path.join(testdir, 'vistrails.db')}
+        try:
+            (save_bundle, vt_save_dir) = open_bundle_from_zip_xml(
+                DBVistrail.vtType,
+                os.path.join(
+                    vistrails.core.system.vistrails_examples_directory(),
+                    'primes.vt'))
+            db_connection = open_db_connection(config)
+            try:
+                setup_db_tables(db_connection)
+                save_bundle = save_bundle_to_db(save_bundle, db_connection,
+                                                do_copy=True)
+                expected = group_workflows(save_bundle.vistrail)
+                # primes.vt has groups inside groups
+                self.assertTrue(any(len(path) > 2 for path in expected))
+                bundle = open_bundle_from_db(DBVistrail.vtType,
+                                             db_connection,
+                                             save_bundle.vistrail.db_id)
+                self.assertEqual(group_workflows(bundle.vistrail), expected)
+            finally:
+                close_db_connection(db_connection)
+        finally:
+            shutil.rmtree(testdir)
+
+    def test_sqlite_bulk_commands(self):
+        """test that rows with ids are written in bulk before the rows
+        that need a generated key"""
+
+        daoList = getVersionDAO(currentVersion)
+        dao = daoList['sql'][DBAnnotation.vtType]
+        db_connection = open_sqlite_connection(':memory:')
+        try:
+            db_connection.execute("CREATE TABLE t1(id INTEGER PRIMARY KEY, "
+                                  "name TEXT, value TEXT);")
+            db_connection.execute("CREATE TABLE t2(id INTEGER PRIMARY KEY, "
+                                  "t1_id INTEGER, value TEXT);")
+            new = DBAnnotation()
+            commands = [(new, dao.createSQLInsert('t1', {'name': 'new',
+                                                         'value': 'x'}))]
+            for i in xrange(1, 4):
+                obj = DBAnnotation(id=i)
+                commands.append((obj, dao.createSQLInsert(
+                            't1', {'id': i, 'name': 'a%d' % i, 'value': 'x'})))
+                commands.append((obj, dao.createSQLInsert(
+                            't2', {'id': i, 't1_id': i, 'value': 'b%d' % i})))
+            commands.append((DBAnnotation(id=1), dao.createSQLUpdate(
+                        't1', {'value': 'y'}, {'id': 1})))
+            result = daoList.execute_sql_commands(db_connection, commands)
+            # the key is generated after the rows with ids were written
+            self.assertEqual(result, {new: 4})
+            self.assertEqual(
+                db_connection.execute("SELECT * FROM t1 ORDER BY id;")
+                    .fetchall(),
+                [(1, 'a1', 'y'), (2, 'a2', 'x'), (3, 'a3', 'x'),
+                 (4, 'new', 'x')])
+            self.assertEqual(
+                db_connection.execute("SELECT * FROM t2 ORDER BY id;")
+                    .fetchall(),
+                [(1, 1, 'b1'), (2, 2, 'b2'), (3, 3, 'b3')])
+        finally:
+            db_connection.close()
+
+    def test_multi_insert(self):
+        """test that inserts into the same table and columns are
+        rewritten into multi-row inserts for MySQL"""
+
+        dao = getVersionDAO(currentVersion)['sql'][DBAnnotation.vtType]
+        dao.ROWS_PER_INSERT = 2
+        self.addCleanup(delattr, dao, 'ROWS_PER_INSERT')
+        a1, a2, a3 = [dao.createSQLInsert('t1', {'id': i, 'name': 'a%d' % i})
+                      for i in xrange(1, 4)]
+        b1 = dao.createSQLInsert('t2', {'id': 1, 'value': 'b1'})
+        update = dao.createSQLUpdate('t1', {'name': 'c1'}, {'id': 1})
+        # the commands are only quoted, SQLite runs them as MySQL would
+        db_connection = open_sqlite_connection(':memory:')
+        try:
+            commands = dao.createSQLMultiInsert(db_connection,
+                                                [a1, b1, update, a2, a3])
+            head, row = a1[0].rstrip(';').split(' VALUES ')
+            self.assertEqual(commands[0], '%s VALUES %s,%s;' % (
+                    head, row % dao.escapeSQL(db_connection, a1[1]),
+                    row % dao.escapeSQL(db_connection, a2[1])))
+            self.assertEqual(len(commands), 4)
+
+            db_connection.execute("CREATE TABLE t1(id INTEGER PRIMARY KEY, "
+                                  "name TEXT);")
+            db_connection.execute("CREATE TABLE t2(id INTEGER PRIMARY KEY, "
+                                  "value TEXT);")
+            for bundle in dao.bundleSQL(commands):
+                db_connection.executescript(bundle)
+            self.assertEqual(
+                db_connection.execute("SELECT * FROM t1 ORDER BY id;")
+                    .fetchall(),
+                [(1, 'c1'), (2, 'a2'), (3, 'a3')])
+            self.assertEqual(
+                db_connection.execute("SELECT * FROM t2;").fetchall(),
+                [(1, 'b1')])
+        finally:
+            db_connection.close()
+
+    def test_bundle_size(self):
+        """test that large bulk writes are split into bounded queries"""
+
+        dao = getVersionDAO(currentVersion)['sql'][DBAnnotation.vtType]
+        dao.BUNDLE_BYTES = 10000
+        self.addCleanup(delattr, dao, 'BUNDLE_BYTES')
+        db_connection = open_sqlite_connection(':memory:')
+        try:
+            rows = [dao.createSQLInsert('t1', {'id': i, 'name': 'x' * 50})
+                    for i in xrange(10000)]
+            commands = dao.createSQLMultiInsert(db_connection, rows)
+            # rows are split by size before the row count is reached
+            self.assertLess(max(c.count('),(') + 1 for c in commands),
+                            dao.ROWS_PER_INSERT)
+            self.assertEqual(sum(c.count('),(') + 1 for c in commands),
+                             len(rows))
+            bundles = list(dao.bundleSQL(commands))
+            self.assertGreater(len(bundles), 1)
+            self.assertTrue(all(len(b) <= dao.BUNDLE_BYTES for b in bundles))
+            self.assertEqual(''.join(bundles), ''.join(commands))
+
+            # a command over the budget is sent alone
+            bundles = list(dao.bundleSQL(['a' * 20000, 'b', 'c']))
+            self.assertEqual(bundles, ['a' * 20000, 'bc'])
+            dao.BUNDLE_SIZE = 2
+            self.addCleanup(delattr, dao, 'BUNDLE_SIZE')
+            self.assertEqual(list(dao.bundleSQL(['a', 'b', 'c'])),
+                             ['ab', 'c'])
+        finally:
+            db_connection.close()
+
+    def test_stream_vistrail(self):
+        """test that streaming gives the same vistrail as a full parse"""
+
+        filename = os.path.join(
+            vistrails.core.system.vistrails_root_directory(),
+            'tests/resources/test-streaming.vt')
+        testdir = tempfile.mkdtemp(prefix='vt_')
+        try:
+            vt_fname = os.path.join(testdir, 'vistrail')
+            with open(vt_fname, 'wb') as f:
+                f.write(zipfile.ZipFile(filename).read('vistrail'))
+            daoList = getVersionDAO(currentVersion)
+            streamed = daoList.stream_from_xml(vt_fname, DBVistrail.vtType)
+            parsed = daoList.open_from_xml(vt_fname, DBVistrail.vtType)
+        finally:
+            shutil.rmtree(testdir)
+        self.assertFalse(streamed.is_dirty)
+        self.assertEqual(
+                ElementTree.tostring(daoList.write_xml_object(streamed)),
+                ElementTree.tostring(daoList.write_xml_object(parsed)))
+
+    def test_appended_log(self):
+        """test reading a log written in append mode, with filters"""
+
+        filename = os.path.join(
+            vistrails.core.system.vistrails_root_directory(),
+            'tests/resources/test-streaming.vt')
+        testdir = tempfile.mkdtemp(prefix='vt_')
+        try:
+            log_fname = os.path.join(testdir, 'log')
+            with open(log_fname, 'wb') as f:
+                f.write(zipfile.ZipFile(filename).read('log'))
+            log = open_log_from_xml(log_fname, True)
+            self.assertEqual(len(log.db_workflow_execs), 62)
+            versions = set(w.db_parent_version for w in log.db_workflow_execs)
+            version = min(versions)
+            log = open_log_from_xml(log_fname, True,
+                                    versions=(version, version))
+            self.assertTrue(log.db_workflow_execs)
+            self.assertTrue(all(w.db_parent_version == version
+                                for w in log.db_workflow_execs))
+            log = open_log_from_xml(log_fname, True,
+                                    end_time=datetime(2000, 1, 1))
+            self.assertEqual(log.db_workflow_execs, [])
+        finally:
+            shutil.rmtree(testdir)
+
+    def test_log_segments(self):
+        """test that saving only new executions appends a log segment"""
+
+        def new_log(version):
+            log = DBLog()
+            log.db_add_workflow_exec(DBWorkflowExec(
+                    id=1, parent_version=version, completed=1,
+                    ts_start=datetime(2014, 1, 1), ts_end=datetime(2014, 1, 1)))
+            return log
+
+        testdir = tempfile.mkdtemp(prefix='vt_')
+        filename = os.path.join(testdir, 'dummy_new.vt')
+        vt_save_dirs = []
+        try:
+            (save_bundle, vt_save_dir) = open_bundle_from_zip_xml(
+                DBVistrail.vtType,
+                os.path.join(vistrails.core.system.vistrails_root_directory(),
+                             'tests/resources/dummy_new.vt'))
+            vt_save_dirs.append(vt_save_dir)
+            save_bundle.log = new_log(1)
+            save_bundle_to_zip_xml(save_bundle, filename, vt_save_dir)
+            save_bundle.log = new_log(2)
+            save_bundle_to_zip_xml(save_bundle, filename, vt_save_dir)
+            self.assertIn('log_segments/1', zipfile.ZipFile(filename).namelist())
+
+            (save_bundle, vt_save_dir) = open_bundle_from_zip_xml(
+                DBVistrail.vtType, filename)
+            vt_save_dirs.append(vt_save_dir)
+            log_fname = save_bundle.vistrail.db_log_filename
+            self.assertEqual(os.path.dirname(log_fname), vt_save_dir)
+            self.assertFalse(os.path.exists(os.path.join(vt_save_dir,
+                                                         'log_segments')))
+            log = open_log_from_xml(log_fname, True)
+            self.assertEqual([w.db_parent_version
+                              for w in log.db_workflow_execs], [1, 2])
+
+            # changing the vistrail rewrites and compacts the file
+            save_bundle.vistrail.db_name = 'changed'
+            save_bundle.log = new_log(3)
+            save_bundle_to_zip_xml(save_bundle, filename, vt_save_dir)
+            self.assertNotIn('log_segments/1',
+                             zipfile.ZipFile(filename).namelist())
+            (save_bundle, vt_save_dir) = open_bundle_from_zip_xml(
+                DBVistrail.vtType, filename)
+            vt_save_dirs.append(vt_save_dir)
+            log = open_log_from_xml(save_bundle.vistrail.db_log_filename,
+                                    True)
+            self.assertEqual([w.db_parent_version
+                              for w in log.db_workflow_execs], [1, 2, 3])
+        finally:
+            for vt_save_dir in vt_save_dirs:
+                close_zip_xml(vt_save_dir)
+            shutil.rmtree(testdir)
+
+    def test_log_segment_manifest(self):
+        """test that appending a log segment only reads the changed files,
+        and replaces the vt file instead of modifying it"""
+
+        def new_log(version):
+            log = DBLog()
+            log.db_add_workflow_exec(DBWorkflowExec(
+                    id=1, parent_version=version, completed=1,
+                    ts_start=datetime(2014, 1, 1), ts_end=datetime(2014, 1, 1)))
+            return log
+
+        testdir = tempfile.mkdtemp(prefix='vt_')
+        filename = os.path.join(testdir, 'dummy_new.vt')
+        vt_save_dir = None
+        try:
+            (save_bundle, vt_save_dir) = open_bundle_from_zip_xml(
+                DBVistrail.vtType,
+                os.path.join(vistrails.core.system.vistrails_root_directory(),
+                             'tests/resources/dummy_new.vt'))
+            os.mkdir(os.path.join(vt_save_dir, 'thumbs'))
+            mtime = time.time() - 3600
+            thumbnail = os.path.join(vt_save_dir, 'thumbs', 'a.png')
+            with open(thumbnail, 'wb') as f:
+                f.write('a' * 100)
+            os.utime(thumbnail, (mtime, mtime))
+            save_bundle.log = new_log(1)
+            save_bundle_to_zip_xml(save_bundle, filename, vt_save_dir)
+            inode = os.stat(filename).st_ino
+
+            save_bundle.log = new_log(2)
+            save_bundle_to_zip_xml(save_bundle, filename, vt_save_dir)
+            self.assertIn('log_segments/1', zipfile.ZipFile(filename).namelist())
+            self.assertNotEqual(os.stat(filename).st_ino, inode)
+            self.assertEqual(os.listdir(testdir), ['dummy_new.vt'])
+
+            # the manifest says the thumbnail is unchanged, it is not read
+            with open(thumbnail, 'wb') as f:
+                f.write('b' * 100)
+            os.utime(thumbnail, (mtime, mtime))
+            save_bundle.log = new_log(3)
+            save_bundle_to_zip_xml(save_bundle, filename, vt_save_dir)
+            self.assertIn('log_segments/2', zipfile.ZipFile(filename).namelist())
+
+            # once modified, it is compared and the file is rewritten
+            os.utime(thumbnail, None)
+            save_bundle.log = new_log(4)
+            save_bundle_to_zip_xml(save_bundle, filename, vt_save_dir)
+            z = zipfile.ZipFile(filename)
+            self.assertNotIn('log_segments/1', z.namelist())
+            self.assertEqual(z.read('thumbs/a.png'), 'b' * 100)
+        finally:
+            close_zip_xml(vt_save_dir)
+            shutil.rmtree(testdir)
@@ -219,6 +219,8 @@ class BaseLocator(object):
                 args['version_tag'] = workflow_arg
         if 'workflow_exec' in parsed_dict:
             args['workflow_exec'] = parsed_dict['workflow_exec'][0]
+        if 'dialect' in parsed_dict:
+            args['dialect'] = parsed_dict['dialect'][0]
         if 'parameterExploration' in parsed_dict:
             args['parameterExploration'] = \
                                         parsed_dict['parameterExploration'][0]
@@ -254,6 +256,8 @@ class BaseLocator(object):
             generate_dict['mashup'] = args['mashup']
         if 'workflow_exec' in args and args['workflow_exec']:
             generate_dict['workflow_exec'] = args['workflow_exec']
+        if 'dialect' in args and args['dialect']:
+            generate_dict['dialect'] = args['dialect']
         return urllib.urlencode(generate_dict)
 
 
@@ -728,6 +732,9 @@ class ZIPFileLocator(XMLFileLocator):
 #     def load(self, type):
         
 class DBLocator(BaseLocator):
+    # whether loaded and saved bundles are kept in cache; processes that
+    # manage their own cache turn this off
+    use_cache = True
     cache = {}
     cache_timestamps = {}
     connections = {}
@@ -754,6 +761,8 @@ class DBLocator(BaseLocator):
         else:
             self._mshpversion = self.kwargs.get('mashup', None)
         self._parameterexploration = self.kwargs.get('parameterExploration', None)
+        # 'sqlite' means database is the path of a local SQLite file
+        self._dialect = self.kwargs.get('dialect', None) or 'mysql'
         
     def _get_host(self):
         return self._host
@@ -767,6 +776,10 @@ class DBLocator(BaseLocator):
         return self._db
     db = property(_get_db)
     
+    def _get_dialect(self):
+        return self._dialect
+    dialect = property(_get_dialect)
+
     def _get_obj_id(self):
         return self._obj_id
     obj_id = property(_get_obj_id)
@@ -833,7 +846,8 @@ class DBLocator(BaseLocator):
                   'port': self._port,
                   'db': self._db,
                   'user': self._user,
-                  'passwd': self._passwd}
+                  'passwd': self._passwd,
+                  'dialect': self._dialect}
         #print "config:", config
         connection = io.open_db_connection(config)
             
@@ -844,7 +858,7 @@ class DBLocator(BaseLocator):
     def load(self, type, tmp_dir=None):
         self._hash = self.hash()
         #print "LLoad Big|type", type
-        if DBLocator.cache.has_key(self._hash):
+        if self.use_cache and DBLocator.cache.has_key(self._hash):
             save_bundle = DBLocator.cache[self._hash]
             obj = save_bundle.get_primary_obj()
 
@@ -872,8 +886,10 @@ class DBLocator(BaseLocator):
             obj.locator = self
         
         _hash = self.hash()
-        DBLocator.cache[self._hash] = save_bundle.do_copy()
-        DBLocator.cache_timestamps[self._hash] = primary_obj.db_last_modified
+        if self.use_cache:
+            DBLocator.cache[self._hash] = save_bundle.do_copy()
+            DBLocator.cache_timestamps[self._hash] = \
+                primary_obj.db_last_modified
         return save_bundle
 
     def save(self, save_bundle, do_copy=False, version=None):
@@ -888,8 +904,10 @@ class DBLocator(BaseLocator):
             obj.locator = self
         #update the cache with a copy of the new bundle
         self._hash = self.hash()
-        DBLocator.cache[self._hash] = save_bundle.do_copy()
-        DBLocator.cache_timestamps[self._hash] = primary_obj.db_last_modified
+        if self.use_cache:
+            DBLocator.cache[self._hash] = save_bundle.do_copy()
+            DBLocator.cache_timestamps[self._hash] = \
+                primary_obj.db_last_modified
         return save_bundle
 
     def get_db_modification_time(self, obj_type=None):
@@ -916,6 +934,8 @@ class DBLocator(BaseLocator):
         locator.setAttribute('port', str(self._port))
         locator.setAttribute('db', str(self._db))
         locator.setAttribute('vt_id', str(self._obj_id))
+        if self._dialect != 'mysql':
+            locator.setAttribute('dialect', self._dialect)
         node = dom.createElement('name')
         filename = dom.createTextNode(str(self._name))
         node.appendChild(filename)
@@ -934,6 +954,7 @@ class DBLocator(BaseLocator):
             port = int(element.getAttribute('port'))
             database = str(element.getAttribute('db'))
             vt_id = str(element.getAttribute('vt_id'))
+            dialect = str(element.getAttribute('dialect'))
             user = ""
             passwd = ""
             for n in element.childNodes:
@@ -941,7 +962,8 @@ class DBLocator(BaseLocator):
                     name = str(n.firstChild.nodeValue).strip(" \n\t")
                     #print host, port, database, name, vt_id
                     return DBLocator(host, port, database,
-                                     user, passwd, name, obj_id=vt_id)
+                                     user, passwd, name, obj_id=vt_id,
+                                     dialect=dialect)
             return None
         else:
             return None
@@ -995,6 +1017,8 @@ class DBLocator(BaseLocator):
         node.set('db', str(self._db))
         node.set('vt_id', str(self._obj_id))
         node.set('user', str(self._user))
+        if self._dialect != 'mysql':
+            node.set('dialect', self._dialect)
         if include_name:
             childnode = ElementTree.SubElement(node,'name')
             childnode.text = str(self._name)
@@ -1050,6 +1074,8 @@ class DBLocator(BaseLocator):
             vt_id = convert_from_str(data, 'str')
             data = node.get('user')
             user = convert_from_str(data, 'str')
+            data = node.get('dialect')
+            dialect = convert_from_str(data, 'str')
             passwd = ""
             name = None
             if include_name:
@@ -1057,7 +1083,8 @@ class DBLocator(BaseLocator):
                     if child.tag == 'name':
                         name = str(child.text).strip(" \n\t")
             return DBLocator(host, port, database,
-                             user, passwd, name, obj_id=vt_id, obj_type='vistrail')
+                             user, passwd, name, obj_id=vt_id, obj_type='vistrail',
+                             dialect=dialect)
         else:
             return None
 
@@ -1075,6 +1102,7 @@ vistrail_name="%s"/>' % ( self._host, self._port, self._db,
         return (self._host == other._host and
                 self._port == other._port and
                 self._db == other._db and
+                self._dialect == other._dialect and
                 self._user == other._user and
                 #self._name == other._name and
                 long(self._obj_id) == long(other._obj_id) and
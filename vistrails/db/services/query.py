@@ -36,7 +36,8 @@
 from __future__ import division
 
 from vistrails.db import VistrailsDBException
-from vistrails.db.services.io import open_db_connection, close_db_connection, get_db_lib
+from vistrails.db.services.io import open_db_connection, close_db_connection, \
+    get_db_lib, escape_db_value, db_error_message
 
 def runWorkflowQuery(config, vistrail=None, version=None, fromTime=None,
         toTime=None, user=None, offset=0, limit=100, modules=[], thumbs=None):
@@ -60,22 +61,22 @@ def runWorkflowQuery(config, vistrail=None, version=None, fromTime=None,
             where_part += " AND v.id=%s" % int(vistrail)
         except ValueError:
             where_part += " AND v.name=%s" % \
-                   db.escape(vistrail, get_db_lib().converters.conversions)
+                   escape_db_value(db, vistrail)
     if version:
         try:
             where_part += " AND w.parent_id=%s" % int(version)
         except ValueError:
             where_part += " AND a1.value=%s" % \
-                   db.escape(version, get_db_lib().converters.conversions)
+                   escape_db_value(db, version)
     if fromTime:
         where_part += " AND w.last_modified>%s" % \
-               db.escape(fromTime, get_db_lib().converters.conversions)
+               escape_db_value(db, fromTime)
     if toTime:
         where_part += " AND w.last_modified<%s" % \
-               db.escape(toTime, get_db_lib().converters.conversions)
+               escape_db_value(db, toTime)
     if user:
         where_part += " AND action.user=%s" % \
-               db.escape(user, get_db_lib().converters.conversions)
+               escape_db_value(db, user)
     next_port = 1
     old_alias = None
     for i, module, connected in zip(range(1,len(modules)+1), *zip(*modules)):
@@ -86,7 +87,7 @@ def runWorkflowQuery(config, vistrail=None, version=None, fromTime=None,
                 ({0}.parent_id=w.id AND {0}.entity_type=w.entity_type AND
                  {0}.name={1})
         """.format(alias,
-                   db.escape(module, get_db_lib().converters.conversions))
+                   escape_db_value(db, module))
         if connected:
             p1_alias, p2_alias=("port%s"%next_port), ("port%s"%(next_port+1))
             next_port += 2
@@ -129,9 +130,9 @@ def runWorkflowQuery(config, vistrail=None, version=None, fromTime=None,
         rows = c.fetchall()
         result = rows
         c.close()
-    except get_db_lib().Error, e:
-        msg = "Couldn't perform query on db (%d : %s)" % \
-            (e.args[0], e.args[1])
+    except get_db_lib(db).Error, e:
+        msg = "Couldn't perform query on db (%s)" % \
+            db_error_message(e)
         raise VistrailsDBException(msg)
 
     # count all rows when offset = 0
@@ -145,9 +146,9 @@ def runWorkflowQuery(config, vistrail=None, version=None, fromTime=None,
             res = c.fetchall()
             result= (result, res[0][0])
             c.close()
-        except get_db_lib().Error, e:
-            msg = "Couldn't perform query on db (%d : %s)" % \
-                (e.args[0], e.args[1])
+        except get_db_lib(db).Error, e:
+            msg = "Couldn't perform query on db (%s)" % \
+                db_error_message(e)
             raise VistrailsDBException(msg)
 
     close_db_connection(db)
@@ -182,22 +183,22 @@ def runLogQuery(config, vistrail=None, version=None, fromTime=None, toTime=None,
             where_part += " AND v.id=%s" % int(vistrail)
         except ValueError:
             where_part += " AND v.name=%s" % \
-                   db.escape(vistrail, get_db_lib().converters.conversions)
+                   escape_db_value(db, vistrail)
     if version:
         try:
             where_part += " AND w.parent_version=%s" % int(version)
         except ValueError:
             where_part += " AND a1.value=%s" % \
-                   db.escape(version, get_db_lib().converters.conversions)
+                   escape_db_value(db, version)
     if fromTime:
         where_part += " AND w.ts_end>%s" % \
-               db.escape(fromTime, get_db_lib().converters.conversions)
+               escape_db_value(db, fromTime)
     if toTime:
         where_part += " AND w.ts_start<%s" % \
-               db.escape(toTime, get_db_lib().converters.conversions)
+               escape_db_value(db, toTime)
     if user:
         where_part += " AND w.user=%s" % \
-               db.escape(user, get_db_lib().converters.conversions)
+               escape_db_value(db, user)
     completed_dict = {'no':0, 'yes':1, 'ok':1}
     if completed is not None:
         try:
@@ -227,7 +228,7 @@ def runLogQuery(config, vistrail=None, version=None, fromTime=None, toTime=None,
         where_part += \
         """ AND %s.parent_type='workflow_exec'
             AND %s.module_name=%s """ % (alias, alias,
-              db.escape(module.lower(), get_db_lib().converters.conversions) )
+              escape_db_value(db, module.lower()) )
         if mCompleted is not None:
             mCompleted = completed_dict.get(str(mCompleted).lower(), -1)
             where_part += """ AND %s.completed=%s""" % (alias, mCompleted)
@@ -240,9 +241,9 @@ def runLogQuery(config, vistrail=None, version=None, fromTime=None, toTime=None,
         rows = c.fetchall()
         result = rows
         c.close()
-    except get_db_lib().Error, e:
-        msg = "Couldn't perform query on db (%d : %s)" % \
-            (e.args[0], e.args[1])
+    except get_db_lib(db).Error, e:
+        msg = "Couldn't perform query on db (%s)" % \
+            db_error_message(e)
         raise VistrailsDBException(msg)
 
     # count all rows when offset = 0
@@ -256,9 +257,9 @@ def runLogQuery(config, vistrail=None, version=None, fromTime=None, toTime=None,
             res = c.fetchall()
             result= (result, res[0][0])
             c.close()
-        except get_db_lib().Error, e:
-            msg = "Couldn't perform query on db (%d : %s)" % \
-                (e.args[0], e.args[1])
+        except get_db_lib(db).Error, e:
+            msg = "Couldn't perform query on db (%s)" % \
+                db_error_message(e)
             raise VistrailsDBException(msg)
 
     close_db_connection(db)
@@ -38,7 +38,7 @@ from __future__ import division
 from vistrails.db.domain import DBWorkflow, DBAdd, DBDelete, DBAction, DBAbstraction, \
     DBModule, DBConnection, DBPort, DBFunction, DBParameter, DBGroup
 from vistrails.db.services.action_chain import getActionChain, getCurrentOperationDict, \
-    getCurrentOperations, simplify_ops
+    getCurrentOperations, getCheckpointedOperationDict, simplify_ops
 from vistrails.db import VistrailsDBException
 
 import copy
@@ -76,8 +76,9 @@ def materializeWorkflow(vistrail, version):
         workflow = DBWorkflow()
         #for action in getActionChain(vistrail, version):
         #    oldPerformAction(action, workflow)
-        performActions(getActionChain(vistrail, version), 
-                            workflow)
+        operations = getCheckpointedOperationDict(vistrail, version).values()
+        operations.sort(key=lambda x: x.db_id)
+        performAdds(operations, workflow)
         workflow.db_id = version
         workflow.db_vistrailId = vistrail.db_id
         return workflow
@@ -1634,5 +1635,21 @@ class TestDBVistrailService(unittest.TestCase):
         # test parameter change inequality
         assert heuristicModuleMatch(module1, module5) == 0
 
+    def test_checkpointed_operations(self):
+        """Makes sure checkpoints give the same operations as a replay."""
+        from vistrails.db.services.io import open_vistrail_from_xml
+        import os
+
+        filename = os.path.join(vistrails.core.system.vistrails_root_directory(),
+                                'tests', 'resources', 'test_change_vistrail.xml')
+        vistrail = open_vistrail_from_xml(filename)
+        versions = sorted(a.db_id for a in vistrail.db_actions)
+        for version in reversed(versions):
+            ops = getCheckpointedOperationDict(vistrail, version, interval=4)
+            expected = getCurrentOperationDict(getActionChain(vistrail,
+                                                              version))
+            self.assertEqual(ops, expected)
+        self.assertTrue(vistrail._operation_checkpoints)
+
 if __name__ == '__main__':
     unittest.main()
@@ -42,11 +42,16 @@ from vistrails.core.system import get_elementtree_library
 from vistrails.db import VistrailsDBException
 from vistrails.db.versions.v1_0_4 import version as my_version
 from vistrails.db.versions.v1_0_4.domain import DBGroup, DBWorkflow, DBVistrail, DBLog, \
-    DBRegistry, DBMashuptrail
+    DBRegistry, DBMashuptrail, DBAction, DBWorkflowExec
 
 root_set = set([DBVistrail.vtType, DBWorkflow.vtType, 
                 DBLog.vtType, DBRegistry.vtType, DBMashuptrail.vtType])
 
+# children of root objects that stream_from_xml builds (and releases)
+# as soon as their element has been parsed
+streamed_children = {DBVistrail.vtType: {'action': DBAction.vtType},
+                     DBLog.vtType: {'workflowExec': DBWorkflowExec.vtType}}
+
 ElementTree = get_elementtree_library()
 
 
@@ -90,6 +95,47 @@ class DAOList(dict):
         vistrail = self.read_xml_object(vtType, tree.getroot())
         return vistrail
 
+    def stream_from_xml(self, source, vtType, accept=None):
+        """stream_from_xml(source, vtType, accept) -> DBVistrail | DBLog
+        Same as open_from_xml but the file is read incrementally: actions
+        (or workflow executions for a log) are built as soon as their
+        element is complete and the element is discarded, so the whole
+        tree is never held in memory. If accept is given, only children
+        for which accept(obj) returns True are kept.
+
+        """
+        children = streamed_children.get(vtType, {})
+        root = None
+        depth = 0
+        objs = []
+        for event, elem in ElementTree.iterparse(source, ('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = elem
+                depth += 1
+                continue
+            depth -= 1
+            if depth != 1:
+                continue
+            child_type = children.get(elem.tag.split('}')[-1])
+            if child_type is not None:
+                obj = self.read_xml_object(child_type, elem)
+                if accept is None or accept(obj):
+                    objs.append((child_type, obj))
+                # iterparse reads ahead, so elem is near the end
+                for i in xrange(len(root) - 1, -1, -1):
+                    if root[i] is elem:
+                        del root[i]
+                        break
+        if root is None:
+            raise VistrailsDBException("Couldn't read %s from XML" % vtType)
+        obj = self.read_xml_object(vtType, root)
+        if obj is not None:
+            for (child_type, child) in objs:
+                getattr(obj, 'db_add_%s' % child_type)(child)
+            obj.is_dirty = False
+        return obj
+
     def save_to_xml(self, obj, filename, tags, version=None):
         """save_to_xml(obj : object, filename: str, tags: dict,
                        version: str) -> None
@@ -106,7 +152,6 @@ class DAOList(dict):
 
     def open_from_db(self, db_connection, vtType, id=None, lock=False, 
                      global_props=None):
-        all_objects = {}
         if global_props is None:
             global_props = {}
         if id is not None:
@@ -124,59 +169,8 @@ class DAOList(dict):
                                        "id '%s' exist in the database" % \
                                            (vtType, id))
         
-        all_objects.update(res_objects)
         res = res_objects.values()[0]
-        global_props = {'entity_id': res.db_id,
-                        'entity_type': res.vtType}
-
-        # collect all commands so that they can be executed together
-        # daoList should contain (dao_type, dao, dbCommand) values
-        daoList = []
-        # dbCommandList should contain dbCommand values
-        dbCommandList = []
-        
-        # generate SELECT statements
-        for dao_type, dao in self['sql'].iteritems():
-            if dao_type in root_set:
-                continue
-
-            daoList.append([dao_type, dao, None])
-            dbCommand = dao.get_sql_select(db_connection, global_props, lock)
-            dbCommandList.append(dbCommand)
-            
-        # Exacute all select statements
-        results = self['sql'][vtType].executeSQLGroup(db_connection,
-                                                      dbCommandList, True)
-
-        # add result to correct dao
-        for i in xrange(len(daoList)):
-            daoList[i][2] = results[i]
-        
-        # process results
-        for dao_type, dao, data in daoList:
-            current_objs = dao.process_sql_columns(data, global_props)
-            all_objects.update(current_objs)
-
-            if dao_type == DBGroup.vtType:
-                for key, obj in current_objs.iteritems():
-                    new_props = {'parent_id': key[1],
-                                 'entity_id': global_props['entity_id'],
-                                 'entity_type': global_props['entity_type']}
-                    res_obj = self.open_from_db(db_connection, 
-                                                DBWorkflow.vtType, 
-                                                None, lock, new_props)
-                    res_dict = {}
-                    res_dict[(res_obj.vtType, res_obj.db_id)] = res_obj
-                    all_objects.update(res_dict)
-
-        for key, obj in all_objects.iteritems():
-            if key[0] == vtType and key[1] == id:
-                continue
-            self['sql'][obj.vtType].from_sql_fast(obj, all_objects)
-        for obj in all_objects.itervalues():
-            obj.is_dirty = False
-            obj.is_new = False
-
+        self.open_children_from_db(db_connection, [res], lock)
         return res
 
     def open_many_from_db(self, db_connection, vtType, ids, lock=False):
@@ -193,18 +187,8 @@ class DAOList(dict):
 
         # list of final objects
         objects = []
-        # list of selects
-        selects = []
-        # list of children id:all_objects_dict
-        all_objects_dict = {}
-        # process each result and extract child SELECTS
-        # daoList should contain (id, dao_type, dao, result) values
-        daoList = []
-        # selects should contain dbCommand values
-        selects = []
-        global_props = {}
         for id, data in zip(ids, results):
-            res_objects = log_dao.process_sql_columns(data, global_props)
+            res_objects = log_dao.process_sql_columns(data, {})
             if len(res_objects) > 1:
                 raise VistrailsDBException("More than object of type '%s' and "
                                            "id '%s' exist in the database" % \
@@ -213,58 +197,100 @@ class DAOList(dict):
                 raise VistrailsDBException("No objects of type '%s' and "
                                            "id '%s' exist in the database" % \
                                                (vtType, id))
-            all_objects = {}
-            all_objects_dict[id] = all_objects
-            all_objects.update(res_objects)
             objects.append(res_objects.values()[0])
+        self.open_children_from_db(db_connection, objects, lock)
+        return objects
+
+    def open_children_from_db(self, db_connection, roots, lock=False):
+        """open_children_from_db(db_connection, roots: list, lock: bool)
+             -> dict
+
+        Loads the children of the already loaded root objects, including
+        the workflows of their groups, and attaches them. The children of
+        all entities at the same group depth are fetched with one group of
+        SELECT statements keyed on entity_id, so the number of round trips
+        depends on how deeply groups are nested, not on how many there
+        are. Returns the objects of each entity, keyed by
+        (entity_type, entity_id).
+
+        """
+        workflow_dao = self['sql'][DBWorkflow.vtType]
+        entities = {}
+        # entities whose children still need to be fetched
+        level = {}
+        for root in roots:
+            key = (root.vtType, root.db_id)
+            entities[key] = level[key] = {key: root}
+
+        while level:
+            entity_ids = {}
+            for (entity_type, entity_id) in level:
+                entity_ids.setdefault(entity_type, []).append(entity_id)
+
             # collect all commands so that they can be executed together
-        
-            # generate SELECT statements for children
-            for dao_type, dao in self['sql'].iteritems():
-                if dao_type in root_set:
+            # daoList should contain dao values
+            daoList = []
+            # dbCommandList should contain dbCommand values
+            dbCommandList = []
+            for entity_type, ids in entity_ids.iteritems():
+                global_props = {'entity_type': entity_type,
+                                'entity_id': ids if len(ids) > 1 else ids[0]}
+                for dao_type, dao in self['sql'].iteritems():
+                    if dao_type in root_set:
+                        continue
+                    daoList.append(dao)
+                    dbCommandList.append(dao.get_sql_select(db_connection,
+                                                            global_props,
+                                                            lock))
+                # the workflows of groups are stored under the entity
+                # that contains the group
+                daoList.append(workflow_dao)
+                dbCommandList.append(workflow_dao.get_sql_select(db_connection,
+                                                                 global_props,
+                                                                 lock))
+
+            # Execute all select statements
+            results = workflow_dao.executeSQLGroup(db_connection,
+                                                   dbCommandList, True)
+
+            # sort results by the entity they belong to
+            workflows = []
+            for dao, data in zip(daoList, results):
+                if dao is workflow_dao:
+                    workflows.extend(
+                        dao.process_sql_columns(data, {}).itervalues())
                     continue
-    
-                daoList.append([id, dao_type, dao, None])
-                dbCommand = dao.get_sql_select(db_connection, global_props, lock)
-                selects.append(dbCommand)
-
-        # Execute all child select statements
-        results = self['sql'][vtType].executeSQLGroup(db_connection,
-                                                      selects, True)
-        for i in xrange(len(daoList)):
-            daoList[i][3] = results[i]
-
-        # process results
-        for id, dao_type, dao, data in daoList:
-            all_objects = all_objects_dict[id]
-            current_objs = dao.process_sql_columns(data, global_props)
-            all_objects.update(current_objs)
-
-            if dao_type == DBGroup.vtType:
-                for key, obj in current_objs.iteritems():
-                    new_props = {'parent_id': key[1],
-                                 'entity_id': global_props['entity_id'],
-                                 'entity_type': global_props['entity_type']}
-                    res_obj = self.open_from_db(db_connection, 
-                                                DBWorkflow.vtType, 
-                                                None, lock, new_props)
-                    res_dict = {}
-                    res_dict[(res_obj.vtType, res_obj.db_id)] = res_obj
-                    all_objects.update(res_dict)
+                # ids are only unique within an entity, so rows are
+                # processed one at a time
+                for row in data:
+                    for key, obj in dao.process_sql_columns([row],
+                                                            {}).iteritems():
+                        level[(obj.db_entity_type, obj.db_entity_id)][key] = \
+                            obj
+
+            # group workflows are the entities of the next level
+            next_level = {}
+            for workflow in workflows:
+                all_objects = level.get((workflow.db_entity_type,
+                                         workflow.db_entity_id))
+                if all_objects is None or \
+                        (DBGroup.vtType, workflow.db_group) not in all_objects:
+                    continue
+                key = (workflow.vtType, workflow.db_id)
+                all_objects[key] = workflow
+                entities[key] = next_level[key] = {key: workflow}
+            level = next_level
 
-        
-        for id, all_objects in all_objects_dict.iteritems():
+        for entity_key, all_objects in entities.iteritems():
             for key, obj in all_objects.iteritems():
-                if key[0] == vtType and key[1] == id:
+                if key == entity_key:
                     continue
                 self['sql'][obj.vtType].from_sql_fast(obj, all_objects)
-        for id, dao_type, dao, data in daoList:
-            all_objects = all_objects_dict[id]
+        for all_objects in entities.itervalues():
             for obj in all_objects.itervalues():
                 obj.is_dirty = False
                 obj.is_new = False
-    
-        return objects
+        return entities
 
     def save_to_db(self, db_connection, obj, do_copy=False, global_props=None):
         if do_copy == 'with_ids':
@@ -303,25 +329,16 @@ class DAOList(dict):
 
         # list of all children
         dbCommandList = []
-        writtenChildren = []
         # process remaining children
         for (child, _, _) in children:
             dbCommand = self['sql'][child.vtType].set_sql_command(
                             db_connection, child, global_props, do_copy)
             if dbCommand is not None:
-                dbCommandList.append(dbCommand)
-                writtenChildren.append(child)
+                dbCommandList.append((child, dbCommand))
             self['sql'][child.vtType].to_sql_fast(child, do_copy)
 
-        # Debug version of Execute all insert/update statements
-        #results = [self['sql'][children[0][0].vtType].executeSQL(
-        #                      db_connection, c, False) for c in dbCommandList]
-
         # Execute all insert/update statements
-        results = self['sql'][children[0][0].vtType].executeSQLGroup(
-                                                    db_connection,
-                                                    dbCommandList, False)
-        resultDict = dict(zip(writtenChildren, results))
+        resultDict = self.execute_sql_commands(db_connection, dbCommandList)
         # process remaining children
         for (child, _, _) in children:
             if child in resultDict:
@@ -349,7 +366,6 @@ class DAOList(dict):
         childrenDict = {}
         global_propsDict = {}
         dbCommandList = []
-        writtenChildren = []
         for obj in objList:
             if do_copy and obj.db_id is not None:
                 obj.db_id = None
@@ -362,19 +378,14 @@ class DAOList(dict):
             dbCommand = self['sql'][child.vtType].set_sql_command(
                 db_connection, child, global_props, do_copy)
             if dbCommand is not None:
-                dbCommandList.append(dbCommand)
-                writtenChildren.append(child)
+                dbCommandList.append((child, dbCommand))
             
             childrenDict[child] = children
             global_propsDict[child] = global_props
 
         # Execute all insert/update statements for the main objects
-        results = self['sql'][children[0][0].vtType].executeSQLGroup(
-                                                    db_connection,
-                                                    dbCommandList, False)
-        resultDict = dict(zip(writtenChildren, results))
+        resultDict = self.execute_sql_commands(db_connection, dbCommandList)
         dbCommandList = []
-        writtenChildren = []
         for child, children in childrenDict.iteritems():
             # process objects
             if child in resultDict:
@@ -404,15 +415,11 @@ class DAOList(dict):
                 dbCommand = self['sql'][child.vtType].set_sql_command(
                                 db_connection, child, global_props, do_copy)
                 if dbCommand is not None:
-                    dbCommandList.append(dbCommand)
-                    writtenChildren.append(child)
+                    dbCommandList.append((child, dbCommand))
                 self['sql'][child.vtType].to_sql_fast(child, do_copy)
     
         # Execute all child insert/update statements
-        results = self['sql'][children[0][0].vtType].executeSQLGroup(
-                                                        db_connection,
-                                                        dbCommandList, False)
-        resultDict = dict(zip(writtenChildren, results))
+        resultDict = self.execute_sql_commands(db_connection, dbCommandList)
 
         for child, children in childrenDict.iteritems():
             global_props = global_propsDict[child]
@@ -435,6 +442,31 @@ class DAOList(dict):
                         self.save_to_db(db_connection, child.db_workflow, do_copy,
                                         new_props)
 
+    def execute_sql_commands(self, db_connection, dbCommandList):
+        """execute_sql_commands(db_connection, dbCommandList: list) -> dict
+
+        Executes the (obj, dbCommand) pairs in dbCommandList. Objects that
+        don't have an id yet get it from the database, so their statements
+        are run one by one and the generated keys are returned, keyed by
+        object. All other statements are written in bulk.
+
+        """
+        keyed = []
+        bulk = []
+        for obj, dbCommand in dbCommandList:
+            if getattr(obj, 'db_id', None) is None:
+                keyed.append((obj, dbCommand))
+            else:
+                bulk.append(dbCommand)
+        if not keyed and not bulk:
+            return {}
+        dao = self['sql'][dbCommandList[0][0].vtType]
+        dao.executeSQLBulk(db_connection, bulk)
+        results = dao.executeSQLGroup(db_connection,
+                                      [dbCommand for _, dbCommand in keyed],
+                                      False)
+        return dict(zip((obj for obj, _ in keyed), results))
+
     def delete_from_db(self, db_connection, type, obj_id):
         if type not in root_set:
             raise VistrailsDBException("Cannot delete entity of type '%s'" \
@@ -41,9 +41,16 @@ from datetime import date, datetime
 from vistrails.core import debug
 from vistrails.core.system import strftime, time_strptime
 from vistrails.db import VistrailsDBException
-from vistrails.db.services.io import get_db_lib
+from vistrails.db.services.io import get_db_dialect, escape_db_value
 
 class SQLDAO:
+    # commands sent to the server in one query, and the size that query
+    # stays below (MySQL's max_allowed_packet is at least 1MB)
+    BUNDLE_SIZE = 10000
+    BUNDLE_BYTES = 1000000
+    # rows in one multi-row INSERT
+    ROWS_PER_INSERT = 1000
+
     def __init__(self):
         pass
 
@@ -58,12 +65,12 @@ class SQLDAO:
             elif type == 'int':
                 return int(value)
             elif type == 'date':
-                if db_type == 'date':
+                if isinstance(value, date):
                     return value
                 else:
                     return date(*time_strptime(str(value), '%Y-%m-%d')[0:3])
             elif type == 'datetime':
-                if db_type == 'datetime':
+                if isinstance(value, datetime):
                     return value
                 else:
                     return datetime(*time_strptime(str(value),
@@ -137,9 +144,15 @@ class SQLDAO:
         whereClause = ''
         values = []
         for column, value in whereMap.iteritems():
-            whereStr += '%s%s = %%s' % \
-                        (whereClause, column)
-            values.append(value)
+            if isinstance(value, (list, tuple)):
+                # match any of the values
+                whereStr += '%s%s IN (%s)' % \
+                            (whereClause, column, ','.join(['%s'] * len(value)))
+                values.extend(value)
+            else:
+                whereStr += '%s%s = %%s' % \
+                            (whereClause, column)
+                values.append(value)
             whereClause = ' AND '
         dbCommand = """SELECT %s FROM %s WHERE %s""" % \
                     (columnStr, table, whereStr)
@@ -199,8 +212,19 @@ class SQLDAO:
             (table, whereStr)
         return (dbCommand, tuple(values))
 
-    def executeSQL(self, db, cmd_tuple, isFetch):
+    def formatSQL(self, db, cmd_tuple):
+        """ Adapts a command built by the createSQL* methods (written for
+            MySQL) to the SQL dialect of db
+        """
         dbCommand, values = cmd_tuple
+        if get_db_dialect(db) == 'sqlite':
+            # SQLite locks the whole database when writing
+            dbCommand = dbCommand.replace(" FOR UPDATE", "")
+            dbCommand = dbCommand.replace("%s", "?")
+        return dbCommand, values
+
+    def executeSQL(self, db, cmd_tuple, isFetch):
+        dbCommand, values = self.formatSQL(db, cmd_tuple)
         # print 'db: %s' % dbCommand
         # print 'values:', values
         data = None
@@ -223,17 +247,56 @@ class SQLDAO:
             It returns a list of results from the SELECT statements
         """
         data = []
-        # break up into bundles
-        BUNDLE_SIZE = 10000
-        num_commands = len(dbCommandList)
-        n = 0
-        while n<num_commands:
-            dbCommands = dbCommandList[n:(n+BUNDLE_SIZE)]
-            commandString = ''
-            for prepared, values in dbCommands:
-                command = prepared % \
-                              db.escape(values, get_db_lib().converters.conversions)
-                commandString += command
+        if get_db_dialect(db) == 'sqlite':
+            # sqlite3 doesn't run multiple statements at once, but there is
+            # no round-trip to a server either
+            cur = db.cursor()
+            try:
+                for cmd_tuple in dbCommandList:
+                    dbCommand, values = self.formatSQL(db, cmd_tuple)
+                    cur.execute(dbCommand, values)
+                    data.append(cur.fetchall() if isFetch else cur.lastrowid)
+            except Exception, e:
+                raise VistrailsDBException('Command "%s" with values "%s" '
+                                           'failed: %s' % (dbCommand, values,
+                                                           e))
+            finally:
+                cur.close()
+            return data
+        return self.executeSQLBundles(
+            db, [prepared % self.escapeSQL(db, values)
+                 for prepared, values in dbCommandList], isFetch)
+
+    def escapeSQL(self, db, values):
+        """ Returns the values quoted to be used as literals in a SQL
+            command for db
+        """
+        return tuple(escape_db_value(db, value) for value in values)
+
+    def bundleSQL(self, commands):
+        """ Joins SQL command strings into bundles of at most BUNDLE_SIZE
+            commands and BUNDLE_BYTES characters. A longer command is sent
+            alone
+        """
+        bundle = []
+        size = 0
+        for command in commands:
+            if bundle and (len(bundle) >= self.BUNDLE_SIZE or
+                           size + len(command) > self.BUNDLE_BYTES):
+                yield ''.join(bundle)
+                bundle = []
+                size = 0
+            bundle.append(command)
+            size += len(command)
+        if bundle:
+            yield ''.join(bundle)
+
+    def executeSQLBundles(self, db, commands, isFetch):
+        """ Executes SQL command strings on MySQL, several at a time. It
+            returns a list of results from the statements
+        """
+        data = []
+        for commandString in self.bundleSQL(commands):
             cur = db.cursor()
             try:
                 result = cur.execute(commandString)
@@ -248,10 +311,72 @@ class SQLDAO:
                                            (e, commandString))
             finally:
                 cur.close()
-            
-            n += BUNDLE_SIZE
         return data
 
+    def groupSQL(self, dbCommandList):
+        """ Groups the values of identical statements, keeping the order
+            the statements first appear in. Returns a list of
+            (statement, list of values) pairs
+        """
+        groups = []
+        rows = {}
+        for prepared, values in dbCommandList:
+            if prepared not in rows:
+                rows[prepared] = []
+                groups.append((prepared, rows[prepared]))
+            rows[prepared].append(values)
+        return groups
+
+    def createSQLMultiInsert(self, db, dbCommandList):
+        """ Returns the SQL command strings for the statements, with the
+            INSERT statements for the same table and columns rewritten into
+            multi-row INSERTs of at most ROWS_PER_INSERT rows and
+            BUNDLE_BYTES characters
+        """
+        commands = []
+        for prepared, all_values in self.groupSQL(dbCommandList):
+            if not prepared.startswith('INSERT INTO'):
+                commands.extend(prepared % self.escapeSQL(db, values)
+                                for values in all_values)
+                continue
+            head, row = prepared.rstrip(';').split(' VALUES ', 1)
+            head += ' VALUES '
+            rows = []
+            size = len(head)
+            for values in all_values:
+                row_str = row % self.escapeSQL(db, values)
+                if rows and (len(rows) >= self.ROWS_PER_INSERT or
+                             size + len(row_str) + 1 > self.BUNDLE_BYTES):
+                    commands.append('%s%s;' % (head, ','.join(rows)))
+                    rows = []
+                    size = len(head)
+                rows.append(row_str)
+                size += len(row_str) + 1
+            if rows:
+                commands.append('%s%s;' % (head, ','.join(rows)))
+        return commands
+
+    def executeSQLBulk(self, db, dbCommandList):
+        """ Executes INSERT and UPDATE statements that don't need their
+            results. INSERT statements for the same table and columns are
+            sent as multi-row inserts (executemany for SQLite), so generated
+            keys are not available; use executeSQLGroup for those rows.
+        """
+        if get_db_dialect(db) == 'sqlite':
+            cur = db.cursor()
+            try:
+                for prepared, all_values in self.groupSQL(dbCommandList):
+                    dbCommand, _ = self.formatSQL(db, (prepared, None))
+                    cur.executemany(dbCommand, all_values)
+            except Exception, e:
+                raise VistrailsDBException('Command "%s" failed: %s' % \
+                                               (dbCommand, e))
+            finally:
+                cur.close()
+            return
+        self.executeSQLBundles(db, self.createSQLMultiInsert(db, dbCommandList),
+                               False)
+
     def start_transaction(self, db):
         db.begin()
 
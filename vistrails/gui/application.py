@@ -557,7 +557,8 @@ class VistrailsApplicationSingleton(VistrailsApplicationInterface,
             if self.temp_configuration.check('parameterExploration'):
                 errs.extend(
                     vistrails.core.console_mode.run_parameter_explorations(
-                        w_list, extra_info=extra_info))
+                        w_list, extra_info=extra_info,
+                        output_dir=output_dir))
             else:
                 errs.extend(vistrails.core.console_mode.run(
                         w_list,
@@ -36,7 +36,6 @@
 """ This is the application for vistrails when running as a server. """
 from __future__ import division
 
-import Queue
 import base64
 import hashlib
 import inspect
@@ -46,8 +45,10 @@ import logging.handlers
 import os
 import re
 import shutil
+import socket
 import subprocess
 import tempfile
+import threading
 import time
 import traceback
 import urllib
@@ -63,8 +64,10 @@ from vistrails.core.application import VistrailsApplicationInterface
 import vistrails.gui.theme
 import vistrails.core.application
 from vistrails.gui import qt
+from vistrails.gui.worker_pool import WorkerPool
 from vistrails.core.db.locator import DBLocator, ZIPFileLocator, FileLocator
 from vistrails.core.db import io
+from vistrails.core.db.cache import VistrailCache
 import vistrails.core.db.action
 
 from vistrails.core.vistrail.vistrail import Vistrail
@@ -83,6 +86,15 @@ from vistrails.db.versions import currentVersion
 
 ElementTree = system.get_elementtree_library()
 
+# vistrails loaded by the request handlers, shared by all the threads of the
+# server; the [cache] section of the config file sets its bounds
+vistrail_cache = VistrailCache()
+# when the server process uses more than this many kilobytes of memory the
+# least recently used vistrails are dropped (0 means no limit)
+cache_memory_limit = 0
+# WorkerPool options from the [workers] section of the config file
+worker_options = {}
+
 
 
 ################################################################################
@@ -121,28 +133,32 @@ class RequestHandler(object):
     """This class will handle all the requests sent to the server.
     Add new methods here and they will be exposed through the XML-RPC interface
     """
-    def __init__(self, logger, instances):
+    def __init__(self, logger, workers=None):
         self.server_logger = logger
-        self.instances = instances
-        self.proxies_queue = None
-        self.instantiate_proxies()
-
-    #proxies
-    def instantiate_proxies(self):
-        """instantiate_proxies() -> None
-        If this server started other instances of VisTrails, this will create
-        the client proxies to connect to them.
+        # WorkerPool of the instances started by this server, requests can
+        # be forwarded to them
+        self.workers = workers
+        self._requests = 0
+        self._requests_lock = threading.Lock()
+
+    def _dispatch(self, method, params):
+        """Called by the XML-RPC server for each request, this keeps track
+        of the number of requests being served.
+
         """
-        if len(self.instances) > 0:
-            self.proxies_queue = Queue.Queue()
-            for uri in self.instances:
-                try:
-                    proxy = xmlrpclib.ServerProxy(uri)
-                    self.proxies_queue.put(proxy)
-                    self.server_logger.info("Instantiated client for %s" % uri)
-                except Exception, e:
-                    self.server_logger.error("Error when instantiating proxy %s" % uri)
-                    self.server_logger.error(str(e))
+        func = None
+        if not method.startswith('_'):
+            func = getattr(self, method, None)
+        if func is None:
+            raise Exception('method "%s" is not supported' % method)
+        with self._requests_lock:
+            self._requests += 1
+        try:
+            return func(*params)
+        finally:
+            with self._requests_lock:
+                self._requests -= 1
+
     #utils
     def memory_usage(self):
         """memory_usage() -> dict
@@ -166,6 +182,91 @@ class RequestHandler(object):
                 status.close()
         return result
 
+    def get_load(self):
+        """get_load() -> dict
+        Number of other requests being served by this instance and its
+        memory usage. This is used by the worker pool of the main server.
+
+        """
+        with self._requests_lock:
+            requests = self._requests - 1
+        return {'requests': requests, 'memory': self.memory_usage()}
+
+    def get_workers_status(self):
+        """get_workers_status() -> list of dict
+        State of the instances started by this server.
+
+        """
+        if self.workers is None:
+            return []
+        return self.workers.status()
+
+    def cache_stats(self):
+        """cache_stats() -> dict
+        Hit and miss counters and size of the vistrail cache, along with the
+        memory usage of the current process.
+
+        """
+        result = vistrail_cache.stats()
+        result['memory'] = self.memory_usage()
+        result['memory_limit'] = cache_memory_limit
+        return result
+
+    def clear_cache(self):
+        """clear_cache() -> int
+        Drops all the vistrails loaded by this server.
+
+        """
+        vistrail_cache.clear()
+        return 1
+
+    def _check_cache_memory(self):
+        if cache_memory_limit and \
+                self.memory_usage()['rss'] > cache_memory_limit:
+            self.server_logger.info("Memory limit reached, shrinking cache")
+            vistrail_cache.shrink()
+
+    def _load_cached(self, host, port, db_name, vt_id, version=None):
+        locator = DBLocator(host=host,
+                            port=int(port),
+                            database=db_name,
+                            user=db_read_user,
+                            passwd=db_read_pass,
+                            obj_id=int(vt_id),
+                            obj_type=None,
+                            connection_id=None)
+        # the vistrail cache holds the only copy, so that evicting a
+        # vistrail from it frees it
+        locator.use_cache = False
+        key = (host, int(port), db_name, int(vt_id))
+        mod_time = locator.get_db_modification_time()
+        load = lambda: io.load_vistrail(locator)
+        if version is None:
+            result = vistrail_cache.get_bundle(key, mod_time, load)
+        else:
+            result = vistrail_cache.get_pipeline(key, mod_time, version, load)
+        self._check_cache_memory()
+        return result
+
+    def _load_vistrail(self, host, port, db_name, vt_id):
+        """_load_vistrail(host:str, port:int, db_name:str, vt_id:int)
+            -> (Vistrail, abstractions, thumbnails, mashups)
+        Loads a vistrail from the database, going through the vistrail cache.
+        The returned objects are shared and should not be modified.
+
+        """
+        return self._load_cached(host, port, db_name, vt_id)
+
+    def _load_pipeline(self, host, port, db_name, vt_id, version):
+        """_load_pipeline(host:str, port:int, db_name:str, vt_id:int,
+                           version:int) -> Pipeline
+        Materializes a workflow from a vistrail in the database, going
+        through the vistrail cache.
+        The returned pipeline is shared and should not be modified.
+
+        """
+        return self._load_cached(host, port, db_name, vt_id, long(version))
+
     def path_exists_and_not_empty(self, path):
         """path_exists_and_not_empty(path:str) -> boolean
         Returns True if given path exists and it's not empty, otherwise returns
@@ -193,17 +294,7 @@ class RequestHandler(object):
         self.server_logger.info("Request: get_wf_modules(%s,%s,%s,%s,%s)" % \
                                 (host, port, db_name, vt_id, version))
         try:
-            locator = DBLocator(host=host,
-                                port=int(port),
-                                database=db_name,
-                                user=db_read_user,
-                                passwd=db_read_pass,
-                                obj_id=int(vt_id),
-                                obj_type=None,
-                                connection_id=None)
-
-            v = locator.load().vistrail
-            p = v.getPipeline(long(version))
+            p = self._load_pipeline(host, port, db_name, vt_id, version)
 
             if p:
                 result = []
@@ -246,16 +337,8 @@ class RequestHandler(object):
                                 (host, port, db_name, vt_id, version))
         result = []
         try:
-            locator = DBLocator(host=host,
-                                port=int(port),
-                                database=db_name,
-                                user=db_read_user,
-                                passwd=db_read_pass,
-                                obj_id=int(vt_id),
-                                obj_type=None,
-                                connection_id=None)
             (vistrail, abstractions, thumbnails, mashups) = \
-                                                      io.load_vistrail(locator)
+                          self._load_vistrail(host, port, db_name, vt_id)
             for mashuptrail in mashups:
                 # Find tagged mashups for this version
                 if mashuptrail.vtVersion == version:
@@ -331,19 +414,17 @@ class RequestHandler(object):
         self.server_logger.info("Request: get_server_packages()")
 
         messages = []
-        if self.proxies_queue is not None:
-            # collect all proxies:
-            proxies = []
-            while len(proxies) < len(self.instances):
-                self.server_logger.info("Proxies: %s Instances: %s" % (len(proxies), len(self.instances)))
-                if self.proxies_queue.empty():
-                    for p in  proxies:
-                        self.proxies_queue.put(p)
-                    return [[[],
-                        "Not all vistrail instances are free, please try again."], 1]
-                proxies.append(self.proxies_queue.get())
-            for proxy in proxies:
+        if self.workers is not None:
+            try:
+                workers = self.workers.acquire_all()
+            except RuntimeError, e:
+                self.server_logger.error(str(e))
+                messages.append('An error occurred: %s' % e)
+                workers = []
+            for worker in workers:
+                proxy = self.workers.make_proxy(worker)
                 result, s = 'Please contact the server admin', 0
+                failed = False
                 try:
                     if codepath and status is not None:
                         result, s = proxy.get_server_packages(codepath, status)
@@ -357,8 +438,12 @@ class RequestHandler(object):
                            "Error message: %s\n") % (err.url, err.headers,
                                                  err.errcode, err.errmsg)
                     self.server_logger.error(err_msg)
+                    failed = True
+                except socket.error, e:
+                    self.server_logger.error(str(e))
+                    failed = True
                 finally:
-                    self.proxies_queue.put(proxy)
+                    self.workers.release(worker, failed)
                 if s == 0:
                     messages.append('An error occurred: %s' % result)
                 else:
@@ -556,15 +641,8 @@ class RequestHandler(object):
 
     def get_runnable_workflows(self, host, port, db_name, vt_id):
         try:
-            locator = DBLocator(host=host,
-                                port=int(port),
-                                database=db_name,
-                                user=db_read_user,
-                                passwd=db_read_pass,
-                                obj_id=int(vt_id),
-                                obj_type=None,
-                                connection_id=None)
-            (vistrail, _, _, _)  = io.load_vistrail(locator)
+            (vistrail, _, _, _)  = self._load_vistrail(host, port, db_name,
+                                                       vt_id)
 
             # get server packages
             local_packages = [x.identifier for x in \
@@ -724,16 +802,15 @@ class RequestHandler(object):
             path_to_images = \
                os.path.join(media_dir, 'medleys/images', subdir)
             if (not self.path_exists_and_not_empty(path_to_images) and
-                self.proxies_queue is not None):
+                self.workers is not None):
                 #this server can send requests to other instances
-                proxy = self.proxies_queue.get()
                 try:
-                    self.server_logger.info("Sending request to %s" % proxy)
                     if extra_info is not None:
-                        result = proxy.executeMedley(xml_medley, extra_info)
+                        result = self.workers.call('executeMedley',
+                                                   xml_medley, extra_info)
                     else:
-                        result = proxy.executeMedley(xml_medley)
-                    self.proxies_queue.put(proxy)
+                        result = self.workers.call('executeMedley',
+                                                   xml_medley)
                     self.server_logger.info("returning %s"% result)
                     return result
                 except Exception, e:
@@ -913,7 +990,6 @@ class RequestHandler(object):
 
         self.server_logger.info("path_exists_and_not_empty? %s" % self.path_exists_and_not_empty(path_to_figures))
         self.server_logger.info("build_always? %s" % build_always)
-        self.server_logger.info(str(self.proxies_queue))
 
         if not is_local:
             # use same hashing as on crowdlabs webserver
@@ -922,16 +998,14 @@ class RequestHandler(object):
             path_to_figures = os.path.join(media_dir, "photos", "wf_execution", dest_version)
 
         if ((not self.path_exists_and_not_empty(path_to_figures) or 
-             build_always) and self.proxies_queue is not None):
+             build_always) and self.workers is not None):
             self.server_logger.info("will forward request")
             #this server can send requests to other instances
-            proxy = self.proxies_queue.get()
             try:
-                self.server_logger.info("Sending request to %s" % proxy)
-                result = proxy.run_from_db(host, port, db_name, vt_id,
-                                           path_to_figures, version, pdf, vt_tag,
-                                           build_always, parameters, is_local)
-                self.proxies_queue.put(proxy)
+                result = self.workers.call('run_from_db', host, port, db_name,
+                                           vt_id, path_to_figures, version,
+                                           pdf, vt_tag, build_always,
+                                           parameters, is_local)
                 self.server_logger.info("returning %s" % result)
                 return result
             except xmlrpclib.ProtocolError, err:
@@ -1045,17 +1119,7 @@ class RequestHandler(object):
         self.server_logger.info("Request: get_wf_datasets(%s,%s,%s,%s,%s)" % \
                                 (host, port, db_name, vt_id, version))
         try:
-            locator = DBLocator(host=host,
-                                port=int(port),
-                                database=db_name,
-                                user=db_read_user,
-                                passwd=db_read_pass,
-                                obj_id=int(vt_id),
-                                obj_type=None,
-                                connection_id=None)
-
-            v = locator.load().vistrail
-            p = v.getPipeline(long(version))
+            p = self._load_pipeline(host, port, db_name, vt_id, version)
 
             if p:
                 result = []
@@ -1088,16 +1152,7 @@ class RequestHandler(object):
                                 (host, port, db_name, vt_id, vt_tag))
         version = -1
         try:
-            locator = DBLocator(host=host,
-                                port=int(port),
-                                database=db_name,
-                                user=db_read_user,
-                                passwd=db_read_pass,
-                                obj_id=int(vt_id),
-                                obj_type=None,
-                                connection_id=None)
-
-            (v, _ , _, _)  = io.load_vistrail(locator)
+            (v, _ , _, _)  = self._load_vistrail(host, port, db_name, vt_id)
             if v.has_tag_str(vt_tag):
                 version = v.get_tag_str(vt_tag).action_id
             self.server_logger.info("Answer: %s" % version)
@@ -1122,16 +1177,7 @@ class RequestHandler(object):
         self.server_logger.info("Request: get_vt_xml(%s,%s,%s,%s)" % \
                                 (host, port, db_name, vt_id))
         try:
-            locator = DBLocator(host=host,
-                                port=int(port),
-                                database=db_name,
-                                user=db_read_user,
-                                passwd=db_read_pass,
-                                obj_id=int(vt_id),
-                                obj_type=None,
-                                connection_id=None)
-
-            (v, _ , _, _)  = io.load_vistrail(locator)
+            (v, _ , _, _)  = self._load_vistrail(host, port, db_name, vt_id)
             result = io.serialize(v)
             return (result, 1)
         except xmlrpclib.ProtocolError, err:
@@ -1152,17 +1198,7 @@ class RequestHandler(object):
         self.server_logger.info("Request: get_wf_xml(%s,%s,%s,%s,%s)" % \
                                 (host, port, db_name, vt_id, version))
         try:
-            locator = DBLocator(host=host,
-                                port=int(port),
-                                database=db_name,
-                                user=db_read_user,
-                                passwd=db_read_pass,
-                                obj_id=int(vt_id),
-                                obj_type=None,
-                                connection_id=None)
-
-            (v, _ , _, _)  = io.load_vistrail(locator)
-            p = v.getPipeline(long(version))
+            p = self._load_pipeline(host, port, db_name, vt_id, version)
             if p:
                 result = io.serialize(p)
                 self.server_logger.info("success")
@@ -1201,12 +1237,11 @@ class RequestHandler(object):
             filename = os.path.join(filepath,base_fname)
             if ((not os.path.exists(filepath) or
                 os.path.exists(filepath) and not os.path.exists(filename))
-                and self.proxies_queue is not None):
+                and self.workers is not None):
                 #this server can send requests to other instances
-                proxy = self.proxies_queue.get()
                 try:
-                    result = proxy.get_wf_graph_pdf(host,port,db_name, vt_id, version, is_local)
-                    self.proxies_queue.put(proxy)
+                    result = self.workers.call('get_wf_graph_pdf', host, port,
+                                               db_name, vt_id, version, is_local)
                     self.server_logger.info("get_wf_graph_pdf returning %s"% result)
                     return result
                 except xmlrpclib.ProtocolError, err:
@@ -1285,13 +1320,11 @@ class RequestHandler(object):
             filename = os.path.join(filepath,base_fname)
             if ((not os.path.exists(filepath) or
                 os.path.exists(filepath) and not os.path.exists(filename))
-                and self.proxies_queue is not None):
+                and self.workers is not None):
                 #this server can send requests to other instances
-                proxy = self.proxies_queue.get()
                 try:
-                    self.server_logger.info("Sending request to %s" % proxy)
-                    result = proxy.get_wf_graph_png(host, port, db_name, vt_id, version, is_local)
-                    self.proxies_queue.put(proxy)
+                    result = self.workers.call('get_wf_graph_png', host, port,
+                                               db_name, vt_id, version, is_local)
                     self.server_logger.info("returning %s" % result)
                     return result
                 except xmlrpclib.ProtocolError, err:
@@ -1385,13 +1418,11 @@ class RequestHandler(object):
             if ((not os.path.exists(filepath) or
                 (os.path.exists(filepath) and not os.path.exists(filename)) or
                  self._is_image_stale(filename, host, port, db_name, vt_id)) and 
-                self.proxies_queue is not None):
+                self.workers is not None):
                 #this server can send requests to other instances
-                proxy = self.proxies_queue.get()
                 try:
-                    self.server_logger.info("Sending request to %s" % proxy)
-                    result = proxy.get_vt_graph_png(host, port, db_name, vt_id, is_local)
-                    self.proxies_queue.put(proxy)
+                    result = self.workers.call('get_vt_graph_png', host, port,
+                                               db_name, vt_id, is_local)
                     self.server_logger.info("returning %s" % result)
                     return result
                 except xmlrpclib.ProtocolError, err:
@@ -1474,13 +1505,11 @@ class RequestHandler(object):
             if ((not os.path.exists(filepath) or
                 (os.path.exists(filepath) and not os.path.exists(filename)) or
                  self._is_image_stale(filename, host, port, db_name, vt_id)) and 
-                self.proxies_queue is not None):
+                self.workers is not None):
                 #this server can send requests to other instances
-                proxy = self.proxies_queue.get()
                 try:
-                    self.server_logger.info("Sending request to %s" % proxy)
-                    result = proxy.get_vt_graph_pdf(host, port, db_name, vt_id, is_local)
-                    self.proxies_queue.put(proxy)
+                    result = self.workers.call('get_vt_graph_pdf', host, port,
+                                               db_name, vt_id, is_local)
                     self.server_logger.info("returning %s" % result)
                     return result
                 except xmlrpclib.ProtocolError, err:
@@ -1604,18 +1633,11 @@ class RequestHandler(object):
         self.server_logger.info("Request: get_wf_vt_zip(%s,%s,%s,%s,%s)" % \
                                 (host, port, db_name, vt_id, version))
         try:
-            locator = DBLocator(host=host,
-                                port=int(port),
-                                database=db_name,
-                                user=db_read_user,
-                                passwd=db_read_pass,
-                                obj_id=int(vt_id),
-                                obj_type=None,
-                                connection_id=None)
-
-            (v, _ , _, _)  = io.load_vistrail(locator)
-            p = v.getPipeline(long(version))
+            p = self._load_pipeline(host, port, db_name, vt_id, version)
             if p:
+                # the modules end up in the new vistrail, don't share the
+                # cached ones
+                p = p.do_copy()
                 vistrail = Vistrail()
                 action_list = []
                 for module in p.module_list:
@@ -1708,17 +1730,8 @@ class RequestHandler(object):
         self.server_logger.info("Request: get_vt_tagged_versions(%s,%s,%s,%s,%s)" % \
                                 (host, port, db_name, vt_id, is_local))
         try:
-            locator = DBLocator(host=host,
-                                port=int(port),
-                                database=db_name,
-                                user=db_read_user,
-                                passwd=db_read_pass,
-                                obj_id=int(vt_id),
-                                obj_type=None,
-                                connection_id=None)
-
             result = []
-            v = locator.load().vistrail
+            (v, _, _, _) = self._load_vistrail(host, port, db_name, vt_id)
             for elem, tag in v.get_tagMap().iteritems():
                 action_map = v.actionMap[long(elem)]
                 thumbnail_fname = ""
@@ -2092,6 +2105,7 @@ class VistrailsServerSingleton(VistrailsApplicationInterface,
 
         self.rpcserver = None
         self.pingserver = None
+        self.workers = None
         self.images_url = "http://vistrails.sci.utah.edu/medleys/images/"
         qt.allowQObjects()
 
@@ -2116,6 +2130,7 @@ class VistrailsServerSingleton(VistrailsApplicationInterface,
         If file doesn't exist, create one and raise error. """
 
         global accessList, db_host, db_read_user, db_read_pass, db_write_user, db_write_pass, media_dir, script_file, virtual_display
+        global cache_memory_limit, worker_options
         accessList = []
         db_host = ''
         db_read_user = ''
@@ -2207,6 +2222,23 @@ class VistrailsServerSingleton(VistrailsApplicationInterface,
         if virtual_display == "":
             virtual_display = "0"
 
+        # worker and cache fields are optional
+        worker_options = {}
+        for option in ['max_workers', 'memory_limit', 'probe_interval',
+                       'startup_timeout', 'idle_timeout', 'max_failures',
+                       'queue_timeout']:
+            if config.has_option("workers", option):
+                worker_options[option] = config.getint("workers", option)
+
+        if config.has_option("cache", "max_vistrails"):
+            vistrail_cache.max_vistrails = config.getint("cache",
+                                                         "max_vistrails")
+        if config.has_option("cache", "max_pipelines"):
+            vistrail_cache.max_pipelines = config.getint("cache",
+                                                         "max_pipelines")
+        if config.has_option("cache", "memory_limit"):
+            cache_memory_limit = config.getint("cache", "memory_limit")
+
         # check if all required parameters are present
         missing_req_fields = [y for (x,y) in ((db_host,"host"),
                                               (db_read_user,"read_user"),
@@ -2256,34 +2288,24 @@ class VistrailsServerSingleton(VistrailsApplicationInterface,
         return True
 
     def start_other_instances(self, number):
-        self.others = []
-        host = self.temp_configuration.check('rpcServer')
-        port = self.temp_configuration.check('rpcPort')
-        virt_disp = int(virtual_display)
-        for x in xrange(number):
-            port += 1   # each instance needs one port space for now
-                        #later we might need 2 (normal requests and status requests)
-            virt_disp += 1
-            args = [script_file,":%s"%virt_disp,host,str(port),'0', '0']
-            try:
-                subprocess.Popen(args)
-                time.sleep(20)
-                self.others.append("http://%s:%s"%(host,port))
-            except Exception, e:
-                self.server_logger.error(("Couldn't start the instance on display:"
-                                          "%s port: %s") % (virtual_display, port))
-                self.server_logger.error(str(e))
+        """start_other_instances(number: int) -> None
+        Starts the pool of instances requests are forwarded to, with number
+        instances to begin with.
+
+        """
+        self.workers = None
+        if number <= 0:
+            return
+        self.workers = WorkerPool(self.server_logger,
+                                  self.temp_configuration.check('rpcServer'),
+                                  self.temp_configuration.check('rpcPort'),
+                                  int(virtual_display), script_file,
+                                  min_workers=number, **worker_options)
+        self.workers.start()
 
     def stop_other_instances(self):
-        script = os.path.join(system.vistrails_root_directory(), "stop_vistrails_server.py")
-        for o in self.others:
-            args = ['python', script, o]
-            try:
-                subprocess.Popen(args)
-                time.sleep(15)
-            except Exception, e:
-                self.server_logger.error("Couldn't stop instance: %s" % o)
-                self.server_logger.error(str(e))
+        if self.workers is not None:
+            self.workers.stop()
 
     def run_server(self):
         """run_server() -> None
@@ -2314,10 +2336,10 @@ class VistrailsServerSingleton(VistrailsApplicationInterface,
             self.server_logger.info("    singlethreaded instance")
         #self.rpcserver.register_introspection_functions()
         self.rpcserver.register_instance(RequestHandler(self.server_logger,
-                                                        self.others))
+                                                        self.workers))
         if self.pingserver:
             self.pingserver.register_instance(RequestHandler(
-                                                      self.server_logger, []))
+                                                      self.server_logger))
             self.server_logger.info(
                        "Status XML RPC Server is listening on http://%s:%s"% \
                             (self.temp_configuration.check('rpcServer'),
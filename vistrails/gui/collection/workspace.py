@@ -76,13 +76,24 @@ class QCollectionWidget(QtGui.QTreeWidget):
         """ Called from the collection when committed """
         self.setup_widget()
             
-    def run_search(self, search, items=None):
-        # FIXME only uses top level items
+    def run_search(self, search, items=None, matches=None):
         if items is None:
             items = [self.topLevelItem(i) 
                      for i in xrange(self.topLevelItemCount())]
+        if matches is None:
+            # saved entities are matched by the collection's indexes
+            matches = set(e.id for e in self.collection.search(search))
         for item in items:
-            if search.match(item.entity):
+            entity = getattr(item, 'entity', None)
+            if entity is None:
+                found = False
+            elif entity.was_updated or \
+                    self.collection.is_temp_entity(entity):
+                # not in the index yet
+                found = search.match(entity)
+            else:
+                found = entity.id in matches
+            if found:
                 item.setHidden(False)
                 parent = item.parent()
                 while parent is not None:
@@ -92,7 +103,8 @@ class QCollectionWidget(QtGui.QTreeWidget):
             else:
                 item.setHidden(True)
             self.run_search(search, [item.child(i) 
-                                     for i in xrange(item.childCount())])
+                                     for i in xrange(item.childCount())],
+                            matches)
             
     def reset_search(self, items=None):
         if items is None:
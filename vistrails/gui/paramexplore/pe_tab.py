@@ -51,7 +51,8 @@ from vistrails.core.system import current_time, strftime, \
     get_vistrails_default_pkg_prefix
 from vistrails.gui.common_widgets import QDockContainer, QToolWindowInterface
 from vistrails.gui.paramexplore.pe_table import QParameterExplorationWidget, QParameterSetEditor
-from vistrails.gui.paramexplore.virtual_cell import QVirtualCellWindow
+from vistrails.gui.paramexplore.virtual_cell import QVirtualCellWindow, \
+    positionPipeline
 from vistrails.gui.paramexplore.param_view import QParameterView
 from vistrails.gui.paramexplore.pe_pipeline import QAnnotatedPipelineView
 
@@ -278,28 +279,28 @@ class QParameterExplorationTab(QDockContainer, QToolWindowInterface):
 
         if self.controller.current_pipeline and actions:
             explorer = ActionBasedParameterExploration()
-            (pipelines, performedActions) = explorer.explore(
+            # pipelines are derived and positioned one at a time as
+            # they are executed
+            explored = explorer.iter_explore(
                 self.controller.current_pipeline, actions)
             
             dim = [max(1, len(a)) for a in actions]
             if (registry.has_module(spreadsheet_pkg, 'CellLocation') and
                 registry.has_module(spreadsheet_pkg, 'SheetReference')):
-                modifiedPipelines = self.virtualCell.positionPipelines(
-                    'PE#%d %s' % (QParameterExplorationTab.explorationId,
-                                  self.controller.name),
-                    dim[2], dim[1], dim[0], pipelines, self.controller)
+                sheetPrefix = 'PE#%d %s' % (
+                    QParameterExplorationTab.explorationId,
+                    self.controller.name)
+                cells = self.virtualCell.getConfiguration()[2]
+                def position(pi, pipeline):
+                    return positionPipeline(sheetPrefix, dim[2], dim[1],
+                                            dim[0], pi, pipeline, cells)[0]
             else:
-                modifiedPipelines = pipelines
+                def position(pi, pipeline):
+                    return pipeline
 
-            mCount = []
-            for p in modifiedPipelines:
-                if len(mCount)==0:
-                    mCount.append(0)
-                else:
-                    mCount.append(len(p.modules)+mCount[len(mCount)-1])
-                
             # Now execute the pipelines
-            totalProgress = sum([len(p.modules) for p in modifiedPipelines])
+            totalProgress = explorer.count(actions) * \
+                len(self.controller.current_pipeline.modules)
             progress = QtGui.QProgressDialog('Performing Parameter '
                                              'Exploration...',
                                              '&Cancel',
@@ -310,8 +311,10 @@ class QParameterExplorationTab(QDockContainer, QToolWindowInterface):
 
             QParameterExplorationTab.explorationId += 1
             interpreter = get_default_interpreter()
-            for pi in xrange(len(modifiedPipelines)):
-                progress.setValue(mCount[pi])
+            executedModules = 0
+            for pi, (pipeline, performedActions) in enumerate(explored):
+                pipeline = position(pi, pipeline)
+                progress.setValue(min(executedModules, totalProgress))
                 QtCore.QCoreApplication.processEvents()
                 if progress.wasCanceled():
                     break
@@ -329,9 +332,10 @@ class QParameterExplorationTab(QDockContainer, QToolWindowInterface):
                           'view': self.controller.current_pipeline_scene,
                           'module_executed_hook': [moduleExecuted],
                           'reason': 'Parameter Exploration',
-                          'actions': performedActions[pi],
+                          'actions': performedActions,
                           }
-                interpreter.execute(modifiedPipelines[pi], **kwargs)
+                interpreter.execute(pipeline, **kwargs)
+                executedModules += len(pipeline.modules)
             progress.setValue(totalProgress)
 
     def exploreChange(self, notEmpty):
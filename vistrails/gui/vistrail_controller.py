@@ -365,7 +365,7 @@ class VistrailController(QtCore.QObject, BaseController):
         if action is not None:
             BaseController.add_new_action(self, action, description)
             self.emit(QtCore.SIGNAL("new_action"), action)
-            self.recompute_terse_graph()
+            self.update_terse_graph()
 
     ##########################################################################
 
@@ -672,6 +672,11 @@ class VistrailController(QtCore.QObject, BaseController):
         self._current_graph_layout.layout_from(self.vistrail,
                                                self._current_terse_graph)
 
+    def update_terse_graph(self, versions=()):
+        BaseController.update_terse_graph(self, versions)
+        self._current_graph_layout.layout_from(self.vistrail,
+                                               self._current_terse_graph)
+
     def refine_graph(self, step=1.0):
         """ refine_graph(step: float in [0,1]) -> (Graph, Graph)        
         Refine the graph of the current vistrail based the search
@@ -723,9 +728,10 @@ class VistrailController(QtCore.QObject, BaseController):
                 # so just rename the node on the terse graph
                 self._current_terse_graph.rename_vertex(current, new_version)
                 self.replace_unnamed_node_in_version_tree(current, new_version)
+                # bring the incremental state in line, without a new layout
+                BaseController.update_terse_graph(self)
             else:
-                # bail, for now
-                self.recompute_terse_graph()
+                self.update_terse_graph()
                 self.invalidate_version_tree(False)
         
 
@@ -797,7 +803,9 @@ class VistrailController(QtCore.QObject, BaseController):
             self.vistrail.addTag(tag, self.current_base_version)
 
         self.set_changed(True)
-        self.recompute_terse_graph()
+        self.update_terse_graph([v for v in (tag_version,
+                                             self.current_base_version)
+                                 if v is not None])
         self.invalidate_version_tree(False)
         return True
 
@@ -1267,33 +1275,32 @@ class VistrailController(QtCore.QObject, BaseController):
         if self.current_pipeline and actions:
             pe_log_id = uuid.uuid1()
             explorer = ActionBasedParameterExploration()
-            (pipelines, performedActions) = explorer.explore(
-                self.current_pipeline, actions, pre_actions)
+            # pipelines are derived and positioned one at a time as
+            # they are executed
+            explored = explorer.iter_explore(self.current_pipeline,
+                                             actions, pre_actions)
+            pipelineCount = explorer.count(actions)
             
             dim = [max(1, len(a)) for a in actions]
             if use_spreadsheet:
-                from vistrails.gui.paramexplore.virtual_cell import positionPipelines, assembleThumbnails
+                from vistrails.gui.paramexplore.virtual_cell import positionPipeline, assembleThumbnails
                 from vistrails.gui.paramexplore.pe_view import QParamExploreView
-                modifiedPipelines, pipelinePositions = positionPipelines(
-                    'PE#%d %s' % (QParamExploreView.explorationId, self.name),
-                    dim[2], dim[1], dim[0], pipelines, pe.layout, self)
+                sheetPrefix = 'PE#%d %s' % (QParamExploreView.explorationId,
+                                            self.name)
                 QParamExploreView.explorationId += 1
+                def position(pi, pipeline):
+                    return positionPipeline(sheetPrefix, dim[2], dim[1],
+                                            dim[0], pi, pipeline, pe.layout)
             else:
-                from vistrails.core.param_explore import _pipelinePositions
-                modifiedPipelines = pipelines
-                pipelinePositions = _pipelinePositions(
-                    dim[2], dim[1], dim[0], pipelines)
-
-            mCount = []
-            for p in modifiedPipelines:
-                if len(mCount)==0:
-                    mCount.append(0)
-                else:
-                    mCount.append(len(p.modules)+mCount[len(mCount)-1])
-                
+                from vistrails.core.param_explore import _pipelinePosition
+                def position(pi, pipeline):
+                    return pipeline, _pipelinePosition(pi, dim[2], dim[1],
+                                                       dim[0])
+
             # Now execute the pipelines
             if showProgress:
-                totalProgress = sum([len(p.modules) for p in modifiedPipelines])
+                totalProgress = pipelineCount * \
+                    len(self.current_pipeline.modules)
                 progress = QtGui.QProgressDialog('Performing Parameter '
                                                  'Exploration...',
                                                  '&Cancel',
@@ -1306,9 +1313,11 @@ class VistrailController(QtCore.QObject, BaseController):
             
             images = {}
             errors = []
-            for pi in xrange(len(modifiedPipelines)):
+            executedModules = 0
+            for pi, (pipeline, performedActions) in enumerate(explored):
+                pipeline, pipelinePosition = position(pi, pipeline)
                 if showProgress:
-                    progress.setValue(mCount[pi])
+                    progress.setValue(min(executedModules, totalProgress))
                     QtCore.QCoreApplication.processEvents()
                     if progress.wasCanceled():
                         break
@@ -1318,17 +1327,17 @@ class VistrailController(QtCore.QObject, BaseController):
                             QtCore.QCoreApplication.processEvents()
                 if use_spreadsheet:
                     name = os.path.splitext(self.name)[0] + \
-                                         ("_%s_%s_%s" % pipelinePositions[pi])
+                                         ("_%s_%s_%s" % pipelinePosition)
                     extra_info['nameDumpCells'] = name
                     if 'pathDumpCells' in extra_info:
-                        images[pipelinePositions[pi]] = \
+                        images[pipelinePosition] = \
                                    os.path.join(extra_info['pathDumpCells'], name)
-                pe_cell_id = (pe_log_id,) + pipelinePositions[pi]
+                pe_cell_id = (pe_log_id,) + pipelinePosition
                 kwargs = {'locator': self.locator,
                           'current_version': self.current_version,
                           'reason': 'Parameter Exploration %s %s_%s_%s' % pe_cell_id,
                           'logger': self.get_logger(),
-                          'actions': performedActions[pi],
+                          'actions': performedActions,
                           'extra_info': extra_info
                           }
                 if view:
@@ -1340,10 +1349,11 @@ class VistrailController(QtCore.QObject, BaseController):
                     vars = dict([(v.uuid, v) for v in self.get_vistrail_variables()
                             if v.uuid not in vistrail_vars])
                     kwargs['vistrail_variables'] = lambda x: vars.get(x, None)
-                result = interpreter.execute(modifiedPipelines[pi], **kwargs)
+                result = interpreter.execute(pipeline, **kwargs)
+                executedModules += len(pipeline.modules)
                 for error in result.errors.itervalues():
                     if use_spreadsheet:
-                        pp = pipelinePositions[pi]
+                        pp = pipelinePosition
                         errors.append(((pp[1], pp[0], pp[2]), error))
                     else:
                         errors.append(((0,0,0), error))
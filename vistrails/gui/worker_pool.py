@@ -0,0 +1,613 @@
+###############################################################################
+##
+## Copyright (C) 2014-2015, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+"""Pool of VisTrails server instances that requests are forwarded to.
+
+The main server starts its workers with the server script and talks to them
+over XML-RPC. Workers are probed periodically: each reports how many
+requests it is serving and how much memory it uses. A worker serves one
+request at a time: requests go to the least loaded idle worker, waiting for
+one to be free if they are all busy. Crashed, unresponsive or bloated workers are restarted,
+and the pool grows and shrinks between its bounds with the load.
+
+"""
+from __future__ import division
+
+import socket
+import subprocess
+import threading
+import time
+import unittest
+import xmlrpclib
+
+
+class TimeoutTransport(xmlrpclib.Transport):
+    """XML-RPC transport with a socket timeout, so that probes don't hang
+    on a stuck worker.
+
+    """
+    def __init__(self, timeout):
+        xmlrpclib.Transport.__init__(self)
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        connection = xmlrpclib.Transport.make_connection(self, host)
+        connection.timeout = self.timeout
+        return connection
+
+
+class Worker(object):
+    def __init__(self, slot, host, port, display):
+        self.slot = slot
+        self.uri = "http://%s:%s" % (host, port)
+        self.port = port
+        self.display = display
+        self.process = None
+        self.ready = False
+        self.retiring = False
+        # requests forwarded by us and not answered yet
+        self.active = 0
+        # last load reported by the worker itself
+        self.requests = 0
+        self.rss = 0
+        self.failures = 0
+        self.last_used = time.time()
+
+    def is_alive(self):
+        return self.process is None or self.process.poll() is None
+
+    def status(self):
+        return {'uri': self.uri,
+                'ready': self.ready,
+                'active': self.active,
+                'requests': self.requests,
+                'rss': self.rss,
+                'failures': self.failures}
+
+
+class WorkerPool(object):
+    """WorkerPool manages the VisTrails instances started by a server.
+
+    Worker i listens on port + i and uses display + i, for i between 1 and
+    max_workers. memory_limit is in kilobytes, 0 meaning no limit; the
+    intervals and timeouts are in seconds. queue_timeout is how long a
+    request waits for a worker to be free.
+
+    """
+    def __init__(self, logger, host, port, display, script_file,
+                 min_workers=1, max_workers=None, memory_limit=0,
+                 probe_interval=10, startup_timeout=120, idle_timeout=600,
+                 max_failures=3, queue_timeout=600):
+        self.logger = logger
+        self.host = host
+        self.port = port
+        self.display = display
+        self.script_file = script_file
+        self.min_workers = min_workers
+        if max_workers is None or max_workers < min_workers:
+            max_workers = min_workers
+        self.max_workers = max_workers
+        self.memory_limit = memory_limit
+        self.probe_interval = probe_interval
+        self.startup_timeout = startup_timeout
+        self.idle_timeout = idle_timeout
+        self.max_failures = max_failures
+        self.queue_timeout = queue_timeout
+        self.workers = []
+        self._condition = threading.Condition()
+        self._launchers = []
+        self._monitor = None
+        self._stopped = False
+
+    # Process management, overridden by the tests
+
+    def spawn_process(self, worker):
+        # Workers are single-threaded: they are only sent a request when
+        # they are idle, see acquire()
+        args = [self.script_file, ":%s" % worker.display, self.host,
+                str(worker.port), '0', '0']
+        return subprocess.Popen(args)
+
+    def make_proxy(self, worker, timeout=None):
+        if timeout is None:
+            return xmlrpclib.ServerProxy(worker.uri)
+        return xmlrpclib.ServerProxy(worker.uri,
+                                     transport=TimeoutTransport(timeout))
+
+    def stop_process(self, worker):
+        try:
+            self.make_proxy(worker, self.probe_interval).quit()
+        except Exception, e:
+            self.logger.error("Couldn't stop instance %s: %s" % (worker.uri,
+                                                                 e))
+        process = worker.process
+        if process is None:
+            return
+        deadline = time.time() + self.probe_interval
+        while process.poll() is None and time.time() < deadline:
+            time.sleep(0.1)
+        if process.poll() is None:
+            self.logger.error("Killing instance %s" % worker.uri)
+            process.kill()
+            process.wait()
+
+    # Starting workers
+
+    def _new_worker(self):
+        # must be called with self._condition held
+        used = set(w.slot for w in self.workers)
+        for slot in xrange(1, self.max_workers + 1):
+            if slot not in used:
+                worker = Worker(slot, self.host, self.port + slot,
+                                self.display + slot)
+                self.workers.append(worker)
+                return worker
+        return None
+
+    def _wait_ready(self, worker):
+        deadline = time.time() + self.startup_timeout
+        while time.time() < deadline and not self._stopped:
+            if not worker.is_alive():
+                return False
+            try:
+                self.make_proxy(worker, 5).try_ping()
+                return True
+            except Exception:
+                time.sleep(0.5)
+        return False
+
+    def _launch(self, worker):
+        self.logger.info("Starting instance %s" % worker.uri)
+        try:
+            worker.process = self.spawn_process(worker)
+            ready = self._wait_ready(worker)
+        except Exception, e:
+            self.logger.error("Couldn't start the instance on display: "
+                              "%s port: %s" % (worker.display, worker.port))
+            self.logger.error(str(e))
+            ready = False
+        with self._condition:
+            worker.failures = 0
+            worker.last_used = time.time()
+            if ready:
+                worker.ready = True
+                self.logger.info("Instance %s is ready" % worker.uri)
+            else:
+                self.logger.error("Instance %s didn't start" % worker.uri)
+                if worker in self.workers:
+                    self.workers.remove(worker)
+            self._condition.notify_all()
+        if not ready and worker.process is not None:
+            if worker.process.poll() is None:
+                worker.process.kill()
+
+    def _in_thread(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        self._launchers = [t for t in self._launchers if t.is_alive()]
+        self._launchers.append(thread)
+        thread.start()
+
+    def _launch_async(self, worker):
+        self._in_thread(self._launch, worker)
+
+    def wait_started(self):
+        """wait_started() -> None
+        Waits for the workers being started to be ready (or to fail).
+
+        """
+        for thread in list(self._launchers):
+            thread.join()
+
+    def start(self):
+        """start() -> None
+        Starts min_workers instances concurrently, waits until they answer
+        and starts monitoring them.
+
+        """
+        with self._condition:
+            for i in xrange(self.min_workers):
+                self._launch_async(self._new_worker())
+        self.wait_started()
+        if self.probe_interval:
+            self._monitor = threading.Thread(target=self._run_monitor)
+            self._monitor.daemon = True
+            self._monitor.start()
+
+    def stop(self):
+        """stop() -> None
+        Stops monitoring and shuts down all the workers.
+
+        """
+        with self._condition:
+            self._stopped = True
+            workers = list(self.workers)
+            del self.workers[:]
+            self._condition.notify_all()
+        for worker in workers:
+            self.stop_process(worker)
+
+    def _restart(self, worker, reason):
+        # must be called with self._condition held
+        self.logger.info("Restarting instance %s: %s" % (worker.uri, reason))
+        worker.ready = False
+        def restart():
+            self.stop_process(worker)
+            if self._stopped:
+                return
+            with self._condition:
+                if worker not in self.workers:
+                    self.workers.append(worker)
+            self._launch(worker)
+        self._in_thread(restart)
+
+    def _retire(self, worker):
+        # must be called with self._condition held
+        self.logger.info("Stopping idle instance %s" % worker.uri)
+        worker.ready = False
+        self.workers.remove(worker)
+        self._in_thread(self.stop_process, worker)
+
+    # Monitoring
+
+    def _probe(self, worker):
+        if not worker.is_alive():
+            return False
+        try:
+            load = self.make_proxy(worker, self.probe_interval or 5).get_load()
+        except Exception, e:
+            self.logger.error("Probe of %s failed: %s" % (worker.uri, e))
+            return None
+        return load
+
+    def check(self):
+        """check() -> None
+        Probes every ready worker, restarts the dead or bloated ones and
+        scales the pool with its load.
+
+        """
+        with self._condition:
+            workers = [w for w in self.workers if w.ready]
+        for worker in workers:
+            load = self._probe(worker)
+            with self._condition:
+                if not worker.ready:
+                    continue
+                if load is False:
+                    self._restart(worker, "process exited")
+                    continue
+                if load is None:
+                    if worker.active > 0:
+                        # busy with a request we forwarded; restarting it
+                        # would lose that request
+                        continue
+                    worker.failures += 1
+                    if worker.failures >= self.max_failures:
+                        self._restart(worker, "not responding")
+                    continue
+                worker.failures = 0
+                worker.requests = load['requests']
+                worker.rss = load['memory']['rss']
+                if (self.memory_limit and worker.rss > self.memory_limit and
+                        worker.active == 0):
+                    self._restart(worker, "using %d kB" % worker.rss)
+        with self._condition:
+            self._scale()
+            self._condition.notify_all()
+
+    def _scale(self):
+        # must be called with self._condition held
+        if self._stopped:
+            return
+        ready = [w for w in self.workers if w.ready]
+        if len(self.workers) < self.min_workers or \
+                (len(self.workers) < self.max_workers and
+                 len(ready) == len(self.workers) and
+                 all(w.active > 0 for w in ready)):
+            self._launch_async(self._new_worker())
+        elif len(self.workers) > self.min_workers:
+            now = time.time()
+            for worker in ready:
+                if (worker.active == 0 and
+                        now - worker.last_used > self.idle_timeout):
+                    self._retire(worker)
+                    break
+
+    def _run_monitor(self):
+        while not self._stopped:
+            time.sleep(self.probe_interval)
+            if self._stopped:
+                break
+            try:
+                self.check()
+            except Exception, e:
+                self.logger.error("Error when checking instances: %s" % e)
+
+    # Dispatching
+
+    def _load(self, worker):
+        return (worker.active + worker.requests, worker.rss)
+
+    def acquire(self, timeout=None):
+        """acquire(timeout: float) -> Worker
+        Returns the least loaded idle worker, waiting for one to be free or
+        to be started if there is none. release() must be called when done.
+
+        """
+        if timeout is None:
+            timeout = self.queue_timeout
+        deadline = time.time() + timeout
+        with self._condition:
+            while True:
+                idle = [w for w in self.workers if w.ready and w.active == 0]
+                if idle:
+                    worker = min(idle, key=self._load)
+                    worker.active += 1
+                    return worker
+                # everybody is busy or starting, ask for some help
+                self._scale()
+                remaining = deadline - time.time()
+                if remaining <= 0 or self._stopped:
+                    raise RuntimeError("No VisTrails instance available")
+                self._condition.wait(remaining)
+
+    def acquire_all(self, timeout=None):
+        """acquire_all(timeout: float) -> list of Worker
+        Returns all the ready workers, waiting for each of them to be idle.
+        release() must be called on each.
+
+        """
+        if timeout is None:
+            timeout = self.queue_timeout
+        deadline = time.time() + timeout
+        with self._condition:
+            pending = [w for w in self.workers if w.ready]
+            workers = []
+            while True:
+                for worker in list(pending):
+                    if not worker.ready:
+                        # being restarted or stopped, skip it
+                        pending.remove(worker)
+                    elif worker.active == 0:
+                        worker.active += 1
+                        pending.remove(worker)
+                        workers.append(worker)
+                if not pending:
+                    return workers
+                remaining = deadline - time.time()
+                if remaining <= 0 or self._stopped:
+                    for worker in workers:
+                        worker.active -= 1
+                    self._condition.notify_all()
+                    raise RuntimeError("VisTrails instances are busy")
+                self._condition.wait(remaining)
+
+    def release(self, worker, failed=False):
+        """release(worker: Worker, failed: bool) -> None
+        Signals that a request to worker is done. failed means the worker
+        couldn't be reached.
+
+        """
+        with self._condition:
+            worker.active -= 1
+            worker.last_used = time.time()
+            if failed and worker.ready:
+                worker.failures += 1
+                if not worker.is_alive():
+                    self._restart(worker, "process exited")
+                elif worker.failures >= self.max_failures:
+                    self._restart(worker, "not responding")
+            self._condition.notify_all()
+
+    def call(self, method, *args):
+        """call(method: str, *args) -> object
+        Forwards a request to the least loaded idle worker.
+
+        """
+        worker = self.acquire()
+        self.logger.info("Sending request %s to %s" % (method, worker.uri))
+        failed = False
+        try:
+            return getattr(self.make_proxy(worker), method)(*args)
+        except (socket.error, xmlrpclib.ProtocolError):
+            failed = True
+            raise
+        finally:
+            self.release(worker, failed)
+
+    def status(self):
+        """status() -> list of dict
+        Returns the state of the workers.
+
+        """
+        with self._condition:
+            return [w.status() for w in self.workers]
+
+################################################################################
+
+class TestWorkerPool(unittest.TestCase):
+    class Logger(object):
+        def info(self, msg):
+            pass
+        error = info
+
+    class FakeProcess(object):
+        def __init__(self):
+            self.returncode = None
+
+        def poll(self):
+            return self.returncode
+
+        def kill(self):
+            self.returncode = -9
+
+        def wait(self):
+            return self.returncode
+
+    class FakeProxy(object):
+        def __init__(self, pool, worker):
+            self.pool = pool
+            self.worker = worker
+
+        def try_ping(self):
+            return 1
+
+        def get_load(self):
+            if self.worker.port in self.pool.hung:
+                raise socket.error("timed out")
+            return {'requests': 0,
+                    'memory': {'rss': self.pool.rss.get(self.worker.port, 0),
+                               'peak': 0}}
+
+        def quit(self):
+            self.worker.process.returncode = 0
+
+        def echo(self, value):
+            return (self.worker.port, value)
+
+    def make_pool(self, **kwargs):
+        test = self
+        class Pool(WorkerPool):
+            spawned = []
+            hung = set()
+            rss = {}
+            def spawn_process(self, worker):
+                self.spawned.append(worker.port)
+                return test.FakeProcess()
+
+            def make_proxy(self, worker, timeout=None):
+                return test.FakeProxy(self, worker)
+        kwargs.setdefault('probe_interval', 0)
+        pool = Pool(self.Logger(), 'localhost', 8080, 0, 'script', **kwargs)
+        pool.start()
+        return pool
+
+    def test_start(self):
+        pool = self.make_pool(min_workers=3)
+        self.assertEqual(sorted(pool.spawned), [8081, 8082, 8083])
+        self.assertTrue(all(w['ready'] for w in pool.status()))
+        self.assertEqual(pool.call('echo', 'a')[1], 'a')
+        pool.stop()
+        self.assertEqual(pool.status(), [])
+
+    def test_least_loaded(self):
+        pool = self.make_pool(min_workers=3)
+        w1 = pool.acquire()
+        w2 = pool.acquire()
+        self.assertNotEqual(w1, w2)
+        pool.rss = {w1.port: 100, w2.port: 10}
+        pool.check()
+        w3 = pool.acquire()
+        self.assertNotIn(w3, (w1, w2))
+        pool.release(w1)
+        pool.release(w3)
+        # w1 and w3 are idle now, w3 uses less memory
+        self.assertIs(pool.acquire(), w3)
+
+    def test_restart(self):
+        pool = self.make_pool(min_workers=2, max_failures=2,
+                              memory_limit=1000)
+        w1, w2 = pool.workers
+        w1.process.returncode = 1
+        pool.check()
+        pool.wait_started()
+        self.assertEqual(pool.spawned.count(w1.port), 2)
+        self.assertTrue(w1.ready)
+        pool.hung.add(w2.port)
+        pool.check()
+        self.assertEqual(pool.spawned.count(w2.port), 1)
+        pool.check()
+        pool.wait_started()
+        self.assertEqual(pool.spawned.count(w2.port), 2)
+        pool.hung.clear()
+        pool.rss = {w2.port: 2000}
+        pool.check()
+        pool.wait_started()
+        self.assertEqual(pool.spawned.count(w2.port), 3)
+        self.assertEqual(len(pool.workers), 2)
+
+    def test_busy(self):
+        pool = self.make_pool(min_workers=1, max_failures=1)
+        worker = pool.acquire()
+        pool.hung.add(worker.port)
+        pool.check()
+        pool.check()
+        pool.wait_started()
+        # it doesn't answer because it's busy serving our request
+        self.assertEqual(pool.spawned.count(worker.port), 1)
+        self.assertTrue(worker.ready)
+        pool.release(worker)
+        pool.check()
+        pool.wait_started()
+        self.assertEqual(pool.spawned.count(worker.port), 2)
+
+    def test_queue(self):
+        pool = self.make_pool(min_workers=1)
+        worker = pool.acquire()
+        acquired = []
+        thread = threading.Thread(
+                target=lambda: acquired.append(pool.acquire()))
+        thread.start()
+        time.sleep(0.1)
+        # the worker is busy: the second request waits for it
+        self.assertEqual(acquired, [])
+        self.assertEqual(worker.active, 1)
+        self.assertRaises(RuntimeError, pool.acquire_all, 0.1)
+        self.assertEqual(worker.active, 1)
+        pool.release(worker)
+        thread.join(5)
+        self.assertEqual(acquired, [worker])
+        self.assertEqual(worker.active, 1)
+        pool.release(worker)
+        self.assertEqual(pool.acquire_all(), [worker])
+        pool.release(worker)
+        pool.stop()
+
+    def test_scaling(self):
+        pool = self.make_pool(min_workers=1, max_workers=2, idle_timeout=0)
+        w1 = pool.acquire()
+        # the only worker is busy: another one gets started and gets the
+        # request
+        w2 = pool.acquire()
+        self.assertIsNot(w2, w1)
+        self.assertEqual(len(pool.workers), 2)
+        # the pool is full: requests wait for a worker to be free
+        self.assertRaises(RuntimeError, pool.acquire, 0.1)
+        # w1 goes idle and gets stopped
+        pool.release(w1)
+        time.sleep(0.01)
+        pool.check()
+        pool.wait_started()
+        self.assertEqual(pool.workers, [w2])
@@ -163,6 +163,17 @@ class TestIf(unittest.TestCase):
     def test_if_false(self):
         self.do_if(False)
 
+    def test_if_threads(self):
+        from vistrails.core.configuration import get_vistrails_configuration
+        conf = get_vistrails_configuration()
+        old_threads = conf.executionThreads
+        conf.executionThreads = 4
+        try:
+            self.do_if(True)
+            self.do_if(False)
+        finally:
+            conf.executionThreads = old_threads
+
 
 class TestDefault(unittest.TestCase):
     def do_default(self, val):
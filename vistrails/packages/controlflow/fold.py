@@ -158,15 +158,10 @@ class FoldWithModule(Fold):
             inputList = rawInputList
         suspended = []
         loop = self.logging.begin_loop_execution(self, len(inputList))
-        ## Update everything for each value inside the list
+        connectors = self.inputPorts.get('FunctionPort')
+        iterations = []
         for i, element in enumerate(inputList):
-            self.logging.update_progress(self, float(i)/len(inputList))
-            if element_is_iter:
-                self.element = element
-            else:
-                self.element = element[0]
-            do_operation = True
-            for connector in self.inputPorts.get('FunctionPort'):
+            for connector in connectors:
                 module = copy.copy(connector.obj)
 
                 if not self.upToDate: # pragma: no branch
@@ -178,19 +173,23 @@ class FoldWithModule(Fold):
                     module.computed = False
 
                     self.setInputValues(module, nameInput, element, i)
+                iterations.append((i, module))
 
-                loop.begin_iteration(module, i)
-
-                try:
-                    module.update()
-                except ModuleSuspended, e:
+        ## Update everything for each value inside the list
+        results = izip(iterations, self.update_iterations(loop, iterations))
+        for i, element in enumerate(inputList):
+            if element_is_iter:
+                self.element = element
+            else:
+                self.element = element[0]
+            do_operation = True
+            for connector in connectors:
+                (_, module), e = next(results)
+                if e is not None:
                     suspended.append(e)
                     do_operation = False
-                    loop.end_iteration(module)
                     continue
 
-                loop.end_iteration(module)
-
                 ## Getting the result from the output port
                 if nameOutput not in module.outputPorts:
                     raise ModuleError(module,
@@ -199,8 +198,6 @@ class FoldWithModule(Fold):
             if do_operation:
                 self.operation()
 
-            self.logging.update_progress(self, i * 1.0 / len(inputList))
-
         if suspended:
             raise ModuleSuspended(
                     self,
@@ -90,6 +90,17 @@ class TestOrder(unittest.TestCase):
                 ]))
         self.assertEqual(output, ['one', 'two'])
 
+    def test_1_threads(self):
+        from vistrails.core.configuration import get_vistrails_configuration
+        conf = get_vistrails_configuration()
+        old_threads = conf.executionThreads
+        conf.executionThreads = 4
+        try:
+            self.test_1()
+            self.test_2()
+        finally:
+            conf.executionThreads = old_threads
+
     def test_2(self):
         with capture_stdout() as output:
             self.assertFalse(execute([
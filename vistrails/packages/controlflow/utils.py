@@ -204,6 +204,30 @@ class TestMap(unittest.TestCase):
                 ]))
         self.assertEqual(results, [[3, 11, 1]])
 
+    def test_threads(self):
+        from vistrails.core.configuration import get_vistrails_configuration
+        conf = get_vistrails_configuration()
+        old_threads = conf.loopThreads
+        conf.loopThreads = 4
+        try:
+            with intercept_result(Map, 'Result') as results:
+                self.assertFalse(execute([
+                        ('ConcatenateString', 'org.vistrails.vistrails.basic', [
+                            ('str2', [('String', '!')]),
+                        ]),
+                        ('Map', 'org.vistrails.vistrails.control_flow', [
+                            ('InputPort', [('List', "['str1']")]),
+                            ('OutputPort', [('String', 'value')]),
+                            ('InputList', [('List', repr(map(str, xrange(20))))]),
+                        ]),
+                    ],
+                    [
+                        (0, 'self', 1, 'FunctionPort'),
+                    ]))
+        finally:
+            conf.loopThreads = old_threads
+        self.assertEqual(results, [['%d!' % i for i in xrange(20)]])
+
 
 class TestUtils(unittest.TestCase):
     def test_filter(self):
@@ -38,10 +38,14 @@ from __future__ import division
 
 from vistrails.core.modules.vistrails_module import Module
 from vistrails.core.modules.module_registry import get_module_registry
-from vistrails.core.modules.basic_modules import List, String
+from vistrails.core.modules.basic_modules import Integer, List, String
 
-from engine_manager import EngineManager
+try:
+    from engine_manager import EngineManager
+except ImportError:
+    EngineManager = None
 from map import Map
+import local_pool
 
 
 def initialize(*args,**keywords):
@@ -52,14 +56,24 @@ def initialize(*args,**keywords):
     reg.add_input_port(Map, 'InputList', (List, ''))
     reg.add_input_port(Map, 'InputPort', (List, ''))
     reg.add_input_port(Map, 'OutputPort', (String, ''))
+    reg.add_input_port(Map, 'Backend', (String, ''), optional=True,
+                       entry_types=['enum'],
+                       values=[['auto', 'ipython', 'local']],
+                       defaults=['auto'])
+    reg.add_input_port(Map, 'ChunkSize', (Integer, ''), optional=True)
+    reg.add_input_port(Map, 'Processes', (Integer, ''), optional=True)
     reg.add_output_port(Map, 'Result', (List, ''))
 
 
 def finalize():
-    EngineManager.cleanup()
+    local_pool.cleanup()
+    if EngineManager is not None:
+        EngineManager.cleanup()
 
 
 def menu_items():
+    if EngineManager is None:
+        return ()
     return (
             ("Start new engine processes",
              lambda: EngineManager.start_engines()),
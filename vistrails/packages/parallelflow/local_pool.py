@@ -0,0 +1,136 @@
+###############################################################################
+##
+## Copyright (C) 2014-2015, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+
+"""Local process pool, used by Map when no IPython cluster is used.
+
+The pool is started on first use and kept around for the next executions, so
+that the worker processes only pay the cost of initializing VisTrails once.
+It is restarted if the number of processes changes or if packages were
+enabled since it was started, so that the workers know about every module.
+
+parallel_map() sends the elements to the workers in chunks, along with the
+same leading arguments, so that these only get pickled once per chunk.
+"""
+
+from __future__ import division
+
+import multiprocessing
+
+from vistrails.core.packagemanager import get_package_manager
+
+
+__all__ = ['parallel_map', 'cleanup']
+
+
+_pool = None
+_pool_key = None
+
+
+def init_worker():
+    """Initializes VisTrails in a new worker process.
+
+    When the process is forked, the application was copied from the parent
+    and doesn't need to be initialized again.
+    """
+    import vistrails.core.application
+
+    app = vistrails.core.application.get_vistrails_application()
+    if app is None:
+        app = vistrails.core.application.init({'spawned': True}, args=[])
+    # The execution log is what gets sent back to the parent
+    app.temp_configuration.executionLog = True
+
+
+def get_pool(processes=None):
+    """Returns the pool, starting it if needed.
+    """
+    global _pool, _pool_key
+
+    if not processes:
+        processes = multiprocessing.cpu_count()
+    packages = frozenset(pkg.identifier
+                         for pkg in get_package_manager().enabled_package_list())
+    key = processes, packages
+    if _pool is not None and _pool_key != key:
+        cleanup()
+    if _pool is None:
+        _pool = multiprocessing.Pool(processes, initializer=init_worker)
+        _pool_key = key
+    return _pool
+
+
+def cleanup():
+    """Terminates the worker processes.
+    """
+    global _pool, _pool_key
+
+    if _pool is not None:
+        _pool.terminate()
+        _pool.join()
+        _pool = None
+        _pool_key = None
+
+
+def chunks(elements, chunksize):
+    """Splits a list into consecutive lists of at most chunksize elements.
+    """
+    return [elements[i:i + chunksize]
+            for i in xrange(0, len(elements), chunksize)]
+
+
+def parallel_map(function, args, elements, processes=None, chunksize=None):
+    """Calls function(*args, chunk) for each chunk of elements in the pool.
+
+    The function should return a list of results for its chunk; the results
+    are returned in the order of the elements.
+    """
+    if not elements:
+        return []
+    if not processes:
+        processes = multiprocessing.cpu_count()
+    pool = get_pool(processes)
+    if not chunksize:
+        # Same heuristic as Pool.map()
+        chunksize, extra = divmod(len(elements), processes * 4)
+        if extra or not chunksize:
+            chunksize += 1
+
+    async_results = [pool.apply_async(function, args + (chunk,))
+                     for chunk in chunks(elements, chunksize)]
+    results = []
+    for async_result in async_results:
+        results.extend(async_result.get())
+    return results
@@ -41,6 +41,7 @@ from vistrails.core.db.locator import XMLFileLocator
 from vistrails.core.db.io import serialize, unserialize
 from vistrails.core import debug
 from vistrails.core.interpreter.default import get_default_interpreter
+from vistrails.core.log.controller import DummyLogController
 from vistrails.core.log.group_exec import GroupExec
 from vistrails.core.log.machine import Machine
 from vistrails.core.log.module_exec import ModuleExec
@@ -67,9 +68,15 @@ import re
 import sys
 import tempfile
 
-from IPython.parallel.error import CompositeError
+try:
+    from IPython.parallel.error import CompositeError
+except ImportError:
+    ipython_available = False
+else:
+    ipython_available = True
 
 from .api import get_client
+from . import local_pool
 
 try:
     import hashlib
@@ -87,6 +94,33 @@ except ImportError:
 # It returns the corresponding computed outputs and the execution log
 #
 def execute_wf(wf, output_port):
+    workflow = load_pipeline(wf)
+    return execute_pipeline(workflow, output_port)
+
+
+###############################################################################
+# This function is sent to the local worker processes
+#
+# It receives the module to execute serialized once, and the list of input
+# values for a whole batch of elements
+#
+# It returns the list of dictionaries that execute_wf() would have returned
+#
+def execute_batch(wf, input_ports, port_types, output_port, elements):
+    template = load_pipeline(wf).module_list[0]
+    results = []
+    for element in elements:
+        module = make_element_module(template, input_ports, port_types,
+                                     element)
+        workflow = Pipeline()
+        workflow.add_module(module)
+        results.append(execute_pipeline(workflow, output_port))
+    return results
+
+
+def load_pipeline(wf):
+    """Loads a Pipeline from its serialized XML.
+    """
     # Save the workflow in a temporary file
     temp_wf_fd, temp_wf = tempfile.mkstemp()
 
@@ -96,80 +130,118 @@ def execute_wf(wf, output_port):
         f.close()
         os.close(temp_wf_fd)
 
-        # Clean the cache
-        interpreter = get_default_interpreter()
-        interpreter.flush()
-
         # Load the Pipeline from the temporary file
-        vistrail = Vistrail()
         locator = XMLFileLocator(temp_wf)
-        workflow = locator.load(Pipeline)
-
-        # Build a Vistrail from this single Pipeline
-        action_list = []
-        for module in workflow.module_list:
-            action_list.append(('add', module))
-        for connection in workflow.connection_list:
-            action_list.append(('add', connection))
-        action = vistrails.core.db.action.create_action(action_list)
-
-        vistrail.add_action(action, 0L)
-        vistrail.update_id_scope()
-        tag = 'parallel flow'
-        vistrail.addTag(tag, action.id)
-
-        # Build a controller and execute
-        controller = VistrailController()
-        controller.set_vistrail(vistrail, None)
-        controller.change_selected_version(vistrail.get_version_number(tag))
-        execution = controller.execute_current_workflow(
-                custom_aliases=None,
-                custom_params=None,
-                extra_info=None,
-                reason='API Pipeline Execution')
-
-        # Build a list of errors
-        errors = []
-        pipeline = vistrail.getPipeline(tag)
-        execution_errors = execution[0][0].errors
-        if execution_errors:
-            for key in execution_errors:
-                module = pipeline.modules[key]
-                msg = '%s: %s' %(module.name, execution_errors[key])
-                errors.append(msg)
+        return locator.load(Pipeline)
+    finally:
+        os.unlink(temp_wf)
+
+
+def make_element_module(template, input_ports, port_types, element):
+    """Copies the mapped module, setting the inputs for one element.
+    """
+    module = template.do_copy()
+
+    # getting highest id between functions to guarantee unique ids
+    # TODO: can get current IdScope here?
+    if module.functions:
+        high_id = max(function.db_id for function in module.functions)
+    else:
+        high_id = 0
+
+    # adding function and parameter to module in pipeline
+    # TODO: 'pos' should not be always 0 here
+    id_scope = IdScope(beginId=long(high_id+1))
+    for elementValue, inputPort, type in izip(element, input_ports,
+                                              port_types):
+        mod_function = ModuleFunction(id=id_scope.getNewId(ModuleFunction.vtType),
+                                      pos=0,
+                                      name=inputPort)
+        mod_param = ModuleParam(id=0L,
+                                pos=0,
+                                type=type,
+                                val=elementValue)
+
+        mod_function.add_parameter(mod_param)
+        module.add_function(mod_function)
+
+    return module
+
 
-        # Get the execution log from the controller
+def execute_pipeline(workflow, output_port):
+    """Executes a Pipeline holding a single module.
+
+    Returns a dictionary with the errors, the output value and the execution
+    log.
+    """
+    # Clean the cache
+    interpreter = get_default_interpreter()
+    interpreter.flush()
+
+    # Build a Vistrail from this single Pipeline
+    vistrail = Vistrail()
+    action_list = []
+    for module in workflow.module_list:
+        action_list.append(('add', module))
+    for connection in workflow.connection_list:
+        action_list.append(('add', connection))
+    action = vistrails.core.db.action.create_action(action_list)
+
+    vistrail.add_action(action, 0L)
+    vistrail.update_id_scope()
+    tag = 'parallel flow'
+    vistrail.addTag(tag, action.id)
+
+    # Build a controller and execute
+    controller = VistrailController()
+    controller.set_vistrail(vistrail, None)
+    controller.change_selected_version(vistrail.get_version_number(tag))
+    execution = controller.execute_current_workflow(
+            custom_aliases=None,
+            custom_params=None,
+            extra_info=None,
+            reason='API Pipeline Execution')
+
+    # Build a list of errors
+    errors = []
+    pipeline = vistrail.getPipeline(tag)
+    execution_errors = execution[0][0].errors
+    if execution_errors:
+        for key in execution_errors:
+            module = pipeline.modules[key]
+            msg = '%s: %s' %(module.name, execution_errors[key])
+            errors.append(msg)
+
+    # Get the execution log from the controller
+    try:
+        module_log = controller.log.workflow_execs[0].item_execs[0]
+    except IndexError:
+        errors.append("Module log not found")
+        return dict(errors=errors)
+    else:
+        machine = controller.log.workflow_execs[0].machines[
+                module_log.machine_id]
+        xml_log = serialize(module_log)
+        machine_log = serialize(machine)
+
+    # Get the output value
+    output = None
+    if not execution_errors:
+        executed_module, = execution[0][0].executed
+        executed_module = execution[0][0].objects[executed_module]
         try:
-            module_log = controller.log.workflow_execs[0].item_execs[0]
-        except IndexError:
-            errors.append("Module log not found")
+            output = executed_module.get_output(output_port)
+        except ModuleError:
+            errors.append("Output port not found: %s" % output_port)
             return dict(errors=errors)
-        else:
-            machine = controller.log.workflow_execs[0].machines[
-                    module_log.machine_id]
-            xml_log = serialize(module_log)
-            machine_log = serialize(machine)
-
-        # Get the output value
-        output = None
-        if not execution_errors:
-            executed_module, = execution[0][0].executed
-            executed_module = execution[0][0].objects[executed_module]
-            try:
-                output = executed_module.get_output(output_port)
-            except ModuleError:
-                errors.append("Output port not found: %s" % output_port)
-                return dict(errors=errors)
-            if isinstance(output, Module):
-                raise TypeError("Output value is a Module instance")
-
-        # Return the dictionary, that will be sent back to the client
-        return dict(errors=errors,
-                    output=output,
-                    xml_log=xml_log,
-                    machine_log=machine_log)
-    finally:
-        os.unlink(temp_wf)
+        if isinstance(output, Module):
+            raise TypeError("Output value is a Module instance")
+
+    # Return the dictionary, that will be sent back to the client
+    return dict(errors=errors,
+                output=output,
+                xml_log=xml_log,
+                machine_log=machine_log)
 
 ###############################################################################
 
@@ -187,6 +259,9 @@ class Map(Module):
     The FunctionPort should be connected to the 'self' output of the module you
     want to execute.
     The InputList is the list of values to be scattered on the engines.
+    If IPython is not available, or if Backend is set to 'local', a pool of
+    local processes is used instead; ChunkSize sets how many elements are sent
+    to a process at once.
     """
     def __init__(self):
         Module.__init__(self)
@@ -246,166 +321,50 @@ class Map(Module):
             element_is_iter = True
             inputList = rawInputList
 
-        workflows = []
-        module = None
-        vtType = None
+        # getting first connector, ignoring the rest
+        connector = self.inputPorts.get('FunctionPort')[0]
+        module = connector.obj
 
-        # iterating through the connectors
-        for connector in self.inputPorts.get('FunctionPort'):
-            module = connector.obj
+        # pipeline
+        original_pipeline = connector.obj.moduleInfo['pipeline']
 
-            # pipeline
-            original_pipeline = connector.obj.moduleInfo['pipeline']
+        # module
+        module_id = connector.obj.moduleInfo['moduleId']
+        vtType = original_pipeline.modules[module_id].vtType
 
-            # module
-            module_id = connector.obj.moduleInfo['moduleId']
-            vtType = original_pipeline.modules[module_id].vtType
-
-            # serialize the module for each value in the list
-            for i, element in enumerate(inputList):
-                if element_is_iter:
-                    self.element = element
-                else:
-                    self.element = element[0]
-
-                # checking type and setting input in the module
-                self.typeChecking(connector.obj, nameInput, inputList)
-                self.setInputValues(connector.obj, nameInput, element, i)
-
-                pipeline_db_module = original_pipeline.modules[module_id].do_copy()
-
-                # transforming a subworkflow in a group
-                # TODO: should we also transform inner subworkflows?
-                if pipeline_db_module.is_abstraction():
-                    group = Group(id=pipeline_db_module.id,
-                                  cache=pipeline_db_module.cache,
-                                  location=pipeline_db_module.location,
-                                  functions=pipeline_db_module.functions,
-                                  annotations=pipeline_db_module.annotations)
-
-                    source_port_specs = pipeline_db_module.sourcePorts()
-                    dest_port_specs = pipeline_db_module.destinationPorts()
-                    for source_port_spec in source_port_specs:
-                        group.add_port_spec(source_port_spec)
-                    for dest_port_spec in dest_port_specs:
-                        group.add_port_spec(dest_port_spec)
-
-                    group.pipeline = pipeline_db_module.pipeline
-                    pipeline_db_module = group
-
-                # getting highest id between functions to guarantee unique ids
-                # TODO: can get current IdScope here?
-                if pipeline_db_module.functions:
-                    high_id = max(function.db_id
-                                  for function in pipeline_db_module.functions)
-                else:
-                    high_id = 0
-
-                # adding function and parameter to module in pipeline
-                # TODO: 'pos' should not be always 0 here
-                id_scope = IdScope(beginId=long(high_id+1))
-                for elementValue, inputPort in izip(element, nameInput):
-
-                    p_spec = pipeline_db_module.get_port_spec(inputPort, 'input')
-                    descrs = p_spec.descriptors()
-                    if len(descrs) != 1:
-                        raise ModuleError(
-                                self,
-                                "Tuple input ports are not supported")
-                    if not issubclass(descrs[0].module, Constant):
-                        raise ModuleError(
-                                self,
-                                "Module inputs should be Constant types")
-                    type = p_spec.sigstring[1:-1]
-
-                    mod_function = ModuleFunction(id=id_scope.getNewId(ModuleFunction.vtType),
-                                                  pos=0,
-                                                  name=inputPort)
-                    mod_param = ModuleParam(id=0L,
-                                            pos=0,
-                                            type=type,
-                                            val=elementValue)
-
-                    mod_function.add_parameter(mod_param)
-                    pipeline_db_module.add_function(mod_function)
-
-                # serializing module
-                wf = self.serialize_module(pipeline_db_module)
-                workflows.append(wf)
-
-            # getting first connector, ignoring the rest
-            break
-
-        # IPython stuff
-        try:
-            rc = get_client()
-        except Exception, error:
-            raise ModuleError(self, "Exception while loading IPython: %s" %
-                              debug.format_exception(error))
-        if rc is None:
-            raise ModuleError(self, "Couldn't get an IPython connection")
-        engines = rc.ids
-        if not engines:
-            raise ModuleError(
-                    self,
-                    "Exception while loading IPython: No IPython engines "
-                    "detected!")
+        # checking type and setting input in the module
+        for i, element in enumerate(inputList):
+            if element_is_iter:
+                self.element = element
+            else:
+                self.element = element[0]
+            self.typeChecking(connector.obj, nameInput, inputList)
+            self.setInputValues(connector.obj, nameInput, element, i)
 
-        # initializes each engine
-        # importing modules and initializing the VisTrails application
-        # in the engines *only* in the first execution on this engine
-        uninitialized = []
-        for eng in engines:
-            try:
-                rc[eng]['init']
-            except Exception:
-                uninitialized.append(eng)
-        if uninitialized:
-            init_view = rc[uninitialized]
-            with init_view.sync_imports():
-                import tempfile
-                import inspect
+        template = self.make_template(original_pipeline.modules[module_id])
+        port_types = self.get_port_types(template, nameInput)
+        inputList = self.translate_elements(template, nameInput, inputList)
 
-                # VisTrails API
-                import vistrails
-                import vistrails.core
-                import vistrails.core.db.action
-                import vistrails.core.application
-                import vistrails.core.modules.module_registry
-                from vistrails.core.db.io import serialize
-                from vistrails.core.vistrail.vistrail import Vistrail
-                from vistrails.core.vistrail.pipeline import Pipeline
-                from vistrails.core.db.locator import XMLFileLocator
-                from vistrails.core.vistrail.controller import VistrailController
-                from vistrails.core.interpreter.default import get_default_interpreter
+        backend = self.get_backend()
+        if backend == 'local':
+            # setting computing color
+            module.logging.set_computing(module)
 
-            # initializing a VisTrails application
-            try:
-                init_view.execute(
-                        'app = vistrails.core.application.init('
-                        '        {"spawned": True},'
-                        '        args=[])',
-                        block=True)
-            except CompositeError, e:
-                self.print_compositeerror(e)
-                raise ModuleError(self, "Error initializing application on "
-                                  "IPython engines:\n"
-                                  "%s" % self.list_exceptions(e))
+            map_result = self.execute_local(template, nameInput, port_types,
+                                            nameOutput, inputList)
+        else:
+            # serialize the module for each value in the list
+            workflows = [
+                    self.serialize_module(make_element_module(
+                            template, nameInput, port_types, element))
+                    for element in inputList]
 
-            init_view['init'] = True
+            rc = self.initialize_engines()
 
-        # setting computing color
-        module.logging.set_computing(module)
+            # setting computing color
+            module.logging.set_computing(module)
 
-        # executing function in engines
-        # each map returns a dictionary
-        try:
-            ldview = rc.load_balanced_view()
-            map_result = ldview.map_sync(execute_wf, workflows, [nameOutput]*len(workflows))
-        except CompositeError, e:
-            self.print_compositeerror(e)
-            raise ModuleError(self, "Error from IPython engines:\n"
-                              "%s" % self.list_exceptions(e))
+            map_result = self.execute_ipython(rc, workflows, nameOutput)
 
         # verifying errors
         errors = []
@@ -422,13 +381,14 @@ class Map(Module):
         # setting success color
         module.logging.signalSuccess(module)
 
-        reg = vistrails.core.modules.module_registry.get_module_registry()
         self.result = []
         for map_execution in map_result:
             output = map_execution['output']
             self.result.append(output)
 
-        # including execution logs
+        # including execution logs, unless logging is turned off
+        if self.logging.log is DummyLogController:
+            return
         for engine in range(len(map_result)):
             log = map_result[engine]['xml_log']
             exec_ = None
@@ -468,6 +428,176 @@ class Map(Module):
 
             self.logging.add_exec(exec_)
 
+    def get_backend(self):
+        """Returns which backend to use, 'ipython' or 'local'.
+
+        'auto' selects IPython if it is installed, and the local process pool
+        otherwise.
+        """
+        backend = self.force_get_input('Backend', 'auto')
+        if backend == 'auto':
+            if ipython_available:
+                return 'ipython'
+            else:
+                return 'local'
+        elif backend == 'ipython':
+            if not ipython_available:
+                raise ModuleError(self, "IPython.parallel is not available")
+            return backend
+        elif backend == 'local':
+            return backend
+        else:
+            raise ModuleError(self, "Unknown backend %r" % backend)
+
+    def make_template(self, pipeline_db_module):
+        """Copies the mapped module, before the inputs get set.
+        """
+        pipeline_db_module = pipeline_db_module.do_copy()
+
+        # transforming a subworkflow in a group
+        # TODO: should we also transform inner subworkflows?
+        if pipeline_db_module.is_abstraction():
+            group = Group(id=pipeline_db_module.id,
+                          cache=pipeline_db_module.cache,
+                          location=pipeline_db_module.location,
+                          functions=pipeline_db_module.functions,
+                          annotations=pipeline_db_module.annotations)
+
+            source_port_specs = pipeline_db_module.sourcePorts()
+            dest_port_specs = pipeline_db_module.destinationPorts()
+            for source_port_spec in source_port_specs:
+                group.add_port_spec(source_port_spec)
+            for dest_port_spec in dest_port_specs:
+                group.add_port_spec(dest_port_spec)
+
+            group.pipeline = pipeline_db_module.pipeline
+            pipeline_db_module = group
+
+        return pipeline_db_module
+
+    def get_port_types(self, pipeline_db_module, input_ports):
+        """Returns the type of the parameter to set on each input port.
+        """
+        port_types = []
+        for inputPort in input_ports:
+            p_spec = pipeline_db_module.get_port_spec(inputPort, 'input')
+            descrs = p_spec.descriptors()
+            if len(descrs) != 1:
+                raise ModuleError(
+                        self,
+                        "Tuple input ports are not supported")
+            if not issubclass(descrs[0].module, Constant):
+                raise ModuleError(
+                        self,
+                        "Module inputs should be Constant types")
+            port_types.append(p_spec.sigstring[1:-1])
+        return port_types
+
+    def translate_elements(self, pipeline_db_module, input_ports, inputList):
+        """Converts the elements to the strings the parameters hold.
+        """
+        translators = [
+                pipeline_db_module.get_port_spec(inputPort, 'input')
+                        .descriptors()[0].module.translate_to_string
+                for inputPort in input_ports]
+        return [[translate(value)
+                 for translate, value in izip(translators, element)]
+                for element in inputList]
+
+    def execute_local(self, template, input_ports, port_types, output_port,
+                      inputList):
+        """Executes the map on the local process pool.
+
+        The module is serialized once, and the elements are sent in chunks to
+        the worker processes, which set the inputs themselves.
+        """
+        wf = self.serialize_module(template)
+        try:
+            return local_pool.parallel_map(
+                    execute_batch,
+                    (wf, input_ports, port_types, output_port),
+                    list(inputList),
+                    processes=self.force_get_input('Processes', None),
+                    chunksize=self.force_get_input('ChunkSize', None))
+        except Exception, e:
+            raise ModuleError(self, "Error from local worker processes:\n"
+                              "%s" % debug.format_exception(e))
+
+    def initialize_engines(self):
+        """Gets the IPython client, initializing the engines if needed.
+        """
+        try:
+            rc = get_client()
+        except Exception, error:
+            raise ModuleError(self, "Exception while loading IPython: %s" %
+                              debug.format_exception(error))
+        if rc is None:
+            raise ModuleError(self, "Couldn't get an IPython connection")
+        engines = rc.ids
+        if not engines:
+            raise ModuleError(
+                    self,
+                    "Exception while loading IPython: No IPython engines "
+                    "detected!")
+
+        # initializes each engine
+        # importing modules and initializing the VisTrails application
+        # in the engines *only* in the first execution on this engine
+        uninitialized = []
+        for eng in engines:
+            try:
+                rc[eng]['init']
+            except Exception:
+                uninitialized.append(eng)
+        if uninitialized:
+            init_view = rc[uninitialized]
+            with init_view.sync_imports():
+                import tempfile
+                import inspect
+
+                # VisTrails API
+                import vistrails
+                import vistrails.core
+                import vistrails.core.db.action
+                import vistrails.core.application
+                import vistrails.core.modules.module_registry
+                from vistrails.core.db.io import serialize
+                from vistrails.core.vistrail.vistrail import Vistrail
+                from vistrails.core.vistrail.pipeline import Pipeline
+                from vistrails.core.db.locator import XMLFileLocator
+                from vistrails.core.vistrail.controller import VistrailController
+                from vistrails.core.interpreter.default import get_default_interpreter
+
+            # initializing a VisTrails application
+            try:
+                init_view.execute(
+                        'app = vistrails.core.application.init('
+                        '        {"spawned": True},'
+                        '        args=[])',
+                        block=True)
+            except CompositeError, e:
+                self.print_compositeerror(e)
+                raise ModuleError(self, "Error initializing application on "
+                                  "IPython engines:\n"
+                                  "%s" % self.list_exceptions(e))
+
+            init_view['init'] = True
+
+        return rc
+
+    def execute_ipython(self, rc, workflows, output_port):
+        """Executes the map on the IPython engines.
+
+        Each map returns a dictionary.
+        """
+        try:
+            ldview = rc.load_balanced_view()
+            return ldview.map_sync(execute_wf, workflows,
+                                   [output_port]*len(workflows))
+        except CompositeError, e:
+            self.print_compositeerror(e)
+            raise ModuleError(self, "Error from IPython engines:\n"
+                              "%s" % self.list_exceptions(e))
 
     def serialize_module(self, module):
         """
@@ -545,3 +675,53 @@ def get_module(value, signature):
         debug.warning("Could not identify the type of the list element.")
         debug.warning("Type checking is not going to be done inside Map module.")
         return None
+
+###############################################################################
+
+import unittest
+
+class TestLocalMap(unittest.TestCase):
+    def test_concatenate(self):
+        """Maps ConcatenateString on the local process pool.
+        """
+        from vistrails.tests.utils import execute, intercept_result
+        from .__init__ import identifier
+        with intercept_result(Map, 'Result') as results:
+            self.assertFalse(execute([
+                    ('ConcatenateString', 'org.vistrails.vistrails.basic', [
+                        ('str2', [('String', '!')]),
+                    ]),
+                    ('Map', identifier, [
+                        ('InputPort', [('List', "['str1']")]),
+                        ('OutputPort', [('String', 'value')]),
+                        ('InputList', [('List', "['a', 'b', 'c', 'd', 'e']")]),
+                        ('Backend', [('String', 'local')]),
+                        ('ChunkSize', [('Integer', '2')]),
+                        ('Processes', [('Integer', '2')]),
+                    ]),
+                ],
+                [
+                    (0, 'self', 1, 'FunctionPort'),
+                ]))
+        self.assertEqual(results, [['a!', 'b!', 'c!', 'd!', 'e!']])
+
+    def test_integers(self):
+        """Maps a module with an Integer input port.
+        """
+        from vistrails.tests.utils import execute, intercept_result
+        from .__init__ import identifier
+        with intercept_result(Map, 'Result') as results:
+            self.assertFalse(execute([
+                    ('Integer', 'org.vistrails.vistrails.basic', []),
+                    ('Map', identifier, [
+                        ('InputPort', [('List', "['value']")]),
+                        ('OutputPort', [('String', 'value')]),
+                        ('InputList', [('List', "[1, 2, 3]")]),
+                        ('Backend', [('String', 'local')]),
+                        ('Processes', [('Integer', '2')]),
+                    ]),
+                ],
+                [
+                    (0, 'self', 1, 'FunctionPort'),
+                ]))
+        self.assertEqual(results, [[1, 2, 3]])
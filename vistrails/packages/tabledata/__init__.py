@@ -58,11 +58,18 @@ extraction and conversion routines.
 
 from __future__ import division
 
+from vistrails.core.configuration import ConfigurationObject
 from vistrails.core.packagemanager import get_package_manager
 
 from .identifiers import *
 
 
+# csv_cache: keep the numeric CSV columns that were read in .npy files, up
+# to csv_cache_size megabytes
+configuration = ConfigurationObject(csv_cache=False,
+                                    csv_cache_size=256)
+
+
 def package_dependencies():
     pm = get_package_manager()
     spreadsheet_identifier = 'org.vistrails.vistrails.spreadsheet'
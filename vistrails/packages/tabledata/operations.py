@@ -57,6 +57,15 @@ def utf8(obj):
         return bytes(obj)
 
 
+def take_rows(column, rows):
+    """Returns the given rows of a column, using fancy indexing on arrays.
+    """
+    if numpy is not None and isinstance(column, numpy.ndarray):
+        return column[numpy.asarray(rows, dtype=numpy.intp)]
+    else:
+        return [column[i] for i in rows]
+
+
 class JoinedTables(TableObject):
     def __init__(self, left_t, right_t, left_key_col, right_key_col,
                  case_sensitive=False, always_prefix=False):
@@ -104,22 +113,17 @@ class JoinedTables(TableObject):
         if (index, numeric) in self.column_cache:
             return self.column_cache[(index, numeric)]
 
-        result = []
         if index < self.left_t.columns:
             column = self.left_t.get_column(index, numeric)
-            for i in xrange(self.left_t.rows):
-                if i in self.row_map:
-                    result.append(column[i])
+            rows = self.left_rows
         else:
             column = self.right_t.get_column(index - self.left_t.columns,
                                              numeric)
-            for i in xrange(self.left_t.rows):
-                if i in self.row_map:
-                    j = self.row_map[i]
-                    result.append(column[j])
+            rows = self.right_rows
+        result = take_rows(column, rows)
 
         if numeric and numpy is not None:
-            result = numpy.array(result, dtype=numpy.float32)
+            result = numpy.asarray(result, dtype=numpy.float32)
         self.column_cache[(index, numeric)] = result
         return result
 
@@ -144,6 +148,8 @@ class JoinedTables(TableObject):
                 key = key.upper()
             if key in right_keys:
                 self.row_map[left_row_idx] = right_keys[key]
+        self.left_rows = sorted(self.row_map)
+        self.right_rows = [self.row_map[i] for i in self.left_rows]
 
 
 class JoinTables(Table):
@@ -296,6 +302,31 @@ class SelectFromTable(Table):
         else:
             raise ValueError("Invalid comparison operator %r" % comparer)
 
+    @staticmethod
+    def make_mask(column, comparand, comparer):
+        """Evaluates a numeric comparison on a whole column at once.
+
+        Returns a boolean array, or None if the condition has to be checked
+        value by value with make_condition().
+        """
+        if numpy is None or not isinstance(comparand, float):
+            return None
+        column = numpy.asarray(column, dtype=numpy.float64)
+        if comparer == '==':
+            return column == comparand
+        elif comparer == '!=':
+            return column != comparand
+        elif comparer == '<':
+            return column < comparand
+        elif comparer == '>':
+            return column > comparand
+        elif comparer == '<=':
+            return column <= comparand
+        elif comparer == '>=':
+            return column >= comparand
+        else:
+            return None
+
     def compute(self):
         table = self.get_input('table')
 
@@ -322,13 +353,17 @@ class SelectFromTable(Table):
         condition = self.make_condition(comparand, comparer)
         numeric = isinstance(comparand, float)
         column = table.get_column(idx, numeric)
-        matched_rows = [i
-                        for i, col_val in enumerate(column)
-                        if condition(col_val)]
+        mask = self.make_mask(column, comparand, comparer)
+        if mask is not None:
+            matched_rows = numpy.flatnonzero(mask)
+        else:
+            matched_rows = [i
+                            for i, col_val in enumerate(column)
+                            if condition(col_val)]
         columns = []
         for col in xrange(table.columns):
             column = table.get_column(col)
-            columns.append([column[row] for row in matched_rows])
+            columns.append(take_rows(column, matched_rows))
         selected_table = TableObject(columns, len(matched_rows), table.names)
         self.set_output('value', selected_table)
 
@@ -343,44 +378,73 @@ class AggregatedTable(TableObject):
         self.build_map()
 
     def build_map(self):
-        agg_map = {}
+        # number the groups in order of first appearance, which is the
+        # order they are output in
+        group_index = {}
+        group_ids = []
+        first_rows = []
         for i, val in enumerate(self.table.get_column(self.group_col)):
-            if val in agg_map:
-                agg_map[val].append(i)
-            else:
-                agg_map[val] = [i]
-        self.agg_rows = [(min(rows), rows) for rows in agg_map.itervalues()]
-        self.agg_rows.sort()
-        self.rows = len(self.agg_rows)
+            try:
+                group_ids.append(group_index[val])
+            except KeyError:
+                group_index[val] = len(first_rows)
+                group_ids.append(len(first_rows))
+                first_rows.append(i)
+        self.group_ids = group_ids
+        self.first_rows = first_rows
+        self.rows = len(first_rows)
         self.columns = 2
         if self.table.names is not None:
             self.names = [self.table.names[self.group_col],
                           self.table.names[self.col]]
 
     def get_column(self, index, numeric=False):
-        def average(value_iter):
-            # value_iter can only be used once
-            sum = 0
-            count = 0
-            for count, v in enumerate(value_iter):
-                sum += v
-            return sum / (count+1)
+        if index == 0:
+            col = self.table.get_column(self.group_col, numeric)
+            return [col[i] for i in self.first_rows]
+        elif self.op not in ('count', 'sum', 'average', 'min', 'max'):
+            raise ValueError('Unknown operation: "%s"' % self.op)
+        elif numpy is not None:
+            return self.aggregate_numpy().tolist()
+        else:
+            return self.aggregate_python()
+
+    def aggregate_numpy(self):
+        ids = numpy.asarray(self.group_ids, dtype=numpy.intp)
+        counts = numpy.bincount(ids, minlength=self.rows)
+        if self.op == 'count':
+            return counts
+        values = numpy.asarray(self.table.get_column(self.col, True),
+                               dtype=numpy.float64)
+        if self.op == 'sum':
+            return numpy.bincount(ids, values, minlength=self.rows)
+        elif self.op == 'average':
+            return numpy.bincount(ids, values, minlength=self.rows) / counts
+        elif self.op == 'min':
+            result = numpy.empty(self.rows)
+            result.fill(numpy.inf)
+            numpy.minimum.at(result, ids, values)
+            return result
+        else: # self.op == 'max'
+            result = numpy.empty(self.rows)
+            result.fill(-numpy.inf)
+            numpy.maximum.at(result, ids, values)
+            return result
+
+    def aggregate_python(self):
+        groups = [[] for i in xrange(self.rows)]
+        for i, group in enumerate(self.group_ids):
+            groups[group].append(i)
+        if self.op == 'count':
+            return [len(rows) for rows in groups]
+        def average(values):
+            return sum(values) / len(values)
         op_map = {'sum': sum,
                   'average': average,
                   'min': min,
                   'max': max}
-        if index == 0:
-            col = self.table.get_column(self.group_col, numeric)
-            return [col[x[0]] for x in self.agg_rows]
-        else:
-            if self.op == 'count':
-                return [len(x[1]) for x in self.agg_rows]
-            elif self.op in op_map:
-                col = self.table.get_column(self.col, True)
-                return [op_map[self.op](col[idx] for idx in x[1])
-                        for x in self.agg_rows]
-            else:
-                raise ValueError('Unknown operation: "%s"' % self.op)
+        col = self.table.get_column(self.col, True)
+        return [op_map[self.op]([col[i] for i in rows]) for rows in groups]
 
 
 class AggregateColumn(Table):
@@ -36,12 +36,16 @@
 from __future__ import division
 
 import csv
-import operator
+import hashlib
+import os
+import tempfile
 try:
     import numpy
 except ImportError: # pragma: no cover
     numpy = None
 
+from vistrails.core.system import current_dot_vistrails
+
 from ..common import TableObject, Table, InternalModuleError
 
 
@@ -52,6 +56,44 @@ def count_lines(fp):
     return lines
 
 
+def sidecar_directory():
+    """Directory where parsed numeric columns are kept between runs.
+
+    Returns None unless the csv_cache option of the package is set.
+    """
+    from .. import configuration
+    if not configuration.check('csv_cache'):
+        return None
+    return os.path.join(current_dot_vistrails(), 'tabledata_cache')
+
+
+def prune_sidecars(directory, max_size=None):
+    """Removes the least recently used sidecar files past max_size bytes.
+
+    The default size is the csv_cache_size option of the package.
+    """
+    if max_size is None:
+        from .. import configuration
+        max_size = configuration.csv_cache_size * 1024 * 1024
+    try:
+        files = []
+        for name in os.listdir(directory):
+            if name.endswith('.npy'):
+                stat = os.stat(os.path.join(directory, name))
+                files.append((stat.st_mtime, stat.st_size, name))
+    except OSError:
+        return
+    total = sum(size for mtime, size, name in files)
+    for mtime, size, name in sorted(files):
+        if total <= max_size:
+            break
+        try:
+            os.remove(os.path.join(directory, name))
+        except OSError:
+            continue
+        total -= size
+
+
 # FIXME : test coverage for CSVTable
 class CSVTable(TableObject):
     def __init__(self, csv_file, header_present, delimiter,
@@ -125,43 +167,129 @@ class CSVTable(TableObject):
 
         return column_count, column_names, delimiter, header_present, dialect
 
-    def get_column(self, index, numeric=False):
-        if (index, numeric) in self.column_cache:
-            return self.column_cache[(index, numeric)]
-
-        if numeric and numpy is not None:
-            result = numpy.loadtxt(
-                    self.filename,
-                    dtype=numpy.float32,
-                    delimiter=self.delimiter,
-                    skiprows=self.skip_lines,
-                    usecols=[index])
-        else:
-            with open(self.filename, 'rb') as fp:
-                for i in xrange(self.skip_lines):
-                    line = fp.readline()
-                    if not line:
-                        raise ValueError("skip_lines greater than the number "
-                                         "of lines in the file")
-                if self.dialect is not None:
-                    reader = csv.reader(fp, dialect=self.dialect)
-                else:
-                    reader = csv.reader(fp, delimiter=self.delimiter)
+    def iter_records(self):
+        """Parses the file, yielding (line number, record) pairs.
+        """
+        with open(self.filename, 'rb') as fp:
+            for i in xrange(self.skip_lines):
+                line = fp.readline()
+                if not line:
+                    raise ValueError("skip_lines greater than the number "
+                                     "of lines in the file")
+            if self.dialect is not None:
+                reader = csv.reader(fp, dialect=self.dialect)
+            else:
+                reader = csv.reader(fp, delimiter=self.delimiter)
+            for rownb, row in enumerate(reader, 1):
+                yield rownb, row
 
-                getter = operator.itemgetter(index)
+    @staticmethod
+    def short_row(rownb, row, index):
+        return ValueError("Invalid CSV file: only %d fields on line %d "
+                          "(column %d requested)" % (len(row), rownb, index))
+
+    def read_column(self, index):
+        """Parses a single column of the file as a list of strings.
+        """
+        column = []
+        for rownb, row in self.iter_records():
+            try:
+                column.append(row[index])
+            except IndexError:
+                raise self.short_row(rownb, row, index)
+        return column
+
+    def read_numeric_column(self, index):
+        """Parses a single column of the file straight into an array.
+        """
+        def values():
+            for rownb, row in self.iter_records():
                 try:
-                    result = []
-                    for rownb, row in enumerate(reader, 1):
-                        result.append(getter(row))
+                    yield float(row[index])
                 except IndexError:
-                    raise ValueError("Invalid CSV file: only %d fields on "
-                                     "line %d (column %d requested)" % (
-                                         len(row), rownb, index))
-            if numeric:
-                result = [float(e) for e in result]
+                    raise self.short_row(rownb, row, index)
+        return numpy.fromiter(values(), dtype=numpy.float32)
 
-        self.column_cache[(index, numeric)] = result
-        return result
+    def get_column(self, index, numeric=False):
+        if (index, numeric) not in self.column_cache:
+            if numeric and numpy is not None:
+                sidecar = self.sidecar_filename(index)
+                result = self.load_sidecar(sidecar)
+                if result is None:
+                    if (index, False) in self.column_cache:
+                        result = numpy.array(self.get_column(index),
+                                             dtype=numpy.float32)
+                    else:
+                        result = self.read_numeric_column(index)
+                    self.save_sidecar(sidecar, result)
+                self.column_cache[(index, numeric)] = result
+            elif numeric:
+                self.column_cache[(index, numeric)] = [
+                        float(e) for e in self.get_column(index)]
+            else:
+                self.column_cache[(index, numeric)] = self.read_column(index)
+        return self.column_cache[(index, numeric)]
+
+    def sidecar_filename(self, index):
+        """Name of the file caching the given numeric column.
+
+        It depends on everything that affects parsing, including the size
+        and modification time of the CSV file. Returns None if the cache is
+        disabled.
+        """
+        directory = sidecar_directory()
+        if directory is None:
+            return None
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return None
+        dialect = self.dialect
+        if dialect is not None and not isinstance(dialect, basestring):
+            dialect = tuple(getattr(dialect, attr, None)
+                            for attr in ('delimiter', 'doublequote',
+                                         'escapechar', 'quotechar',
+                                         'quoting', 'skipinitialspace'))
+        key = repr((os.path.abspath(self.filename),
+                    stat.st_size, stat.st_mtime,
+                    self.delimiter, self.skip_lines, dialect, index))
+        return os.path.join(directory,
+                            '%s.npy' % hashlib.sha1(key).hexdigest())
+
+    @staticmethod
+    def load_sidecar(filename):
+        if filename is None or not os.path.isfile(filename):
+            return None
+        try:
+            array = numpy.load(filename, mmap_mode='r')
+        except (IOError, OSError, ValueError):
+            return None
+        try:
+            # marks it as recently used, see prune_sidecars()
+            os.utime(filename, None)
+        except OSError:
+            pass
+        return array
+
+    @staticmethod
+    def save_sidecar(filename, array):
+        if filename is None or not array.size:
+            return
+        directory = os.path.dirname(filename)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            fd, tmp = tempfile.mkstemp(dir=directory, suffix='.npy')
+        except (IOError, OSError):
+            return
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                numpy.save(fp, array)
+            os.rename(tmp, filename)
+        except (IOError, OSError):
+            os.remove(tmp)
+        else:
+            prune_sidecars(directory)
 
     @property
     def rows(self):
@@ -322,6 +450,65 @@ class CSVTestCase(unittest.TestCase):
         self.assertEqual(results[0],
                          ['col moutarde', '4', 'not a number', '7'])
 
+    @unittest.skipIf(numpy is None, "numpy is not available")
+    def test_csv_sidecar(self):
+        """Reads a numeric column again from its cached sidecar file.
+        """
+        import os
+        from .. import configuration
+        filename = os.path.join(self._test_dir, 'test.csv')
+        table = CSVTable(filename, True, ';')
+        self.assertIsNone(table.sidecar_filename(1))
+        old_cache = configuration.csv_cache
+        configuration.csv_cache = True
+        self.addCleanup(setattr, configuration, 'csv_cache', old_cache)
+        sidecar = table.sidecar_filename(1)
+        if os.path.exists(sidecar):
+            os.remove(sidecar)
+        try:
+            self.assertEqual(list(table.get_column(1, True)),
+                             [2.0, 3.0, 14.5])
+            # parsed straight into an array
+            self.assertNotIn((1, False), table.column_cache)
+            self.assertTrue(os.path.isfile(sidecar))
+            table = CSVTable(filename, True, ';')
+            column = table.get_column(1, True)
+            self.assertIsInstance(column, numpy.memmap)
+            self.assertEqual(list(column), [2.0, 3.0, 14.5])
+        finally:
+            if os.path.exists(sidecar):
+                os.remove(sidecar)
+
+    def test_csv_single_column(self):
+        """Only keeps the requested column of the file.
+        """
+        import os
+        table = CSVTable(os.path.join(self._test_dir, 'test.csv'), True, ';')
+        self.assertEqual(table.get_column(2),
+                         ['4', 'not a number', '7'])
+        self.assertEqual(table.column_cache.keys(), [(2, False)])
+
+    def test_prune_sidecars(self):
+        """Removes the least recently used sidecar files.
+        """
+        import os
+        import shutil
+        directory = tempfile.mkdtemp(prefix='vt_sidecars_')
+        try:
+            for i, name in enumerate(['a.npy', 'b.npy', 'c.npy', 'd.txt']):
+                filename = os.path.join(directory, name)
+                with open(filename, 'wb') as fp:
+                    fp.write('x' * 100)
+                os.utime(filename, (1000 * (i + 1), 1000 * (i + 1)))
+            prune_sidecars(directory, 250)
+            self.assertEqual(sorted(os.listdir(directory)),
+                             ['b.npy', 'c.npy', 'd.txt'])
+            prune_sidecars(directory, 100)
+            self.assertEqual(sorted(os.listdir(directory)),
+                             ['c.npy', 'd.txt'])
+        finally:
+            shutil.rmtree(directory)
+
 
 class TestCountlines(unittest.TestCase):
     def test_countlines(self):
@@ -96,7 +96,7 @@ def execute(modules, connections=[], add_port_specs=[],
     format:
         [
             (mod_id, 'input'/'output', 'portname',
-             '(port_sig)'),
+             '(port_sig)'[, depth]),
         ]
     It is useful to test modules that can have custom ports through a
     configuration widget.
@@ -141,13 +141,16 @@ def execute(modules, connections=[], add_port_specs=[],
 
     port_spec_per_module = {} # mod_id -> [portspec: PortSpec]
     j = 0
-    for i, (mod_id, inout, name, sig) in enumerate(add_port_specs):
+    for i, spec in enumerate(add_port_specs):
+        mod_id, inout, name, sig = spec[:4]
+        depth = spec[4] if len(spec) > 4 else 0
         mod_specs = port_spec_per_module.setdefault(mod_id, [])
         ps = PortSpec(id=i,
                       name=name,
                       type=inout,
                       sigstring=sig,
-                      sort_key=-1)
+                      sort_key=-1,
+                      depth=depth)
         for psi in ps.port_spec_items:
             psi.id = j
             j += 1